@@ -2,7 +2,7 @@ import re
 
 from frontend.measure_tags import MEASURE_TAGS
 from frontend.models import Measure, MeasureGlobal, MeasureValue, Presentation
-from matrixstore.db import get_db, get_row_grouper
+from matrixstore.db import query_presentations_by_org
 from rest_framework.decorators import api_view, renderer_classes
 from rest_framework.exceptions import APIException
 from rest_framework.renderers import BrowsableAPIRenderer, JSONRenderer
@@ -109,19 +109,15 @@ def measure_numerators_by_org(request, format=None):
     measure_id = request.query_params.get("measure", None)
     measure = Measure.objects.get(pk=measure_id)
     org_type, org_id = _get_org_type_and_id_from_request(request)
-    group_by_org = get_row_grouper(org_type)
 
-    # Nested function which takes a prescribing matrix and returns the total
-    # value for the current organisation over the last 3 months (where the
-    # current organisation is defined by the `group_by_org` and `org_id`
-    # variables)
+    # Nested function which takes a prescribing matrix for the current
+    # organisation (i.e. with just a single row) and returns the total value
+    # over the last 3 months
     def get_total(matrix):
-        latest_three_months = matrix[:, -3:]
-        values_for_org = group_by_org.sum_one_group(latest_three_months, org_id)
-        return values_for_org.sum()
+        return matrix[0, -3:].sum()
 
     bnf_codes, sort_field = _get_bnf_codes_and_sort_field_for_measure(measure)
-    prescribing = _get_prescribing_for_bnf_codes(bnf_codes)
+    prescribing = _get_prescribing_for_bnf_codes(bnf_codes, org_type, org_id)
     results = []
     for bnf_code, items_matrix, quantity_matrix, actual_cost_matrix in prescribing:
         items = get_total(items_matrix)
@@ -187,23 +183,13 @@ def _get_bnf_codes_and_sort_field_for_measure(measure):
     return bnf_codes, sort_field
 
 
-def _get_prescribing_for_bnf_codes(bnf_codes):
+def _get_prescribing_for_bnf_codes(bnf_codes, org_type, org_id):
     """
     Return the items, quantity and actual cost matrices for the given list of
-    BNF codes
+    BNF codes, summed over the given organisation
     """
-    return get_db().query(
-        """
-        SELECT
-          bnf_code, items, quantity, actual_cost
-        FROM
-          presentation
-        WHERE
-          bnf_code IN ({})
-        """.format(
-            ",".join(["?"] * len(bnf_codes))
-        ),
-        bnf_codes,
+    return query_presentations_by_org(
+        ["items", "quantity", "actual_cost"], bnf_codes, org_type, org_ids=[org_id]
     )
 
 
@@ -69,7 +69,9 @@ def _get_orgs(org_type, org_codes):
 
 def _get_practice_stats_entries(keys, org_type, orgs):
     db = get_db()
-    practice_stats = db.query(*_get_query_and_params(keys))
+    practice_stats = db.query_rows(
+        "practice_statistic", "name", ["value"], _get_statistic_names(keys)
+    )
     group_by_org = get_row_grouper(org_type)
     practice_stats = [
         (name, group_by_org.sum(matrix)) for (name, matrix) in practice_stats
@@ -117,23 +119,25 @@ def _get_practice_stats_entries(keys, org_type, orgs):
                 yield entry
 
 
-def _get_query_and_params(keys):
-    params = []
+def _get_statistic_names(keys):
+    """
+    Return the names of the statistics to fetch for the supplied keys, or None
+    to fetch all statistics
+    """
+    names = []
     for key in keys:
         if key == "nothing":
             # "nothing" is a special key which always has the value 1
             pass
         elif key in STATS_COLUMN_WHITELIST or key.startswith("star_pu."):
-            params.append(key)
+            names.append(key)
         else:
             raise KeysNotValid("%s is not a valid key" % key)
     if keys:
-        # `params` might be empty here because the only key supplied was
-        # "nothing", but that's fine: the empty IN clause won't match any rows,
-        # which is what we want
-        where = "name IN ({})".format(",".join("?" * len(params)))
+        # `names` might be empty here because the only key supplied was
+        # "nothing", but that's fine: an empty list won't match any rows, which
+        # is what we want
+        return names
     else:
         # If no keys are supplied we treat this as an implicit "select all"
-        where = "1=1"
-    query = "SELECT name, value FROM practice_statistic WHERE {}".format(where)
-    return query, params
+        return None
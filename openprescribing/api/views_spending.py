@@ -13,7 +13,12 @@ from frontend.price_per_unit.savings import (
     get_all_savings_for_orgs,
     get_savings_for_orgs,
 )
-from matrixstore.db import get_db, get_row_grouper
+from matrixstore.db import (
+    get_db,
+    get_row_grouper,
+    sum_by_org_and_bnf_prefixes,
+    use_practice_index,
+)
 from rest_framework.decorators import api_view
 from rest_framework.exceptions import APIException, NotFound, ValidationError
 from rest_framework.response import Response
@@ -430,27 +435,30 @@ def _get_prescribing_entries(bnf_code_prefixes, orgs, org_type, date=None):
     all available dates are returned.
     """
     db = get_db()
-    items_matrix, quantity_matrix, actual_cost_matrix = _get_prescribing_for_codes(
-        db, bnf_code_prefixes
-    )
-    # If no data at all was found, return early which results in an empty
-    # iterator
-    if items_matrix is None:
-        return
-    # Group together practice level data to the appropriate organisation level
     group_by_org = get_row_grouper(org_type)
-    items_matrix = group_by_org.sum(items_matrix)
-    quantity_matrix = group_by_org.sum(quantity_matrix)
-    actual_cost_matrix = group_by_org.sum(actual_cost_matrix)
     # `group_by_org.offsets` maps each organisation's primary key to its row
-    # offset within the matrices. We pair each organisation with its row
-    # offset, ignoring those organisations which aren't in the mapping (which
-    # implies that they did not prescribe in this period)
+    # offset within the grouped matrices. We pair each organisation with its
+    # row offset, ignoring those organisations which aren't in the mapping
+    # (which implies that they did not prescribe in this period)
     org_offsets = [
         (org, group_by_org.offsets[org.pk])
         for org in orgs
         if org.pk in group_by_org.offsets
     ]
+    practice_codes = [org.pk for org, _ in org_offsets]
+    if use_practice_index(org_type, practice_codes):
+        # For just a few practices we can read their prescribing directly from
+        # the practice-major index, giving matrices with one row per practice
+        # in the order supplied
+        matrices = _get_prescribing_for_codes(db, bnf_code_prefixes, practice_codes)
+        org_offsets = [(org, n) for n, (org, _) in enumerate(org_offsets)]
+    else:
+        matrices = _get_prescribing_for_codes(db, bnf_code_prefixes, org_type=org_type)
+    items_matrix, quantity_matrix, actual_cost_matrix = matrices
+    # If no data at all was found, return early which results in an empty
+    # iterator
+    if items_matrix is None:
+        return
     # Pair each date with its column offset (either all available dates or just
     # the specified one)
     if date:
@@ -484,34 +492,48 @@ def _get_prescribing_entries(bnf_code_prefixes, orgs, org_type, date=None):
             yield entry
 
 
-def _get_prescribing_for_codes(db, bnf_code_prefixes):
+def _get_prescribing_for_codes(
+    db, bnf_code_prefixes, practice_codes=None, org_type=None
+):
     """
     Return items, quantity and actual_cost matrices giving the totals for all
     prescribing which matches any of the supplied BNF code prefixes. If no
     prefixes are supplied then the totals will be over all prescribing for all
     presentations.
+
+    If `practice_codes` are supplied then the matrices contain rows for just
+    those practices, read from the practice-major index. Otherwise they contain
+    a row for each org of type `org_type`.
     """
-    if bnf_code_prefixes:
-        where_clause = " OR ".join(["bnf_code LIKE ?"] * len(bnf_code_prefixes))
-        params = [code + "%" for code in bnf_code_prefixes]
-        sql = """
-            SELECT
-                matrix_sum(items) AS items,
-                matrix_sum(quantity) AS quantity,
-                matrix_sum(actual_cost) AS actual_cost
-            FROM
-                presentation
-            WHERE
-                {}
-            """.format(
-            where_clause
+    if practice_codes is not None:
+        # The empty prefix matches every presentation
+        items, quantity, actual_cost = db.sum_practices_by_bnf_prefixes(
+            ["items", "quantity", "actual_cost"],
+            bnf_code_prefixes or [""],
+            practice_codes,
+        )
+    elif bnf_code_prefixes:
+        # This uses precalculated totals for BNF chapters, sections etc where
+        # it can, rather than summing over every matching presentation, and
+        # reads prescribing already grouped by org where the file has it
+        items, quantity, actual_cost = sum_by_org_and_bnf_prefixes(
+            ["items", "quantity", "actual_cost"], bnf_code_prefixes, org_type
         )
     else:
         # As summing over all presentations can be quite slow we use the
         # precalculated results table
-        sql = "SELECT items, quantity, actual_cost FROM all_presentations"
-        params = []
-    items, quantity, actual_cost = db.query_one(sql, params)
+        _, items, quantity, actual_cost = next(
+            db.query_rows(
+                "all_presentations", "rowid", ["items", "quantity", "actual_cost"]
+            )
+        )
+        # Group together practice level data to the appropriate organisation
+        # level
+        if items is not None:
+            group_by_org = get_row_grouper(org_type)
+            items, quantity, actual_cost = [
+                group_by_org.sum(matrix) for matrix in [items, quantity, actual_cost]
+            ]
     # Convert from pence to pounds
     if actual_cost is not None:
         actual_cost = actual_cost / 100.0
@@ -0,0 +1,269 @@
+"""
+Renders the chart images which we attach to alert emails
+
+Starting a new PhantomJS process for every image made this the slowest part of
+sending alerts, so instead we keep a pool of PhantomJS processes running
+`grab_chart.js`, each of which renders images one at a time on request.
+
+Rendered images are saved to disk, in a directory for the version of the data
+they show, so that a chart which appears in many emails (for instance, because
+many users have bookmarked the same org) is only rendered once. Directories for
+old versions are removed at the start of each run (see
+`remove_old_chart_images`). Requests for an image
+which is already being rendered wait for that to finish rather than rendering
+it again.
+"""
+
+import atexit
+import hashlib
+import json
+import logging
+import os
+import queue
+import select
+import shutil
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import Future
+
+from django.conf import settings
+from frontend.models import ImportLog
+
+logger = logging.getLogger(__name__)
+
+RENDER_COMMAND = [
+    "/usr/local/bin/phantomjs",
+    "--ignore-ssl-errors=true",
+    settings.APPS_ROOT + "/frontend/management/commands/grab_chart.js",
+]
+
+# The renderer waits up to a minute for the chart to appear, so this leaves
+# plenty of time to load the page and save the image
+RENDER_TIMEOUT = 120
+
+
+class ChartRenderError(Exception):
+    pass
+
+
+class RendererProcess(object):
+    """
+    A long-lived renderer process, which reads requests from stdin and writes
+    responses to stdout (see `grab_chart.js`)
+    """
+
+    def __init__(self, command):
+        self.process = subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+            # Fix for PhantomJS under new versions of Debian/Ubuntu
+            # See https://github.com/ariya/phantomjs/issues/15449
+            env=dict(os.environ, OPENSSL_CONF="/etc/ssl"),
+        )
+        # Set if the process has stopped responding as we expect, after which it
+        # can't be used again
+        self.broken = False
+
+    def render(self, request, timeout):
+        try:
+            self.process.stdin.write(json.dumps(request) + "\n")
+            self.process.stdin.flush()
+        except OSError as e:
+            self.broken = True
+            raise ChartRenderError("Unable to send request to renderer: {}".format(e))
+        ready, _, _ = select.select([self.process.stdout], [], [], timeout)
+        if not ready:
+            self.broken = True
+            raise ChartRenderError(
+                "Timed out after {}s rendering {}".format(timeout, request["url"])
+            )
+        line = self.process.stdout.readline()
+        if not line:
+            self.broken = True
+            raise ChartRenderError(
+                "Renderer exited with code {}".format(self.process.wait())
+            )
+        error = json.loads(line)["error"]
+        if error:
+            raise ChartRenderError(error)
+
+    def close(self):
+        if self.process.poll() is None:
+            # The renderer exits when stdin is closed, unless it's stuck
+            try:
+                self.process.stdin.close()
+                self.process.wait(timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                self.process.kill()
+                self.process.wait()
+
+
+class RendererPool(object):
+    """
+    Renders images using up to `size` renderer processes at once, which are
+    started when first needed and then reused
+    """
+
+    def __init__(self, size, command=RENDER_COMMAND, timeout=RENDER_TIMEOUT):
+        self.command = command
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = queue.LifoQueue()
+
+    def render(self, url, path, selector, dimensions, wait):
+        request = {
+            "url": url,
+            "path": path,
+            "selector": selector,
+            "dimensions": dimensions,
+            "wait": wait,
+        }
+        with self._slots:
+            try:
+                process = self._idle.get_nowait()
+            except queue.Empty:
+                try:
+                    process = RendererProcess(self.command)
+                except OSError as e:
+                    raise ChartRenderError("Unable to start renderer: {}".format(e))
+            try:
+                process.render(request, self.timeout)
+            finally:
+                if process.broken:
+                    process.close()
+                else:
+                    self._idle.put(process)
+
+    def close(self):
+        while True:
+            try:
+                process = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            process.close()
+
+
+class ChartImageCache(object):
+    """
+    Stores images rendered by `renderer` in `directory`, and ensures that each
+    image is only rendered once, even when requested by several threads at once
+    """
+
+    def __init__(self, renderer, directory):
+        self.renderer = renderer
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._futures = {}
+
+    def get(self, url, selector, dimensions, wait, version):
+        """
+        Return the path to an image of the element matching `selector` in the
+        page at `url`, rendering it if necessary
+
+        `version` identifies the data shown by the page: images rendered for
+        the same version in an earlier run are reused. If it's None, we only
+        reuse images rendered in this run.
+        """
+        key = hashlib.sha256(
+            json.dumps([version, url, selector, dimensions, wait]).encode("utf8")
+        ).hexdigest()
+        with self._lock:
+            future = self._futures.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = self._futures[key] = Future()
+        if not is_owner:
+            return future.result()
+        path = os.path.join(self.get_version_directory(version), key + ".png")
+        try:
+            if version is None or not os.path.exists(path):
+                self._render(url, path, selector, dimensions, wait)
+        except Exception as e:
+            # Let later requests try again
+            with self._lock:
+                del self._futures[key]
+            future.set_exception(e)
+            raise
+        future.set_result(path)
+        return path
+
+    def get_version_directory(self, version):
+        if version is None:
+            name = "unversioned"
+        else:
+            name = hashlib.sha256(version.encode("utf8")).hexdigest()[:16]
+        return os.path.join(self.directory, name)
+
+    def remove_other_versions(self, version):
+        """
+        Remove the images rendered for every version other than `version`, as
+        we'll never use them again
+        """
+        if not os.path.isdir(self.directory):
+            return
+        keep = self.get_version_directory(version) if version is not None else None
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if os.path.isdir(path) and path != keep:
+                logger.info("Removing old chart images at %s", path)
+                shutil.rmtree(path)
+
+    def _render(self, url, path, selector, dimensions, wait):
+        os.makedirs(self.directory, exist_ok=True)
+        # We render to a temporary file and then move it into place so that
+        # we never leave a partial image at `path`
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".png")
+        os.close(fd)
+        try:
+            self.renderer.render(url, tmp_path, selector, dimensions, wait)
+            if os.path.getsize(tmp_path) == 0:
+                raise ChartRenderError(
+                    "File at %s empty (generated from url %s)" % (tmp_path, url)
+                )
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        logger.debug("Rendered %s from %s", path, url)
+
+
+_chart_image_cache = None
+_chart_image_cache_lock = threading.Lock()
+
+
+def get_chart_image_cache():
+    """
+    Return the ChartImageCache shared by everything in this process, whose
+    renderer processes are stopped when the process exits
+    """
+    global _chart_image_cache
+    with _chart_image_cache_lock:
+        if _chart_image_cache is None:
+            pool = RendererPool(settings.CHART_RENDERER_PROCESSES)
+            atexit.register(pool.close)
+            _chart_image_cache = ChartImageCache(pool, settings.CHART_IMAGE_CACHE_DIR)
+        return _chart_image_cache
+
+
+def remove_old_chart_images():
+    """
+    Remove any images rendered for data other than that currently shown in the
+    dashboard
+    """
+    get_chart_image_cache().remove_other_versions(get_data_version())
+
+
+def get_data_version():
+    """
+    Return a string identifying the data shown in the dashboard charts, or None
+    if we can't tell
+    """
+    import_log = ImportLog.objects.latest_in_category("dashboard_data")
+    if import_log is None:
+        return None
+    return "{}:{}".format(import_log.current_at, import_log.imported_at.isoformat())
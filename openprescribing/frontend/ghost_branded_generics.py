@@ -19,7 +19,6 @@ from django.db import connection
 from frontend.models import Presentation
 from matrixstore.cachelib import memoize
 from matrixstore.db import get_db, get_row_grouper
-from matrixstore.matrix_ops import get_submatrix
 
 # Minimum difference (positive or negative) between a practice's net costs for
 # a drug and our calculated tariff costs. Any differences below this level we
@@ -251,20 +250,6 @@ def get_prescribing(db, bnf_codes, date):
 
     Yields tuples of the form: (bnf_code, quantity_matrix, net_cost_matrix)
     """
-    date_column = db.date_offsets[date]
-    date_slice = slice(date_column, date_column + 1)
-
-    results = db.query(
-        """
-        SELECT bnf_code, quantity, net_cost FROM presentation WHERE bnf_code IN ({})
-        """.format(
-            ",".join("?" * len(bnf_codes))
-        ),
-        bnf_codes,
-    )
+    results = db.query_date_range(["quantity", "net_cost"], bnf_codes, date, date)
     for bnf_code, quantity, net_cost in results:
-        yield (
-            bnf_code,
-            get_submatrix(quantity, cols=date_slice),
-            get_submatrix(net_cost, cols=date_slice),
-        )
+        yield bnf_code, quantity, net_cost
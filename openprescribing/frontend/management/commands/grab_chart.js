@@ -1,115 +1,129 @@
+// Renders images of charts for alert emails, one after another, so that a
+// PhantomJS process can be kept running to serve many requests (see
+// frontend/chart_images.py)
+//
+// Each request is a line on stdin containing a JSON object with the keys
+// `url`, `path`, `selector`, `dimensions` (as "<width>x<height>") and `wait`.
+// For each request we write a line to stdout containing a JSON object whose
+// `error` is null if the image was saved to `path`, or otherwise a message.
+// We exit when stdin is closed.
 var system = require('system');
-var page = new WebPage();
-page.onConsoleMessage = function(msg) {
-  system.stderr.writeLine('console: ' + msg);
-};
-page.viewportSize = {
-  width: 1024,
-  height: 1024
-};
-var address;
+var webpage = require('webpage');
 
-if (system.args.length < 6) {
-  console.log('Usage: phantomjs grab_chart.js <url> <filename> <selector> <width>x<height> timeout');
-  phantom.exit(1);
-} else {
-  address = system.args[1];
-  var path = system.args[2];
-  var selector = system.args[3];
-  var parts = system.args[4].split('x');
+next();
+
+function next() {
+  var line = system.stdin.readLine();
+  if (!line) {
+    phantom.exit();
+    return;
+  }
+  var request;
+  try {
+    request = JSON.parse(line);
+  } catch (e) {
+    respond('Unable to parse request: ' + line);
+    return;
+  }
+  render(request, respond);
+}
+
+function respond(error) {
+  system.stdout.writeLine(JSON.stringify({error: error || null}));
+  system.stdout.flush();
+  // Reading the next request blocks, so let PhantomJS tidy up the previous
+  // page first
+  setTimeout(next, 0);
+}
+
+function render(request, callback) {
+  var page = webpage.create();
+  var finished = false;
+  var finish = function(error) {
+    if (finished) {
+      return;
+    }
+    finished = true;
+    page.close();
+    callback(error);
+  };
+  page.onConsoleMessage = function(msg) {
+    system.stderr.writeLine('console: ' + msg);
+  };
+  var parts = request.dimensions.split('x');
   page.viewportSize = {
     width: parseInt(parts[0], 10),
     height: parseInt(parts[1], 10)
   };
-  var wait = parseInt(system.args[5]);
-  page.open(address, function(status) {
-    if (!status === 'success') {
-      console.log('Unable to load the address!');
-    } else {
-      waitFor({
-        debug: true,
-        extraWait: wait,
-        interval: 500,  // The time series chart is actually
-                        // visible some time after the element is
-                        // visible (there's a jerky refresh thing
-                        // going on). We should fix the jerky thing,
-                        // then we can make the timeout shorter
-        timeout: 60000,
-        check: function() {
-          return page.evaluate(function(s) {
-            // trigger scroll-related events in measures pages.
-            // without this, we'd be screenshotting undrawn charts
-            $('body').scrollTop(1);
-            return $(s).is(':visible');
-          }, selector);
-        },
-        success: function() {
-          captureSelector(path, selector);
-          phantom.exit();
-        },
-        error: function() {
-          console.log("Error waiting for element " + selector);
-          phantom.exit(1);
-        }
-      });
+  page.open(request.url, function(status) {
+    if (status !== 'success') {
+      finish('Unable to load the address ' + request.url);
+      return;
     }
+    waitFor({
+      extraWait: request.wait,
+      interval: 500,  // The time series chart is actually
+                      // visible some time after the element is
+                      // visible (there's a jerky refresh thing
+                      // going on). We should fix the jerky thing,
+                      // then we can make the timeout shorter
+      timeout: 60000,
+      check: function() {
+        return !finished && page.evaluate(function(s) {
+          // trigger scroll-related events in measures pages.
+          // without this, we'd be screenshotting undrawn charts
+          $('body').scrollTop(1);
+          return $(s).is(':visible');
+        }, request.selector);
+      },
+      success: function() {
+        finish(captureSelector(page, request.path, request.selector));
+      },
+      error: function() {
+        finish('Error waiting for element ' + request.selector);
+      }
+    });
   });
 }
 
 function waitFor($config) {
   $config._start = $config._start || new Date();
   if ($config.timeout && new Date() - $config._start > $config.timeout) {
-    if ($config.error) {
-      $config.error();
-    }
-    if ($config.debug) {
-      console.log('timedout ' + (new Date() - $config._start) + 'ms');
-    }
+    $config.error();
     return;
   }
-
   if ($config.check()) {
-    if ($config.debug) {
-      console.log('success ' + (new Date() - $config._start) + 'ms');
-    }
     return setTimeout(function() {
       return $config.success();
     }, $config.extraWait); // the extra wait is for the graph to paint
   }
-
   setTimeout(waitFor, $config.interval || 0, $config);
 }
 
-var capture = function(targetFile, clipRect) {
-  // save specified clip rectangle on current page to targetFile
-  var previousClipRect;
-  previousClipRect = page.clipRect;
+// Save the area of the page covered by the selected element to `targetFile`,
+// returning an error message if we can't
+function captureSelector(page, targetFile, selector) {
+  var clipRect = page.evaluate(function(selector) {
+    var element = document.querySelector(selector);
+    if (!element) {
+      return null;
+    }
+    var rect = element.getBoundingClientRect();
+    return {
+      top: rect.top,
+      left: rect.left,
+      width: rect.width,
+      height: rect.height
+    };
+  }, selector);
+  if (!clipRect) {
+    return 'Unable to fetch bounds for element ' + selector;
+  }
   page.clipRect = clipRect;
   try {
     page.render(targetFile);
   } catch (e) {
-    console.log(
-      'Failed to capture screenshot as ' + targetFile + ': ' + e, "error");
-  }
-  if (previousClipRect) {
-    page.clipRect = previousClipRect;
+    return 'Failed to capture screenshot as ' + targetFile + ': ' + e;
   }
-  return this;
-};
-
-var captureSelector = function(targetFile, selector) {
-  return capture(targetFile, page.evaluate(function(selector) {
-    // work out how to clip the screen shot around the selected element
-    try {
-      var clipRect = document.querySelector(selector).getBoundingClientRect();
-      return {
-        top: clipRect.top,
-        left: clipRect.left,
-        width: clipRect.width,
-        height: clipRect.height
-      };
-    } catch (e) {
-      console.log("Unable to fetch bounds for element " + selector, "warning");
-    }
-  }, selector));
-};
+  return null;
+}
@@ -6,15 +6,26 @@ the alternative, which is looping over thousands of practices
 individually with a custom SQL query. However, the tradeoff is that
 most of the logic now lives in SQL which is harder to read and test
 clearly.
+
+Alternatively, with `--engine matrixstore`, we compute those measures which
+we can directly from the MatrixStore (see `frontend.measure_calculation`),
+falling back to BigQuery for the rest. Use `--parity-check` to compare the
+results of the two.
+
+With `--incremental` we recalculate only the latest month, plus a few trailing
+months to pick up late corrections to the data, for each measure whose
+definition hasn't changed since its values were last calculated.
 """
 
 import csv
 import glob
+import hashlib
+import io
 import json
 import logging
 import os
 import re
-import tempfile
+import time
 from contextlib import contextmanager
 from datetime import datetime
 from pathlib import Path
@@ -23,9 +34,19 @@ from urllib.parse import urlencode
 from common import utils
 from dateutil.relativedelta import relativedelta
 from django.conf import settings
-from django.core.management import BaseCommand
+from django.core.management import BaseCommand, CommandError
 from django.db import connection, transaction
+from django.db.models import Max, Q
 from django.urls import reverse
+from frontend.measure_calculation import (
+    CENTILES,
+    UnsupportedMeasureError,
+    calculate_measure_tables,
+    check_measure_def,
+    compare_measure_tables,
+    filter_bnf_codes,
+    get_measures_read_by_views,
+)
 from frontend.models import ImportLog, Measure, MeasureGlobal, MeasureValue
 from frontend.utils.bnf_hierarchy import get_all_bnf_codes, simplify_bnf_codes
 from gcutils.bigquery import Client
@@ -33,7 +54,14 @@ from google.api_core.exceptions import BadRequest
 
 logger = logging.getLogger(__name__)
 
-CENTILES = [10, 20, 30, 40, 50, 60, 70, 80, 90]
+# Org types of the tables built by each MeasureCalculation
+TABLE_ORG_TYPES = ["practice", "pcn", "ccg", "stp", "regtm", "global"]
+
+# Number of months before the latest which are recalculated in incremental mode
+DEFAULT_TRAILING_MONTHS = 2
+
+# Numerator/denominator types which are lists of BNF codes
+BNF_CODE_TYPES = ["bnf_items", "bnf_quantity", "bnf_cost"]
 
 MEASURE_FIELDNAMES = [
     "measure_id",
@@ -50,6 +78,16 @@ MEASURE_FIELDNAMES = [
     "cost_savings",
 ]
 
+MEASURE_GLOBAL_FIELDNAMES = [
+    "measure_id",
+    "month",
+    "numerator",
+    "denominator",
+    "calc_value",
+    "percentiles",
+    "cost_savings",
+]
+
 
 class Command(BaseCommand):
     """
@@ -78,8 +116,64 @@ class Command(BaseCommand):
         if errors:
             raise BadRequest("\n".join(errors))
 
-    def build_measures(self, measure_defs, start_date, end_date, verbose, options):
+    def check_parity(self, measure_defs, start_date, end_date, verbose):
+        """Calculates each measure both in BigQuery and from the MatrixStore,
+        without writing any values to the database, and reports any
+        differences."""
+
         upload_supplementary_tables()
+        errors = []
+        for measure_def in measure_defs:
+            measure_id = measure_def["id"]
+            try:
+                check_measure_def(measure_def)
+            except UnsupportedMeasureError as e:
+                logger.warning("Skipping %s: %s" % (measure_id, e))
+                continue
+            logger.info("Checking parity for measure: %s" % measure_id)
+            measure = create_or_update_measure(measure_def, end_date)
+            bigquery = MeasureCalculation(
+                measure, start_date=start_date, end_date=end_date, verbose=verbose
+            )
+            bigquery.calculate(bigquery_only=True)
+            matrixstore = MatrixStoreMeasureCalculation(
+                measure, start_date=start_date, end_date=end_date, verbose=verbose
+            )
+            matrixstore.calculate(bigquery_only=True)
+            messages = compare_measure_tables(
+                {
+                    org_type: list(
+                        bigquery.get_rows_as_dicts(bigquery.table_name(org_type))
+                    )
+                    for org_type in TABLE_ORG_TYPES
+                },
+                matrixstore.tables,
+            )
+            for num_or_denom in ["numerator", "denominator"]:
+                if getattr(measure, num_or_denom + "_type") not in BNF_CODE_TYPES:
+                    continue
+                bnf_codes = get_bnf_codes_from_matrixstore(
+                    None, getattr(measure, num_or_denom + "_bnf_codes_filter")
+                )
+                if bnf_codes != getattr(measure, num_or_denom + "_bnf_codes"):
+                    messages.append(
+                        "{} BNF codes differ from those found in BigQuery".format(
+                            num_or_denom
+                        )
+                    )
+            errors.extend("* {}: {}".format(measure_id, m) for m in messages)
+        if errors:
+            raise CommandError(
+                "Measures calculated from the MatrixStore differ:\n" + "\n".join(errors)
+            )
+
+    def build_measures(self, measure_defs, start_date, end_date, verbose, options):
+        engine = options["engine"]
+        if engine == "bigquery":
+            upload_supplementary_tables()
+            uploaded_supplementary_tables = True
+        else:
+            uploaded_supplementary_tables = False
         # This is an optimisation that only makes sense when we're updating the
         # entire table, any of these supplied options mean we're doing
         # something else
@@ -87,33 +181,76 @@ class Command(BaseCommand):
             not options["measure"]
             and not options["definitions_only"]
             and not options["bigquery_only"]
+            and not options["incremental"]
         )
+        # The tables of these measures are read by other measures, so we always
+        # calculate them in full to keep those tables complete
+        measures_read_by_views = get_measures_read_by_views()
         with conditional_constraint_and_index_reconstructor(drop_and_rebuild_indices):
             for measure_def in measure_defs:
                 measure_id = measure_def["id"]
                 logger.info("Updating measure: %s" % measure_id)
                 measure_start = datetime.now()
 
+                measure_engine = engine
+                if engine == "matrixstore":
+                    try:
+                        check_measure_def(measure_def)
+                    except UnsupportedMeasureError as e:
+                        logger.warning(
+                            "Calculating %s in BigQuery: %s" % (measure_id, e)
+                        )
+                        measure_engine = "bigquery"
+                if measure_engine == "bigquery" and not uploaded_supplementary_tables:
+                    upload_supplementary_tables()
+                    uploaded_supplementary_tables = True
+
+                # create_or_update_measure modifies the definition
+                definition_hash = get_definition_hash(measure_def)
+
                 with transaction.atomic():
-                    measure = create_or_update_measure(measure_def, end_date)
+                    measure = create_or_update_measure(
+                        measure_def, end_date, engine=measure_engine
+                    )
 
                     if options["definitions_only"]:
                         continue
 
-                    calcuation = MeasureCalculation(
+                    if (
+                        options["incremental"]
+                        and measure.definition_hash == definition_hash
+                        and measure_id not in measures_read_by_views
+                    ):
+                        update_start_date = get_update_start_date(
+                            measure, start_date, end_date, options["trailing_months"]
+                        )
+                        logger.info(
+                            "Updating %s from %s" % (measure_id, update_start_date)
+                        )
+                    else:
+                        update_start_date = start_date
+
+                    if measure_engine == "matrixstore":
+                        calculation_class = MatrixStoreMeasureCalculation
+                    else:
+                        calculation_class = MeasureCalculation
+                    calcuation = calculation_class(
                         measure,
-                        start_date=start_date,
+                        start_date=update_start_date,
                         end_date=end_date,
                         verbose=verbose,
                     )
 
                     if not options["bigquery_only"]:
-                        MeasureValue.objects.filter(measure=measure).delete()
-                        MeasureGlobal.objects.filter(measure=measure).delete()
+                        delete_measure_values(measure, start_date, update_start_date)
 
                     # Compute the measures
                     calcuation.calculate(options["bigquery_only"])
 
+                    if not options["bigquery_only"]:
+                        measure.definition_hash = definition_hash
+                        measure.save(update_fields=["definition_hash"])
+
                 elapsed = datetime.now() - measure_start
                 logger.warning(
                     "Elapsed time for %s: %s seconds" % (measure_id, elapsed.seconds)
@@ -134,6 +271,8 @@ class Command(BaseCommand):
         verbose = options["verbosity"] > 1
         if options["check"]:
             self.check_definitions(measure_defs, start_date, end_date, verbose)
+        elif options["parity_check"]:
+            self.check_parity(measure_defs, start_date, end_date, verbose)
         else:
             self.build_measures(measure_defs, start_date, end_date, verbose, options)
 
@@ -156,6 +295,21 @@ class Command(BaseCommand):
         parser.add_argument("--bigquery_only", action="store_true")
         parser.add_argument("--check", action="store_true")
         parser.add_argument("--print-confirmation", action="store_true")
+        parser.add_argument(
+            "--engine", choices=["bigquery", "matrixstore"], default="bigquery"
+        )
+        parser.add_argument("--parity-check", action="store_true")
+        parser.add_argument(
+            "--incremental",
+            action="store_true",
+            help="Recalculate only recent months of unchanged measures",
+        )
+        parser.add_argument(
+            "--trailing-months",
+            type=int,
+            default=DEFAULT_TRAILING_MONTHS,
+            help="Number of months before the latest to recalculate incrementally",
+        )
 
 
 def load_measure_defs(measure_ids=None):
@@ -285,8 +439,53 @@ def arrays_to_strings(measure_def):
     return measure_def
 
 
-def create_or_update_measure(measure_def, end_date):
-    """Create a measure object based on a measure definition"""
+def get_definition_hash(measure_def):
+    """Return a hash of a measure definition, which changes whenever the
+    definition does."""
+    definition = json.dumps(measure_def, sort_keys=True).encode("utf8")
+    return hashlib.sha256(definition).hexdigest()
+
+
+def get_update_start_date(measure, start_date, end_date, trailing_months):
+    """Return the month from which an incremental update should recalculate a
+    measure's values.
+
+    This is the start of the last `trailing_months` months (whose prescribing
+    may have been revised) unless the latest month for which we have values is
+    earlier than that (e.g. because an import was skipped) in which case we
+    start from the month after it."""
+    latest_month = MeasureGlobal.objects.filter(measure=measure).aggregate(
+        Max("month")
+    )["month__max"]
+    if latest_month is None:
+        return start_date
+    update_start_date = min(
+        latest_month + relativedelta(months=1),
+        end_date - relativedelta(months=trailing_months),
+    )
+    return max(update_start_date, start_date)
+
+
+def delete_measure_values(measure, start_date, update_start_date):
+    """Delete a measure's values which are about to be recalculated, from
+    `update_start_date` onwards, along with any from before `start_date`, which
+    are too old to keep."""
+    for model in [MeasureValue, MeasureGlobal]:
+        values = model.objects.filter(measure=measure)
+        if update_start_date > start_date:
+            values = values.filter(
+                Q(month__lt=start_date) | Q(month__gte=update_start_date)
+            )
+        values.delete()
+
+
+def create_or_update_measure(measure_def, end_date, engine="bigquery"):
+    """Create a measure object based on a measure definition
+
+    With the "matrixstore" engine we find BNF codes from the MatrixStore rather
+    than from BigQuery, which we can only do for measures accepted by
+    `check_measure_def`.
+    """
     measure_id = measure_def["id"]
     v = arrays_to_strings(measure_def)
 
@@ -341,7 +540,11 @@ def create_or_update_measure(measure_def, end_date):
 
         m.numerator_bnf_codes_filter = v.get("numerator_bnf_codes_filter")
         m.numerator_bnf_codes_query = v.get("numerator_bnf_codes_query")
-        m.numerator_bnf_codes = get_bnf_codes(
+        if engine == "matrixstore":
+            get_codes = get_bnf_codes_from_matrixstore
+        else:
+            get_codes = get_bnf_codes
+        m.numerator_bnf_codes = get_codes(
             m.numerator_bnf_codes_query, m.numerator_bnf_codes_filter
         )
 
@@ -391,7 +594,11 @@ def create_or_update_measure(measure_def, end_date):
 
         m.denominator_bnf_codes_filter = v.get("denominator_bnf_codes_filter")
         m.denominator_bnf_codes_query = v.get("denominator_bnf_codes_query")
-        m.denominator_bnf_codes = get_bnf_codes(
+        if engine == "matrixstore":
+            get_codes = get_bnf_codes_from_matrixstore
+        else:
+            get_codes = get_bnf_codes
+        m.denominator_bnf_codes = get_codes(
             m.denominator_bnf_codes_query, m.denominator_bnf_codes_filter
         )
 
@@ -445,6 +652,19 @@ def get_bnf_codes(base_query, filter_):
     return sorted(bnf_codes & get_all_bnf_codes())
 
 
+def get_bnf_codes_from_matrixstore(base_query, filter_):
+    """Return list of BNF codes used to calculate measure numerator/denominator
+    values, exactly as `get_bnf_codes` does but by filtering the BNF codes in
+    the MatrixStore rather than querying BigQuery.
+
+    This is only possible where `base_query` is None.
+    """
+
+    assert base_query is None and filter_
+
+    return filter_bnf_codes(get_all_bnf_codes(), filter_)
+
+
 def build_bnf_codes_query(base_query, filter_):
     if base_query is None:
         base_query = "SELECT bnf_code FROM {hscic}.presentation"
@@ -645,7 +865,7 @@ class MeasureCalculation(object):
         if self.measure.is_cost_based:
             self.calculate_cost_savings_for_practices()
         if not bigquery_only:
-            self.write_practice_ratios_to_database()
+            self.write_ratios_to_database("practice")
 
     def calculate_practice_ratios(self, dry_run=False):
         """Given a measure defition, construct a BigQuery query which computes
@@ -727,33 +947,29 @@ class MeasureCalculation(object):
             query_id = "practice_list_size_measure_cost_savings"
         self.insert_rows_from_query(query_id, self.table_name("practice"), {})
 
-    def write_practice_ratios_to_database(self):
-        """Copy the bigquery ratios data to the local postgres database.
+    def write_ratios_to_database(self, org_type):
+        """Copy the bigquery ratios data for the given org type to the local
+        postgres database.
 
-        Uses COPY command via a CSV file for performance as this can
-        be a very large number, especially when computing many months'
-        data at once.  We drop and then recreate indexes to improve
-        load time performance.
+        Uses COPY command, streaming rows as they are downloaded, for
+        performance as this can be a very large number, especially when
+        computing many months' data at once.  We drop and then recreate
+        indexes to improve load time performance.
 
         """
-        f = tempfile.TemporaryFile(mode="r+")
-        writer = csv.DictWriter(f, fieldnames=MEASURE_FIELDNAMES)
-        # Write the data we want to load into a file
-        for datum in self.get_rows_as_dicts(self.table_name("practice")):
-            datum["measure_id"] = self.measure.id
-            if self.measure.is_cost_based:
-                datum["cost_savings"] = json.dumps(convertSavingsToDict(datum))
-            datum["percentile"] = normalisePercentile(datum["percentile"])
-            datum = {fn: datum[fn] for fn in MEASURE_FIELDNAMES if fn in datum}
-            writer.writerow(datum)
-        # load data
-        copy_str = "COPY frontend_measurevalue(%s) FROM STDIN "
-        copy_str += "WITH (FORMAT CSV)"
-        self.log(copy_str % ", ".join(MEASURE_FIELDNAMES))
-        f.seek(0)
-        with connection.cursor() as cursor:
-            cursor.copy_expert(copy_str % ", ".join(MEASURE_FIELDNAMES), f)
-        f.close()
+        rows = (
+            self.get_measure_value_row(datum)
+            for datum in self.get_rows_as_dicts(self.table_name(org_type))
+        )
+        self.copy_rows_to_database("frontend_measurevalue", MEASURE_FIELDNAMES, rows)
+
+    def get_measure_value_row(self, datum):
+        """Convert a row of a ratios table to the values of a MeasureValue."""
+        datum["measure_id"] = self.measure.id
+        if self.measure.is_cost_based:
+            datum["cost_savings"] = json.dumps(convertSavingsToDict(datum))
+        datum["percentile"] = normalisePercentile(datum["percentile"])
+        return {fn: datum[fn] for fn in MEASURE_FIELDNAMES if fn in datum}
 
     def calculate_orgs(self, org_type, bigquery_only=False):
         """Calculate ratios, centiles and (optionally) cost savings at a
@@ -766,7 +982,7 @@ class MeasureCalculation(object):
         if self.measure.is_cost_based:
             self.calculate_cost_savings_for_orgs(org_type)
         if not bigquery_only:
-            self.write_org_ratios_to_database(org_type)
+            self.write_ratios_to_database(org_type)
 
     def calculate_org_ratios(self, org_type):
         """Sums all the fields in the per-practice table, grouped by
@@ -827,16 +1043,6 @@ class MeasureCalculation(object):
             query_id = "{}_list_size_measure_cost_savings".format(org_type)
         self.insert_rows_from_query(query_id, self.table_name(org_type), {})
 
-    def write_org_ratios_to_database(self, org_type):
-        """Create measure values for organisation ratios."""
-        for datum in self.get_rows_as_dicts(self.table_name(org_type)):
-            datum["measure_id"] = self.measure.id
-            if self.measure.is_cost_based:
-                datum["cost_savings"] = convertSavingsToDict(datum)
-            datum["percentile"] = normalisePercentile(datum["percentile"])
-            datum = {fn: datum[fn] for fn in MEASURE_FIELDNAMES if fn in datum}
-            MeasureValue.objects.create(**datum)
-
     def calculate_global(self, bigquery_only=False):
         if self.measure.is_cost_based:
             self.calculate_global_cost_savings()
@@ -853,61 +1059,106 @@ class MeasureCalculation(object):
         )
 
     def write_global_centiles_to_database(self):
-        """Write the globals data from BigQuery to the local database"""
+        """Write the globals data from BigQuery to the local database.
+
+        There is only one row per month, so we replace any existing values
+        for the same months and then use COPY just as for MeasureValues.
+
+        """
         self.log(
             "Writing global centiles from %s to database" % self.table_name("global")
         )
-        for d in self.get_rows_as_dicts(self.table_name("global")):
-            regtm_cost_savings = {}
-            stp_cost_savings = {}
-            ccg_cost_savings = {}
-            pcn_cost_savings = {}
-            practice_cost_savings = {}
-            d["measure_id"] = self.measure.id
-            # The cost-savings calculations prepend columns with
-            # global_. There is probably a better way of constructing
-            # the query so this clean-up doesn't have to happen...
-            new_d = {}
-            for attr, value in d.items():
-                new_d[attr.replace("global_", "")] = value
-            d = new_d
-
-            mg, _ = MeasureGlobal.objects.get_or_create(
-                measure_id=self.measure.id, month=d["month"]
+        rows = [
+            self.get_measure_global_row(d)
+            for d in self.get_rows_as_dicts(self.table_name("global"))
+        ]
+        with transaction.atomic():
+            MeasureGlobal.objects.filter(
+                measure_id=self.measure.id, month__in=[row["month"] for row in rows]
+            ).delete()
+            self.copy_rows_to_database(
+                "frontend_measureglobal", MEASURE_GLOBAL_FIELDNAMES, rows
             )
 
-            # Coerce decile-based values into JSON objects
-            if self.measure.is_cost_based:
-                practice_cost_savings = convertSavingsToDict(d, prefix="practice")
-                pcn_cost_savings = convertSavingsToDict(d, prefix="pcn")
-                ccg_cost_savings = convertSavingsToDict(d, prefix="ccg")
-                stp_cost_savings = convertSavingsToDict(d, prefix="stp")
-                regtm_cost_savings = convertSavingsToDict(d, prefix="regtm")
-                mg.cost_savings = {
-                    "regional_team": regtm_cost_savings,
-                    "stp": stp_cost_savings,
-                    "ccg": ccg_cost_savings,
-                    "pcn": pcn_cost_savings,
-                    "practice": practice_cost_savings,
+    def get_measure_global_row(self, d):
+        """Convert a row of the global table to the values of a
+        MeasureGlobal.
+
+        """
+        # The cost-savings calculations prepend columns with
+        # global_. There is probably a better way of constructing
+        # the query so this clean-up doesn't have to happen...
+        new_d = {}
+        for attr, value in d.items():
+            new_d[attr.replace("global_", "")] = value
+        d = new_d
+
+        row = {
+            "measure_id": self.measure.id,
+            "month": d["month"],
+            "numerator": float_or_null(d["numerator"]),
+            "denominator": float_or_null(d["denominator"]),
+        }
+        # This matches the calculation in MeasureGlobal.save()
+        if row["denominator"]:
+            if row["numerator"]:
+                row["calc_value"] = row["numerator"] / row["denominator"]
+            else:
+                row["calc_value"] = row["numerator"]
+        else:
+            row["calc_value"] = None
+
+        # Coerce decile-based values into JSON objects
+        if self.measure.is_cost_based:
+            row["cost_savings"] = json.dumps(
+                {
+                    "regional_team": convertSavingsToDict(d, prefix="regtm"),
+                    "stp": convertSavingsToDict(d, prefix="stp"),
+                    "ccg": convertSavingsToDict(d, prefix="ccg"),
+                    "pcn": convertSavingsToDict(d, prefix="pcn"),
+                    "practice": convertSavingsToDict(d, prefix="practice"),
                 }
-            practice_deciles = convertDecilesToDict(d, prefix="practice")
-            pcn_deciles = convertDecilesToDict(d, prefix="pcn")
-            ccg_deciles = convertDecilesToDict(d, prefix="ccg")
-            stp_deciles = convertDecilesToDict(d, prefix="stp")
-            regtm_deciles = convertDecilesToDict(d, prefix="regtm")
-            mg.percentiles = {
-                "regional_team": regtm_deciles,
-                "stp": stp_deciles,
-                "ccg": ccg_deciles,
-                "pcn": pcn_deciles,
-                "practice": practice_deciles,
+            )
+        else:
+            row["cost_savings"] = None
+        row["percentiles"] = json.dumps(
+            {
+                "regional_team": convertDecilesToDict(d, prefix="regtm"),
+                "stp": convertDecilesToDict(d, prefix="stp"),
+                "ccg": convertDecilesToDict(d, prefix="ccg"),
+                "pcn": convertDecilesToDict(d, prefix="pcn"),
+                "practice": convertDecilesToDict(d, prefix="practice"),
             }
+        )
+        return row
 
-            # Set the rest of the data returned from bigquery directly
-            # on the model
-            for attr, value in d.items():
-                setattr(mg, attr, value)
-            mg.save()
+    def copy_rows_to_database(self, table_name, fieldnames, rows):
+        """Load the given dicts into a table using COPY, encoding them as CSV
+        only as COPY reads them.
+
+        Since rows are generally streamed straight from BigQuery, the rate
+        we log covers both downloading and writing them.
+
+        """
+        stream = CSVRowStream(rows, fieldnames)
+        copy_str = "COPY %s(%s) FROM STDIN WITH (FORMAT CSV)" % (
+            table_name,
+            ", ".join(fieldnames),
+        )
+        self.log(copy_str)
+        start = time.monotonic()
+        with connection.cursor() as cursor:
+            cursor.copy_expert(copy_str, stream)
+        elapsed = time.monotonic() - start
+        self.log(
+            "Copied %s rows to %s in %.1fs (%.0f rows/s)"
+            % (
+                stream.row_count,
+                table_name,
+                elapsed,
+                stream.row_count / elapsed if elapsed else 0,
+            )
+        )
 
     def insert_rows_from_query(self, query_id, table_name, ctx, dry_run=False):
         """Interpolate values from ctx into SQL identified by query_id, and
@@ -975,6 +1226,70 @@ class MeasureCalculation(object):
         return val
 
 
+class MatrixStoreMeasureCalculation(MeasureCalculation):
+    """Logic for measure calculations from the MatrixStore.
+
+    The values are calculated in one go (see `frontend.measure_calculation`)
+    as rows of the same form as the tables built in BQ, which are then written
+    to the database exactly as those tables are.
+    """
+
+    def calculate(self, bigquery_only=False):
+        """Calculate all values and, unless `bigquery_only` is set (which here
+        just means "don't write anything"), write them to the database.
+
+        """
+        self.log("Calculating %s from the MatrixStore" % self.measure.id)
+        self.tables = calculate_measure_tables(
+            self.measure, self.start_date, self.end_date
+        )
+        if not bigquery_only:
+            for org_type in ["practice", "pcn", "ccg", "stp", "regtm"]:
+                self.write_ratios_to_database(org_type)
+            self.write_global_centiles_to_database()
+
+    def get_rows_as_dicts(self, table_name):
+        """Iterate over the rows of the specified table, as calculated by
+        `calculate`, returning a fresh dict for each row.
+
+        """
+        org_types = {self.table_name(org_type): org_type for org_type in self.tables}
+        for row in self.tables[org_types[table_name]]:
+            yield dict(row)
+
+
+class CSVRowStream(object):
+    """File-like object which encodes dicts as lines of CSV as they are read,
+    so that they can be passed to `copy_expert` without first being written
+    out in full.
+
+    """
+
+    def __init__(self, rows, fieldnames):
+        self.rows = iter(rows)
+        self.buffer = io.StringIO()
+        self.writer = csv.DictWriter(self.buffer, fieldnames=fieldnames)
+        self.row_count = 0
+
+    def read(self, size=-1):
+        while size < 0 or self.buffer.tell() < size:
+            try:
+                row = next(self.rows)
+            except StopIteration:
+                break
+            self.writer.writerow(row)
+            self.row_count += 1
+        data = self.buffer.getvalue()
+        if size >= 0:
+            data, rest = data[:size], data[size:]
+        else:
+            rest = ""
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        self.buffer.write(rest)
+        return data
+
+
 @contextmanager
 def conditional_constraint_and_index_reconstructor(enabled):
     if not enabled:
@@ -5,6 +5,7 @@ import sys
 from common.alert_utils import EmailErrorDeferrer
 from django.core.management.base import BaseCommand, CommandError
 from django.db.models import Q
+from frontend.chart_images import remove_old_chart_images
 from frontend.models import (
     PCN,
     PCT,
@@ -187,21 +188,52 @@ class Command(BaseCommand):
                 "You must specify either a URL, or one of a ccg or a practice"
             )
 
-    def send_org_bookmark_email(self, org_bookmark, now_month, options):
+    def get_org(self, org_bookmark, options):
         if org_bookmark.practice or options["practice"]:
-            org = org_bookmark.practice or Practice.objects.get(pk=options["practice"])
+            return org_bookmark.practice or Practice.objects.get(pk=options["practice"])
         elif org_bookmark.pct or options["ccg"]:
-            org = org_bookmark.pct or PCT.objects.get(pk=options["ccg"])
+            return org_bookmark.pct or PCT.objects.get(pk=options["ccg"])
         elif org_bookmark.pcn or options["pcn"]:
-            org = org_bookmark.pcn or PCN.objects.get(pk=options["pcn"])
+            return org_bookmark.pcn or PCN.objects.get(pk=options["pcn"])
         elif org_bookmark.stp or options["stp"]:
-            org = org_bookmark.stp or STP.objects.get(pk=options["stp"])
+            return org_bookmark.stp or STP.objects.get(pk=options["stp"])
         else:
             assert False
+
+    def prefetch_org_stats(self, org_bookmarks, options):
+        """Calculate the stats for every open org with a bookmark in one batch,
+        as this is much quicker than doing so for each org in turn
+
+        """
+        orgs = set()
+        for org_bookmark in org_bookmarks:
+            # Test bookmarks, which aren't saved, are handled individually
+            if org_bookmark.pk is None:
+                continue
+            org = self.get_org(org_bookmark, options)
+            if not getattr(org, "close_date", None):
+                orgs.add(org)
+        org_stats = bookmark_utils.get_org_email_contexts(orgs)
+        self.org_stats.update(org_stats)
+        self.log_info(
+            "Calculated stats for %s of %s orgs" % (len(org_stats), len(orgs))
+        )
+
+    def get_org_stats(self, org):
+        # Many users bookmark the same org, so we only calculate its stats once.
+        # This also covers any orgs whose stats failed to prefetch, so that
+        # errors are handled per email.
+        if org not in self.org_stats:
+            finder = bookmark_utils.InterestingMeasureFinder(org)
+            self.org_stats[org] = finder.context_for_org_email()
+        return self.org_stats[org]
+
+    def send_org_bookmark_email(self, org_bookmark, now_month, options):
+        org = self.get_org(org_bookmark, options)
         if getattr(org, "close_date", None):
             self.log_info("Skipping sending alert for closed org %s" % org.pk)
             return
-        stats = bookmark_utils.InterestingMeasureFinder(org).context_for_org_email()
+        stats = self.get_org_stats(org)
 
         try:
             msg = bookmark_utils.make_org_email(org_bookmark, stats, tag=now_month)
@@ -267,9 +299,13 @@ class Command(BaseCommand):
             .lower()
         )
         self.error_count = 0
+        self.org_stats = {}
+        remove_old_chart_images()
         self.send_all_england_alerts(options)
+        org_bookmarks = list(self.get_org_bookmarks(now_month, **options))
+        self.prefetch_org_stats(org_bookmarks, options)
         with EmailErrorDeferrer(int(options["max_errors"])) as error_deferrer:
-            for org_bookmark in self.get_org_bookmarks(now_month, **options):
+            for org_bookmark in org_bookmarks:
                 error_deferrer.try_email(
                     self.send_org_bookmark_email, org_bookmark, now_month, options
                 )
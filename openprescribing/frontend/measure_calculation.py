@@ -0,0 +1,544 @@
+"""
+Calculates measure values directly from the MatrixStore, as an alternative to
+the chain of BigQuery queries run by `import_measures.MeasureCalculation`
+
+We can do this for any measure whose numerator and denominator are either sums
+of prescribing over a list of BNF codes or practice list sizes (or STAR-PUs),
+which covers most of our measures. Everything else, including measures whose
+BNF codes can only be found by running a query in BigQuery, still has to be
+calculated there (see `check_measure_def`).
+
+We produce rows of exactly the same form as the BigQuery tables built by the
+SQL in `measure_sql/`, one table per org type plus one of global values, so
+that the same code can write the results of either calculation to the database
+and so that we can compare the two (see `compare_measure_tables`). That
+includes the infinite ratios which BigQuery gives orgs other than practices
+that have a zero denominator, and which count towards percentiles. As in
+BigQuery, practices and their orgs come from the database; we include every
+standard practice, whether or not it has any prescribing.
+"""
+
+import math
+import re
+from pathlib import Path
+
+import numpy
+import scipy.sparse
+from dateutil.parser import parse as parse_date
+from django.conf import settings
+from frontend.models import Practice
+from matrixstore.db import get_db
+from matrixstore.row_grouper import RowGrouper
+
+CENTILES = [10, 20, 30, 40, 50, 60, 70, 80, 90]
+
+# The org types for which we build tables, named as in BigQuery, and the org ID
+# columns of each table. The first column identifies the org.
+ORG_TYPE_COLUMNS = {
+    "practice": ["practice_id", "pcn_id", "pct_id", "stp_id", "regional_team_id"],
+    "pcn": ["pcn_id"],
+    "ccg": ["pct_id", "stp_id", "regional_team_id"],
+    "stp": ["stp_id"],
+    "regtm": ["regional_team_id"],
+}
+
+PRESCRIBING_COLUMNS = {
+    "bnf_items": "items",
+    "bnf_quantity": "quantity",
+    "bnf_cost": "actual_cost",
+}
+
+PRACTICE_STATISTICS = {
+    "list_size": "total_list_size",
+    "star_pu_antibiotics": "star_pu.oral_antibacterials_item",
+}
+
+# RowGrouper needs sortable group IDs, so we group practices which don't
+# belong to an org under this ID instead of None
+NO_ORG = ""
+
+
+class UnsupportedMeasureError(Exception):
+    pass
+
+
+def check_measure_def(measure_def):
+    """
+    Raise UnsupportedMeasureError unless we can calculate the measure defined
+    by `measure_def` from the MatrixStore
+    """
+    for num_or_denom in ["numerator", "denominator"]:
+        measure_type = measure_def[num_or_denom + "_type"]
+        if measure_type in PRESCRIBING_COLUMNS:
+            if measure_def.get(num_or_denom + "_bnf_codes_query"):
+                raise UnsupportedMeasureError(
+                    "{} BNF codes are found by a query".format(num_or_denom)
+                )
+        elif num_or_denom == "numerator" or measure_type not in PRACTICE_STATISTICS:
+            raise UnsupportedMeasureError(
+                "{} has type {}".format(num_or_denom, measure_type)
+            )
+    if measure_def["id"] in get_measures_read_by_views():
+        # Other measures read this measure's table in BigQuery, so we have to
+        # keep it up to date
+        raise UnsupportedMeasureError("its BigQuery table is read by other measures")
+
+
+def get_measures_read_by_views():
+    """
+    Return the IDs of measures whose BigQuery tables are read by the views in
+    `measures/views`
+    """
+    measure_ids = set()
+    for path in (Path(settings.APPS_ROOT) / "measures" / "views").glob("*.sql"):
+        measure_ids.update(
+            re.findall(r"\{measures\}\.practice_data_(\w+)", path.read_text())
+        )
+    return measure_ids
+
+
+def filter_bnf_codes(bnf_codes, filter_):
+    """
+    Return the sorted list of the supplied BNF codes which match `filter_`, a
+    list of BNF code filters exactly as described in
+    `import_measures.get_bnf_codes`
+    """
+    includes = []
+    excludes = []
+    for element in filter_:
+        element = element.split("#")[0].strip()
+        if element[0] == "~":
+            excludes.append(build_bnf_code_regex(element[1:]))
+        else:
+            includes.append(build_bnf_code_regex(element))
+    include_regex = re.compile("|".join(includes)) if includes else None
+    exclude_regex = re.compile("|".join(excludes)) if excludes else None
+    return sorted(
+        bnf_code
+        for bnf_code in bnf_codes
+        if (include_regex is None or include_regex.match(bnf_code))
+        and (exclude_regex is None or not exclude_regex.match(bnf_code))
+    )
+
+
+def build_bnf_code_regex(element):
+    """
+    Return a regex matching the same BNF codes as the SQL fragment built by
+    `import_measures.build_bnf_codes_query_fragment`
+    """
+    if element[:2] <= "19":
+        # this is a drug
+        full_code_length = 15
+    else:
+        # this is an appliance
+        full_code_length = 11
+
+    if "%" in element:
+        # A LIKE pattern, in which "_" also matches any single character
+        pattern = "".join(
+            ".*" if char == "%" else "." if char == "_" else re.escape(char)
+            for char in element
+        )
+        return "(?:{})$".format(pattern)
+    elif len(element) == full_code_length:
+        return "(?:{})$".format(re.escape(element))
+    else:
+        return re.escape(element)
+
+
+def calculate_measure_tables(measure, start_date, end_date):
+    """
+    Return a dict mapping each org type in ORG_TYPE_COLUMNS, plus "global", to
+    a list of dicts giving the rows of the equivalent BigQuery table for the
+    supplied measure, for each month of the MatrixStore between `start_date`
+    and `end_date`
+    """
+    db = get_db()
+    dates = [date for date in db.dates if str(start_date) <= date <= str(end_date)]
+    months = [parse_date(date).date() for date in dates]
+    practices = list(
+        Practice.objects.filter(setting=4, ccg__isnull=False)
+        .order_by("code")
+        .values_list(
+            "code",
+            "pcn_id",
+            "ccg_id",
+            "ccg__stp_id",
+            "ccg__regional_team_id",
+            "ccg__org_type",
+        )
+    )
+    get_values = PracticeValues(db, [practice[0] for practice in practices], dates)
+
+    values = {}
+    values["numerator"], num_totals = get_numerator_or_denominator(
+        db, get_values, measure, "numerator"
+    )
+    values["denominator"], denom_totals = get_numerator_or_denominator(
+        db, get_values, measure, "denominator"
+    )
+    with_costs = measure.is_cost_based and measure.is_percentage
+    if with_costs:
+        for name in ["items", "quantity", "actual_cost"]:
+            values["num_" + name] = num_totals[name]
+            values["denom_" + name] = denom_totals[name]
+
+    # Practices which don't belong to a CCG proper (as opposed to some other
+    # kind of PCT) are excluded from CCG level data and hence from STP and
+    # regional team level data too
+    in_ccg = numpy.array([practice[5] == "CCG" for practice in practices], dtype=bool)
+    org_ids = {
+        "practice": [tuple(practice[:5]) for practice in practices],
+        "pcn": [(practice[1],) for practice in practices],
+        "ccg": [practice[2:5] for practice in practices],
+        "stp": [(practice[3],) for practice in practices],
+        "regtm": [(practice[4],) for practice in practices],
+    }
+    org_values = {"practice": values}
+    for org_type in ["pcn", "ccg", "stp", "regtm"]:
+        if org_type == "pcn":
+            rows = numpy.arange(len(practices))
+        else:
+            rows = numpy.flatnonzero(in_ccg)
+        org_ids[org_type], org_values[org_type] = group_values(
+            values, [org_ids[org_type][row] for row in rows], rows
+        )
+
+    if with_costs:
+        cost_per_num, cost_per_denom = get_global_unit_costs(values)
+
+    tables = {}
+    global_row_values = {
+        "numerator": values["numerator"].sum(axis=0),
+        "denominator": values["denominator"].sum(axis=0),
+    }
+    for org_type, level_values in org_values.items():
+        ratios = get_ratios(
+            level_values["numerator"],
+            level_values["denominator"],
+            infinite_as_null=(org_type == "practice"),
+        )
+        percentiles = get_centiles(ratios)
+        columns = {
+            "numerator": level_values["numerator"],
+            "denominator": level_values["denominator"],
+            "calc_value": ratios,
+            "percentile": get_percent_ranks(ratios),
+        }
+        for centile, values_at_centile in zip(CENTILES, percentiles):
+            global_row_values["{}_{}th".format(org_type, centile)] = values_at_centile
+            if not measure.is_cost_based:
+                continue
+            if measure.is_percentage:
+                cost_savings = get_percentage_cost_savings(
+                    level_values, values_at_centile, cost_per_num, cost_per_denom
+                )
+            else:
+                cost_savings = get_list_size_cost_savings(
+                    level_values, values_at_centile
+                )
+            columns["cost_savings_{}".format(centile)] = cost_savings
+            global_row_values["{}_cost_savings_{}".format(org_type, centile)] = (
+                numpy.where(cost_savings > 0, cost_savings, 0).sum(axis=0)
+            )
+        tables[org_type] = build_rows(
+            ORG_TYPE_COLUMNS[org_type], org_ids[org_type], months, columns
+        )
+    tables["global"] = build_rows([], [()], months, global_row_values)
+    return tables
+
+
+class PracticeValues(object):
+    """
+    Selects the values for the supplied practices and dates from practice level
+    matrices, giving zeros for any practices not in the MatrixStore
+    """
+
+    def __init__(self, db, practice_codes, dates):
+        rows = numpy.array(
+            [db.practice_offsets.get(code, -1) for code in practice_codes],
+            dtype=numpy.int64,
+        )
+        self.present = rows >= 0
+        self.rows = rows[self.present]
+        self.columns = numpy.array(
+            [db.date_offsets[date] for date in dates], dtype=numpy.int64
+        )
+        self.shape = (len(practice_codes), len(dates))
+
+    def __call__(self, matrix):
+        values = numpy.zeros(self.shape)
+        if matrix is None:
+            return values
+        if scipy.sparse.issparse(matrix):
+            matrix = matrix.toarray()
+        values[self.present] = matrix[numpy.ix_(self.rows, self.columns)]
+        return values
+
+
+def get_numerator_or_denominator(db, get_values, measure, num_or_denom):
+    """
+    Return the values of the numerator or denominator for each practice and
+    month, along with a dict giving the totals of each prescribing column over
+    the measure's BNF codes (which is empty where it doesn't have any)
+    """
+    measure_type = getattr(measure, num_or_denom + "_type")
+    if measure_type in PRACTICE_STATISTICS:
+        name = PRACTICE_STATISTICS[measure_type]
+        matrices = dict(db.query_rows("practice_statistic", "name", ["value"], [name]))
+        values = get_values(matrices.get(name))
+        if measure_type == "list_size":
+            values = values / 1000.0
+        return values, {}
+    bnf_codes = getattr(measure, num_or_denom + "_bnf_codes")
+    columns = ["items", "quantity", "actual_cost"]
+    if bnf_codes:
+        matrices = db.sum_matrices(
+            "SELECT {} FROM presentation WHERE bnf_code IN ({})".format(
+                ", ".join(columns), ",".join(["?"] * len(bnf_codes))
+            ),
+            bnf_codes,
+        )
+    else:
+        matrices = [None] * len(columns)
+    totals = {column: get_values(matrix) for column, matrix in zip(columns, matrices)}
+    # Costs are stored in pence in the MatrixStore but in pounds in BigQuery
+    totals["actual_cost"] /= 100
+    return totals[PRESCRIBING_COLUMNS[measure_type]], totals
+
+
+def group_values(values, ids, rows):
+    """
+    Sum each array in the `values` dict over the supplied rows, grouped by the
+    corresponding tuples of org IDs, and return the list of tuples along with
+    a dict of the summed arrays
+
+    As in BigQuery's GROUP BY, practices which don't belong to an org are
+    grouped together as though they did.
+    """
+    group_by_org = RowGrouper(
+        (row, tuple(NO_ORG if org_id is None else org_id for org_id in org_ids))
+        for row, org_ids in zip(rows, ids)
+    )
+    grouped_ids = [
+        tuple(None if org_id == NO_ORG else org_id for org_id in org_ids)
+        for org_ids in group_by_org.ids
+    ]
+    return grouped_ids, {
+        name: group_by_org.sum(array) for name, array in values.items()
+    }
+
+
+def get_ratios(numerators, denominators, infinite_as_null=False):
+    """
+    Divide numerators by denominators as BigQuery's IEEE_DIVIDE does, so that
+    0/0 gives NaN (which becomes NULL) and x/0 gives an infinity
+
+    `practice_ratios.sql` replaces infinite ratios with NULL but the SQL for
+    the other org types keeps them, so we only do so if `infinite_as_null` is
+    set.
+    """
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        ratios = numerators / denominators
+    if infinite_as_null:
+        ratios[numpy.isinf(ratios)] = numpy.nan
+    return ratios
+
+
+def get_percent_ranks(ratios):
+    """
+    Return the equivalent of BigQuery's `PERCENT_RANK() OVER (PARTITION BY
+    month ORDER BY calc_value)` for the non-NaN ratios in each column
+    """
+    percent_ranks = numpy.full(ratios.shape, numpy.nan)
+    for column in range(ratios.shape[1]):
+        valid = ~numpy.isnan(ratios[:, column])
+        values = ratios[valid, column]
+        if len(values) == 0:
+            continue
+        # The rank of each value, less one, is the number of smaller values
+        ranks = numpy.searchsorted(numpy.sort(values), values, side="left")
+        if len(values) > 1:
+            percent_ranks[valid, column] = ranks / (len(values) - 1)
+        else:
+            percent_ranks[valid, column] = 0.0
+    return percent_ranks
+
+
+def get_centiles(ratios):
+    """
+    Return an array giving each centile of the non-NaN ratios in each column
+    (or NaN where there are none), interpolated as by BigQuery's
+    PERCENTILE_CONT
+
+    Infinite ratios sort to either end and count towards the centiles as they
+    do in BigQuery. Interpolating towards an infinity gives that infinity, so
+    we don't rely on the arithmetic, which would give NaN for `-inf + inf`.
+    """
+    centiles = numpy.full((len(CENTILES), ratios.shape[1]), numpy.nan)
+    fractions = numpy.array(CENTILES) / 100
+    for column in range(ratios.shape[1]):
+        values = numpy.sort(ratios[~numpy.isnan(ratios[:, column]), column])
+        if len(values) == 0:
+            continue
+        positions = fractions * (len(values) - 1)
+        lower_indexes = numpy.floor(positions).astype(numpy.intp)
+        upper_indexes = numpy.ceil(positions).astype(numpy.intp)
+        weights = positions - lower_indexes
+        lower = values[lower_indexes]
+        upper = values[upper_indexes]
+        with numpy.errstate(invalid="ignore"):
+            interpolated = lower + (upper - lower) * weights
+        interpolated = numpy.where(numpy.isinf(upper), upper, interpolated)
+        interpolated = numpy.where(numpy.isinf(lower), lower, interpolated)
+        centiles[:, column] = numpy.where(
+            lower_indexes == upper_indexes, lower, interpolated
+        )
+    return centiles
+
+
+def get_global_unit_costs(values):
+    """
+    Return the cost per unit of numerator, and of the rest of the denominator,
+    over all practices in each month
+    """
+    num_cost = values["num_actual_cost"].sum(axis=0)
+    num_quantity = values["num_quantity"].sum(axis=0)
+    denom_cost = values["denom_actual_cost"].sum(axis=0)
+    denom_quantity = values["denom_quantity"].sum(axis=0)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        cost_per_denom = (denom_cost - num_cost) / (denom_quantity - num_quantity)
+        cost_per_num = num_cost / num_quantity
+    return cost_per_num, cost_per_denom
+
+
+def get_percentage_cost_savings(values, centile, cost_per_num, cost_per_denom):
+    """
+    Return the savings each org would make if the numerator's share of the
+    denominator's quantity were at the supplied centile, exactly as calculated
+    by `measure_sql/*_percentage_measure_cost_savings.sql`
+    """
+    num_cost = values["num_actual_cost"]
+    num_quantity = values["num_quantity"]
+    denom_cost = values["denom_actual_cost"]
+    denom_quantity = values["denom_quantity"]
+    other_quantity = denom_quantity - num_quantity
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        num_unit_cost = numpy.where(
+            num_quantity > 0, num_cost / num_quantity, cost_per_num
+        )
+        other_unit_cost = numpy.where(
+            other_quantity == 0,
+            cost_per_denom,
+            (denom_cost - num_cost) / other_quantity,
+        )
+    cost_savings = denom_cost - (
+        (centile * denom_quantity * num_unit_cost)
+        + ((denom_quantity - (denom_quantity * centile)) * other_unit_cost)
+    )
+    # Orgs with no prescribing at all in the denominator have NULL costs in
+    # BigQuery, and hence NULL savings
+    cost_savings[values["denom_items"] == 0] = numpy.nan
+    return cost_savings
+
+
+def get_list_size_cost_savings(values, centile):
+    """
+    Return the savings each org would make if its ratio were at the supplied
+    centile, as calculated by `measure_sql/*_list_size_measure_cost_savings.sql`
+    """
+    return values["numerator"] - centile * values["denominator"]
+
+
+def build_rows(id_columns, ids, months, columns):
+    """
+    Return a list of dicts, one for each tuple of org IDs in `ids` and each
+    month, giving the corresponding values of each array in `columns`
+
+    NaN values are replaced with None.
+    """
+    rows = []
+    columns = {name: array.tolist() for name, array in columns.items()}
+    for row, org_ids in enumerate(ids):
+        for column, month in enumerate(months):
+            values = dict(zip(id_columns, org_ids))
+            values["month"] = month
+            for name, array in columns.items():
+                value = array[row][column] if len(org_ids) else array[column]
+                values[name] = None if math.isnan(value) else value
+            rows.append(values)
+    return rows
+
+
+def compare_measure_tables(expected, actual, rel_tol=1e-6, abs_tol=1e-6):
+    """
+    Compare two sets of measure tables of the form returned by
+    `calculate_measure_tables` and return a list of messages describing any
+    differences
+
+    Values are compared only for the columns in `actual`. Rows from BigQuery
+    can include other columns, and global columns with a "global_" prefix
+    (which we ignore, just as `get_measure_global_row` does).
+    """
+    messages = []
+    for table, actual_rows in actual.items():
+        id_column = ORG_TYPE_COLUMNS[table][0] if table in ORG_TYPE_COLUMNS else None
+        expected_by_key = {
+            get_row_key(row, id_column): row
+            for row in (strip_prefix(row) for row in expected.get(table, []))
+        }
+        actual_by_key = {get_row_key(row, id_column): row for row in actual_rows}
+        missing = expected_by_key.keys() - actual_by_key.keys()
+        extra = actual_by_key.keys() - expected_by_key.keys()
+        if missing:
+            messages.append(
+                "{}: {} rows missing, e.g. {}".format(table, len(missing), min(missing))
+            )
+        if extra:
+            messages.append(
+                "{}: {} unexpected rows, e.g. {}".format(table, len(extra), min(extra))
+            )
+        differences = {}
+        for key in sorted(expected_by_key.keys() & actual_by_key.keys()):
+            expected_row = expected_by_key[key]
+            for name, value in actual_by_key[key].items():
+                if name in ORG_TYPE_COLUMNS.get(table, []) or name == "month":
+                    continue
+                expected_value = expected_row.get(name)
+                if not values_match(expected_value, value, rel_tol, abs_tol):
+                    differences.setdefault(name, []).append(
+                        (key, expected_value, value)
+                    )
+        for name, examples in sorted(differences.items()):
+            key, expected_value, value = examples[0]
+            messages.append(
+                "{}: {} differs in {} rows, e.g. {} expected {} got {}".format(
+                    table, name, len(examples), key, expected_value, value
+                )
+            )
+    return messages
+
+
+def strip_prefix(row):
+    return {name.replace("global_", ""): value for name, value in row.items()}
+
+
+def get_row_key(row, id_column):
+    month = str(row["month"])[:10]
+    if id_column is None:
+        return (month,)
+    return (row[id_column] or "", month)
+
+
+def values_match(expected, actual, rel_tol, abs_tol):
+    expected = to_float_or_none(expected)
+    actual = to_float_or_none(actual)
+    if expected is None or actual is None:
+        return expected is None and actual is None
+    return math.isclose(expected, actual, rel_tol=rel_tol, abs_tol=abs_tol)
+
+
+def to_float_or_none(value):
+    if value is None or math.isnan(float(value)):
+        return None
+    return float(value)
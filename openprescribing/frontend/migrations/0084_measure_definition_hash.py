@@ -0,0 +1,18 @@
+# Generated by Django 3.2.18 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('frontend', '0083_measure_radar_exclude'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='measure',
+            name='definition_hash',
+            field=models.CharField(max_length=64, null=True),
+        ),
+    ]
@@ -665,6 +665,11 @@ class Measure(models.Model):
     denominator_bnf_codes_query = models.CharField(max_length=10000, null=True)
     denominator_bnf_codes = ArrayField(models.CharField(max_length=15), null=True)
 
+    # Hash of the definition from which this measure's values were last
+    # calculated, so that we know when they need to be rebuilt in full (see
+    # `import_measures --incremental`)
+    definition_hash = models.CharField(max_length=64, null=True)
+
     def __str__(self):
         return self.name
 
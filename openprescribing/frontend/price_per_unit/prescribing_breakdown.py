@@ -1,10 +1,15 @@
+from collections import namedtuple
+
 import numpy
 from frontend.models import Presentation
 from matrixstore.db import get_db, get_row_grouper
-from matrixstore.matrix_ops import get_submatrix
 
 from .substitution_sets import get_substitution_sets
 
+# `quantities` and `net_costs` are matrices of shape (practices, presentations)
+# whose columns correspond to the BNF codes in `bnf_codes`
+Prescribing = namedtuple("Prescribing", "bnf_codes quantities net_costs")
+
 
 def get_prescribing(generic_code, date):
     """
@@ -12,12 +17,7 @@ def get_prescribing(generic_code, date):
     `generic_code`) get all prescribing of those presentations on the given
     date
 
-    Return value is a dict of the form:
-        {
-            ...
-            bnf_code: (quantity_matrix, net_cost_matrix)
-            ...
-        }
+    Returns a `Prescribing` tuple (see above)
     """
     # If the supplied code doesn't represent a substitution set just show
     # prescribing for that single BNF code
@@ -27,32 +27,19 @@ def get_prescribing(generic_code, date):
         bnf_codes = [generic_code]
 
     db = get_db()
-    try:
-        date_column = db.date_offsets[date]
-    except KeyError:
-        return {}
-    date_slice = slice(date_column, date_column + 1)
-
-    results = db.query(
-        """
-        SELECT
-          bnf_code, quantity, net_cost
-        FROM
-          presentation
-        WHERE
-          bnf_code IN ({})
-        """.format(
-            ",".join("?" * len(bnf_codes))
-        ),
-        bnf_codes,
+    if date not in db.date_offsets:
+        empty = numpy.zeros((len(db.practices), 0))
+        return Prescribing(bnf_codes=[], quantities=empty, net_costs=empty)
+    offset = db.date_offsets[date]
+    date_slice = slice(offset, offset + 1)
+    bnf_codes, quantities = db.fetch_stack("quantity", bnf_codes, date_slice)
+    _, net_costs = db.fetch_stack("net_cost", bnf_codes, date_slice)
+    # Each stack has shape (presentations, practices, 1)
+    return Prescribing(
+        bnf_codes=bnf_codes,
+        quantities=quantities[:, :, 0].T,
+        net_costs=net_costs[:, :, 0].T,
     )
-    return {
-        bnf_code: (
-            get_submatrix(quantity, cols=date_slice),
-            get_submatrix(net_cost, cols=date_slice),
-        )
-        for bnf_code, quantity, net_cost in results
-    }
 
 
 def get_ppu_breakdown(prescribing, org_type, org_id):
@@ -61,28 +48,34 @@ def get_ppu_breakdown(prescribing, org_type, org_id):
     of how much of each presentation was prescribed at each price-per-unit by
     the given org.
 
+    The breakdown is over the individual practices within the org so this
+    needs practice level prescribing, even for org types whose prescribing is
+    already grouped in the MatrixStore file.
+
     Note that we round PPUs to the nearest pence, so that if 10 units were
     prescribed at 9.9p each and 5 units at 10.1p this function will say that 15
     units were prescribed at 10p each.
     """
     group_by_org = get_row_grouper(org_type)
-    names = Presentation.names_for_bnf_codes(prescribing.keys())
+    names = Presentation.names_for_bnf_codes(prescribing.bnf_codes)
+    # These have shape (practices in org, presentations)
+    quantities = group_by_org.get_group(prescribing.quantities, org_id)
+    net_costs = group_by_org.get_group(prescribing.net_costs, org_id)
+    rounded_ppus = numpy.rint(net_costs / quantities)
+    mean_ppus = net_costs.sum(axis=0) / quantities.sum(axis=0)
     presentations = []
-    for bnf_code, (quantities, net_costs) in prescribing.items():
-        quantities = group_by_org.get_group(quantities, org_id)[:, 0]
-        net_costs = group_by_org.get_group(net_costs, org_id)[:, 0]
-        ppu = net_costs / quantities
-        rounded_ppu = numpy.rint(ppu)
+    for n, bnf_code in enumerate(prescribing.bnf_codes):
+        rounded_ppu = rounded_ppus[:, n]
         ppu_values = numpy.unique(rounded_ppu)
         ppu_values = ppu_values[numpy.isfinite(ppu_values)]
         if len(ppu_values):
             presentations.append(
                 {
                     "name": names.get(bnf_code, "{} (unknown)".format(bnf_code)),
-                    "mean_ppu": net_costs.sum() / quantities.sum(),
+                    "mean_ppu": mean_ppus[n],
                     "is_generic": bnf_code[9:11] == "AA",
                     "quantity_at_each_ppu": [
-                        (ppu_value, quantities[rounded_ppu == ppu_value].sum())
+                        (ppu_value, quantities[rounded_ppu == ppu_value, n].sum())
                         for ppu_value in ppu_values
                     ],
                 }
@@ -97,11 +90,8 @@ def get_mean_ppu(prescribing, org_type, org_id):
     price-per-unit achieved by the given org over all included presentations
     """
     group_by_org = get_row_grouper(org_type)
-    total_quantity = 0
-    total_net_cost = 0
-    for quantities, net_costs in prescribing.values():
-        total_quantity += group_by_org.sum_one_group(quantities, org_id)[0]
-        total_net_cost += group_by_org.sum_one_group(net_costs, org_id)[0]
+    total_quantity = group_by_org.sum_one_group(prescribing.quantities, org_id).sum()
+    total_net_cost = group_by_org.sum_one_group(prescribing.net_costs, org_id).sum()
     if total_quantity > 0:
         return total_net_cost / total_quantity
     else:
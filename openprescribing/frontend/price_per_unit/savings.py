@@ -1,10 +1,11 @@
+from collections import namedtuple
+
 import numpy
+import scipy.sparse
 from matrixstore.cachelib import memoize
 from matrixstore.db import get_db, get_row_grouper
-from matrixstore.matrix_ops import get_submatrix, zeros_like
-from matrixstore.sql_functions import MatrixSum
 
-from .substitution_sets import get_substitution_sets
+from .substitution_sets import DictWithCacheID, get_substitution_sets
 
 # Defines how we determine the target PPU against which savings are calculated.
 # We want to know which set of practices we are comparing with and which
@@ -24,21 +25,42 @@ CONFIG_MIN_SAVINGS_FOR_ORG_TYPE = {
     # based on the CCG limit
     "all_standard_practices": 50000 * 100,
 }
+# Maximum number of values we fetch from the MatrixStore in a single stack (see
+# `get_quantities_and_net_costs_at_date`), which bounds the memory used to
+# around 128MB
+MAX_STACK_SIZE = 2**24
+
+# Each entry describes the saving available to one org for one substitution set
+# and `OrgTypeSavings` holds an array for each of the fields listed here, plus:
+#
+#       target_ppus: an array giving the target PPU for every set
+#  prescribing_orgs: a dict mapping the offset of any set for which an org has
+#                    a saving but no quantity to the offsets of the orgs which
+#                    do have some quantity
+#
+ENTRY_FIELDS = {
+    "set_offsets": numpy.int64,
+    "org_offsets": numpy.int64,
+    "quantities": numpy.float64,
+    "net_costs": numpy.float64,
+    "savings": numpy.float64,
+}
+OrgTypeSavings = namedtuple(
+    "OrgTypeSavings", list(ENTRY_FIELDS) + ["target_ppus", "prescribing_orgs"]
+)
 
 
 def get_all_savings_for_orgs(date, org_type, org_ids):
     """
     Get all available savings through presentation switches for the given orgs
     """
-    min_saving = CONFIG_MIN_SAVINGS_FOR_ORG_TYPE[org_type]
-    results = []
-    for generic_code in get_substitution_sets().keys():
-        savings = get_savings_for_orgs(
-            generic_code, date, org_type, org_ids, min_saving=min_saving
-        )
-        results.extend(savings)
-    results.sort(key=lambda i: i["possible_savings"], reverse=True)
-    return results
+    return get_savings_for_sets(
+        get_substitution_sets(),
+        date,
+        org_type,
+        org_ids,
+        min_saving=CONFIG_MIN_SAVINGS_FOR_ORG_TYPE[org_type],
+    )
 
 
 def get_savings_for_orgs(generic_code, date, org_type, org_ids, min_saving=1):
@@ -52,45 +74,69 @@ def get_savings_for_orgs(generic_code, date, org_type, org_ids, min_saving=1):
     # substitutions (to which the answer is always: no savings)
     except KeyError:
         return []
-
-    quantities, net_costs = get_quantities_and_net_costs_at_date(
-        get_db(), substitution_set, date
+    return get_savings_for_sets(
+        DictWithCacheID([(generic_code, substitution_set)]),
+        date,
+        org_type,
+        org_ids,
+        min_saving=min_saving,
     )
 
-    group_by_org = get_row_grouper(org_type)
-    quantities_for_orgs = group_by_org.sum(quantities, org_ids)
-    # Bail early if none of the orgs have any relevant prescribing
-    if not numpy.any(quantities_for_orgs):
-        return []
-    net_costs_for_orgs = group_by_org.sum(net_costs, org_ids)
-    ppu_for_orgs = net_costs_for_orgs / quantities_for_orgs
 
-    target_ppu = get_target_ppu(
-        quantities,
-        net_costs,
-        group_by_org=get_row_grouper(CONFIG_TARGET_PEER_GROUP),
+def get_savings_for_sets(substitution_sets, date, org_type, org_ids, min_saving):
+    """
+    Get available savings for the given orgs within each of the supplied
+    substitution sets, sorted by size of saving
+    """
+    group_by_org = get_row_grouper(org_type)
+    savings = get_savings_for_org_type(
+        db=get_db(),
+        substitution_sets=substitution_sets,
+        date=date,
+        group_by_org=group_by_org,
+        min_saving=min_saving,
+        practice_group_by_org=get_row_grouper(CONFIG_TARGET_PEER_GROUP),
         target_centile=CONFIG_TARGET_CENTILE,
     )
-    practice_savings = get_savings(quantities, net_costs, target_ppu)
-
-    savings_for_orgs = group_by_org.sum(practice_savings, org_ids)
-
-    results = [
-        {
-            "date": date,
-            "org_id": org_id,
-            "price_per_unit": ppu_for_orgs[offset, 0] / 100,
-            "possible_savings": savings_for_orgs[offset, 0] / 100,
-            "quantity": quantities_for_orgs[offset, 0],
-            "lowest_decile": target_ppu[0] / 100,
-            "presentation": substitution_set.id,
-            "formulation_swap": substitution_set.formulation_swaps,
-            "name": substitution_set.name,
-        }
-        for offset, org_id in enumerate(org_ids)
-        if savings_for_orgs[offset, 0] >= min_saving
+    # Maps the offset of each org in `group_by_org` to its position in
+    # `org_ids`, or -1 for orgs we're not interested in
+    org_positions = numpy.full(len(group_by_org.ids), -1)
+    org_offsets = group_by_org.select_groups(
+        numpy.arange(len(group_by_org.ids)), org_ids
+    )
+    org_positions[org_offsets] = numpy.arange(len(org_ids))
+    positions = org_positions[savings.org_offsets]
+    selected = numpy.flatnonzero(positions >= 0)
+    # Order by set and then by position in `org_ids`
+    selected = selected[
+        numpy.lexsort((positions[selected], savings.set_offsets[selected]))
     ]
-
+    substitution_sets = list(substitution_sets.values())
+    results = []
+    for n in selected:
+        set_offset = savings.set_offsets[n]
+        quantity = savings.quantities[n]
+        # We ignore sets for which none of the orgs have any relevant
+        # prescribing, which can only be the case if this org's total quantity
+        # is zero
+        if quantity == 0:
+            prescribing_orgs = savings.prescribing_orgs[set_offset]
+            if not numpy.any(org_positions[prescribing_orgs] >= 0):
+                continue
+        substitution_set = substitution_sets[set_offset]
+        results.append(
+            {
+                "date": date,
+                "org_id": org_ids[positions[n]],
+                "price_per_unit": savings.net_costs[n] / quantity / 100,
+                "possible_savings": savings.savings[n] / 100,
+                "quantity": quantity,
+                "lowest_decile": savings.target_ppus[set_offset] / 100,
+                "presentation": substitution_set.id,
+                "formulation_swap": substitution_set.formulation_swaps,
+                "name": substitution_set.name,
+            }
+        )
     results.sort(key=lambda i: i["possible_savings"], reverse=True)
     return results
 
@@ -133,35 +179,95 @@ def get_total_savings_for_org_type(
 ):
     """
     Return a matrix giving total savings for all orgs of a given type
+    """
+    savings = get_savings_for_org_type(
+        db,
+        substitution_sets,
+        date,
+        group_by_org,
+        min_saving,
+        practice_group_by_org,
+        target_centile,
+    )
+    totals = numpy.zeros((len(group_by_org.ids), 1))
+    # Savings are ordered by set so this adds up each org's savings in the same
+    # order as summing the sets one by one would
+    numpy.add.at(totals[:, 0], savings.org_offsets, savings.savings)
+    return totals
 
-    This duplicates some of the logic in `get_savings_for_orgs` but it gives us
-    much better caching behaviour to calculate savings for all orgs of a given
-    type together in a single, cacheable matrix than it does to do them one by
-    one.
+
+# Increment the version number if the logic of this function changes such that
+# the same inputs no longer produce the same outputs
+@memoize(version=1)
+def get_savings_for_org_type(
+    db,
+    substitution_sets,
+    date,
+    group_by_org,
+    min_saving,
+    practice_group_by_org,
+    target_centile,
+):
+    """
+    Return an `OrgTypeSavings` giving every saving of at least `min_saving`
+    available to any org of a given type, ordered by set and then by org
+
+    It gives us much better caching behaviour to calculate savings for all
+    orgs of a given type together than it does to do them one by one. And
+    rather than querying and grouping the prescribing for each set in turn we
+    work on batches of sets at once, with each set as a column of a (practices
+    x sets) matrix, so that we can calculate the target PPUs and savings for
+    all of them with a few vectorised operations.
 
     Because we want this function to be cacheable it needs to touch no global
     state or configuration and have eveything passed into it, hence the
     slightly convoluted call signature.
     """
-    totals = None
-    for substitution_set in substitution_sets.values():
-        quantities, net_costs = get_quantities_and_net_costs_at_date(
-            db, substitution_set, date
-        )
-        target_ppu = get_target_ppu(
+    entries = {field: [] for field in ENTRY_FIELDS}
+    target_ppus = []
+    prescribing_orgs = {}
+    start = 0
+    for batch, quantities, net_costs in get_quantities_and_net_costs_at_date(
+        db, substitution_sets, date
+    ):
+        batch_target_ppus = get_target_ppu(
             quantities,
             net_costs,
             group_by_org=practice_group_by_org,
             target_centile=target_centile,
         )
-        practice_savings = get_savings(quantities, net_costs, target_ppu)
+        # An org's saving is the sum of its practices' savings (practices which
+        # beat the target don't offset those which don't) so, unlike the
+        # spending API, we can't use prescribing already grouped by org here
+        practice_savings = get_savings(quantities, net_costs, batch_target_ppus)
+        quantities_for_orgs = group_by_org.sum(quantities)
+        net_costs_for_orgs = group_by_org.sum(net_costs)
         savings_for_orgs = group_by_org.sum(practice_savings)
-        savings_above_threshold = savings_for_orgs >= min_saving
-        if totals is None:
-            totals = zeros_like(savings_for_orgs)
-        numpy.add(totals, savings_for_orgs, out=totals, where=savings_above_threshold)
-    assert totals is not None
-    return totals
+        # We transpose so that entries are ordered by set and then by org
+        set_offsets, org_offsets = numpy.nonzero((savings_for_orgs >= min_saving).T)
+        entries["set_offsets"].append(set_offsets + start)
+        entries["org_offsets"].append(org_offsets)
+        entries["quantities"].append(quantities_for_orgs[org_offsets, set_offsets])
+        entries["net_costs"].append(net_costs_for_orgs[org_offsets, set_offsets])
+        entries["savings"].append(savings_for_orgs[org_offsets, set_offsets])
+        target_ppus.append(batch_target_ppus)
+        # Orgs can have savings without having any quantity (e.g. where
+        # positive and negative quantities cancel out) so for these sets we
+        # record which orgs do have some quantity
+        zero_quantity = quantities_for_orgs[org_offsets, set_offsets] == 0
+        for set_offset in numpy.unique(set_offsets[zero_quantity]):
+            prescribing_orgs[set_offset + start] = numpy.flatnonzero(
+                quantities_for_orgs[:, set_offset]
+            )
+        start += len(batch)
+    return OrgTypeSavings(
+        target_ppus=concatenate(target_ppus, numpy.float64),
+        prescribing_orgs=prescribing_orgs,
+        **{
+            field: concatenate(values, ENTRY_FIELDS[field])
+            for field, values in entries.items()
+        },
+    )
 
 
 def get_target_ppu(quantities, net_costs, group_by_org, target_centile):
@@ -172,10 +278,39 @@ def get_target_ppu(quantities, net_costs, group_by_org, target_centile):
     quantities = group_by_org.sum(quantities)
     net_costs = group_by_org.sum(net_costs)
     ppu = net_costs / quantities
-    target_ppu = numpy.nanpercentile(ppu, axis=0, q=target_centile)
+    target_ppu = nanpercentile_by_column(ppu, target_centile)
     return target_ppu
 
 
+def nanpercentile_by_column(matrix, q):
+    """
+    Return exactly the same result as `numpy.nanpercentile(matrix, q=q, axis=0)`
+
+    numpy handles each column separately in a Python loop, which is slow when
+    we have a column for every substitution set. Instead we sort all the columns
+    at once (which moves the NaNs to the end of each column) and interpolate
+    between the relevant values using the same arithmetic as numpy's default
+    "linear" method.
+    """
+    matrix = numpy.sort(matrix, axis=0)
+    counts = numpy.count_nonzero(~numpy.isnan(matrix), axis=0)
+    last_indexes = numpy.maximum(counts - 1, 0)
+    virtual_indexes = (counts - 1) * (q / 100)
+    lower_indexes = numpy.floor(virtual_indexes).astype(numpy.intp)
+    gamma = virtual_indexes - lower_indexes
+    lower_indexes = numpy.clip(lower_indexes, 0, last_indexes)
+    upper_indexes = numpy.minimum(lower_indexes + 1, last_indexes)
+    columns = numpy.arange(matrix.shape[1])
+    lower = matrix[lower_indexes, columns]
+    upper = matrix[upper_indexes, columns]
+    diff = upper - lower
+    result = lower + diff * gamma
+    numpy.subtract(upper, diff * (1 - gamma), out=result, where=gamma >= 0.5)
+    # Columns which are all NaN have no percentile
+    result[counts == 0] = numpy.nan
+    return result
+
+
 def get_savings(quantities, net_costs, target_ppu):
     """
     For a given target price-per-unit calculate how much would be saved by each
@@ -189,35 +324,86 @@ def get_savings(quantities, net_costs, target_ppu):
     return savings
 
 
-# Increment the version number if the logic of this function changes such that
-# the same inputs no longer produce the same outputs
-@memoize(version=1)
-def get_quantities_and_net_costs_at_date(db, substitution_set, date):
-    """
-    Sum quantities and net costs over the supplied list of BNF codes for just
-    the specified date.
-    """
-    bnf_codes = substitution_set.presentations
-    date_column = db.date_offsets[date]
-    date_slice = slice(date_column, date_column + 1)
-
-    results = db.query(
-        """
-        SELECT
-          quantity, net_cost
-        FROM
-          presentation
-        WHERE
-          bnf_code IN ({})
-        """.format(
-            ",".join("?" * len(bnf_codes))
-        ),
-        bnf_codes,
+def get_quantities_and_net_costs_at_date(db, substitution_sets, date):
+    """
+    Yield triples of: a list of substitution sets; and a pair of matrices of
+    shape (practices, sets) giving, for each set, the total quantity and net
+    cost of its presentations on the specified date
+
+    The sets are yielded in batches so that the prescribing we hold in memory
+    at once is bounded, but each batch is read with a single query per column
+    and summed into its sets with a single sparse matrix product.
+    """
+    offset = db.date_offsets[date]
+    date_slice = slice(offset, offset + 1)
+    batch_size = max(1, MAX_STACK_SIZE // len(db.practices))
+    for batch in get_batches(substitution_sets.values(), batch_size):
+        bnf_codes = sorted(
+            {
+                code
+                for substitution_set in batch
+                for code in substitution_set.presentations
+            }
+        )
+        # Each stack has shape (presentations, practices, 1)
+        quantity_codes, quantities = db.fetch_stack("quantity", bnf_codes, date_slice)
+        net_cost_codes, net_costs = db.fetch_stack("net_cost", bnf_codes, date_slice)
+        yield (
+            batch,
+            sum_by_set(batch, quantity_codes, quantities[:, :, 0]),
+            sum_by_set(batch, net_cost_codes, net_costs[:, :, 0]),
+        )
+
+
+def get_batches(substitution_sets, batch_size):
+    """
+    Split the supplied substitution sets into lists containing no more than
+    `batch_size` presentations in total (except where a single set is larger
+    than this)
+    """
+    batch = []
+    num_presentations = 0
+    for substitution_set in substitution_sets:
+        size = len(substitution_set.presentations)
+        if batch and num_presentations + size > batch_size:
+            yield batch
+            batch = []
+            num_presentations = 0
+        batch.append(substitution_set)
+        num_presentations += size
+    if batch:
+        yield batch
+
+
+def sum_by_set(substitution_sets, bnf_codes, matrix):
+    """
+    Given a matrix of shape (presentations, practices), where each row
+    corresponds to one of `bnf_codes`, return a matrix of shape (practices,
+    sets) giving the total for each practice over the presentations in each of
+    the supplied substitution sets
+
+    We sum each set's rows in BNF code order so that the totals are exactly the
+    same as summing the prescribing for each set separately.
+    """
+    code_offsets = {bnf_code: n for n, bnf_code in enumerate(bnf_codes)}
+    set_codes = [
+        sorted(
+            code_offsets[code]
+            for code in substitution_set.presentations
+            if code in code_offsets
+        )
+        for substitution_set in substitution_sets
+    ]
+    indices = numpy.array([n for codes in set_codes for n in codes], dtype=numpy.int64)
+    indptr = numpy.cumsum([0] + [len(codes) for codes in set_codes], dtype=numpy.int64)
+    membership = scipy.sparse.csr_matrix(
+        (numpy.ones(len(indices), dtype=matrix.dtype), indices, indptr),
+        shape=(len(substitution_sets), len(bnf_codes)),
     )
+    return numpy.ascontiguousarray((membership @ matrix).T)
+
 
-    quantity_sum = MatrixSum()
-    net_cost_sum = MatrixSum()
-    for quantity, net_cost in results:
-        quantity_sum.add(get_submatrix(quantity, cols=date_slice))
-        net_cost_sum.add(get_submatrix(net_cost, cols=date_slice))
-    return quantity_sum.value(), net_cost_sum.value()
+def concatenate(arrays, dtype):
+    if not arrays:
+        return numpy.array([], dtype=dtype)
+    return numpy.concatenate(arrays).astype(dtype, copy=False)
@@ -20,10 +20,9 @@ import hashlib
 import os.path
 import re
 from collections import defaultdict
-from functools import lru_cache
 
 from frontend.models import Presentation
-from matrixstore.db import get_db
+from matrixstore.db import get_db, memoize_per_db
 
 
 # This would be a good candidate for a dataclass when we move to Python 3.7
@@ -71,12 +70,6 @@ class DictWithCacheID(dict):
         return instance
 
 
-# Create a memoize decorator (i.e. a decorator which caches the return value
-# for a given set of arguments). Here `maxsize=None` means "don't apply any
-# cache eviction, just keep values for ever"
-memoize = lru_cache(maxsize=None)
-
-
 # The below file defines groups of generics of different formulations which we
 # believe can be substituted for each other (e.g tramadol tablets and
 # capsules). The canonical version is maintained as a Google Sheet:
@@ -139,13 +132,13 @@ GENERIC_CHEMICALS = {
 }
 
 
-@memoize
+@memoize_per_db
 def get_substitution_sets():
     bnf_codes = [row[0] for row in get_db().query("SELECT bnf_code FROM presentation")]
     return get_substitution_sets_from_bnf_codes(bnf_codes, FORMULATION_SWAPS_FILE)
 
 
-@memoize
+@memoize_per_db
 def get_substitution_sets_by_presentation():
     """
     Build a mapping of all substitutable presentations to the substitution set
@@ -1,6 +1,8 @@
 from __future__ import print_function
 
 import csv
+import datetime
+import io
 import itertools
 import json
 import os
@@ -13,12 +15,15 @@ import numpy as np
 import pandas as pd
 from django.conf import settings
 from django.core.management import call_command
-from django.test import TestCase, override_settings
+from django.test import SimpleTestCase, TestCase, override_settings
 from frontend import bq_schemas as schemas
 from frontend.management.commands.import_measures import (
+    CSVRowStream,
+    MatrixStoreMeasureCalculation,
     build_bnf_codes_query,
     load_measure_defs,
 )
+from frontend.measure_calculation import CENTILES
 from frontend.models import (
     PCN,
     PCT,
@@ -445,6 +450,171 @@ class BuildMeasureSQLTests(TestCase):
         self.assertEqual(build_bnf_codes_query(base_query, None), base_query)
 
 
+class WriteToDatabaseTests(TestCase):
+    def test_write_ratios_and_global_centiles(self):
+        measure = Measure.objects.create(
+            id="test", tags=[], is_cost_based=False, is_percentage=True
+        )
+        PCT.objects.create(code="C01", org_type="CCG")
+        october = datetime.date(2018, 10, 1)
+        november = datetime.date(2018, 11, 1)
+        MeasureGlobal.objects.create(
+            measure=measure, month=october, numerator=1, denominator=1
+        )
+
+        calculation = MatrixStoreMeasureCalculation(measure)
+        calculation.tables = {
+            "ccg": [
+                {
+                    "pct_id": "C01",
+                    "stp_id": None,
+                    "regional_team_id": None,
+                    "month": october,
+                    "numerator": 1.0,
+                    "denominator": 4.0,
+                    "calc_value": 0.25,
+                    "percentile": 0.5,
+                }
+            ],
+            "global": [
+                dict(
+                    {
+                        "{}_{}th".format(org_type, centile): centile / 100
+                        for org_type in ["practice", "pcn", "ccg", "stp", "regtm"]
+                        for centile in CENTILES
+                    },
+                    month=month,
+                    numerator=1.0,
+                    denominator=4.0,
+                )
+                for month in [october, november]
+            ],
+        }
+        calculation.write_ratios_to_database("ccg")
+        calculation.write_global_centiles_to_database()
+
+        mv = MeasureValue.objects.get(measure=measure)
+        self.assertEqual(mv.pct_id, "C01")
+        self.assertEqual(mv.month, october)
+        self.assertEqual(mv.calc_value, 0.25)
+        self.assertEqual(mv.percentile, 50.0)
+        self.assertIsNone(mv.cost_savings)
+
+        mgs = MeasureGlobal.objects.filter(measure=measure).order_by("month")
+        self.assertEqual([mg.month for mg in mgs], [october, november])
+        for mg in mgs:
+            self.assertEqual(mg.numerator, 1.0)
+            self.assertEqual(mg.denominator, 4.0)
+            self.assertEqual(mg.calc_value, 0.25)
+            self.assertEqual(mg.percentiles["ccg"]["50"], 0.5)
+            self.assertIsNone(mg.cost_savings)
+
+
+class CSVRowStreamTests(SimpleTestCase):
+    def test_read(self):
+        rows = [{"a": i, "b": "x,{}".format(i)} for i in range(100)]
+        expected = io.StringIO()
+        csv.DictWriter(expected, fieldnames=["a", "b"]).writerows(rows)
+
+        stream = CSVRowStream(rows, ["a", "b"])
+        chunks = []
+        while True:
+            chunk = stream.read(10)
+            if not chunk:
+                break
+            self.assertLessEqual(len(chunk), 10)
+            chunks.append(chunk)
+
+        self.assertEqual("".join(chunks), expected.getvalue())
+        self.assertEqual(stream.row_count, 100)
+
+    def test_read_all(self):
+        # None is written as an empty field, which COPY reads as NULL
+        stream = CSVRowStream([{"a": 1, "b": None}, {"a": 2, "b": 3.5}], ["a", "b"])
+        self.assertEqual(stream.read(), "1,\r\n2,3.5\r\n")
+        self.assertEqual(stream.read(), "")
+
+
+class ImportMeasuresIncrementalTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        ImportLog.objects.create(category="prescribing", current_at="2018-11-01")
+        ccg = PCT.objects.create(code="C01", org_type="CCG")
+        factory = DataFactory()
+        months = factory.create_months("2018-09-01", 3)
+        practices = factory.create_practices(2)
+        for practice in practices:
+            Practice.objects.create(code=practice["code"], ccg=ccg, setting=4)
+        presentations = [
+            factory.create_presentation(bnf_code)
+            for bnf_code in ["0703021Q0AAAAAA", "0703021Q0BBAAAA"]
+        ]
+        factory.create_prescribing(presentations, practices, months)
+        cls.factory = factory
+        cls.practice_code = practices[0]["code"]
+
+    def import_measures(self, **options):
+        with patched_global_matrixstore_from_data_factory(self.factory):
+            call_command(
+                "import_measures",
+                measure="desogestrel",
+                engine="matrixstore",
+                incremental=True,
+                **options
+            )
+
+    def get_numerators(self):
+        return {
+            str(mv.month): mv.numerator
+            for mv in MeasureValue.objects.filter(practice_id=self.practice_code)
+        }
+
+    def test_incremental(self):
+        # With no values calculated so far, we calculate all of them
+        self.import_measures(trailing_months=0)
+        numerators = self.get_numerators()
+        self.assertEqual(sorted(numerators), ["2018-09-01", "2018-10-01", "2018-11-01"])
+        self.assertEqual(MeasureGlobal.objects.count(), 3)
+
+        # Now only the latest month, and the one before, are recalculated
+        MeasureValue.objects.filter(practice_id=self.practice_code).update(numerator=-1)
+        self.import_measures(trailing_months=1)
+        self.assertEqual(
+            self.get_numerators(),
+            {
+                "2018-09-01": -1,
+                "2018-10-01": numerators["2018-10-01"],
+                "2018-11-01": numerators["2018-11-01"],
+            },
+        )
+        self.assertEqual(MeasureGlobal.objects.count(), 3)
+
+        # But if the definition changes then we recalculate everything
+        Measure.objects.update(definition_hash="0" * 64)
+        self.import_measures(trailing_months=1)
+        self.assertEqual(self.get_numerators(), numerators)
+
+    def test_incremental_after_missed_months(self):
+        self.import_measures(trailing_months=0)
+        numerators = self.get_numerators()
+
+        # If values are missing for more than the trailing months, we calculate
+        # everything from the month after the latest value we have
+        MeasureValue.objects.filter(month__gt="2018-09-01").delete()
+        MeasureGlobal.objects.filter(month__gt="2018-09-01").delete()
+        MeasureValue.objects.filter(practice_id=self.practice_code).update(numerator=-1)
+        self.import_measures(trailing_months=0)
+        self.assertEqual(
+            self.get_numerators(),
+            {
+                "2018-09-01": -1,
+                "2018-10-01": numerators["2018-10-01"],
+                "2018-11-01": numerators["2018-11-01"],
+            },
+        )
+        self.assertEqual(MeasureGlobal.objects.count(), 3)
+
+
 class ImportMeasuresDefinitionsOnlyTests(TestCase):
     @classmethod
     def setUpTestData(cls):
@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
+import os
 import re
 import unittest
 
 from common.alert_utils import BatchedEmailErrors
+from django.conf import settings
 from django.core import mail
 from django.core.management import call_command
 from django.core.management.base import CommandError
@@ -17,6 +19,10 @@ from mock import MagicMock, patch
 
 CMD_NAME = "send_monthly_alerts"
 
+TEST_IMAGE_PATH = os.path.join(
+    settings.APPS_ROOT, "frontend", "tests", "fixtures", "alert-email-image.png"
+)
+
 
 class ValidateOptionsTestCase(unittest.TestCase):
     def _defaultOpts(self, **extra):
@@ -118,7 +124,7 @@ class GetBookmarksTestCase(TestCase):
 
 
 @patch("frontend.views.bookmark_utils.InterestingMeasureFinder")
-@patch("frontend.views.bookmark_utils.attach_image")
+@patch("frontend.views.bookmark_utils.get_chart_image", return_value=TEST_IMAGE_PATH)
 class FailingEmailTestCase(TestCase):
     """Exercise the error batching mechanism that allowed a maximum number
     of errors before failing the batch.
@@ -127,8 +133,8 @@ class FailingEmailTestCase(TestCase):
 
     fixtures = ["bookmark_alerts", "measures", "importlog"]
 
-    def test_successful_sends(self, attach_image, finder):
-        attach_image.side_effect = [Exception, None, None]
+    def test_successful_sends(self, get_chart_image, finder):
+        get_chart_image.side_effect = [Exception, TEST_IMAGE_PATH, TEST_IMAGE_PATH]
         measure = MagicMock()
         measure.id = "measureid"
         test_context = _makeContext(worst=[measure])
@@ -139,9 +145,9 @@ class FailingEmailTestCase(TestCase):
         self.assertEqual(len(mail.outbox), 2)
 
     def test_bad_alert_image_error_not_sent_and_exits_with_error(
-        self, attach_image, finder
+        self, get_chart_image, finder
     ):
-        attach_image.side_effect = BadAlertImageError
+        get_chart_image.side_effect = BadAlertImageError
         measure = MagicMock()
         measure.id = "measureid"
         test_context = _makeContext(worst=[measure])
@@ -150,8 +156,8 @@ class FailingEmailTestCase(TestCase):
         self.assertNotEqual(exc.exception.code, 0)
         self.assertEqual(len(mail.outbox), 0)
 
-    def test_max_errors(self, attach_image, finder):
-        attach_image.side_effect = [Exception, None, None]
+    def test_max_errors(self, get_chart_image, finder):
+        get_chart_image.side_effect = [Exception, TEST_IMAGE_PATH, TEST_IMAGE_PATH]
         measure = MagicMock()
         measure.id = "measureid"
         test_context = _makeContext(worst=[measure])
@@ -163,11 +169,11 @@ class FailingEmailTestCase(TestCase):
 
 
 @patch("frontend.views.bookmark_utils.InterestingMeasureFinder")
-@patch("frontend.views.bookmark_utils.attach_image")
+@patch("frontend.views.bookmark_utils.get_chart_image", return_value=TEST_IMAGE_PATH)
 class OrgEmailTestCase(TestCase):
     fixtures = ["bookmark_alerts", "measures", "importlog"]
 
-    def test_email_recipient(self, attach_image, finder):
+    def test_email_recipient(self, get_chart_image, finder):
         test_context = _makeContext()
         self.assertEqual(EmailMessage.objects.count(), 1)  # a text fixture
         call_mocked_command_with_defaults(test_context, finder)
@@ -177,14 +183,21 @@ class OrgEmailTestCase(TestCase):
         self.assertEqual(mail.outbox[-1].to, email_message.to)
         self.assertEqual(mail.outbox[-1].to, ["s@s.com"])
 
-    def test_email_all_recipients(self, attach_image, finder):
+    def test_email_all_recipients(self, get_chart_image, finder):
         test_context = _makeContext()
         self.assertEqual(EmailMessage.objects.count(), 1)
         call_mocked_command(test_context, finder)
         self.assertEqual(EmailMessage.objects.count(), 4)
         self.assertEqual(len(mail.outbox), 3)
 
-    def test_email_body_no_data(self, attach_image, finder):
+    def test_stats_calculated_once_per_org(self, get_chart_image, finder):
+        test_context = _makeContext()
+        call_mocked_command(test_context, finder)
+        # Two of the three bookmarks are for the same practice
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(finder.return_value.context_for_org_email.call_count, 2)
+
+    def test_email_body_no_data(self, get_chart_image, finder):
         test_context = _makeContext()
         call_mocked_command_with_defaults(test_context, finder)
         message = mail.outbox[-1].alternatives[0]
@@ -195,7 +208,7 @@ class OrgEmailTestCase(TestCase):
         self.assertIn("/bookmarks/dummykey/", html)
         self.assertIn("We've no new information", html)
 
-    def test_email_headers(self, attach_image, finder):
+    def test_email_headers(self, get_chart_image, finder):
         test_context = _makeContext()
         call_mocked_command_with_defaults(test_context, finder)
         message = mail.outbox[-1]
@@ -204,13 +217,13 @@ class OrgEmailTestCase(TestCase):
             "<http://localhost/bookmarks/dummykey/>",
         )
 
-    def test_email_body_text(self, attach_image, finder):
+    def test_email_body_text(self, get_chart_image, finder):
         test_context = _makeContext()
         call_mocked_command_with_defaults(test_context, finder)
         message = mail.outbox[-1].body
         self.assertIn("**Hello!**", message)
 
-    def test_email_body_has_ga_tracking(self, attach_image, finder):
+    def test_email_body_has_ga_tracking(self, get_chart_image, finder):
         measure = Measure.objects.get(pk="cerazette")
         call_mocked_command_with_defaults(
             _makeContext(declines=[{"measure": measure, "from": 99.92, "to": 0.12}]),
@@ -220,8 +233,7 @@ class OrgEmailTestCase(TestCase):
         html = message[0]
         self.assertRegex(html, '<a href=".*&utm_content=.*#cerazette".*>')
 
-    def test_email_body_declines(self, attach_image, finder):
-        attach_image.return_value = "unique-image-id"
+    def test_email_body_declines(self, get_chart_image, finder):
         measure = Measure.objects.get(pk="cerazette")
         call_mocked_command_with_defaults(
             _makeContext(declines=[{"measure": measure, "from": 99.92, "to": 0.12}]),
@@ -237,11 +249,11 @@ class OrgEmailTestCase(TestCase):
             "Cerazette vs. Desogestrel</a>",
         )
         self.assertIn('<span class="worse"', html)
-        self.assertIn('<img src="cid:unique-image-id', html)
+        self.assertIn('<img src="cid:{}'.format(get_image_cid()), html)
         self.assertNotIn("Your best prescribing areas", html)
         self.assertNotIn("Cost savings", html)
 
-    def test_email_body_two_declines(self, attach_image, finder):
+    def test_email_body_two_declines(self, get_chart_image, finder):
         measure = Measure.objects.get(pk="cerazette")
         call_mocked_command_with_defaults(
             _makeContext(
@@ -256,7 +268,7 @@ class OrgEmailTestCase(TestCase):
         html = message[0]
         self.assertRegex(html, "It also slipped considerably")
 
-    def test_email_body_three_declines(self, attach_image, finder):
+    def test_email_body_three_declines(self, get_chart_image, finder):
         measure = Measure.objects.get(pk="cerazette")
         call_mocked_command_with_defaults(
             _makeContext(
@@ -278,9 +290,8 @@ class OrgEmailTestCase(TestCase):
             ),
         )
 
-    def test_email_body_worst(self, attach_image, finder):
+    def test_email_body_worst(self, get_chart_image, finder):
         measure = Measure.objects.get(pk="cerazette")
-        attach_image.return_value = "unique-image-id"
         call_mocked_command_with_defaults(_makeContext(worst=[measure]), finder)
         message = mail.outbox[-1].alternatives[0]
         html = message[0]
@@ -294,9 +305,9 @@ class OrgEmailTestCase(TestCase):
                 re.DOTALL,
             ),
         )
-        self.assertIn('<img src="cid:unique-image-id', html)
+        self.assertIn('<img src="cid:{}'.format(get_image_cid()), html)
 
-    def test_email_body_three_worst(self, attach_image, finder):
+    def test_email_body_three_worst(self, get_chart_image, finder):
         measure = Measure.objects.get(pk="cerazette")
         call_mocked_command_with_defaults(
             _makeContext(worst=[measure, measure, measure]), finder
@@ -311,7 +322,7 @@ class OrgEmailTestCase(TestCase):
             ),
         )
 
-    def test_email_body_two_savings(self, attach_image, finder):
+    def test_email_body_two_savings(self, get_chart_image, finder):
         measure = Measure.objects.get(pk="cerazette")
         call_mocked_command_with_defaults(
             _makeContext(possible_savings=[(measure, 9.9), (measure, 1.12)]), finder
@@ -326,7 +337,7 @@ class OrgEmailTestCase(TestCase):
             "Cerazette vs. Desogestrel</a>",
         )
 
-    def test_email_body_one_saving(self, attach_image, finder):
+    def test_email_body_one_saving(self, get_chart_image, finder):
         measure = Measure.objects.get(pk="cerazette")
         call_mocked_command_with_defaults(
             _makeContext(possible_savings=[(measure, 9.9)]), finder
@@ -341,7 +352,7 @@ class OrgEmailTestCase(TestCase):
             "Cerazette vs. Desogestrel</a>",
         )
 
-    def test_email_body_achieved_saving(self, attach_image, finder):
+    def test_email_body_achieved_saving(self, get_chart_image, finder):
         measure = Measure.objects.get(pk="cerazette")
         call_mocked_command_with_defaults(
             _makeContext(achieved_savings=[(measure, 9.9)]), finder
@@ -350,7 +361,7 @@ class OrgEmailTestCase(TestCase):
         html = message[0]
         self.assertIn("this practice saved around <b>£10", html)
 
-    def test_email_body_two_achieved_savings(self, attach_image, finder):
+    def test_email_body_two_achieved_savings(self, get_chart_image, finder):
         measure = Measure.objects.get(pk="cerazette")
         call_mocked_command_with_defaults(
             _makeContext(achieved_savings=[(measure, 9.9), (measure, 12.0)]), finder
@@ -360,7 +371,7 @@ class OrgEmailTestCase(TestCase):
         self.assertIn("<li>\n<b>£10</b> on", html)
         self.assertIn("<li>\n<b>£10</b> on", html)
 
-    def test_email_body_total_savings(self, attach_image, finder):
+    def test_email_body_total_savings(self, get_chart_image, finder):
         call_mocked_command_with_defaults(
             _makeContext(possible_top_savings_total=9000.1), finder
         )
@@ -500,6 +511,11 @@ class STPAlertTestCase(ApiTestBase):
         self.assertIn("ICB", mail.outbox[0].body)
 
 
+def get_image_cid():
+    attachment = mail.outbox[-1].attachments[0]
+    return attachment["Content-ID"].strip("<>")
+
+
 def call_mocked_command(context, mock_finder, **opts):
     mock_finder.return_value.context_for_org_email.return_value = context
     call_command(CMD_NAME, **opts)
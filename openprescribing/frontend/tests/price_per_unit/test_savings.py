@@ -1,15 +1,19 @@
 import json
 import warnings
 from collections import defaultdict
+from unittest.mock import patch
 
 import numpy
 from django.core.cache import CacheKeyWarning
-from django.test import TestCase, override_settings
+from django.test import SimpleTestCase, TestCase, override_settings
 from frontend.models import PCT, Practice, Presentation
+from frontend.price_per_unit import savings
 from frontend.price_per_unit.savings import (
     CONFIG_MIN_SAVINGS_FOR_ORG_TYPE,
     CONFIG_TARGET_CENTILE,
+    get_all_savings_for_orgs,
     get_total_savings_for_org,
+    nanpercentile_by_column,
 )
 from frontend.price_per_unit.substitution_sets import get_substitution_sets
 from matrixstore.tests.data_factory import DataFactory
@@ -171,12 +175,53 @@ class PricePerUnitSavingsTest(TestCase):
 
         self.assertEqual(round_floats(result), round_floats(expected))
 
+    def test_savings_are_identical_however_sets_are_batched(self):
+        date = self.factory.months[0][:10]
+        practice = self.factory.practices[0]
+        results = get_all_savings_for_orgs(date, "practice", [practice["code"]])
+        total = get_total_savings_for_org(date, "practice", practice["code"])
+        # Force each set into a batch of its own
+        with patch.object(savings, "MAX_STACK_SIZE", 1):
+            batched_results = get_all_savings_for_orgs(
+                date, "practice", [practice["code"]]
+            )
+            batched_total = get_total_savings_for_org(
+                date, "practice", practice["code"]
+            )
+        self.assertTrue(results)
+        self.assertEqual(batched_results, results)
+        self.assertEqual(batched_total, total)
+
     @classmethod
     def tearDownClass(cls):
         cls._remove_patch()
         super().tearDownClass()
 
 
+class NanpercentileByColumnTest(SimpleTestCase):
+    def test_matches_numpy(self):
+        rng = numpy.random.default_rng(0)
+        matrix = rng.lognormal(size=(200, 50))
+        matrix[rng.random(matrix.shape) < rng.random(50)] = numpy.nan
+        # Include some awkward columns: all NaN, a single value, infinities
+        # and repeated values
+        matrix[:, 0] = numpy.nan
+        matrix[:, 1] = numpy.nan
+        matrix[5, 1] = 2.5
+        matrix[7, 2] = numpy.inf
+        matrix[:, 3] = numpy.nan
+        matrix[:2, 3] = numpy.inf
+        matrix[10:20, 4] = 0.5
+        for q in [0, 10, 37.5, 50, 100]:
+            with warnings.catch_warnings():
+                # numpy warns about the all-NaN column
+                warnings.simplefilter("ignore", RuntimeWarning)
+                expected = numpy.nanpercentile(matrix, q=q, axis=0)
+            result = nanpercentile_by_column(matrix, q)
+            # We need exactly the same values, not just approximately the same
+            numpy.testing.assert_array_equal(result, expected)
+
+
 def invent_generic_bnf_code(index):
     assert 0 <= index <= 9
     chemical = "0601022B{}".format(index)
@@ -1,17 +1,21 @@
 import base64
 import os
 import re
+import shutil
 import socket
+import tempfile
 import unittest
 from datetime import datetime
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from threading import Thread
 
+import numpy as np
 import requests
 from dateutil.relativedelta import relativedelta
 from django.conf import settings
 from django.core.mail import EmailMultiAlternatives
 from django.test import SimpleTestCase, TestCase
+from frontend.chart_images import ChartImageCache
 from frontend.models import (
     PCT,
     ImportLog,
@@ -22,6 +26,7 @@ from frontend.models import (
 )
 from frontend.templatetags.template_extras import deltawords
 from frontend.tests.data_factory import DataFactory
+from frontend.tests.test_chart_images import FakeRenderer
 from frontend.views import bookmark_utils
 from frontend.views.spending_utils import ncso_spending_for_entity
 from matrixstore.tests.decorators import copy_fixtures_to_matrixstore
@@ -209,6 +214,27 @@ class TestCUSUM(unittest.TestCase):
             else:
                 self.assertEqual(test["deltawords"], "not at all")
 
+    def test_batch_matches_cusum(self):
+        with open(
+            settings.APPS_ROOT + "/frontend/tests/fixtures/" "alert_test_cases.txt"
+        ) as expected:
+            test_cases = expected.readlines()
+        data = [test["data"] for test in each_cusum_test(test_cases)]
+        # Run the cases in groups of the same length, as the batch needs a
+        # 2D array
+        lengths = sorted(set(len(row) for row in data))
+        for length in lengths:
+            rows = [row for row in data if len(row) == length]
+            batch = bookmark_utils.get_last_cusum_alerts(
+                [[np.nan if x is None else x for x in row] for row in rows],
+                window_size=3,
+                sensitivity=5,
+            )
+            for row, info in zip(rows, batch):
+                cusum = bookmark_utils.CUSUM(row, window_size=3, sensitivity=5)
+                cusum.work()
+                self.assertEqual(info, cusum.get_last_alert_info(), row)
+
 
 class TestBookmarkUtilsPerforming(TestCase):
     fixtures = ["bookmark_alerts", "measurevalues_with_performance", "importlog"]
@@ -358,6 +384,49 @@ class TestBookmarkUtilsChanging(TestCase):
         self.assertAlmostEqual(measure_info["from"], 21)  # start
         self.assertAlmostEqual(measure_info["to"], 7)  # end
 
+    def test_org_email_contexts_match_finder(self):
+        practices = [
+            self.practice_with_high_change,
+            self.practice_with_high_neg_change,
+            self.practice_with_low_change,
+        ]
+        contexts = bookmark_utils.get_org_email_contexts(
+            practices + [self.practice_with_high_change.ccg], batch_size=2
+        )
+        self.assertEqual(len(contexts), 4)
+        for org, context in contexts.items():
+            finder = bookmark_utils.InterestingMeasureFinder(org)
+            self.assertEqual(context, finder.context_for_org_email())
+
+    def test_org_email_contexts_skips_failed_batches(self):
+        practices = [
+            self.practice_with_high_change,
+            self.practice_with_high_neg_change,
+            self.practice_with_low_change,
+        ]
+        get_measure_values_for_orgs = bookmark_utils.get_measure_values_for_orgs
+
+        def fail_for_first_batch(batch, since):
+            if self.practice_with_high_change in batch:
+                raise ValueError("Bad measure values")
+            return get_measure_values_for_orgs(batch, since)
+
+        with patch(
+            "frontend.views.bookmark_utils.get_measure_values_for_orgs",
+            side_effect=fail_for_first_batch,
+        ):
+            with self.assertLogs("frontend.views.bookmark_utils", "ERROR"):
+                contexts = bookmark_utils.get_org_email_contexts(
+                    practices, batch_size=1
+                )
+        self.assertEqual(
+            set(contexts),
+            {self.practice_with_high_neg_change, self.practice_with_low_change},
+        )
+
+    def test_org_email_contexts_for_no_orgs(self):
+        self.assertEqual(bookmark_utils.get_org_email_contexts([]), {})
+
 
 def _makeCostSavingMeasureValues(measure, practice, savings):
     """Create measurevalues for the given practice and measure with
@@ -514,12 +583,13 @@ class GenerateImageTestCase(unittest.TestCase):
             if e.errno != errno.ENOENT:
                 raise
 
-    @patch("subprocess.run")
-    def test_empty_image_raises(self, run):
-        run.return_value.returncode = 0
-        with open(self.file_path, "a"):
-            # create an empty file
-            os.utime(self.file_path, None)
+    @patch("frontend.views.bookmark_utils.get_chart_image_cache")
+    def test_empty_image_raises(self, get_chart_image_cache):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        get_chart_image_cache.return_value = ChartImageCache(
+            FakeRenderer(content=b""), cache_dir
+        )
         with self.assertRaises(bookmark_utils.BadAlertImageError):
             bookmark_utils.attach_image(
                 self.msg, self.url, self.file_path, self.selector
@@ -568,6 +638,40 @@ class GenerateImageTestCase(unittest.TestCase):
             )
 
 
+class UrlRenderer(object):
+    """Renders each "image" as the URL it was rendered from"""
+
+    def render(self, url, path, selector, dimensions, wait):
+        with open(path, "wb") as f:
+            f.write(url.encode("utf8"))
+
+
+class AttachImagesTestCase(SimpleTestCase):
+    @patch("frontend.views.bookmark_utils.get_data_version")
+    @patch("frontend.views.bookmark_utils.get_chart_image_cache")
+    def test_images_attached_in_order(self, get_chart_image_cache, get_data_version):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        get_chart_image_cache.return_value = ChartImageCache(UrlRenderer(), cache_dir)
+        msg = EmailMultiAlternatives(
+            "Subject", "body", "sender@email.com", ["recipient@email.com"]
+        )
+        urls = ["/practice/P1/", "/practice/P2/", "/practice/P3/"]
+        content_ids = bookmark_utils.attach_images(
+            msg, [(url, "#chart") for url in urls], "v1"
+        )
+        self.assertEqual(
+            [base64.b64decode(a.get_payload()).decode("utf8") for a in msg.attachments],
+            [settings.GRAB_HOST + url for url in urls],
+        )
+        self.assertEqual(
+            content_ids, [a["Content-ID"].strip("<>") for a in msg.attachments]
+        )
+        # The data version is supplied by the caller rather than being looked
+        # up in each thread
+        get_data_version.assert_not_called()
+
+
 class UnescapeTestCase(unittest.TestCase):
     def test_no_url(self):
         example = "Foo bar"
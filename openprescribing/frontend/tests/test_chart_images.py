@@ -0,0 +1,188 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.test import SimpleTestCase
+from frontend.chart_images import ChartImageCache, ChartRenderError, RendererPool
+
+# Speaks the same protocol as grab_chart.js, but rather than rendering
+# anything it writes its process ID to the requested path, or misbehaves in the
+# way described by the URL
+FAKE_RENDERER = """
+import json, os, sys, time
+
+for line in sys.stdin:
+    request = json.loads(line)
+    if request["url"] == "crash":
+        sys.exit(1)
+    if request["url"] == "hang":
+        time.sleep(60)
+    error = None
+    if request["url"] == "error":
+        error = "Unable to load the address"
+    else:
+        with open(request["path"], "w") as f:
+            f.write(str(os.getpid()))
+    print(json.dumps({"error": error}), flush=True)
+"""
+
+
+class RendererPoolTests(SimpleTestCase):
+    def setUp(self):
+        self.pool = RendererPool(
+            2, command=[sys.executable, "-c", FAKE_RENDERER], timeout=5
+        )
+        self.addCleanup(self.pool.close)
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.path = os.path.join(tmp_dir, "image.png")
+
+    def render(self, url):
+        self.pool.render(url, self.path, "#chart", "800x600", 1000)
+        with open(self.path) as f:
+            return f.read()
+
+    def test_process_reused(self):
+        pid = self.render("ok")
+        self.assertEqual(self.render("ok"), pid)
+
+    def test_process_reused_after_error(self):
+        pid = self.render("ok")
+        with self.assertRaisesRegex(ChartRenderError, "Unable to load"):
+            self.render("error")
+        self.assertEqual(self.render("ok"), pid)
+
+    def test_process_replaced_after_crash(self):
+        pid = self.render("ok")
+        with self.assertRaisesRegex(ChartRenderError, "exited with code 1"):
+            self.render("crash")
+        self.assertNotEqual(self.render("ok"), pid)
+
+    def test_process_replaced_after_timeout(self):
+        self.pool.timeout = 0.5
+        pid = self.render("ok")
+        with self.assertRaisesRegex(ChartRenderError, "Timed out"):
+            self.render("hang")
+        self.assertNotEqual(self.render("ok"), pid)
+
+    def test_concurrent_renders(self):
+        paths = [self.path + str(i) for i in range(4)]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(
+                executor.map(
+                    lambda path: self.pool.render(path, path, "#c", "8x6", 0), paths
+                )
+            )
+        pids = set()
+        for path in paths:
+            with open(path) as f:
+                pids.add(f.read())
+        # We never have more processes than the size of the pool
+        self.assertLessEqual(len(pids), 2)
+
+
+class FakeRenderer(object):
+    def __init__(self, content=b"png"):
+        self.content = content
+        self.urls = []
+        self.started = threading.Event()
+        self.finish = threading.Event()
+        self.finish.set()
+
+    def render(self, url, path, selector, dimensions, wait):
+        self.urls.append(url)
+        self.started.set()
+        self.finish.wait()
+        if url == "error":
+            raise ChartRenderError("Unable to load the address")
+        with open(path, "wb") as f:
+            f.write(self.content)
+
+
+class ChartImageCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.renderer = FakeRenderer()
+        self.cache = ChartImageCache(self.renderer, self.directory)
+
+    def get(self, url, version="2020-01-01", cache=None, **kwargs):
+        if cache is None:
+            cache = self.cache
+        args = dict(url=url, selector="#chart", dimensions="800x600", wait=1000)
+        args.update(kwargs)
+        return cache.get(version=version, **args)
+
+    def test_image_rendered_once(self):
+        path = self.get("/a/")
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), b"png")
+        self.assertEqual(self.get("/a/"), path)
+        self.assertEqual(self.renderer.urls, ["/a/"])
+
+    def test_different_images_rendered(self):
+        paths = {
+            self.get("/a/"),
+            self.get("/b/"),
+            self.get("/a/", selector="#other"),
+            self.get("/a/", dimensions="100x100"),
+        }
+        self.assertEqual(len(paths), 4)
+        self.assertEqual(len(self.renderer.urls), 4)
+
+    def test_concurrent_requests_rendered_once(self):
+        self.renderer.finish.clear()
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            first = executor.submit(self.get, "/a/")
+            self.renderer.started.wait()
+            second = executor.submit(self.get, "/a/")
+            self.renderer.finish.set()
+            self.assertEqual(first.result(), second.result())
+        self.assertEqual(self.renderer.urls, ["/a/"])
+
+    def test_images_reused_between_runs(self):
+        path = self.get("/a/")
+        next_run = ChartImageCache(self.renderer, self.directory)
+        self.assertEqual(self.get("/a/", cache=next_run), path)
+        self.assertEqual(self.renderer.urls, ["/a/"])
+
+    def test_images_not_reused_for_new_version(self):
+        self.get("/a/")
+        next_run = ChartImageCache(self.renderer, self.directory)
+        self.get("/a/", version="2020-02-01", cache=next_run)
+        self.assertEqual(self.renderer.urls, ["/a/", "/a/"])
+
+    def test_images_not_reused_between_runs_without_version(self):
+        self.get("/a/", version=None)
+        self.get("/a/", version=None)
+        next_run = ChartImageCache(self.renderer, self.directory)
+        self.get("/a/", version=None, cache=next_run)
+        self.assertEqual(self.renderer.urls, ["/a/", "/a/"])
+
+    def test_remove_other_versions(self):
+        self.get("/a/", version="2020-01-01")
+        self.get("/a/", version=None)
+        path = self.get("/a/", version="2020-02-01")
+        self.assertEqual(len(os.listdir(self.directory)), 3)
+        self.cache.remove_other_versions("2020-02-01")
+        self.assertEqual(
+            os.listdir(self.directory), [os.path.basename(os.path.dirname(path))]
+        )
+        self.assertTrue(os.path.exists(path))
+
+    def test_failed_render_retried(self):
+        with self.assertRaises(ChartRenderError):
+            self.get("error")
+        with self.assertRaises(ChartRenderError):
+            self.get("error")
+        self.assertEqual(self.renderer.urls, ["error", "error"])
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_empty_image_raises(self):
+        self.renderer.content = b""
+        with self.assertRaisesRegex(ChartRenderError, "empty"):
+            self.get("/a/")
+        self.assertEqual(os.listdir(self.directory), [])
@@ -0,0 +1,318 @@
+import datetime
+
+import numpy
+from django.test import SimpleTestCase, TestCase
+from frontend.measure_calculation import (
+    CENTILES,
+    UnsupportedMeasureError,
+    calculate_measure_tables,
+    check_measure_def,
+    compare_measure_tables,
+    filter_bnf_codes,
+    get_centiles,
+    get_percent_ranks,
+)
+from frontend.models import PCN, PCT, STP, Measure, Practice, RegionalTeam
+from matrixstore.tests.contextmanagers import (
+    patched_global_matrixstore_from_data_factory,
+)
+from matrixstore.tests.data_factory import DataFactory
+
+BRANDED = "0703021Q0BBAAAA"
+GENERIC = "0703021Q0AAAAAA"
+
+
+class CalculateMeasureTablesTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        regional_team = RegionalTeam.objects.create(code="Y01")
+        stp = STP.objects.create(code="E01")
+        ccg = PCT.objects.create(
+            code="C01", org_type="CCG", stp=stp, regional_team=regional_team
+        )
+        hub = PCT.objects.create(code="H01", org_type="H")
+        pcn = PCN.objects.create(code="E0001")
+        Practice.objects.create(code="ABC000", ccg=ccg, pcn=pcn, setting=4)
+        Practice.objects.create(code="ABC001", ccg=ccg, pcn=pcn, setting=4)
+        # This practice's PCT isn't a CCG, so it only appears in practice and
+        # PCN level data
+        Practice.objects.create(code="ABC002", ccg=hub, setting=4)
+        # This practice isn't a standard practice, so it is ignored entirely
+        Practice.objects.create(code="ABC003", ccg=ccg, setting=1)
+        # This practice has no prescribing and isn't in the MatrixStore at all
+        Practice.objects.create(code="ABC004", ccg=ccg, setting=4)
+
+    def setUp(self):
+        self.factory = DataFactory()
+        self.months = self.factory.create_months("2018-10-01", 2)
+        self.practices = self.factory.create_practices(4)
+        branded = self.factory.create_presentation(BRANDED)
+        generic = self.factory.create_presentation(GENERIC)
+        month_1, month_2 = self.months
+        self.prescribe(branded, 0, month_1, items=2, quantity=20, actual_cost=40)
+        self.prescribe(generic, 0, month_1, items=6, quantity=60, actual_cost=30)
+        self.prescribe(generic, 1, month_1, items=5, quantity=50, actual_cost=25)
+        self.prescribe(branded, 2, month_1, items=3, quantity=30, actual_cost=60)
+        self.prescribe(branded, 3, month_1, items=10, quantity=100, actual_cost=200)
+        self.prescribe(branded, 0, month_2, items=1, quantity=10, actual_cost=20)
+        self.prescribe(generic, 0, month_2, items=1, quantity=10, actual_cost=5)
+        for ix, list_size in [(0, 2000), (1, 1000)]:
+            for month in self.months:
+                statistics = self.factory.create_statistics_for_one_practice_and_month(
+                    self.practices[ix], month
+                )
+                statistics["total_list_size"] = list_size
+
+    def prescribe(self, presentation, practice_ix, month, **values):
+        prescription = self.factory.create_prescription(
+            presentation, self.practices[practice_ix], month
+        )
+        prescription.update(values)
+
+    def calculate(self, **measure_kwargs):
+        measure = Measure(id="test", **measure_kwargs)
+        with patched_global_matrixstore_from_data_factory(self.factory):
+            return calculate_measure_tables(measure, "2018-10-01", "2018-11-01")
+
+    def calculate_percentage_measure(self):
+        return self.calculate(
+            numerator_type="bnf_items",
+            numerator_bnf_codes=[BRANDED],
+            denominator_type="bnf_items",
+            denominator_bnf_codes=[BRANDED, GENERIC],
+            is_cost_based=True,
+            is_percentage=True,
+        )
+
+    def calculate_list_size_measure(self):
+        return self.calculate(
+            numerator_type="bnf_cost",
+            numerator_bnf_codes=[BRANDED],
+            denominator_type="list_size",
+            denominator_bnf_codes=[],
+            is_cost_based=True,
+            is_percentage=False,
+        )
+
+    def test_practice_rows(self):
+        tables = self.calculate_percentage_measure()
+        rows = index_rows(tables["practice"], "practice_id")
+        self.assertEqual(sorted(rows), ["ABC000", "ABC001", "ABC002", "ABC004"])
+        row = rows["ABC000"][datetime.date(2018, 10, 1)]
+        self.assertEqual(
+            {name: row[name] for name in ["pcn_id", "pct_id", "stp_id"]},
+            {"pcn_id": "E0001", "pct_id": "C01", "stp_id": "E01"},
+        )
+        self.assertEqual(
+            get_column(rows, "calc_value", "2018-10-01"),
+            {"ABC000": 0.25, "ABC001": 0.0, "ABC002": 1.0, "ABC004": None},
+        )
+        self.assertEqual(
+            get_column(rows, "percentile", "2018-10-01"),
+            {"ABC000": 0.5, "ABC001": 0.0, "ABC002": 1.0, "ABC004": None},
+        )
+        self.assertEqual(
+            get_column(rows, "calc_value", "2018-11-01"),
+            {"ABC000": 0.5, "ABC001": None, "ABC002": None, "ABC004": None},
+        )
+        self.assertEqual(
+            get_column(rows, "percentile", "2018-11-01"),
+            {"ABC000": 0.0, "ABC001": None, "ABC002": None, "ABC004": None},
+        )
+
+    def test_org_rows(self):
+        tables = self.calculate_percentage_measure()
+        pcn_rows = index_rows(tables["pcn"], "pcn_id")
+        self.assertEqual(
+            get_column(pcn_rows, "numerator", "2018-10-01"), {"E0001": 2, None: 3}
+        )
+        self.assertEqual(
+            get_column(pcn_rows, "denominator", "2018-10-01"), {"E0001": 13, None: 3}
+        )
+        # Only practices in CCGs count towards CCG, STP and regional team data
+        for org_type, id_column, org_id in [
+            ("ccg", "pct_id", "C01"),
+            ("stp", "stp_id", "E01"),
+            ("regtm", "regional_team_id", "Y01"),
+        ]:
+            rows = index_rows(tables[org_type], id_column)
+            self.assertEqual(get_column(rows, "numerator", "2018-10-01"), {org_id: 2})
+            self.assertEqual(
+                get_column(rows, "denominator", "2018-10-01"), {org_id: 13}
+            )
+
+    def test_percentage_cost_savings(self):
+        tables = self.calculate_percentage_measure()
+        rows = index_rows(tables["practice"], "practice_id")
+        # The practice 50th centile is 0.25. ABC002 prescribes nothing but the
+        # branded presentation, so its generic costs are given by the overall
+        # cost per unit of generic: (70 + 25 + 60 - 40 - 60) / (160 - 50)
+        self.assertEqual(
+            get_column(rows, "cost_savings_50", "2018-10-01"),
+            {
+                "ABC000": 70 - (0.25 * 80 * 2 + 60 * 0.5),
+                "ABC001": 25 - (0.25 * 50 * 2 + 37.5 * 0.5),
+                "ABC002": 60 - (0.25 * 30 * 2 + 22.5 * 0.5),
+                "ABC004": None,
+            },
+        )
+        global_row = tables["global"][0]
+        self.assertEqual(global_row["month"], datetime.date(2018, 10, 1))
+        self.assertEqual(global_row["practice_50th"], 0.25)
+        self.assertAlmostEqual(global_row["practice_10th"], 0.05)
+        self.assertEqual(global_row["practice_cost_savings_50"], 33.75)
+        self.assertEqual(global_row["numerator"], 5)
+        self.assertEqual(global_row["denominator"], 16)
+
+    def test_list_size_measure(self):
+        tables = self.calculate_list_size_measure()
+        rows = index_rows(tables["practice"], "practice_id")
+        self.assertEqual(
+            get_column(rows, "denominator", "2018-10-01"),
+            {"ABC000": 2.0, "ABC001": 1.0, "ABC002": 0.0, "ABC004": 0.0},
+        )
+        self.assertEqual(
+            get_column(rows, "calc_value", "2018-10-01"),
+            {"ABC000": 20.0, "ABC001": 0.0, "ABC002": None, "ABC004": None},
+        )
+        self.assertEqual(
+            get_column(rows, "cost_savings_50", "2018-10-01"),
+            {"ABC000": 20.0, "ABC001": -10.0, "ABC002": 60.0, "ABC004": 0.0},
+        )
+        self.assertNotIn("num_items", tables["practice"][0])
+
+    def test_zero_denominator_org_rows(self):
+        tables = self.calculate_list_size_measure()
+        # As in BigQuery, a practice with a zero denominator gets a NULL ratio
+        # but an org gets an infinite one, which counts towards its percentile
+        # and the centiles
+        rows = index_rows(tables["practice"], "practice_id")
+        self.assertEqual(get_column(rows, "calc_value", "2018-10-01")["ABC002"], None)
+        pcn_rows = index_rows(tables["pcn"], "pcn_id")
+        self.assertEqual(
+            get_column(pcn_rows, "calc_value", "2018-10-01"),
+            {"E0001": 40 / 3, None: float("inf")},
+        )
+        self.assertEqual(
+            get_column(pcn_rows, "percentile", "2018-10-01"),
+            {"E0001": 0.0, None: 1.0},
+        )
+        # An org with nothing in either numerator or denominator still gets a
+        # NULL ratio
+        self.assertEqual(
+            get_column(pcn_rows, "calc_value", "2018-11-01"),
+            {"E0001": 20 / 3, None: None},
+        )
+        global_row = tables["global"][0]
+        self.assertEqual(global_row["pcn_50th"], float("inf"))
+        self.assertEqual(global_row["practice_50th"], 10.0)
+
+    def test_matches_itself(self):
+        tables = self.calculate_percentage_measure()
+        self.assertEqual(compare_measure_tables(tables, tables), [])
+
+
+class CheckMeasureDefTests(SimpleTestCase):
+    def test_supported(self):
+        check_measure_def(
+            {
+                "id": "test",
+                "numerator_type": "bnf_quantity",
+                "denominator_type": "list_size",
+            }
+        )
+
+    def test_custom_numerator(self):
+        with self.assertRaises(UnsupportedMeasureError):
+            check_measure_def(
+                {
+                    "id": "test",
+                    "numerator_type": "custom",
+                    "denominator_type": "list_size",
+                }
+            )
+
+    def test_bnf_codes_query(self):
+        with self.assertRaises(UnsupportedMeasureError):
+            check_measure_def(
+                {
+                    "id": "test",
+                    "numerator_type": "bnf_items",
+                    "numerator_bnf_codes_query": "SELECT bnf_code FROM foo",
+                    "denominator_type": "list_size",
+                }
+            )
+
+
+class FilterBnfCodesTests(SimpleTestCase):
+    bnf_codes = [
+        "0703021Q0AAAAAA",
+        "0703021Q0BBAAAA",
+        "0703021Q0BCAAAA",
+        "0703021P0AAAAAA",
+        "21220000223",
+        "2122000022X",
+    ]
+
+    def test_prefix(self):
+        self.assertEqual(
+            filter_bnf_codes(self.bnf_codes, ["0703021Q0B # Desogestrel (brands)"]),
+            ["0703021Q0BBAAAA", "0703021Q0BCAAAA"],
+        )
+
+    def test_exclusion(self):
+        self.assertEqual(
+            filter_bnf_codes(self.bnf_codes, ["0703021Q0", "~0703021Q0BC"]),
+            ["0703021Q0AAAAAA", "0703021Q0BBAAAA"],
+        )
+
+    def test_full_code_and_wildcard(self):
+        self.assertEqual(
+            filter_bnf_codes(self.bnf_codes, ["0703021P0AAAAAA", "0703021Q0%BAAAA"]),
+            ["0703021P0AAAAAA", "0703021Q0BBAAAA"],
+        )
+
+    def test_appliance(self):
+        self.assertEqual(
+            filter_bnf_codes(self.bnf_codes, ["2122000022"]),
+            ["21220000223", "2122000022X"],
+        )
+        self.assertEqual(
+            filter_bnf_codes(self.bnf_codes, ["21220000223"]), ["21220000223"]
+        )
+
+
+class CentileTests(SimpleTestCase):
+    def test_percent_ranks(self):
+        ratios = numpy.array([[0.5, numpy.nan], [0.1, 1.0], [0.5, numpy.nan]])
+        numpy.testing.assert_array_equal(
+            get_percent_ranks(ratios), [[0.5, numpy.nan], [0.0, 0.0], [0.5, numpy.nan]]
+        )
+
+    def test_centiles(self):
+        ratios = numpy.array([[0.0, numpy.nan], [1.0, numpy.nan]])
+        numpy.testing.assert_allclose(
+            get_centiles(ratios),
+            [[centile / 100, numpy.nan] for centile in CENTILES],
+        )
+
+    def test_centiles_with_infinite_ratios(self):
+        ratios = numpy.array([[-numpy.inf, 0.0], [1.0, numpy.inf], [numpy.nan, 1.0]])
+        centiles = get_centiles(ratios)
+        numpy.testing.assert_array_equal(centiles[:, 0], [-numpy.inf] * 9)
+        numpy.testing.assert_allclose(
+            centiles[:, 1],
+            [0.2, 0.4, 0.6, 0.8, 1.0, numpy.inf, numpy.inf, numpy.inf, numpy.inf],
+        )
+
+
+def index_rows(rows, id_column):
+    indexed = {}
+    for row in rows:
+        indexed.setdefault(row[id_column], {})[row["month"]] = row
+    return indexed
+
+
+def get_column(indexed_rows, name, month):
+    month = datetime.date.fromisoformat(month)
+    return {org_id: rows[month][name] for org_id, rows in indexed_rows.items()}
@@ -18,6 +18,7 @@ from frontend.views.spending_utils import (
     BRAND_DISCOUNT_PERCENTAGE,
     GENERIC_DISCOUNT_PERCENTAGE,
     NATIONAL_AVERAGE_DISCOUNT_PERCENTAGE,
+    _get_prescribed_quantity_matrix,
     ncso_spending_breakdown_for_entity,
     ncso_spending_for_entity,
 )
@@ -101,6 +102,16 @@ class TestSpendingViews(TestCase):
             expected = recalculate_ncso_spending_breakdown_for_entity(*args, **kwargs)
             self.assertEqual(round_floats(results), round_floats(expected))
 
+    def test_prescribed_quantity_matrix_with_no_dates(self):
+        bnf_code_offsets = {
+            presentation.bnf_code: offset
+            for offset, presentation in enumerate(self.presentations)
+        }
+        quantities = _get_prescribed_quantity_matrix(
+            bnf_code_offsets, {}, "ccg", self.ccg.code
+        )
+        self.assertEqual(quantities.shape, (len(self.presentations), 0))
+
     def test_spending_views(self):
         # Basic smoketest which just checks that the view loads OK and has
         # something we expect in it
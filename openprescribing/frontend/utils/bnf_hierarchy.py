@@ -1,4 +1,4 @@
-from matrixstore.db import get_db
+from matrixstore.db import get_db, memoize_per_db
 
 
 def simplify_bnf_codes(bnf_codes):
@@ -32,11 +32,12 @@ def simplify_bnf_codes(bnf_codes):
     return sorted(prefixes)
 
 
+@memoize_per_db
 def get_all_bnf_codes():
     """Return list of all BNF codes for which we have prescribing."""
 
     db = get_db()
-    return {r[0] for r in db.query("SELECT bnf_code FROM presentation")}
+    return frozenset(r[0] for r in db.query("SELECT bnf_code FROM presentation"))
 
 
 def get_subsection_prefixes(prefix):
@@ -1,9 +1,10 @@
 # -*- coding: utf-8 -*-
 import logging
-import os
 import re
-import subprocess
+import shutil
 import urllib.parse
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 from html import unescape
 from tempfile import NamedTemporaryFile
@@ -19,6 +20,11 @@ from django.core.mail import EmailMultiAlternatives
 from django.template.loader import get_template
 from django.urls import reverse
 from django.utils.safestring import mark_safe
+from frontend.chart_images import (
+    ChartRenderError,
+    get_chart_image_cache,
+    get_data_version,
+)
 from frontend.models import (
     PCN,
     PCT,
@@ -43,14 +49,11 @@ from frontend.views.views import (
 )
 from premailer import Premailer
 
-GRAB_CMD = (
-    "/usr/local/bin/phantomjs --ignore-ssl-errors=true "
-    + settings.APPS_ROOT
-    + "/frontend/management/commands/grab_chart.js"
-)
-
 logger = logging.getLogger(__name__)
 
+# The number of months over which we look for changes in alerts
+CHANGE_WINDOW = 12
+
 
 class BadAlertImageError(Exception):
     pass
@@ -232,6 +235,105 @@ class CUSUM(object):
         return cusum_pos, cusum_neg
 
 
+def get_last_cusum_alerts(data, window_size=12, sensitivity=5):
+    """Return what `CUSUM(row, window_size, sensitivity).get_last_alert_info()`
+    would, after calling `work()`, for each row of the 2D array `data`.
+
+    This follows exactly the same steps as `CUSUM` (quirks included), but
+    works through the months across every row at once rather than through
+    each row value by value, which makes it practical to run over every
+    measure for thousands of organisations.
+
+    """
+    data = np.array(data, dtype=float)
+    num_rows, num_months = data.shape
+    results = [None] * num_rows
+    if num_months == 0:
+        return results
+    not_null = ~np.isnan(data)
+    has_data = not_null.any(axis=1)
+    # CUSUM skips leading nulls until its first window contains a value
+    start_index = np.maximum(not_null.argmax(axis=1) - window_size + 1, 0)
+    pos_cusum = np.zeros(num_rows)
+    neg_cusum = np.zeros(num_rows)
+    target_mean = np.full(num_rows, np.nan)
+    alert_threshold = np.full(num_rows, np.nan)
+    target_means = np.empty_like(data)
+    alerts = np.zeros(data.shape, dtype=bool)
+    with warnings.catch_warnings():
+        # Windows with no values give a NaN mean and threshold, as in CUSUM
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        for i in range(num_months):
+            datum = data[:, i]
+            at_start = i <= start_index
+            within_threshold = ~(
+                (pos_cusum > alert_threshold) | (neg_cusum < -alert_threshold)
+            )
+            # The windows are the same for every row, so we only need to know
+            # which of them each row uses
+            start_window = data[:, i : i + window_size]
+            start_mean = np.nanmean(start_window, axis=1)
+            start_threshold = np.nanstd(start_window * sensitivity, axis=1)
+            moving_window = data[:, i - window_size : i]
+            moving_mean = np.nanmean(moving_window, axis=1)
+            moving_threshold = np.nanstd(moving_window * sensitivity, axis=1)
+            # Peek ahead to see whether the CUSUM is moving in the same direction
+            next_pos_cusum, next_neg_cusum = _compute_cusums(
+                datum, moving_mean, alert_threshold, sensitivity, pos_cusum, neg_cusum
+            )
+            moving_in_same_direction = (
+                (next_pos_cusum > pos_cusum) & (pos_cusum > alert_threshold)
+            ) | ((next_neg_cusum < neg_cusum) & (neg_cusum < -alert_threshold))
+            new_threshold = ~at_start & ~within_threshold & ~moving_in_same_direction
+            target_mean = np.where(
+                at_start,
+                start_mean,
+                np.where(within_threshold, target_mean, moving_mean),
+            )
+            alert_threshold = np.where(
+                at_start,
+                start_threshold,
+                np.where(new_threshold, moving_threshold, alert_threshold),
+            )
+            reset = at_start | new_threshold
+            pos_cusum, neg_cusum = _compute_cusums(
+                datum,
+                target_mean,
+                alert_threshold,
+                sensitivity,
+                np.where(reset, 0, pos_cusum),
+                np.where(reset, 0, neg_cusum),
+            )
+            target_means[:, i] = target_mean
+            alerts[:, i] = (pos_cusum > alert_threshold) | (
+                neg_cusum < -alert_threshold
+            )
+    end_index = num_months - 1
+    # CUSUM ignores an alert in the first month (see `get_last_alert_info`)
+    if end_index == 0:
+        return results
+    for row in np.flatnonzero(alerts[:, end_index] & has_data):
+        start_index = end_index
+        while start_index > 0 and alerts[row, start_index - 1]:
+            start_index -= 1
+        results[row] = {
+            "from": target_means[row, start_index - 1],
+            "to": data[row, end_index],
+            "period": end_index - start_index + 1,
+        }
+    return results
+
+
+def _compute_cusums(datum, target_mean, alert_threshold, sensitivity, pos, neg):
+    delta = 0.5 * alert_threshold / sensitivity
+    cusum_pos = datum - (target_mean + delta) + pos
+    cusum_neg = datum - (target_mean - delta) + neg
+    # Unlike `np.maximum`, these treat NaNs as the builtin `max` does
+    cusum_pos = np.round(np.where(cusum_pos > 0, cusum_pos, 0), 2)
+    cusum_neg = np.round(np.where(cusum_neg < 0, cusum_neg, 0), 2)
+    return cusum_pos, cusum_neg
+
+
 def percentiles_without_jaggedness(df2, is_percentage=False):
     """Remove records that are outside the standard error of the mean or
     where they hit 0% or 100% more than once.
@@ -255,45 +357,65 @@ def percentiles_without_jaggedness(df2, is_percentage=False):
 
 
 class InterestingMeasureFinder(object):
-    def __init__(self, org, interesting_saving=1000, interesting_change_window=12):
-        if isinstance(org, Practice):
-            self.measure_filter_for_org = {"practice": org}
-        elif isinstance(org, PCN):
-            self.measure_filter_for_org = {"pcn": org, "practice": None}
-        elif isinstance(org, PCT):
-            self.measure_filter_for_org = {"pct": org, "practice": None}
-        elif isinstance(org, STP):
-            self.measure_filter_for_org = {"stp": org, "practice": None, "pct": None}
-        else:
-            assert False, "Unexpected org {}".format(org)
-
+    def __init__(
+        self, org, interesting_saving=1000, interesting_change_window=12, measures=None
+    ):
+        # Check that this is an org we can find measure values for
+        get_measure_value_filter([org])
+        self.org = org
         self.interesting_change_window = interesting_change_window
         self.interesting_saving = interesting_saving
+        # Maps measure IDs to Measures, and may be shared between finders
+        self.measures = measures if measures is not None else {}
+        self.measure_values = None
+        self.measure_values_since = None
+        # Maps CUSUM window sizes to the alerts found for this org, see
+        # `most_change_against_window`
+        self.last_alerts = {}
 
     def months_ago(self, period):
-        now = ImportLog.objects.latest_in_category("prescribing").current_at
-        return now + relativedelta(months=-(period - 1))
+        return get_months_ago(period)
+
+    def preload(self, measure_values, since, last_alerts=None):
+        """Use the given measure values (covering every month from `since`) and
+        CUSUM alerts, as returned by `get_measure_values_for_orgs` and
+        `get_last_alerts_by_org`, rather than calculating them for this org
+        alone
+
+        """
+        self.measure_values = measure_values
+        self.measure_values_since = since
+        self.last_alerts.update(last_alerts or {})
+
+    def get_measure_values(self, period):
+        since = self.months_ago(period)
+        if self.measure_values is None or since < self.measure_values_since:
+            self.measure_values = get_measure_values_for_orgs([self.org], since)
+            self.measure_values_since = since
+        return self.measure_values[self.measure_values.month >= since]
+
+    def get_measures(self, measure_ids):
+        missing_ids = set(measure_ids) - set(self.measures)
+        if missing_ids:
+            self.measures.update(Measure.objects.in_bulk(missing_ids))
+        return self.measures
 
     def _best_or_worst_performing_in_period(self, period, best_or_worst=None):
         assert best_or_worst in ["best", "worst"]
         worst = []
-        measure_filter = {
-            "month__gte": self.months_ago(period),
-            "measure__include_in_alerts": True,
-        }
-        measure_filter.update(self.measure_filter_for_org)
+        measure_values = self.get_measure_values(period)
         invert_percentile_for_comparison = False
         if best_or_worst == "worst":
             invert_percentile_for_comparison = True
-            measure_filter["percentile__gte"] = 90
+            measure_values = measure_values[measure_values.percentile >= 90]
         else:
-            measure_filter["percentile__lte"] = 10
+            measure_values = measure_values[measure_values.percentile <= 10]
         df = self.measurevalues_dataframe(
-            MeasureValue.objects.filter(**measure_filter),
-            ["numerator", "calc_value", "percentile"],
+            measure_values, ["numerator", "calc_value", "percentile"]
         )
+        measures = self.get_measures(df.index)
         for row in df.iterrows():
-            measure = Measure.objects.get(pk=row[0])
+            measure = measures[row[0]]
             measure_df = row[1]
             non_jagged = percentiles_without_jaggedness(
                 measure_df, measure.is_percentage
@@ -331,57 +453,41 @@ class InterestingMeasureFinder(object):
         """
         improvements = []
         declines = []
-        # We multiply the window because we want to include alerts
-        # that are continuing after they were first detected
-        window_multiplier = 1.5
-        window_plus = int(round(window * window_multiplier))
-        measure_filter = {
-            "month__gte": self.months_ago(window_plus),
-            "measure__include_in_alerts": True,
-        }
-        measure_filter.update(self.measure_filter_for_org)
-        df = self.measurevalues_dataframe(
-            MeasureValue.objects.filter(**measure_filter), "percentile"
-        )
-        for row in df.itertuples():
-            measure = Measure.objects.get(pk=row[0])
-            percentiles = row[1:]
-            cusum = CUSUM(
-                percentiles, window_size=window, sensitivity=5, name=measure.id
+        last_alerts = self.last_alerts.get(window)
+        if last_alerts is None:
+            measure_values = self.get_measure_values(get_window_plus(window))
+            last_alerts = get_last_alerts_by_org(measure_values, window).get(
+                self.org.pk, {}
             )
-            cusum.work()
-
-            last_alert = cusum.get_last_alert_info()
-            if last_alert:
-                last_alert["measure"] = measure
-                if last_alert["from"] < last_alert["to"]:
-                    if measure.low_is_good:
-                        declines.append(last_alert)
-                    else:
-                        improvements.append(last_alert)
+            self.last_alerts[window] = last_alerts
+        measures = self.get_measures(last_alerts)
+        for measure_id, alert in last_alerts.items():
+            measure = measures[measure_id]
+            last_alert = dict(alert, measure=measure)
+            if last_alert["from"] < last_alert["to"]:
+                if measure.low_is_good:
+                    declines.append(last_alert)
+                else:
+                    improvements.append(last_alert)
+            else:
+                if measure.low_is_good:
+                    improvements.append(last_alert)
                 else:
-                    if measure.low_is_good:
-                        improvements.append(last_alert)
-                    else:
-                        declines.append(last_alert)
+                    declines.append(last_alert)
         improvements = sorted(improvements, key=lambda x: -abs(x["to"] - x["from"]))
         declines = sorted(declines, key=lambda x: -abs(x["to"] - x["from"]))
         return {"improvements": improvements, "declines": declines}
 
-    def measurevalues_dataframe(self, queryset=None, data_col=None):
-        """Given a queryset of many measurevalues across many measures,
-        returns a dataframe indexed by measure, with month columns,
-        and `data_col` values.
+    def measurevalues_dataframe(self, measure_values, data_col=None):
+        """Given a dataframe of many measurevalues across many measures, as
+        returned by `get_measure_values_for_orgs`, returns a dataframe
+        indexed by measure, with month columns, and `data_col` values.
 
         """
         if not isinstance(data_col, list):
             data_col = [data_col]
-        data_cols = ["month", "measure_id"] + data_col
-        data = list(queryset.order_by("measure_id", "month").values_list(*data_cols))
-        if data:
-            df = pd.DataFrame.from_records(
-                data, columns=data_cols, index=["measure_id", "month"]
-            )
+        if len(measure_values):
+            df = measure_values.set_index(["measure_id", "month"])[data_col]
             return df.unstack(level="month")
         else:
             return pd.DataFrame()
@@ -400,16 +506,12 @@ class InterestingMeasureFinder(object):
         possible_savings = []
         achieved_savings = []
         total_savings = 0
-        measure_filter = {
-            "month__gte": self.months_ago(period),
-            "measure__include_in_alerts": True,
-        }
-        measure_filter.update(self.measure_filter_for_org)
         df = self.measurevalues_dataframe(
-            MeasureValue.objects.filter(**measure_filter), "cost_savings"
+            self.get_measure_values(period), "cost_savings"
         )
+        measures = self.get_measures(df.index)
         for row in df.itertuples():
-            measure = Measure.objects.get(pk=row[0])
+            measure = measures[row[0]]
             cost_savings = row[1:]
             if measure.is_cost_based:
                 if len(cost_savings) != period:
@@ -464,7 +566,7 @@ class InterestingMeasureFinder(object):
     def context_for_org_email(self):
         worst = self.worst_performing_in_period(3)
         best = self.best_performing_in_period(3)
-        most_changing = self.most_change_against_window(12)
+        most_changing = self.most_change_against_window(CHANGE_WINDOW)
         interesting = []
         most_changing_interesting = []
         for extreme in [worst, best]:
@@ -482,7 +584,149 @@ class InterestingMeasureFinder(object):
         }
 
 
-def attach_image(msg, url, file_path, selector, dimensions="1024x1024"):
+def get_months_ago(period):
+    now = ImportLog.objects.latest_in_category("prescribing").current_at
+    return now + relativedelta(months=-(period - 1))
+
+
+def get_window_plus(window):
+    # We multiply the window because we want to include alerts
+    # that are continuing after they were first detected
+    window_multiplier = 1.5
+    return int(round(window * window_multiplier))
+
+
+def get_measure_value_filter(orgs):
+    """Return the filter which selects the MeasureValues for `orgs` (which must
+    all be of the same type), and the name of the field identifying the org
+
+    """
+    org_ids = [org.pk for org in orgs]
+    if all(isinstance(org, Practice) for org in orgs):
+        return {"practice_id__in": org_ids}, "practice_id"
+    elif all(isinstance(org, PCN) for org in orgs):
+        return {"pcn_id__in": org_ids, "practice": None}, "pcn_id"
+    elif all(isinstance(org, PCT) for org in orgs):
+        return {"pct_id__in": org_ids, "practice": None}, "pct_id"
+    elif all(isinstance(org, STP) for org in orgs):
+        return {"stp_id__in": org_ids, "practice": None, "pct": None}, "stp_id"
+    else:
+        assert False, "Unexpected orgs {}".format(orgs)
+
+
+def get_measure_values_for_orgs(orgs, since):
+    """Return a dataframe of the values from `since` onwards of every measure
+    included in alerts, for `orgs` (which must all be of the same type)
+
+    """
+    measure_filter, org_field = get_measure_value_filter(orgs)
+    columns = [
+        "org_id",
+        "measure_id",
+        "month",
+        "numerator",
+        "calc_value",
+        "percentile",
+        "cost_savings",
+    ]
+    data = MeasureValue.objects.filter(
+        month__gte=since, measure__include_in_alerts=True, **measure_filter
+    ).values_list(org_field, *columns[1:])
+    df = pd.DataFrame.from_records(list(data), columns=columns)
+    numeric_columns = ["numerator", "calc_value", "percentile"]
+    df[numeric_columns] = df[numeric_columns].astype(float)
+    return df
+
+
+def get_last_alerts_by_org(measure_values, window):
+    """Run CUSUM over the percentiles of every (org, measure) series in
+    `measure_values` at once, and return a dict mapping org IDs to dicts
+    mapping measure IDs to the `get_last_alert_info()` of each series with a
+    current alert
+
+    """
+    if not len(measure_values):
+        return {}
+    percentiles = measure_values.set_index(["org_id", "measure_id", "month"])[
+        "percentile"
+    ].unstack(level="month")
+    # Each org's series cover the months for which it has any values at all, so
+    # we run orgs with the same months together
+    orgs_by_months = {}
+    for org_id, months in measure_values.groupby("org_id")["month"].unique().items():
+        orgs_by_months.setdefault(tuple(sorted(months)), []).append(org_id)
+    last_alerts = {}
+    for months, org_ids in orgs_by_months.items():
+        series = percentiles.loc[org_ids, list(months)]
+        alerts = get_last_cusum_alerts(
+            series.to_numpy(dtype=float), window_size=window, sensitivity=5
+        )
+        for (org_id, measure_id), alert in zip(series.index, alerts):
+            org_alerts = last_alerts.setdefault(org_id, {})
+            if alert:
+                org_alerts[measure_id] = alert
+    return last_alerts
+
+
+def get_org_email_contexts(orgs, batch_size=500):
+    """Return a dict mapping each of `orgs` to its `context_for_org_email()`.
+
+    Rather than querying and running CUSUM for each org in turn, we load the
+    measure values for a batch of orgs of the same type in one query and find
+    the changes across the whole batch at once.
+
+    If calculating the contexts for a batch fails then we log the error and
+    leave that batch out of the results, so that callers can fall
+    back to calculating them one org at a time.
+
+    """
+    orgs_by_type = {}
+    for org in orgs:
+        orgs_by_type.setdefault(type(org), {})[org.pk] = org
+    if not orgs_by_type:
+        return {}
+    # This covers the longest period used by `context_for_org_email`
+    since = get_months_ago(get_window_plus(CHANGE_WINDOW))
+    measures = {}
+    contexts = {}
+    for orgs_of_type in orgs_by_type.values():
+        orgs_of_type = list(orgs_of_type.values())
+        for offset in range(0, len(orgs_of_type), batch_size):
+            batch = orgs_of_type[offset : offset + batch_size]
+            try:
+                contexts.update(
+                    get_org_email_contexts_for_batch(batch, since, measures)
+                )
+            except Exception:
+                logger.exception(
+                    "Failed to calculate email contexts for batch of %s orgs",
+                    len(batch),
+                )
+    return contexts
+
+
+def get_org_email_contexts_for_batch(batch, since, measures):
+    measure_values = get_measure_values_for_orgs(batch, since)
+    last_alerts = get_last_alerts_by_org(measure_values, CHANGE_WINDOW)
+    values_by_org = dict(list(measure_values.groupby("org_id")))
+    contexts = {}
+    for org in batch:
+        finder = InterestingMeasureFinder(org, measures=measures)
+        finder.preload(
+            values_by_org.get(org.pk, measure_values.iloc[:0]),
+            since,
+            {CHANGE_WINDOW: last_alerts.get(org.pk, {})},
+        )
+        contexts[org] = finder.context_for_org_email()
+    return contexts
+
+
+def get_chart_image(url, selector, version, dimensions="1024x1024"):
+    """Return the path to an image of the element matching `selector` in the
+    page at `url`, showing data of the given `version` (see
+    `ChartImageCache.get`).
+
+    """
     if "selectedTab=map" in url:
         wait = 8000
         dimensions = "1000x600"
@@ -494,43 +738,47 @@ def attach_image(msg, url, file_path, selector, dimensions="1024x1024"):
         dimensions = "800x600"
     else:
         wait = 1000
-    cmd = '{cmd} "{host}{url}" {file_path} "{selector}" {dimensions} {wait}'
-    cmd = cmd.format(
-        cmd=GRAB_CMD,
-        host=settings.GRAB_HOST,
-        url=url,
-        file_path=file_path,
-        selector=selector,
-        dimensions=dimensions,
-        wait=wait,
-    )
-    response = subprocess.run(
-        cmd,
-        shell=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        universal_newlines=True,
-        # Fix for PhantomJS under new versions of Debian/Ubuntu
-        # See https://github.com/ariya/phantomjs/issues/15449
-        env=dict(os.environ, OPENSSL_CONF="/etc/ssl"),
-    )
-    if response.returncode > 0:
-        raise BadAlertImageError(
-            f"phantomjs command failed with code {response.returncode}\n\n"
-            f"cmd:\n{cmd}\n\n"
-            f"stdout:\n{response.stdout}\n\n"
-            f"stderr:\n{response.stderr}"
-        )
-    else:
-        logger.debug(
-            "Command %s completed with output %s" % (cmd, response.stdout.strip())
+    try:
+        return get_chart_image_cache().get(
+            settings.GRAB_HOST + url, selector, dimensions, wait, version
         )
-    if os.path.getsize(file_path) == 0:
-        msg = "File at %s empty (generated from url %s)" % (file_path, url)
-        raise BadAlertImageError(msg)
+    except ChartRenderError as e:
+        raise BadAlertImageError(str(e)) from e
+
+
+def attach_image(msg, url, file_path, selector, dimensions="1024x1024"):
+    image_path = get_chart_image(url, selector, get_data_version(), dimensions)
+    shutil.copyfile(image_path, file_path)
     return attach_inline_image_file(msg, file_path, subtype="png")
 
 
+def attach_images(msg, images, version):
+    """Attach an image to `msg` for each of `images`, a list of (url, selector)
+    pairs, showing data of the given `version`, and return the results in
+    order.
+
+    The images are rendered concurrently, but the worker threads only render:
+    we attach the images to `msg` in order on this thread.
+
+    """
+    if not images:
+        return []
+    with ThreadPoolExecutor(max_workers=len(images)) as executor:
+        futures = [
+            executor.submit(get_chart_image, url, selector, version)
+            for url, selector in images
+        ]
+        image_paths = [future.result() for future in futures]
+    results = []
+    for image_path in image_paths:
+        with NamedTemporaryFile(suffix=".png") as image_file:
+            shutil.copyfile(image_path, image_file.name)
+            results.append(
+                attach_inline_image_file(msg, image_file.name, subtype="png")
+            )
+    return results
+
+
 def getIntroText(stats, org_type):
     declines = len(stats["most_changing"]["declines"])
     improvements = len(stats["most_changing"]["improvements"])
@@ -703,42 +951,24 @@ def make_org_email(org_bookmark, stats, tag=None):
     dashboard_uri = org_bookmark.dashboard_url()
     dashboard_uri = settings.GRAB_HOST + dashboard_uri + "?" + msg.qs
 
-    with NamedTemporaryFile(suffix=".png") as getting_worse_file:
-        most_changing = stats["most_changing"]
-        if most_changing["declines"]:
-            measure_id = most_changing["declines"][0]["measure"].id
-            getting_worse_img = attach_image(
-                msg,
-                org_bookmark.dashboard_url(measure_id),
-                getting_worse_file.name,
-                get_chart_id(measure_id),
-            )
-        else:
-            getting_worse_img = None
-
-    with NamedTemporaryFile(suffix=".png") as still_bad_file:
-        if stats["worst"]:
-            measure_id = stats["worst"][0].id
-            still_bad_img = attach_image(
-                msg,
-                org_bookmark.dashboard_url(measure_id),
-                still_bad_file.name,
-                get_chart_id(measure_id),
-            )
-        else:
-            still_bad_img = None
-
-    with NamedTemporaryFile(suffix=".png") as interesting_file:
-        if stats["interesting"]:
-            measure_id = stats["interesting"][0].id
-            interesting_img = attach_image(
-                msg,
-                org_bookmark.dashboard_url(measure_id),
-                interesting_file.name,
-                get_chart_id(measure_id),
-            )
-        else:
-            interesting_img = None
+    measure_ids_for_images = {}
+    most_changing = stats["most_changing"]
+    if most_changing["declines"]:
+        measure_id = most_changing["declines"][0]["measure"].id
+        measure_ids_for_images["getting_worse_image"] = measure_id
+    if stats["worst"]:
+        measure_ids_for_images["still_bad_image"] = stats["worst"][0].id
+    if stats["interesting"]:
+        measure_ids_for_images["interesting_image"] = stats["interesting"][0].id
+    images = attach_images(
+        msg,
+        [
+            (org_bookmark.dashboard_url(measure_id), get_chart_id(measure_id))
+            for measure_id in measure_ids_for_images.values()
+        ],
+        get_data_version(),
+    )
+    images = dict(zip(measure_ids_for_images, images))
 
     unsubscribe_link = settings.GRAB_HOST + reverse(
         "bookmarks", kwargs={"key": org_bookmark.user.profile.key}
@@ -752,9 +982,9 @@ def make_org_email(org_bookmark, stats, tag=None):
         "has_stats": _hasStats(stats),
         "domain": settings.GRAB_HOST,
         "measures_count": Measure.objects.non_preview().count(),
-        "getting_worse_image": getting_worse_img,
-        "still_bad_image": still_bad_img,
-        "interesting_image": interesting_img,
+        "getting_worse_image": images.get("getting_worse_image"),
+        "still_bad_image": images.get("still_bad_image"),
+        "interesting_image": images.get("interesting_image"),
         "bookmark": org_bookmark,
         "dashboard_uri": mark_safe(dashboard_uri),
         "qs": mark_safe(msg.qs),
@@ -20,6 +20,10 @@ PER_CATEGORY_DISCOUNT_CUTOFF_DATE = "2024-04-01"
 GENERIC_DISCOUNT_PERCENTAGE = 20.0
 BRAND_DISCOUNT_PERCENTAGE = 5.0
 APPLIANCE_DISCOUNT_PERCENTAGE = 9.85
+# Maximum number of values we fetch from the MatrixStore in a single stack (see
+# `_get_prescribed_quantity_matrix`), which bounds the memory used to around
+# 128MB
+MAX_STACK_SIZE = 2**24
 
 
 ConcessionPriceMatrices = namedtuple(
@@ -169,21 +173,34 @@ def _get_prescribed_quantity_matrix(bnf_code_offsets, date_offsets, org_type, or
     shape = (len(bnf_code_offsets), len(date_offsets))
     quantities = numpy.zeros(shape, dtype=numpy.int64)
     # If this organisation is not in the set of available groups (because it
-    # has no prescribing data) then return the zero-valued quantity matrix
-    if org_id not in group_by_org.offsets:
+    # has no prescribing data), or there are no dates to fetch, then return the
+    # zero-valued quantity matrix
+    if org_id not in group_by_org.offsets or not date_offsets:
         return quantities
-    # Find the columns corresponding to the dates we're interested in
-    columns_selector = _get_date_columns_selector(db.date_offsets, date_offsets)
-    prescribing = _get_quantities_for_bnf_codes(db, list(bnf_code_offsets.keys()))
-    for bnf_code, quantity in prescribing:
-        # Remap the date columns to just the dates we want
-        quantity = quantity[columns_selector]
-        # Sum the prescribing for the given organisation
-        quantity = group_by_org.sum_one_group(quantity, org_id)
-        # Write that sum into the quantities matrix at the correct offset for
-        # the current BNF code
-        row_offset = bnf_code_offsets[bnf_code]
-        quantities[row_offset] = quantity
+    # Find the columns corresponding to the dates we're interested in, and
+    # fetch just the range of dates which covers them
+    _, columns = _get_date_columns_selector(db.date_offsets, date_offsets)
+    date_slice = slice(min(columns), max(columns) + 1)
+    columns = numpy.array(columns) - date_slice.start
+    # Fetch just the rows for the practices in this organisation
+    practice_rows = group_by_org.get_row_offsets(org_id)
+    bnf_codes = list(bnf_code_offsets.keys())
+    stack_size = len(practice_rows) * (date_slice.stop - date_slice.start)
+    batch_size = max(1, MAX_STACK_SIZE // max(1, stack_size))
+    for start in range(0, len(bnf_codes), batch_size):
+        batch_codes, stack = db.fetch_stack(
+            "quantity",
+            bnf_codes[start : start + batch_size],
+            date_slice=date_slice,
+            practice_rows=practice_rows,
+        )
+        # Sum the prescribing over the organisation's practices and remap the
+        # date columns to just the dates we want
+        totals = stack.sum(axis=1)[:, columns]
+        # Write those sums into the quantities matrix at the correct offsets
+        # for each BNF code
+        row_offsets = [bnf_code_offsets[bnf_code] for bnf_code in batch_codes]
+        quantities[row_offsets] = totals
     return quantities
 
 
@@ -223,25 +240,6 @@ def _get_date_columns_selector(available_date_offsets, required_date_offsets):
     return rows, columns
 
 
-def _get_quantities_for_bnf_codes(db, bnf_codes):
-    """
-    Return the prescribed quantity matrices for the given list of BNF codes
-    """
-    return db.query(
-        """
-        SELECT
-          bnf_code, quantity
-        FROM
-          presentation
-        WHERE
-          bnf_code IN ({})
-        """.format(
-            ",".join(["?"] * len(bnf_codes))
-        ),
-        bnf_codes,
-    )
-
-
 def _get_concession_price_matrices(min_date, max_date):
     """
     Return details of NCSO price concessions in the given date range
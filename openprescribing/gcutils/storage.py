@@ -1,3 +1,6 @@
+import os
+import shutil
+
 from django.conf import settings
 from google.cloud import storage as gcs
 
@@ -16,3 +19,58 @@ class Client(object):
 
     def __getattr__(self, name):
         return getattr(self.gcs_client, name)
+
+
+class LocalBucket(object):
+    """Stands in for a `gcs.Bucket` by storing blobs as files in a local
+    directory, so that code which reads and writes to Cloud Storage can be
+    run and tested offline.
+
+    Only the parts of the `gcs.Bucket` and `gcs.Blob` interfaces which we
+    use are supported.
+    """
+
+    def __init__(self, directory, name="local"):
+        self.directory = directory
+        self.name = name
+
+    def blob(self, name):
+        return LocalBlob(self, name)
+
+    def list_blobs(self, prefix=""):
+        names = []
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, self.directory).replace(os.sep, "/")
+                if name.startswith(prefix):
+                    names.append(name)
+        return [self.blob(name) for name in sorted(names)]
+
+
+class LocalBlob(object):
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.path = os.path.join(bucket.directory, *name.split("/"))
+
+    @property
+    def size(self):
+        return os.path.getsize(self.path) if self.exists() else None
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def upload_from_string(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf8")
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "wb") as f:
+            f.write(data)
+
+    def upload_from_filename(self, filename):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        shutil.copyfile(filename, self.path)
+
+    def download_to_filename(self, filename):
+        shutil.copyfile(self.path, filename)
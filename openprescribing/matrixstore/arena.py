@@ -0,0 +1,88 @@
+"""
+Support for storing a MatrixStore file's matrices in an uncompressed "arena" file
+alongside it
+
+Normally every matrix is stored LZ4-compressed inside the SQLite file, so each read
+has to allocate memory and decompress into it. When a file is built with an arena
+the matrices are instead written uncompressed (and suitably aligned) to the arena
+file and the BLOB columns in the SQLite file hold just small references giving the
+location of each matrix within it. We memory-map the arena and deserialize matrices
+as zero-copy views on to the mapped memory, so reads involve no copying or
+decompression and the pages are shared (via the OS page cache) between all the
+processes which have the file open.
+"""
+
+import mmap
+import os.path
+import struct
+
+from .serializer import deserialize, deserialize_aligned
+
+# Written at the start of every arena file. It also ensures the file is never
+# empty, as empty files can't be memory-mapped.
+ARENA_HEADER = b"MATRIXSTORE-ARENA-1\n"
+
+# Each matrix in the arena starts at a multiple of this many bytes (and so do the
+# buffers within it, see `serialize_aligned`). This is more than enough for any
+# numpy dtype and matches the typical cache line size. The mapping itself is
+# always page-aligned.
+ARENA_ALIGNMENT = 64
+
+# References are stored in place of the serialized matrices in the SQLite file and
+# consist of a magic number followed by the offset and length of the matrix within
+# the arena. Serialized matrices start with either the LZ4 magic number or a small
+# count of buffers, so they can't be confused with references.
+REFERENCE_MAGIC = b"MSAR"
+REFERENCE_STRUCT = struct.Struct("<4sQQ")
+
+
+def get_arena_path(sqlite_path):
+    """
+    Return the path to the arena file which accompanies the supplied SQLite file
+    """
+    return os.path.splitext(sqlite_path)[0] + ".arena"
+
+
+def encode_reference(offset, length):
+    return REFERENCE_STRUCT.pack(REFERENCE_MAGIC, offset, length)
+
+
+def is_reference(value):
+    return len(value) == REFERENCE_STRUCT.size and value[:4] == REFERENCE_MAGIC
+
+
+def decode_reference(value):
+    _, offset, length = REFERENCE_STRUCT.unpack(value)
+    return offset, length
+
+
+class Arena(object):
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            # The mapping is read-only, and so are the matrices we return, as
+            # otherwise modifying a matrix in place would change its value for
+            # every subsequent read
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.size = len(self._mmap)
+        self._view = memoryview(self._mmap)
+        if self._view[: len(ARENA_HEADER)] != ARENA_HEADER:
+            raise RuntimeError("Not a MatrixStore arena file: " + path)
+
+    def deserialize(self, value):
+        """
+        Deserialize a value from the SQLite file, whether that's a reference to
+        a matrix in the arena or a serialized matrix
+        """
+        if is_reference(value):
+            offset, length = decode_reference(value)
+            return deserialize_aligned(self._view[offset : offset + length])
+        return deserialize(value)
+
+    def close(self):
+        try:
+            self._view.release()
+            self._mmap.close()
+        except BufferError:
+            # Matrices which are still in use hold views on to the mapping, and
+            # it will be unmapped once these are garbage collected
+            pass
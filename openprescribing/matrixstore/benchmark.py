@@ -0,0 +1,329 @@
+"""
+Times the queries which account for most of the MatrixStore's workload, so that
+we can tell whether a change makes them faster or slower
+
+The benchmarks run against any MatrixStore file but are designed to be run
+against synthetic files (see `matrixstore.synthetic`), which means they can be
+run anywhere and the results from different commits are directly comparable.
+Results are returned as a JSON-serializable dict.
+
+Invoke with:
+./manage.py matrixstore_benchmark --output results.json
+"""
+
+import datetime
+import functools
+import os.path
+import statistics
+import subprocess
+import sys
+import time
+from collections import Counter, defaultdict
+
+import numpy
+from frontend.ghost_branded_generics import (
+    get_prescribing_for_orgs,
+    infer_tariff_price_for_presentations,
+)
+from frontend.price_per_unit.savings import get_savings_for_org_type
+from frontend.price_per_unit.substitution_sets import SubstitutionSet
+
+from .db import pinned_db, query_by_org, query_presentations_by_org
+from .row_grouper import RowGrouper
+
+COLUMNS = ["items", "quantity", "actual_cost", "net_cost"]
+
+# Lengths of the BNF code prefixes for which we benchmark summing, see
+# `get_benchmarks`
+PREFIX_LEVELS = {"chapter": 2, "section": 4, "chemical": 9}
+
+
+def run_benchmarks(db, repeat=5, only=None):
+    """
+    Run each benchmark `repeat` times against the supplied MatrixStore
+    instance and return a dict describing the results
+
+    If `only` is supplied we run just those benchmarks whose names start with
+    one of the supplied strings.
+    """
+    results = {}
+    with pinned_db(db):
+        for name, func in get_benchmarks(db):
+            if only and not any(name.startswith(prefix) for prefix in only):
+                continue
+            results[name] = time_function(func, repeat)
+    return {
+        "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": get_git_commit(),
+        "python_version": sys.version.split()[0],
+        "numpy_version": numpy.__version__,
+        "matrixstore": describe_matrixstore(db),
+        "repeat": repeat,
+        "benchmarks": results,
+    }
+
+
+def get_benchmarks(db):
+    """
+    Return a list of (name, function) pairs, where each function runs one of
+    the queries we want to time
+
+    The targets of the queries (e.g. which BNF section or which CCG) are
+    picked deterministically from the contents of the file.
+    """
+    bnf_codes = [
+        bnf_code
+        for (bnf_code,) in db.connection.execute(
+            "SELECT bnf_code FROM presentation ORDER BY bnf_code"
+        )
+    ]
+    date = db.dates[-1]
+    prefixes = get_most_common_prefixes(bnf_codes)
+    section_codes = [code for code in bnf_codes if code.startswith(prefixes["section"])]
+    chapter_query = {
+        "columns": ["bnf_code", "items", "actual_cost"],
+        "where": "bnf_code LIKE ?",
+        "params": [prefixes["chapter"] + "%"],
+    }
+    org_groupers = {
+        org_type: RowGrouper(
+            (db.practice_offsets[code], org_id)
+            for code, org_id in db.get_practice_to_org_map(org_type).items()
+        )
+        for org_type in sorted(db.grouped_org_types)
+    }
+    # This is built in exactly the same way as `get_row_grouper("practice")`
+    # but without touching the database
+    org_groupers["practice"] = RowGrouper(
+        (offset, code) for code, offset in db.practice_offsets.items()
+    )
+    substitution_sets = get_substitution_sets(bnf_codes)
+    generic_codes = [code for code in bnf_codes if code[9:11] == "AA"]
+    benchmarks = []
+
+    for level, prefix in prefixes.items():
+        benchmarks.append(
+            (
+                "matrix_sum.{}".format(level),
+                lambda prefix=prefix: db.query_one(
+                    "SELECT {} FROM presentation WHERE bnf_code LIKE ?".format(
+                        ", ".join("MATRIX_SUM({})".format(c) for c in COLUMNS)
+                    ),
+                    [prefix + "%"],
+                ),
+            )
+        )
+        benchmarks.append(
+            (
+                "sum_by_bnf_prefixes.{}".format(level),
+                lambda prefix=prefix: db.sum_by_bnf_prefixes(COLUMNS, [prefix]),
+            )
+        )
+
+    chapter_matrices = [
+        matrix for (_, matrix, _) in db.query_presentations(**chapter_query)
+    ]
+    # Totals over all presentations give us dense matrices to group, as well as
+    # the mostly sparse matrices of individual presentations
+    total_matrices = db.query_one(
+        "SELECT {} FROM all_presentations".format(", ".join(COLUMNS))
+    )
+    for org_type, group_by_org in org_groupers.items():
+        benchmarks.append(
+            (
+                "row_grouper.{}".format(org_type),
+                lambda group_by_org=group_by_org: [
+                    group_by_org.sum(matrix) for matrix in chapter_matrices
+                ],
+            )
+        )
+        benchmarks.append(
+            (
+                "row_grouper_dense.{}".format(org_type),
+                lambda group_by_org=group_by_org: [
+                    group_by_org.sum(matrix) for matrix in total_matrices
+                ],
+            )
+        )
+    for org_type in sorted(db.grouped_org_types):
+        benchmarks.append(
+            (
+                "query_by_org.{}".format(org_type),
+                lambda org_type=org_type: list(
+                    query_by_org(org_type=org_type, **chapter_query)
+                ),
+            )
+        )
+
+    # We call the functions wrapped by `memoize` so that we time the
+    # calculation rather than the cache
+    ppu_groupers = {
+        org_type: org_groupers[org_type]
+        for org_type in ["ccg", "practice"]
+        if org_type in org_groupers
+    }
+    ppu_groupers["all_standard_practices"] = RowGrouper(
+        (offset, None) for offset in db.practice_offsets.values()
+    )
+    for org_type, group_by_org in ppu_groupers.items():
+        benchmarks.append(
+            (
+                "ppu_savings.{}".format(org_type),
+                functools.partial(
+                    get_savings_for_org_type.__wrapped__,
+                    db,
+                    substitution_sets,
+                    date,
+                    group_by_org,
+                    min_saving=1,
+                    practice_group_by_org=org_groupers["practice"],
+                    target_centile=10,
+                ),
+            )
+        )
+
+    benchmarks.append(
+        (
+            "ghost_generics.tariff_prices",
+            lambda: infer_tariff_price_for_presentations(db, generic_codes, date),
+        )
+    )
+    if "ccg" in db.grouped_org_types:
+        ccg_ids = org_groupers["ccg"].ids
+        benchmarks.append(
+            (
+                "ghost_generics.prescribing_for_orgs",
+                lambda: list(
+                    get_prescribing_for_orgs(db, generic_codes, date, "ccg", ccg_ids)
+                ),
+            )
+        )
+
+    measure_orgs = []
+    if "ccg" in db.grouped_org_types:
+        measure_orgs.append(("ccg", org_groupers["ccg"].ids[0]))
+    # Without the practice index, practice queries need org relationships from
+    # the database
+    if db.has_practice_index:
+        measure_orgs.append(("practice", db.practices[0]))
+    for org_type, org_id in measure_orgs:
+        benchmarks.append(
+            (
+                "measure_numerators.{}".format(org_type),
+                lambda org_type=org_type, org_id=org_id: list(
+                    query_presentations_by_org(
+                        ["items", "quantity", "actual_cost"],
+                        section_codes,
+                        org_type,
+                        org_ids=[org_id],
+                    )
+                ),
+            )
+        )
+    return benchmarks
+
+
+def get_most_common_prefixes(bnf_codes):
+    """
+    Return a dict mapping each level in `PREFIX_LEVELS` to the most common
+    prefix of that length, with each prefix nested within the previous one
+    """
+    prefixes = {}
+    prefix = ""
+    for level, length in PREFIX_LEVELS.items():
+        counts = Counter(code[:length] for code in bnf_codes if code.startswith(prefix))
+        # Break ties by picking the lowest prefix, to keep this deterministic
+        prefix = min(counts, key=lambda value: (-counts[value], value))
+        prefixes[level] = prefix
+    return prefixes
+
+
+def get_substitution_sets(bnf_codes):
+    """
+    Return a dict mapping generic codes to SubstitutionSets containing the
+    generic plus its branded equivalents, using the same rule as
+    `frontend.price_per_unit.substitution_sets` but without touching the
+    database
+    """
+    presentations = defaultdict(list)
+    for bnf_code in bnf_codes:
+        generic_code = bnf_code[:9] + "AA" + bnf_code[-2:] + bnf_code[-2:]
+        presentations[generic_code].append(bnf_code)
+    return {
+        generic_code: SubstitutionSet(id=generic_code, presentations=codes)
+        for generic_code, codes in presentations.items()
+        if len(codes) > 1 and generic_code in codes
+    }
+
+
+def time_function(func, repeat):
+    """
+    Return the time taken by the first call to `func` (which may include
+    one-off costs, like populating caches) plus the best and median times over
+    `repeat` further calls, all in seconds
+    """
+    durations = []
+    for _ in range(repeat + 1):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return {
+        "first": durations[0],
+        "best": min(durations[1:]),
+        "median": statistics.median(durations[1:]),
+    }
+
+
+def describe_matrixstore(db):
+    num_presentations = db.connection.execute(
+        "SELECT COUNT(*) FROM presentation"
+    ).fetchone()[0]
+    return {
+        "filename": db.cache_key.decode("utf8"),
+        "practices": len(db.practices),
+        "presentations": num_presentations,
+        "months": len(db.dates),
+        "date_blocks": len(db.date_blocks),
+        "grouped_org_types": sorted(db.grouped_org_types),
+        "practice_index": db.has_practice_index,
+        "arena": db.arena is not None,
+    }
+
+
+def get_git_commit():
+    """
+    Return the hash of the current commit, if we can find one
+    """
+    try:
+        output = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            check=True,
+            text=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.stdout.strip()
+
+
+def compare_results(previous, current):
+    """
+    Return a list of lines comparing the best times of the benchmarks in two
+    sets of results
+    """
+    lines = []
+    for name, result in current["benchmarks"].items():
+        previous_result = previous["benchmarks"].get(name)
+        if previous_result is None:
+            lines.append("{}: {:.2f}ms (new)".format(name, result["best"] * 1000))
+            continue
+        lines.append(
+            "{}: {:.2f}ms -> {:.2f}ms ({:.2f}x)".format(
+                name,
+                previous_result["best"] * 1000,
+                result["best"] * 1000,
+                previous_result["best"] / result["best"],
+            )
+        )
+    return lines
@@ -0,0 +1,385 @@
+"""
+Build a new SQLite file from a previous one by dropping its oldest months of
+data and appending the months which have been published since
+
+Rebuilding from scratch each month means downloading, parsing and importing
+several years of prescribing when nearly all of it is already in the previous
+file. Instead we download and parse just the new months and, for every matrix in
+the previous file, shift its columns along to make room for them and move each
+of its rows to its practice's offset in the new file. This is done in bulk for
+each matrix rather than cell by cell.
+
+The previous file is only ever read, so it remains usable (and live) until the
+new file has been completely built and `verify_appended_months` has checked that
+the two agree on all the months they share.
+"""
+
+import heapq
+import logging
+import os
+import sqlite3
+from itertools import groupby
+
+import numpy
+import scipy.sparse
+from gcutils.bigquery import Client
+from matrixstore.connection import MatrixStore
+from matrixstore.matrix_ops import finalise_matrix, is_integer
+from matrixstore.serializer import serialize_compressed
+
+from . import import_practice_stats, import_prescribing
+from .common import get_temp_filename
+from .dates import generate_dates
+from .init_db import SCHEMA_SQL, get_active_practice_codes, import_dates
+
+logger = logging.getLogger(__name__)
+
+
+COLUMNS = ["items", "quantity", "actual_cost", "net_cost"]
+
+
+def get_dates_to_append(previous_path, end_date, months=None):
+    """
+    Return the dates which a file ending at `end_date` would contain but which
+    the file at `previous_path` does not
+    """
+    previous = MatrixStore.from_file(previous_path)
+    try:
+        return get_new_dates(previous.dates, generate_dates(end_date, months=months))
+    finally:
+        previous.close()
+
+
+def append_months(previous_path, end_date, sqlite_path, months=None):
+    if os.path.exists(sqlite_path):
+        raise RuntimeError("File already exists at: " + sqlite_path)
+    logger.info(
+        "Initialising SQLite database at %s from %s", sqlite_path, previous_path
+    )
+    sqlite_path = os.path.abspath(sqlite_path)
+    temp_filename = get_temp_filename(sqlite_path)
+    previous = MatrixStore.from_file(previous_path)
+    dates = generate_dates(end_date, months=months)
+    new_dates = get_new_dates(previous.dates, dates)
+    bq_conn = Client("hscic")
+    sqlite_conn = sqlite3.connect(temp_filename)
+    # Trade crash-safety for insert speed
+    sqlite_conn.execute("PRAGMA synchronous=OFF")
+    append_months_for_db(
+        previous,
+        sqlite_conn,
+        dates,
+        get_active_practice_codes(bq_conn, new_dates),
+        import_prescribing.get_prescriptions_for_dates(new_dates),
+        import_practice_stats.get_practice_statistics_for_dates(new_dates),
+    )
+    sqlite_conn.commit()
+    sqlite_conn.close()
+    previous.close()
+    os.rename(temp_filename, sqlite_path)
+
+
+def append_months_for_db(
+    previous, connection, dates, new_practice_codes, prescriptions, practice_statistics
+):
+    """
+    Populate the empty database `connection` with the data in the `previous`
+    MatrixStore for `dates`, plus the supplied prescriptions and practice
+    statistics (in the formats produced by `import_prescribing` and
+    `import_practice_stats`) for the remaining dates
+
+    `new_practice_codes` must include every practice with data in those
+    remaining dates.
+    """
+    new_dates = get_new_dates(previous.dates, dates)
+    num_shared = len(dates) - len(new_dates)
+    logger.info(
+        "Keeping %s months from previous file and appending %s to %s",
+        num_shared,
+        new_dates[0],
+        new_dates[-1],
+    )
+    # Shifting the previous file's matrices this many columns to the left drops
+    # the months we no longer want and leaves the shared months at the start
+    shift = num_shared - len(previous.dates)
+    practice_codes = sorted(
+        set(get_practices_with_data(previous, shift)) | set(new_practice_codes)
+    )
+    connection.executescript(SCHEMA_SQL)
+    import_dates(connection, dates)
+    logger.info("Writing %s practice codes to SQLite", len(practice_codes))
+    connection.executemany(
+        "INSERT INTO practice (offset, code) VALUES (?, ?)", enumerate(practice_codes)
+    )
+    practice_offsets = {code: offset for offset, code in enumerate(practice_codes)}
+    # Maps each row in the previous file's matrices to its row in the new file,
+    # or to -1 for practices which have been dropped
+    row_map = numpy.array(
+        [practice_offsets.get(code, -1) for code in previous.practices],
+        dtype=numpy.int64,
+    )
+    appender = MatrixAppender(
+        row_map, shift, num_shared, (len(practice_codes), len(dates))
+    )
+    new_date_offsets = {date: offset for offset, date in enumerate(new_dates)}
+    append_practice_stats(
+        connection,
+        appender,
+        previous.query("SELECT name, value FROM practice_statistic ORDER BY name"),
+        import_practice_stats.build_matrices(
+            practice_statistics, practice_offsets, new_date_offsets
+        ),
+    )
+    append_prescribing(
+        connection,
+        appender,
+        previous.query(
+            "SELECT bnf_code, {} FROM presentation ORDER BY bnf_code".format(
+                ", ".join(COLUMNS)
+            )
+        ),
+        import_prescribing.build_matrices(
+            prescriptions, practice_offsets, new_date_offsets
+        ),
+    )
+
+
+def append_practice_stats(connection, appender, previous_rows, new_rows):
+    count = 0
+    for name, previous_values, new_values in join_sorted(previous_rows, new_rows):
+        matrix = appender.append(
+            previous_values[0] if previous_values else None,
+            new_values[0] if new_values else None,
+        )
+        connection.execute(
+            "INSERT INTO practice_statistic (name, value) VALUES (?, ?)",
+            [name, serialize_compressed(matrix)],
+        )
+        count += 1
+    logger.info("Wrote %s practice statistics matrices to SQLite", count)
+
+
+def append_prescribing(connection, appender, previous_rows, new_rows):
+    count = 0
+    for bnf_code, previous_values, new_values in join_sorted(previous_rows, new_rows):
+        matrices = [
+            appender.append(previous_matrix, new_matrix)
+            for previous_matrix, new_matrix in zip(
+                previous_values or [None] * len(COLUMNS),
+                new_values or [None] * len(COLUMNS),
+            )
+        ]
+        # Presentations which were only prescribed in the months we've dropped
+        # wouldn't appear in a file built from scratch, so we leave them out
+        if new_values is None and not any(map(has_values, matrices)):
+            continue
+        connection.execute(
+            """
+            INSERT INTO
+              presentation (bnf_code, items, quantity, actual_cost, net_cost)
+            VALUES
+              (?, ?, ?, ?, ?)
+            """,
+            [bnf_code] + [serialize_compressed(matrix) for matrix in matrices],
+        )
+        count += 1
+        if import_prescribing.should_log_message(count):
+            logger.info("Writing data for %s (%s)", bnf_code, count)
+    logger.info("Finished writing data for %s presentations", count)
+
+
+class MatrixAppender(object):
+    """
+    Builds the matrices for the new file by combining the shifted and remapped
+    values from the previous file's matrices with the values for the new months
+    """
+
+    def __init__(self, row_map, shift, num_shared, shape):
+        self.row_map = row_map
+        self.shift = shift
+        self.num_shared = num_shared
+        self.shape = shape
+
+    def append(self, previous_matrix, new_matrix):
+        """
+        Return a matrix (in the same form as `finalise_matrix` produces) of the
+        values in `previous_matrix` for the shared months followed by the values
+        in `new_matrix`, either of which may be None if there are no values
+        """
+        entries = []
+        if previous_matrix is not None:
+            entries.append(get_entries(previous_matrix, self.shift, self.row_map))
+        if new_matrix is not None:
+            entries.append(get_entries(new_matrix, self.num_shared))
+        integer = all(is_integer(values) for (_, _, values) in entries)
+        dtype = numpy.int64 if integer else numpy.float64
+        rows, cols, values = [
+            numpy.concatenate([entry[i] for entry in entries]) for i in range(3)
+        ]
+        matrix = scipy.sparse.csc_matrix(
+            (values.astype(dtype), (rows, cols)), shape=self.shape
+        )
+        return finalise_matrix(matrix)
+
+
+def get_entries(matrix, shift, row_map=None):
+    """
+    Return the rows, columns and values of the non-zero entries in `matrix`,
+    with the columns shifted `shift` places to the right (dropping entries which
+    end up before the first column) and the rows mapped through `row_map`
+    """
+    matrix = scipy.sparse.coo_matrix(matrix)
+    rows = matrix.row
+    cols = matrix.col.astype(numpy.int64) + shift
+    values = matrix.data
+    if shift < 0:
+        keep = cols >= 0
+        rows, cols, values = rows[keep], cols[keep], values[keep]
+    if row_map is not None:
+        rows = row_map[rows]
+        if numpy.any(rows < 0):
+            raise RuntimeError("Found values for a practice which has been dropped")
+    return rows, cols, values
+
+
+def has_values(matrix):
+    if scipy.sparse.issparse(matrix):
+        return matrix.nnz > 0
+    return bool(numpy.any(matrix))
+
+
+def get_practices_with_data(previous, shift):
+    """
+    Return the codes of the practices in the `previous` MatrixStore which have
+    prescribing or practice statistics in any of the months we keep (i.e. after
+    shifting its columns `shift` places to the right)
+    """
+    has_data = numpy.zeros(len(previous.practices), dtype=bool)
+    # Totals over all presentations tell us which practices prescribed, without
+    # having to read every presentation
+    matrices = []
+    for row in previous.query(
+        "SELECT {} FROM all_presentations".format(", ".join(COLUMNS))
+    ):
+        matrices.extend(row)
+    for name, value in previous.query("SELECT name, value FROM practice_statistic"):
+        matrices.append(value)
+    for matrix in matrices:
+        rows, _, _ = get_entries(matrix, shift)
+        has_data[rows] = True
+    return [code for code, keep in zip(previous.practices, has_data) if keep]
+
+
+def get_new_dates(previous_dates, dates):
+    """
+    Check that `dates` carry straight on from some of `previous_dates` and return
+    those which aren't in `previous_dates`
+    """
+    num_shared = len(set(previous_dates) & set(dates))
+    if (
+        num_shared == 0
+        or dates[:num_shared] != previous_dates[len(previous_dates) - num_shared :]
+    ):
+        raise RuntimeError(
+            "Dates {} to {} don't follow on from previous dates {} to {}".format(
+                dates[0], dates[-1], previous_dates[0], previous_dates[-1]
+            )
+        )
+    if num_shared == len(dates):
+        raise RuntimeError(
+            "Previous file already contains all dates up to {}".format(dates[-1])
+        )
+    return dates[num_shared:]
+
+
+def join_sorted(previous_rows, new_rows):
+    """
+    Given two iterables of rows sorted by their first value (which must be
+    unique within each iterable), yield triples of the form:
+
+        key, previous_values, new_values
+
+    where either set of values is None if there was no matching row
+    """
+    tagged_rows = heapq.merge(
+        ((row[0], 0, row[1:]) for row in previous_rows),
+        ((row[0], 1, row[1:]) for row in new_rows),
+    )
+    for key, group in groupby(tagged_rows, lambda tagged_row: tagged_row[0]):
+        values = [None, None]
+        for _, index, row_values in group:
+            values[index] = row_values
+        yield key, values[0], values[1]
+
+
+def verify_appended_months(previous_path, sqlite_path):
+    previous = MatrixStore.from_file(previous_path)
+    matrixstore = MatrixStore.from_file(sqlite_path)
+    try:
+        verify_appended_months_for_db(previous, matrixstore)
+    finally:
+        previous.close()
+        matrixstore.close()
+
+
+def verify_appended_months_for_db(previous, matrixstore):
+    """
+    Check that the totals over all presentations in the two MatrixStores match,
+    practice by practice, over all the months they share
+
+    These totals are recalculated from the appended prescribing so this checks
+    that every presentation's prescribing was moved into place correctly. We
+    don't compare practice statistics as the appended file copies these
+    directly from the previous file, so they would match regardless.
+
+    Raises a RuntimeError if they don't.
+    """
+    dates = [date for date in previous.dates if date in matrixstore.date_offsets]
+    if not dates:
+        raise RuntimeError("New file shares no dates with previous file")
+    practices = sorted(set(previous.practices) | set(matrixstore.practices))
+    logger.info(
+        "Checking new file against previous file from %s to %s", dates[0], dates[-1]
+    )
+    sql = "SELECT {} FROM all_presentations".format(", ".join(COLUMNS))
+    previous_row = next(previous.query(sql), None)
+    if previous_row is None:
+        raise RuntimeError("Previous file has no totals over all presentations")
+    row = next(matrixstore.query(sql), [None] * len(COLUMNS))
+    for column, previous_matrix, matrix in zip(COLUMNS, previous_row, row):
+        expected = get_values_for_codes(previous, previous_matrix, practices, dates)
+        if matrix is None:
+            matches = False
+        else:
+            values = get_values_for_codes(matrixstore, matrix, practices, dates)
+            if is_integer(expected) and is_integer(values):
+                matches = numpy.array_equal(expected, values)
+            else:
+                matches = numpy.allclose(expected, values)
+        if not matches:
+            raise RuntimeError(
+                "New file doesn't match previous file for all_presentations.{} "
+                "between {} and {}".format(column, dates[0], dates[-1])
+            )
+    logger.info("New file matches previous file")
+
+
+def get_values_for_codes(matrixstore, matrix, practice_codes, dates):
+    """
+    Return a dense array of the values in `matrix` for each of the supplied
+    practice codes (with rows of zeros for those not in the MatrixStore) and
+    dates
+    """
+    if scipy.sparse.issparse(matrix):
+        matrix = matrix.toarray()
+    rows = []
+    offsets = []
+    for row, code in enumerate(practice_codes):
+        offset = matrixstore.practice_offsets.get(code)
+        if offset is not None:
+            rows.append(row)
+            offsets.append(offset)
+    cols = [matrixstore.date_offsets[date] for date in dates]
+    values = numpy.zeros((len(practice_codes), len(dates)), dtype=matrix.dtype)
+    values[rows] = matrix[numpy.ix_(offsets, cols)]
+    return values
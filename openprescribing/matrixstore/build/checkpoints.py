@@ -0,0 +1,245 @@
+"""
+Run the stages of a MatrixStore build, recording a checkpoint in the working
+SQLite file as each one completes so that a failed build can be resumed
+
+Each checkpoint holds a fingerprint of the stage's inputs: the arguments it was
+called with plus the fingerprint of the stage before it, so that changing the
+inputs to any stage invalidates all the stages which follow it. Re-running a
+build skips each stage whose checkpoint matches and resumes from the first one
+which doesn't (or from the stage named by `from_stage`).
+
+Stages which run before the working file exists (e.g. downloading data for an
+incremental build) have their checkpoints written once it's created. These
+stages skip any files which have already been downloaded so they're cheap to
+repeat if the build fails before that point.
+
+As the working file has a predictable name, each build holds an exclusive lock
+on it (see `lock_working_file`) so that one build can't remove or modify a file
+which another is still using.
+"""
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+
+from matrixstore.arena import get_arena_path
+
+logger = logging.getLogger(__name__)
+
+
+CHECKPOINT_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS build_checkpoint (
+        stage TEXT,
+        fingerprint TEXT,
+        -- Time taken to run the stage, in seconds
+        duration REAL,
+
+        PRIMARY KEY (stage)
+    )
+"""
+
+
+class Stage(object):
+    """
+    A named build step, which consists of calling `func` with the supplied
+    arguments
+
+    `creates_file` marks the stage which creates the working file (and which
+    will fail if a file already exists).
+    """
+
+    def __init__(self, name, func, *args, creates_file=False, **kwargs):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.creates_file = creates_file
+
+    def get_fingerprint(self, previous_fingerprint):
+        inputs = [
+            previous_fingerprint,
+            self.name,
+            self.args,
+            sorted(self.kwargs.items()),
+        ]
+        return hashlib.sha256(repr(inputs).encode("utf8")).hexdigest()
+
+
+class StageRunner(object):
+    def __init__(self, sqlite_path, stages, from_stage=None):
+        names = [stage.name for stage in stages]
+        if from_stage is not None and from_stage not in names:
+            raise ValueError(
+                "Unknown stage '{}', expected one of: {}".format(
+                    from_stage, ", ".join(names)
+                )
+            )
+        self.sqlite_path = sqlite_path
+        self.stages = stages
+        self.from_stage = from_stage
+        # List of (stage, status, duration) tuples
+        self.timings = []
+
+    def run(self):
+        checkpoints = self.read_checkpoints()
+        fingerprint = ""
+        resuming = True
+        completed = []
+        # Checkpoints for stages which have completed but which haven't yet been
+        # written because the working file doesn't exist
+        pending = []
+        for stage in self.stages:
+            fingerprint = stage.get_fingerprint(fingerprint)
+            if (
+                resuming
+                and stage.name != self.from_stage
+                and checkpoints.get(stage.name, (None,))[0] == fingerprint
+            ):
+                duration = checkpoints[stage.name][1]
+                logger.info("Skipping stage %s (already completed)", stage.name)
+                self.timings.append((stage.name, "skipped", duration))
+                completed.append(stage.name)
+                continue
+            if resuming:
+                if completed:
+                    logger.info("Resuming build from stage %s", stage.name)
+                # The checkpoints for this stage and all the stages following it
+                # are no longer valid
+                self.discard_checkpoints(keep=completed)
+                resuming = False
+            if stage.creates_file:
+                self.remove_working_file()
+            logger.info("Running stage %s", stage.name)
+            start = time.time()
+            stage.func(*stage.args, **stage.kwargs)
+            duration = time.time() - start
+            self.timings.append((stage.name, "completed", duration))
+            completed.append(stage.name)
+            pending.append((stage.name, fingerprint, duration))
+            if os.path.exists(self.sqlite_path):
+                self.write_checkpoints(pending)
+                pending = []
+        if pending:
+            raise RuntimeError("No working file at: {}".format(self.sqlite_path))
+
+    def read_checkpoints(self):
+        """
+        Return a dict mapping stage names to (fingerprint, duration) pairs
+        """
+        if not os.path.exists(self.sqlite_path):
+            return {}
+        connection = sqlite3.connect(self.sqlite_path)
+        try:
+            if not has_checkpoint_table(connection):
+                return {}
+            return {
+                stage: (fingerprint, duration)
+                for stage, fingerprint, duration in connection.execute(
+                    "SELECT stage, fingerprint, duration FROM build_checkpoint"
+                )
+            }
+        finally:
+            connection.close()
+
+    def write_checkpoints(self, checkpoints):
+        connection = sqlite3.connect(self.sqlite_path)
+        connection.execute(CHECKPOINT_TABLE_SQL)
+        connection.executemany(
+            "INSERT OR REPLACE INTO build_checkpoint VALUES (?, ?, ?)", checkpoints
+        )
+        connection.commit()
+        connection.close()
+
+    def discard_checkpoints(self, keep):
+        """
+        Delete the checkpoints for all stages not in `keep`
+        """
+        if not os.path.exists(self.sqlite_path):
+            return
+        connection = sqlite3.connect(self.sqlite_path)
+        if has_checkpoint_table(connection):
+            connection.execute(
+                "DELETE FROM build_checkpoint WHERE stage NOT IN ({})".format(
+                    ",".join("?" * len(keep))
+                ),
+                keep,
+            )
+        connection.commit()
+        connection.close()
+
+    def remove_working_file(self):
+        """
+        Remove any existing working file (and its arena) so that a stage can
+        create it afresh
+        """
+        for path in [self.sqlite_path, get_arena_path(self.sqlite_path)]:
+            if os.path.exists(path):
+                logger.info("Removing existing working file at %s", path)
+                os.unlink(path)
+
+    def remove_checkpoints(self):
+        """
+        Remove the checkpoint table from the working file, so it doesn't end up
+        in the finished build
+        """
+        connection = sqlite3.connect(self.sqlite_path)
+        connection.execute("DROP TABLE IF EXISTS build_checkpoint")
+        connection.commit()
+        connection.close()
+
+    def write_report(self, path):
+        """
+        Log the time taken by each stage and write this to `path` as JSON
+        """
+        report = []
+        for name, status, duration in self.timings:
+            logger.info("Stage %s took %.1fs (%s)", name, duration, status)
+            report.append({"stage": name, "status": status, "seconds": duration})
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+class WorkingFileLocked(Exception):
+    pass
+
+
+@contextmanager
+def lock_working_file(sqlite_path):
+    """
+    Hold an exclusive lock on the working file at `sqlite_path` (via a
+    separate lock file, as the working file itself gets removed and renamed)
+
+    Raises WorkingFileLocked if another build already holds the lock.
+    """
+    lock_path = sqlite_path + ".lock"
+    with open(lock_path, "w") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise WorkingFileLocked(
+                "Another build is using the working file at: {}".format(sqlite_path)
+            )
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def has_checkpoint_table(connection):
+    results = connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='build_checkpoint'"
+    )
+    return bool(list(results))
+
+
+def get_report_path(sqlite_path):
+    """
+    Return the path to the stage timing report which accompanies the supplied
+    SQLite file
+    """
+    return os.path.splitext(sqlite_path)[0] + ".stages.json"
@@ -2,6 +2,8 @@ import errno
 import os
 import os.path
 import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 from django.conf import settings
 
@@ -49,6 +51,29 @@ def get_temp_filename(filename):
     )
 
 
+def map_in_processes(func, iterable, workers):
+    """
+    Yield the result of calling `func` on each item in `iterable`, in order,
+    using a pool of `workers` processes (or just this process, if `workers` is
+    1)
+
+    Unlike `ProcessPoolExecutor.map` this only reads as far ahead in `iterable`
+    as it needs to to keep the workers busy, so we never hold more than a few
+    items in memory at once.
+    """
+    if workers == 1:
+        yield from map(func, iterable)
+        return
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for item in iterable:
+            if len(pending) >= workers * 4:
+                yield pending.popleft().result()
+            pending.append(executor.submit(func, item))
+        while pending:
+            yield pending.popleft().result()
+
+
 def _get_filename(date, type_name):
     return os.path.join(
         settings.MATRIXSTORE_IMPORT_DIR, "{}_{}.csv.gz".format(date, type_name)
@@ -5,6 +5,7 @@ Download prescribing data from BigQuery to gzipped CSV files in the
 import glob
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 from django.conf import settings
 
@@ -27,8 +28,13 @@ logger = logging.getLogger(__name__)
 # the export has finished using the suffix below
 SENTINEL_SUFFIX = "done"
 
+# Number of files to download from Google Cloud Storage at once
+DEFAULT_DOWNLOAD_WORKERS = 8
 
-def download_prescribing(end_date, months=None):
+
+def download_prescribing(
+    end_date, months=None, bucket=None, download_workers=DEFAULT_DOWNLOAD_WORKERS
+):
     # Getting a local copy of prescribing data for a given month is a
     # multi-stage process:
     #
@@ -38,8 +44,12 @@ def download_prescribing(end_date, months=None):
     #    into multiple files)
     # 3. Download those shard files
     # 4. Consolidate the shards into a single file, sorted by BNF code
-    bq_client = Client("prescribing_export")
-    bucket = StorageClient().bucket()
+    #
+    # We only connect to BigQuery if there's data which hasn't yet been
+    # exported, so supplying a `gcutils.storage.LocalBucket` in place of the
+    # real bucket lets us run the later stages offline
+    if bucket is None:
+        bucket = StorageClient().bucket()
     # To determine what steps to execute we need to work backwards through this
     # process. For instance, if we already have data downloaded for a given
     # date then there is no point checking whether the corresponding files
@@ -50,17 +60,22 @@ def download_prescribing(end_date, months=None):
     dates_to_consolidate = filter_dates_to_consolidate(dates)
     dates_to_download = filter_dates_to_download(dates_to_consolidate)
     dates_to_export = filter_dates_to_export(dates_to_download, bucket)
-    dates_to_extract = filter_dates_to_extract(dates_to_export, bq_client)
+    if dates_to_export:
+        bq_client = Client("prescribing_export")
+        dates_to_extract = filter_dates_to_extract(dates_to_export, bq_client)
+    else:
+        bq_client = None
+        dates_to_extract = []
     # Once we know what needs doing we loop over the required dates and carry
-    # out the tasks. There's obvious scope for speeding this up by doing things
-    # in parallel, but we keep it simple for now.
+    # out the tasks. Within each date, the shards are downloaded concurrently
+    # and then sorted and merged across a pool of processes.
     for date in dates:
         if date in dates_to_extract:
             extract_data_for_date(date, bq_client)
         if date in dates_to_export:
             export_data_for_date(date, bq_client, bucket)
         if date in dates_to_download:
-            download_data_for_date(date, bucket)
+            download_data_for_date(date, bucket, workers=download_workers)
         if date in dates_to_consolidate:
             consolidate_data_for_date(date)
         clean_up_downloaded_files(date)
@@ -168,31 +183,48 @@ def export_data_for_date(date, bq_client, bucket):
     bucket.blob(sentinel_file).upload_from_string("done")
 
 
-def download_data_for_date(date, bucket):
+def download_data_for_date(date, bucket, workers=DEFAULT_DOWNLOAD_WORKERS):
     """
     Download exported prescribing data for the given date from Google Cloud
     Storage
+
+    Files which were downloaded by a previous, interrupted, attempt are not
+    downloaded again.
     """
     prefix = remote_storage_prefix_for_date(date)
-    blobs = bucket.list_blobs(prefix=prefix)
-    # Sort the files so we always download the sentinel file last
-    blobs = sorted(blobs, key=lambda blob: blob.name)
+    blobs = list(bucket.list_blobs(prefix=prefix))
+    # We download the sentinel file last, once all the data files are in place,
+    # so that it's only present locally if the download is complete
+    sentinel_blobs = [blob for blob in blobs if blob.name.endswith(SENTINEL_SUFFIX)]
+    data_blobs = [blob for blob in blobs if not blob.name.endswith(SENTINEL_SUFFIX)]
     logger.info(
         "Downloading %s files from gs://%s/%s*", len(blobs), bucket.name, prefix
     )
-    for blob in blobs:
-        local_name = get_filename_for_download(blob.name)
-        if not os.path.exists(local_name):
-            temp_name = get_temp_filename(local_name)
-            blob.download_to_filename(temp_name)
-            os.rename(temp_name, local_name)
-            logger.info("Downloaded %s", blob.name)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Consume the results so that any errors get raised
+        list(executor.map(download_blob, data_blobs))
+    for blob in sentinel_blobs:
+        download_blob(blob)
     if not download_is_complete(date):
         raise RuntimeError(
             "Export for {date} looks incomplete (no sentinel file)".format(date=date)
         )
 
 
+def download_blob(blob):
+    local_name = get_filename_for_download(blob.name)
+    if os.path.exists(local_name):
+        return
+    temp_name = get_temp_filename(local_name)
+    try:
+        blob.download_to_filename(temp_name)
+        os.rename(temp_name, local_name)
+    finally:
+        if os.path.exists(temp_name):
+            os.unlink(temp_name)
+    logger.info("Downloaded %s", blob.name)
+
+
 def consolidate_data_for_date(date):
     """
     Consolidate downloaded prescribing data for the given date into a single
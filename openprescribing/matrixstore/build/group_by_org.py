@@ -0,0 +1,111 @@
+"""
+Store the prescribing for each presentation already summed over the practices
+in each CCG, STP, PCN and regional team. Most org level queries can then read
+these much smaller matrices directly, instead of reading the practice level
+matrices and grouping them on every request.
+
+The mapping from practices to orgs is read from the database at build time and
+stored in the file alongside the grouped data, so that the application can
+group any other data in a consistent way (see `matrixstore.db`).
+"""
+import logging
+import os.path
+import sqlite3
+
+from matrixstore.db import get_practice_to_org_map
+from matrixstore.row_grouper import RowGrouper
+from matrixstore.serializer import deserialize
+
+from .precalculate_totals import prepare_matrix_value
+
+
+logger = logging.getLogger(__name__)
+
+
+ORG_TYPES = ["ccg", "stp", "pcn", "regional_team"]
+
+
+def group_by_org(sqlite_path):
+    if not os.path.exists(sqlite_path):
+        raise RuntimeError("No SQLite file at: {}".format(sqlite_path))
+    org_mappings = {
+        org_type: get_practice_to_org_map(org_type) for org_type in ORG_TYPES
+    }
+    connection = sqlite3.connect(sqlite_path)
+    # Disable the sqlite module's magical transaction handling features because
+    # we want to use our own transactions below
+    previous_isolation_level = connection.isolation_level
+    connection.isolation_level = None
+    group_by_org_for_db(connection, org_mappings)
+    connection.isolation_level = previous_isolation_level
+    connection.commit()
+    connection.close()
+
+
+def group_by_org_for_db(connection, org_mappings):
+    """
+    Write prescribing grouped by each of the org types in `org_mappings` (a
+    dict mapping org types to dicts of practice codes to org IDs)
+    """
+    cursor = connection.cursor()
+    practice_offsets = dict(cursor.execute("SELECT code, offset FROM practice"))
+    cursor.execute("SAVEPOINT group_by_org")
+    cursor.execute("DELETE FROM practice_org")
+    cursor.execute("DELETE FROM presentation_by_org")
+    row_groupers = {}
+    for org_type, mapping in org_mappings.items():
+        mapping = {
+            practice_code: org_id
+            for practice_code, org_id in mapping.items()
+            if practice_code in practice_offsets
+        }
+        logger.info("Writing mapping of %s practices to %s", len(mapping), org_type)
+        cursor.executemany(
+            """
+            INSERT INTO
+              practice_org (org_type, practice_code, org_id)
+            VALUES
+              (?, ?, ?)
+            """,
+            [
+                (org_type, practice_code, org_id)
+                for practice_code, org_id in sorted(mapping.items())
+            ],
+        )
+        # This must be constructed in exactly the same way as in
+        # `matrixstore.db.get_row_grouper` so that the rows of the matrices we
+        # write match those of the row grouper used at runtime
+        row_groupers[org_type] = RowGrouper(
+            (offset, mapping[practice_code])
+            for practice_code, offset in practice_offsets.items()
+            if practice_code in mapping
+        )
+    logger.info("Grouping prescribing by %s", ", ".join(row_groupers.keys()))
+    results = connection.cursor().execute(
+        """
+        SELECT
+          bnf_code, items, quantity, actual_cost, net_cost
+        FROM
+          presentation
+        WHERE
+          items IS NOT NULL
+        """
+    )
+    count = 0
+    for bnf_code, *values in results:
+        matrices = list(map(deserialize, values))
+        for org_type, row_grouper in row_groupers.items():
+            cursor.execute(
+                """
+                INSERT INTO
+                  presentation_by_org
+                  (org_type, bnf_code, items, quantity, actual_cost, net_cost)
+                VALUES
+                  (?, ?, ?, ?, ?, ?)
+                """,
+                [org_type, bnf_code]
+                + [prepare_matrix_value(row_grouper.sum(m)) for m in matrices],
+            )
+        count += 1
+    cursor.execute("RELEASE group_by_org")
+    logger.info("Wrote grouped prescribing for %s presentations", count)
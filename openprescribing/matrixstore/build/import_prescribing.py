@@ -1,5 +1,15 @@
 """
 Import prescribing data from CSV files into SQLite
+
+The prescribing for each presentation is gathered into numpy arrays of row
+offsets, column offsets and values from which we construct its matrices
+directly, rather than assigning values to them one at a time. Building,
+finalising and compressing the matrices is then spread over a pool of
+processes, with this process doing all the writing to SQLite.
+
+As the entries pass through this process we also add them to running totals
+over all presentations, which saves a second pass over every matrix to
+calculate the `all_presentations` table.
 """
 from collections import namedtuple
 import csv
@@ -10,10 +20,13 @@ import sqlite3
 import gzip
 import heapq
 
-from matrixstore.matrix_ops import sparse_matrix, finalise_matrix
+import numpy
+
+from matrixstore.matrix_ops import sparse_matrix_from_entries, finalise_matrix
 from matrixstore.serializer import serialize_compressed
 
-from .common import get_prescribing_filename
+from .common import get_prescribing_filename, map_in_processes
+from .precalculate_totals import write_all_presentations_totals
 
 
 logger = logging.getLogger(__name__)
@@ -21,12 +34,22 @@ logger = logging.getLogger(__name__)
 
 MatrixRow = namedtuple("MatrixRow", "bnf_code items quantity actual_cost net_cost")
 
+# The offsets and values of all the prescribing for a single presentation, as
+# numpy arrays, plus the shape of the matrices into which they go
+PrescribingEntries = namedtuple(
+    "PrescribingEntries",
+    "bnf_code shape rows cols items quantity actual_cost net_cost",
+)
+
+# Number of processes used to build and compress matrices
+DEFAULT_WORKERS = os.cpu_count() or 1
+
 
 class MissingHeaderError(Exception):
     pass
 
 
-def import_prescribing(filename):
+def import_prescribing(filename, workers=DEFAULT_WORKERS):
     if not os.path.exists(filename):
         raise RuntimeError("No SQLite file at: {}".format(filename))
     connection = sqlite3.connect(filename)
@@ -34,19 +57,21 @@ def import_prescribing(filename):
     connection.execute("PRAGMA synchronous=OFF")
     dates = [date for (date,) in connection.execute("SELECT date FROM date")]
     prescriptions = get_prescriptions_for_dates(dates)
-    write_prescribing(connection, prescriptions)
+    write_prescribing(connection, prescriptions, workers=workers)
     connection.commit()
     connection.close()
 
 
-def write_prescribing(connection, prescriptions):
+def write_prescribing(connection, prescriptions, workers=1):
     cursor = connection.cursor()
     # Map practice codes and date strings to their corresponding row/column
     # offset in the matrix
     practices = dict(cursor.execute("SELECT code, offset FROM practice"))
     dates = dict(cursor.execute("SELECT date, offset FROM date"))
-    matrices = build_matrices(prescriptions, practices, dates)
-    rows = format_as_sql_rows(matrices, connection)
+    totals = PrescribingTotals()
+    entries = totals.add_all(group_prescriptions(prescriptions, practices, dates))
+    serialized_rows = map_in_processes(serialize_matrix_row, entries, workers)
+    rows = format_as_sql_rows(serialized_rows, connection)
     cursor.executemany(
         """
         UPDATE presentation SET items=?, quantity=?, actual_cost=?, net_cost=?
@@ -54,6 +79,8 @@ def write_prescribing(connection, prescriptions):
         """,
         rows,
     )
+    if totals.accumulators is not None:
+        write_all_presentations_totals(connection, totals.accumulators)
 
 
 def get_prescriptions_for_dates(dates):
@@ -133,59 +160,128 @@ def build_matrices(prescriptions, practices, dates):
     Where the matrices contain the prescribed values for that presentation for
     every practice and date.
     """
+    for entries in group_prescriptions(prescriptions, practices, dates):
+        yield build_matrix_row(entries)
+
+
+def group_prescriptions(prescriptions, practices, dates):
+    """
+    Accepts an iterable of prescriptions (sorted by BNF code) plus mappings of
+    practice codes and date strings to their respective row/column offsets.
+    Yields a PrescribingEntries for each presentation.
+    """
     max_row = max(practices.values())
     max_col = max(dates.values())
     shape = (max_row + 1, max_col + 1)
     grouped_by_bnf_code = groupby(prescriptions, lambda row: row[0])
     for bnf_code, row_group in grouped_by_bnf_code:
-        items_matrix = sparse_matrix(shape, integer=True)
-        quantity_matrix = sparse_matrix(shape, integer=False)
-        actual_cost_matrix = sparse_matrix(shape, integer=True)
-        net_cost_matrix = sparse_matrix(shape, integer=True)
-        for _, practice, date, items, quantity, actual_cost, net_cost in row_group:
-            practice_offset = practices[practice]
-            date_offset = dates[date]
-            items_matrix[practice_offset, date_offset] = items
-            quantity_matrix[practice_offset, date_offset] = quantity
-            actual_cost_matrix[practice_offset, date_offset] = actual_cost
-            net_cost_matrix[practice_offset, date_offset] = net_cost
-        yield MatrixRow(
+        _, practice_codes, date_strs, *values = zip(*row_group)
+        items, quantity, actual_cost, net_cost = values
+        yield PrescribingEntries(
             bnf_code,
-            finalise_matrix(items_matrix),
-            finalise_matrix(quantity_matrix),
-            finalise_matrix(actual_cost_matrix),
-            finalise_matrix(net_cost_matrix),
+            shape,
+            numpy.fromiter(map(practices.__getitem__, practice_codes), numpy.int64),
+            numpy.fromiter(map(dates.__getitem__, date_strs), numpy.int64),
+            numpy.array(items, dtype=numpy.int64),
+            numpy.array(quantity, dtype=numpy.float64),
+            numpy.array(actual_cost, dtype=numpy.int64),
+            numpy.array(net_cost, dtype=numpy.int64),
         )
 
 
-def format_as_sql_rows(matrices, connection):
+def build_matrix_row(entries):
+    """
+    Return a MatrixRow holding the finalised matrices for the supplied
+    PrescribingEntries
+    """
+    return MatrixRow(
+        entries.bnf_code,
+        *[
+            finalise_matrix(
+                sparse_matrix_from_entries(
+                    entries.shape, entries.rows, entries.cols, values
+                )
+            )
+            for values in [
+                entries.items,
+                entries.quantity,
+                entries.actual_cost,
+                entries.net_cost,
+            ]
+        ]
+    )
+
+
+def serialize_matrix_row(entries):
+    """
+    Return a tuple of the form:
+
+        bnf_code, items, quantity, actual_cost, net_cost
+
+    Where the values are the serialized matrices for the supplied
+    PrescribingEntries. This is the bulk of the work of importing prescribing
+    and so runs in the worker processes.
+    """
+    row = build_matrix_row(entries)
+    return (row.bnf_code,) + tuple(serialize_compressed(matrix) for matrix in row[1:])
+
+
+class PrescribingTotals(object):
+    """
+    Sums the prescribing in a stream of PrescribingEntries into dense matrices
+    of the same type and layout as `MATRIX_SUM` produces
+    """
+
+    accumulators = None
+
+    def add_all(self, entries_iter):
+        """
+        Yield each of the supplied PrescribingEntries, adding it to the totals
+        on the way through
+        """
+        for entries in entries_iter:
+            self.add(entries)
+            yield entries
+
+    def add(self, entries):
+        values = [
+            entries.items,
+            entries.quantity,
+            entries.actual_cost,
+            entries.net_cost,
+        ]
+        if self.accumulators is None:
+            self.accumulators = [
+                numpy.zeros(entries.shape, dtype=value.dtype, order="F")
+                for value in values
+            ]
+        for accumulator, value in zip(self.accumulators, values):
+            # Unlike `numpy.add.at`, this only adds the last value for any
+            # repeated offset, which matches `sparse_matrix_from_entries`
+            accumulator[entries.rows, entries.cols] += value
+
+
+def format_as_sql_rows(rows, connection):
     """
-    Given an iterable of MatrixRows (which contain a BNF code plus all
-    prescribing data for that presentation) yield tuples of values ready for
-    insertion into SQLite
+    Given an iterable of serialized rows (as returned by `serialize_matrix_row`)
+    yield tuples of values ready for insertion into SQLite
     """
     cursor = connection.cursor()
     num_presentations = next(cursor.execute("SELECT COUNT(*) FROM presentation"))[0]
     count = 0
-    for row in matrices:
+    for bnf_code, *values in rows:
         count += 1
         # We make sure we have a row for every BNF code in the data, even ones
         # we didn't know about previously. This is a hack that we won't need
         # once we can use SQLite v3.24.0 which has proper UPSERT support.
         cursor.execute(
-            "INSERT OR IGNORE INTO presentation (bnf_code) VALUES (?)", [row.bnf_code]
+            "INSERT OR IGNORE INTO presentation (bnf_code) VALUES (?)", [bnf_code]
         )
         if should_log_message(count):
             logger.info(
-                "Writing data for %s (%s/%s)", row.bnf_code, count, num_presentations
+                "Writing data for %s (%s/%s)", bnf_code, count, num_presentations
             )
-        yield (
-            serialize_compressed(row.items),
-            serialize_compressed(row.quantity),
-            serialize_compressed(row.actual_cost),
-            serialize_compressed(row.net_cost),
-            row.bnf_code,
-        )
+        yield tuple(values) + (bnf_code,)
     logger.info("Finished writing data for %s presentations", count)
 
 
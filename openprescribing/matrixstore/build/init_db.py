@@ -43,6 +43,114 @@ SCHEMA_SQL = """
         net_cost BLOB
     );
 
+    -- This table contains totals pre-calculated from the presentation table
+    -- for every BNF chapter, section, paragraph, subparagraph and chemical
+    -- i.e. for every BNF code prefix of the lengths given in
+    -- `matrixstore.connection.BNF_PREFIX_LENGTHS`
+    CREATE TABLE bnf_prefix (
+        prefix TEXT,
+        -- The below columns will contain total prescribing over all
+        -- presentations with this prefix as serialized matrices of shape
+        -- (number of practices, number of months)
+        items BLOB,
+        quantity BLOB,
+        actual_cost BLOB,
+        net_cost BLOB,
+
+        PRIMARY KEY (prefix)
+    );
+
+    -- The two tables below are only populated by the optional `group_by_org`
+    -- build step. This one records the mapping from practices to orgs, for
+    -- each org type, which was used to group the prescribing data.
+    CREATE TABLE practice_org (
+        org_type TEXT,
+        practice_code TEXT,
+        org_id TEXT,
+
+        PRIMARY KEY (org_type, practice_code)
+    );
+
+    CREATE TABLE presentation_by_org (
+        org_type TEXT,
+        bnf_code TEXT,
+        -- The below columns will contain the same data as the `presentation`
+        -- table but summed over all practices in each org, as serialized
+        -- matrices of shape (number of orgs, number of months) with orgs
+        -- ordered by ID
+        items BLOB,
+        quantity BLOB,
+        actual_cost BLOB,
+        net_cost BLOB,
+
+        PRIMARY KEY (org_type, bnf_code)
+    );
+
+    -- The two tables below are only populated by the optional
+    -- `write_date_blocks` build step. This one gives the range of date offsets
+    -- (from `start_offset` up to but not including `end_offset`) covered by
+    -- each block.
+    CREATE TABLE date_block (
+        start_offset INTEGER,
+        end_offset INTEGER,
+
+        PRIMARY KEY (start_offset)
+    );
+
+    CREATE TABLE presentation_date_block (
+        bnf_code TEXT,
+        start_offset INTEGER,
+        -- The below columns will contain the same data as the `presentation`
+        -- table but for just the dates in the block starting at
+        -- `start_offset`, as serialized matrices of shape (number of
+        -- practices, number of months in block)
+        items BLOB,
+        quantity BLOB,
+        actual_cost BLOB,
+        net_cost BLOB,
+
+        PRIMARY KEY (bnf_code, start_offset)
+    );
+
+    -- The two tables below are only populated by the optional
+    -- `write_practice_index` build step. They store the same prescribing as
+    -- the `presentation` table but transposed so that it's practice-major, to
+    -- make reading the prescribing of individual practices cheap. This one
+    -- assigns an offset to each presentation, in BNF code order.
+    CREATE TABLE practice_index_presentation (
+        offset INTEGER,
+        bnf_code TEXT UNIQUE,
+
+        PRIMARY KEY (offset)
+    );
+
+    CREATE TABLE practice_prescribing (
+        practice_offset INTEGER,
+        -- Serialized array giving the (sorted) offsets of the presentations
+        -- which this practice prescribed
+        presentation_offsets BLOB,
+        -- The below columns contain serialized matrices of shape (number of
+        -- presentations prescribed, number of months) whose rows correspond
+        -- to the presentations above
+        items BLOB,
+        quantity BLOB,
+        actual_cost BLOB,
+        net_cost BLOB,
+
+        PRIMARY KEY (practice_offset)
+    );
+
+    -- Only populated by the optional `write_arena` build step, which moves
+    -- every serialized matrix into an uncompressed "arena" file alongside this
+    -- one and replaces the BLOB values in the other tables with references to
+    -- their locations in that file (see `matrixstore.arena`). This records the
+    -- size and MD5 hash of the arena file so that it's covered by the hash
+    -- which `generate_filename` includes in the name of this file.
+    CREATE TABLE arena (
+        size INTEGER,
+        hash TEXT
+    );
+
     CREATE TABLE practice_statistic (
         name TEXT,
         -- The "value" column will contain the actual statistics as serialized
@@ -102,6 +210,18 @@ def import_practices(bq_conn, sqlite_conn, dates):
     relevant period, either prescribing data or practice statistics; there's no
     sense in having rows in the matrices which will never contain data.
     """
+    practice_codes = get_active_practice_codes(bq_conn, dates)
+    logger.info("Writing %s practice codes to SQLite", len(practice_codes))
+    sqlite_conn.executemany(
+        "INSERT INTO practice (offset, code) VALUES (?, ?)", enumerate(practice_codes)
+    )
+
+
+def get_active_practice_codes(bq_conn, dates):
+    """
+    Return a sorted list of the codes of all practices with prescribing data or
+    practice statistics between the supplied dates
+    """
     date_start = min(dates)
     date_end = max(dates)
     logger.info(
@@ -116,8 +236,4 @@ def import_practices(bq_conn, sqlite_conn, dates):
         ORDER BY practice
         """
     result = bq_conn.query(sql % {"start": date_start, "end": date_end})
-    practice_codes = [row[0] for row in result.rows]
-    logger.info("Writing %s practice codes to SQLite", len(practice_codes))
-    sqlite_conn.executemany(
-        "INSERT INTO practice (offset, code) VALUES (?, ?)", enumerate(practice_codes)
-    )
+    return [row[0] for row in result.rows]
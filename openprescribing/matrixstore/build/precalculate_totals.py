@@ -3,22 +3,36 @@ Pre-calculate totals for prescribing over all presentations. We sometimes need
 these values (e.g. to show prescribing of X as a percentage of all prescribing)
 and they're slightly too expensive to calculate at runtime (45-60 seconds).
 
+We also pre-calculate totals for every BNF chapter, section, paragraph,
+subparagraph and chemical so that queries over these don't need to read every
+presentation they contain.
+
 The resulting matrices are the same shape as the rest of the matrices and thus
 contain individual totals for each practice and month.
+
+When building from scratch the totals over all presentations are accumulated
+as the prescribing is imported (see `import_prescribing`) so we don't need to
+calculate them here, but we can still do so to check the imported totals.
 """
 import logging
 import os.path
 import sqlite3
 
-from matrixstore.connection import MatrixStore
+import numpy
+
+from matrixstore.connection import BNF_PREFIX_LENGTHS, MatrixStore
 from matrixstore.matrix_ops import is_integer, convert_to_smallest_int_type
-from matrixstore.serializer import serialize_compressed
+from matrixstore.serializer import deserialize, serialize_compressed
+from matrixstore.sql_functions import MatrixSum
 
 
 logger = logging.getLogger(__name__)
 
 
-def precalculate_totals(sqlite_path):
+COLUMNS = ["items", "quantity", "actual_cost", "net_cost"]
+
+
+def precalculate_totals(sqlite_path, all_presentations=True, verify=False):
     if not os.path.exists(sqlite_path):
         raise RuntimeError("No SQLite file at: {}".format(sqlite_path))
     connection = sqlite3.connect(sqlite_path)
@@ -26,16 +40,68 @@ def precalculate_totals(sqlite_path):
     # we want to use our own transactions below
     previous_isolation_level = connection.isolation_level
     connection.isolation_level = None
-    precalculate_totals_for_db(connection)
+    precalculate_totals_for_db(
+        connection, all_presentations=all_presentations, verify=verify
+    )
     connection.isolation_level = previous_isolation_level
     connection.commit()
     connection.close()
 
 
-def precalculate_totals_for_db(connection):
+def precalculate_totals_for_db(connection, all_presentations=True, verify=False):
+    """
+    Calculate the `bnf_prefix` totals and, unless `all_presentations` is False
+    (i.e. they were calculated on import), the `all_presentations` totals
+
+    If `verify` is True then totals calculated on import are checked against
+    the sum over every presentation.
+    """
+    if all_presentations:
+        precalculate_all_presentations_totals(connection)
+    elif verify:
+        verify_all_presentations_totals(connection)
+    precalculate_bnf_prefix_totals(connection)
+
+
+def precalculate_all_presentations_totals(connection):
+    values = sum_all_presentations(connection)
+    write_all_presentations_totals(connection, values)
+
+
+def verify_all_presentations_totals(connection):
+    """
+    Check that the existing `all_presentations` totals match the sum over every
+    presentation, raising an error if not
+
+    Floating point values are compared approximately as the order in which we
+    add them can differ.
+    """
+    expected = sum_all_presentations(connection)
+    logger.info("Checking precalculated totals")
+    values = next(
+        MatrixStore(connection).query(
+            "SELECT items, quantity, actual_cost, net_cost FROM all_presentations"
+        ),
+        None,
+    )
+    if values is None:
+        raise RuntimeError("No precalculated all_presentations totals found")
+    for column, value, expected_value in zip(COLUMNS, values, expected):
+        if is_integer(expected_value):
+            matches = numpy.array_equal(value, expected_value)
+        else:
+            matches = numpy.allclose(value, expected_value, rtol=1e-9, atol=1e-6)
+        if not matches:
+            raise RuntimeError(
+                "Precalculated all_presentations.{} doesn't match the sum over "
+                "all presentations".format(column)
+            )
+
+
+def sum_all_presentations(connection):
     matrixstore = MatrixStore(connection)
     logger.info("Summing prescribing over all presentations")
-    values = matrixstore.query_one(
+    return matrixstore.query_one(
         """
         SELECT
           MATRIX_SUM(items),
@@ -48,6 +114,13 @@ def precalculate_totals_for_db(connection):
           items IS NOT NULL
         """
     )
+
+
+def write_all_presentations_totals(connection, values):
+    """
+    Replace the `all_presentations` totals with the supplied matrices (items,
+    quantity, actual_cost and net_cost)
+    """
     logger.info("Writing precalculated totals to db")
     cursor = connection.cursor()
     # We want saving the new value and deleting the old to be an atomic
@@ -68,6 +141,78 @@ def precalculate_totals_for_db(connection):
     cursor.execute("RELEASE update_totals")
 
 
+def precalculate_bnf_prefix_totals(connection):
+    """
+    Calculate totals for every BNF prefix of the lengths in BNF_PREFIX_LENGTHS
+    in a single pass over the presentations
+
+    Because we read presentations in BNF code order, all the presentations
+    matching a given prefix arrive consecutively. So we only need to keep a
+    "stack" of accumulators for the prefixes of the current BNF code. Each
+    presentation is added to the accumulator for its longest prefix and, once
+    we're done with a prefix, its total gets written out and added to the
+    accumulator for the next shortest prefix.
+    """
+    logger.info("Summing prescribing for all BNF code prefixes")
+    cursor = connection.cursor()
+    cursor.execute("SAVEPOINT update_bnf_prefix_totals")
+    cursor.execute("DELETE FROM bnf_prefix")
+    results = connection.cursor().execute(
+        """
+        SELECT
+          bnf_code, items, quantity, actual_cost, net_cost
+        FROM
+          presentation
+        WHERE
+          items IS NOT NULL
+        ORDER BY
+          bnf_code
+        """
+    )
+    # List of (prefix, accumulators) pairs, from shortest prefix to longest
+    stack = []
+    count = 0
+    for bnf_code, *values in results:
+        while stack and not bnf_code.startswith(stack[-1][0]):
+            write_bnf_prefix_total(cursor, stack)
+            count += 1
+        for length in BNF_PREFIX_LENGTHS[len(stack) :]:
+            if length > len(bnf_code):
+                break
+            stack.append((bnf_code[:length], [MatrixSum() for _ in values]))
+        # Codes which are shorter than the shortest prefix don't contribute
+        # to any prefix totals
+        if stack:
+            for accumulator, value in zip(stack[-1][1], values):
+                accumulator.add(deserialize(value))
+    while stack:
+        write_bnf_prefix_total(cursor, stack)
+        count += 1
+    cursor.execute("RELEASE update_bnf_prefix_totals")
+    logger.info("Wrote precalculated totals for %s BNF code prefixes", count)
+
+
+def write_bnf_prefix_total(cursor, stack):
+    """
+    Pop the longest prefix off the stack, write its totals to the db and add
+    them to the totals for the next shortest prefix
+    """
+    prefix, accumulators = stack.pop()
+    values = [accumulator.value() for accumulator in accumulators]
+    if stack:
+        for accumulator, value in zip(stack[-1][1], values):
+            accumulator.add(value)
+    cursor.execute(
+        """
+        INSERT INTO
+          bnf_prefix (prefix, items, quantity, actual_cost, net_cost)
+        VALUES
+          (?, ?, ?, ?, ?)
+        """,
+        [prefix] + list(map(prepare_matrix_value, values)),
+    )
+
+
 def prepare_matrix_value(matrix):
     if is_integer(matrix):
         matrix = convert_to_smallest_int_type(matrix)
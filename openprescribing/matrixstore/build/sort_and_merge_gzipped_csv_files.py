@@ -1,7 +1,62 @@
+"""
+Sort and merge CSV files using an external merge sort, spread across a pool of
+processes
+
+The files are much too large to sort in memory, so we work in two passes:
+
+  1. Each input file is read in chunks of rows. Each chunk is sorted and
+     written out as a "run", split into a separate file for each bucket of
+     rows (where a row's bucket is given by the first few characters of its
+     first sort column e.g. the BNF chapter).
+
+  2. For each bucket, its runs from every input file are merged into a single
+     sorted, gzipped file.
+
+Because every row in a bucket sorts before every row in the next bucket, the
+sorted output is then just the header followed by each bucket's file in order.
+A gzip file may consist of several compressed "members" one after another, so
+we can join the bucket files together without decompressing them.
+
+Input files are handled in parallel in the first pass, and buckets in the
+second.
+
+Memory use is dominated by the chunks sorted in the first pass, so we bound it
+with `max_rows_in_memory`, which is a budget for all the processes together:
+each process reads chunks of `max_rows_in_memory / workers` rows. A row held as
+a list of Python strings takes up roughly half a kilobyte, so the default
+budget comes to around 2GB however many CPUs we have. The merges in the second
+pass only hold one row from each run at a time.
+"""
+
 import csv
+import gzip
+import heapq
+import io
 import os
-from pipes import quote
-import subprocess
+import shutil
+import tempfile
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import partial
+from itertools import count, islice
+from operator import itemgetter
+
+from .common import map_in_processes
+
+# Number of processes used to sort and merge. Beyond this we gain little, as
+# we're mostly waiting on the disk.
+DEFAULT_WORKERS = min(os.cpu_count() or 1, 8)
+
+# Maximum number of rows held in memory at once, across all processes
+DEFAULT_MAX_ROWS_IN_MEMORY = 4000000
+
+# Rows are bucketed by this many characters of their first sort column. For
+# BNF codes this gives a bucket per chapter, which means there are enough
+# buckets to keep several processes busy but not so many that we end up with
+# huge numbers of tiny run files.
+BUCKET_PREFIX_LENGTH = 2
+
+GZIP_MAGIC_NUMBER = b"\x1f\x8b"
 
 
 class InvalidHeaderError(Exception):
@@ -15,6 +70,8 @@ def sort_and_merge_gzipped_csv_files(
     output_filename,
     # Column names to sort by
     sort_columns,
+    workers=DEFAULT_WORKERS,
+    max_rows_in_memory=DEFAULT_MAX_ROWS_IN_MEMORY,
 ):
     """
     Given a list of CSV files, sort the rows by the supplied column names and
@@ -23,97 +80,172 @@ def sort_and_merge_gzipped_csv_files(
     Input files may be gzipped or not (either will work). The output is
     always gzipped.
 
-    We shell out to the `sort` command for this as it much more efficient than
-    trying to do this in Python and can transparently handle sorting files that
-    are many times too large to fit in memory.
-
-    Note that `sort` doesn't really parse CSV, it just splits on commas; so
-    this function won't work where the CSV contains commas -- at least, where
-    these are to the left of the columns which are being sorted on.
+    Rows are compared as strings and, where their sort columns are equal, by
+    their remaining columns, so the output is always the same regardless of the
+    order of the input files.
     """
-    header_line = get_header_line(input_filenames)
-    sort_column_indices = get_column_indices(header_line, sort_columns)
-    # Construct a shell pipeline to read all input files and sort in the
-    # correct order, outputing the header line first
-    pipeline = "( {read_files} ) | ( echo {header_line}; {sort_by_columns} )".format(
-        read_files=read_files(input_filenames, skip_lines=1),
-        header_line=quote(header_line),
-        sort_by_columns=sort_by_columns(sort_column_indices),
-    )
-    pipeline += " | gzip"
-    pipeline += " > {}".format(quote(output_filename))
-    env = os.environ.copy()
-    # For much faster string comparison when sorting
-    env["LANG"] = "C"
-    subprocess.check_call(pipeline, shell=True, env=env)
-
-
-def read_files(filenames, skip_lines=None, max_lines=None):
+    headers = get_headers(input_filenames)
+    sort_column_indices = get_column_indices(headers, sort_columns)
+    rows_per_run = max(max_rows_in_memory // workers, 1)
+    output_dir = os.path.dirname(os.path.abspath(output_filename))
+    work_dir = tempfile.mkdtemp(dir=output_dir, prefix=".tmp.sort.")
+    try:
+        runs_by_bucket = defaultdict(list)
+        write_runs = partial(
+            write_sorted_runs,
+            work_dir=work_dir,
+            sort_column_indices=sort_column_indices,
+            rows_per_run=rows_per_run,
+        )
+        for runs in map_in_processes(write_runs, enumerate(input_filenames), workers):
+            for bucket, run_filename in runs:
+                runs_by_bucket[bucket].append(run_filename)
+        merge = partial(merge_runs, sort_column_indices=sort_column_indices)
+        bucket_filenames = map_in_processes(
+            merge,
+            [runs_by_bucket[bucket] for bucket in sorted(runs_by_bucket)],
+            workers,
+        )
+        with open(output_filename, "wb") as output:
+            with gzip_writer(output) as writer:
+                writer.writerow(headers)
+            for bucket_filename in bucket_filenames:
+                with open(bucket_filename, "rb") as f:
+                    shutil.copyfileobj(f, output)
+                os.unlink(bucket_filename)
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def write_sorted_runs(numbered_input, work_dir, sort_column_indices, rows_per_run):
+    """
+    Split the rows of the input file into sorted runs, with a separate file for
+    each bucket in each run, and return a list of (bucket, filename) pairs
+    """
+    input_number, input_filename = numbered_input
+    sort_key = get_sort_key(sort_column_indices)
+    bucket_column = sort_column_indices[0]
+    output = []
+    with open_csv(input_filename) as f:
+        reader = csv.reader(f)
+        next(reader)
+        for run_number in count():
+            rows = list(islice(reader, rows_per_run))
+            if not rows:
+                break
+            rows.sort(key=sort_key)
+            for bucket, bucket_rows in group_by_bucket(rows, bucket_column):
+                run_filename = os.path.join(
+                    work_dir,
+                    "{}.{}.{}.csv".format(
+                        bucket.encode("utf8").hex(), input_number, run_number
+                    ),
+                )
+                with open(run_filename, "w", encoding="utf8", newline="") as run_file:
+                    csv.writer(run_file).writerows(bucket_rows)
+                output.append((bucket, run_filename))
+    return output
+
+
+def merge_runs(run_filenames, sort_column_indices):
     """
-    Return command to read all supplied files (which may or may not be
-    gzipped), optionally skipping a number of leading and trailing lines
+    Merge the sorted runs into a single gzipped file (without headers), delete
+    the runs and return the merged file's name
     """
-    return "; ".join(
-        [
-            read_file(filename, skip_lines=skip_lines, max_lines=max_lines)
-            for filename in filenames
-        ]
-    )
+    output_filename = run_filenames[0] + ".gz"
+    run_files = [
+        open(filename, encoding="utf8", newline="") for filename in run_filenames
+    ]
+    try:
+        merged = heapq.merge(
+            *[csv.reader(f) for f in run_files], key=get_sort_key(sort_column_indices)
+        )
+        with open(output_filename, "wb") as output:
+            with gzip_writer(output) as writer:
+                writer.writerows(merged)
+    finally:
+        for f in run_files:
+            f.close()
+    for filename in run_filenames:
+        os.unlink(filename)
+    return output_filename
+
+
+def group_by_bucket(rows, bucket_column):
+    """
+    Given a list of sorted rows, yield (bucket, rows) pairs
+    """
+    start = 0
+    while start < len(rows):
+        bucket = rows[start][bucket_column][:BUCKET_PREFIX_LENGTH]
+        end = start + 1
+        while end < len(rows) and (
+            rows[end][bucket_column][:BUCKET_PREFIX_LENGTH] == bucket
+        ):
+            end += 1
+        yield bucket, rows[start:end]
+        start = end
 
 
-def read_file(filename, skip_lines=None, max_lines=None):
+def get_sort_key(sort_column_indices):
+    get_sort_columns = itemgetter(*sort_column_indices)
+    return lambda row: (get_sort_columns(row), row)
+
+
+@contextmanager
+def gzip_writer(output):
     """
-    Return command to read a file (which may or may not be gzipped), optionally
-    skipping a number of leading and trailing lines
+    Return a CSV writer which writes a single gzip member to the supplied binary
+    file
+
+    We leave the filename and modification time out of the gzip header so that
+    the output depends only on the data.
     """
-    # The `--force` flag means that non-gzipped files are handled transparently
-    # as if the command was just `cat`
-    command = "gzip --decompress --force --to-stdout --quiet {}".format(quote(filename))
-    if skip_lines is not None:
-        command += " | tail -n +{}".format(int(skip_lines) + 1)
-    if max_lines is not None:
-        command += " | head -n {}".format(int(max_lines))
-    return command
+    with gzip.GzipFile(
+        filename="", mode="wb", compresslevel=6, fileobj=output, mtime=0
+    ) as gzip_file:
+        with io.TextIOWrapper(gzip_file, encoding="utf8", newline="") as text_file:
+            yield csv.writer(text_file)
 
 
-def sort_by_columns(column_indices):
+def open_csv(filename):
     """
-    Return a `sort` command string configured to sort a CSV file by the supplied column
-    indices
+    Open a CSV file for reading, whether or not it's gzipped
     """
-    sort_keys = ["--key={0},{0}".format(i + 1) for i in column_indices]
-    return "sort --field-separator=, {}".format(" ".join(sort_keys))
+    with open(filename, "rb") as f:
+        is_gzipped = f.read(len(GZIP_MAGIC_NUMBER)) == GZIP_MAGIC_NUMBER
+    if is_gzipped:
+        return gzip.open(filename, "rt", encoding="utf8", newline="")
+    return open(filename, encoding="utf8", newline="")
 
 
-def get_header_line(filenames):
+def get_headers(filenames):
     """
-    Return the first line of one of the files and check it is consistent across
+    Return the headers of one of the files and check they are consistent across
     all files
     """
-    pipeline = "({read_files}) 2>/dev/null".format(
-        read_files=read_files(filenames, max_lines=1)
-    )
-    header_lines = (
-        subprocess.check_output(pipeline, shell=True).decode("utf8").splitlines()
-    )
-    header_line = header_lines[0]
-    for n, filename in enumerate(filenames):
-        other_line = header_lines[n]
-        if other_line != header_line:
+    all_headers = []
+    for filename in filenames:
+        with open_csv(filename) as f:
+            all_headers.append(next(csv.reader(f), []))
+    headers = all_headers[0]
+    for filename, other_headers in zip(filenames, all_headers):
+        if other_headers != headers:
             raise InvalidHeaderError(
                 "Input files do not have identical headers:\n\n"
-                "{}: {}\n{}: {}".format(filenames[0], header_line, filename, other_line)
+                "{}: {}\n{}: {}".format(
+                    filenames[0], ",".join(headers), filename, ",".join(other_headers)
+                )
             )
-    return header_line
+    return headers
 
 
-def get_column_indices(header_line, columns):
+def get_column_indices(headers, columns):
     """
-    Take a CSV header line and a list of columns and return the indices of
+    Take a list of CSV headers and a list of columns and return the indices of
     those columns (or raise InvalidHeaderError)
     """
-    headers = next(csv.reader([header_line]))
     try:
         return [headers.index(column) for column in columns]
     except ValueError as e:
-        raise InvalidHeaderError("{} of headers: {}".format(e, header_line))
+        raise InvalidHeaderError("{} of headers: {}".format(e, ",".join(headers)))
@@ -0,0 +1,126 @@
+"""
+Move every serialized matrix in the file into an uncompressed, memory-mappable
+"arena" file alongside it, leaving just references to their locations in the
+SQLite file (see `matrixstore.arena` for details)
+
+This must be the last step which modifies the data as the other build steps
+expect to find serialized matrices in the SQLite file. The resulting arena is
+much larger than the compressed matrices it replaces, but in return reading a
+matrix requires no decompression or copying.
+"""
+import hashlib
+import logging
+import os.path
+import sqlite3
+
+from matrixstore.arena import (
+    ARENA_ALIGNMENT,
+    ARENA_HEADER,
+    encode_reference,
+    get_arena_path,
+)
+from matrixstore.serializer import deserialize, get_padding, serialize_aligned
+
+
+logger = logging.getLogger(__name__)
+
+
+def write_arena(sqlite_path):
+    if not os.path.exists(sqlite_path):
+        raise RuntimeError("No SQLite file at: {}".format(sqlite_path))
+    connection = sqlite3.connect(sqlite_path)
+    # Disable the sqlite module's magical transaction handling features because
+    # we want to use our own transactions below
+    previous_isolation_level = connection.isolation_level
+    connection.isolation_level = None
+    write_arena_for_db(connection, get_arena_path(sqlite_path))
+    connection.isolation_level = previous_isolation_level
+    connection.commit()
+    connection.close()
+
+
+def write_arena_for_db(connection, arena_path):
+    cursor = connection.cursor()
+    if cursor.execute("SELECT 1 FROM arena").fetchone() is not None:
+        raise RuntimeError("Matrices have already been moved to an arena file")
+    cursor.execute("SAVEPOINT write_arena")
+    with open(arena_path, "wb") as f:
+        writer = ArenaWriter(f)
+        for table, columns in get_blob_columns(connection):
+            logger.info("Writing %s to arena", table)
+            rowids = [
+                rowid
+                for (rowid,) in cursor.execute("SELECT rowid FROM {}".format(table))
+            ]
+            select = "SELECT {} FROM {} WHERE rowid = ?".format(
+                ", ".join(columns), table
+            )
+            update = "UPDATE {} SET {} WHERE rowid = ?".format(
+                table, ", ".join("{} = ?".format(column) for column in columns)
+            )
+            for rowid in rowids:
+                values = cursor.execute(select, [rowid]).fetchone()
+                references = [
+                    writer.write(value) if value is not None else None
+                    for value in values
+                ]
+                cursor.execute(update, references + [rowid])
+    cursor.execute(
+        "INSERT INTO arena (size, hash) VALUES (?, ?)",
+        [writer.size, writer.hashobj.hexdigest()],
+    )
+    cursor.execute("RELEASE write_arena")
+    logger.info("Wrote %s matrices to arena (%s bytes)", writer.count, writer.size)
+
+
+def get_blob_columns(connection):
+    """
+    Return a list of (table, columns) pairs giving the BLOB columns in each
+    table which has any (sorted so that we always write the arena in the same
+    order)
+    """
+    output = []
+    tables = connection.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' ORDER BY name"
+    )
+    for (table,) in list(tables):
+        columns = [
+            name
+            for (_, name, column_type, *_) in connection.execute(
+                "PRAGMA table_info({})".format(table)
+            )
+            if column_type.upper() == "BLOB"
+        ]
+        if columns:
+            output.append((table, columns))
+    return output
+
+
+class ArenaWriter(object):
+    """
+    Appends matrices to an arena file, keeping track of its size and hash
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.size = 0
+        self.count = 0
+        self.hashobj = hashlib.md5()
+        self._write_bytes(ARENA_HEADER)
+
+    def write(self, value):
+        """
+        Write the supplied serialized matrix to the arena and return a
+        reference to it
+        """
+        data = serialize_aligned(deserialize(value), ARENA_ALIGNMENT)
+        self._write_bytes(bytes(get_padding(self.size, ARENA_ALIGNMENT)))
+        offset = self.size
+        self._write_bytes(data)
+        self.count += 1
+        return encode_reference(offset, len(data))
+
+    def _write_bytes(self, data):
+        self.f.write(data)
+        self.hashobj.update(data)
+        self.size += len(data)
@@ -0,0 +1,92 @@
+"""
+Store each presentation's prescribing split into blocks of dates, with each
+block compressed separately. Queries which need only a few months of data (e.g.
+price-per-unit calculations, which need just a single month) can then read and
+decompress just the blocks they need rather than every month in the file.
+
+This is done as a separate step after the BNF code updates have been applied,
+so that we only need to deal with the final set of presentations. The full
+matrices remain in the `presentation` table for queries which need all dates.
+"""
+import logging
+import os.path
+import sqlite3
+
+import scipy.sparse
+from matrixstore.matrix_ops import finalise_matrix, get_submatrix
+from matrixstore.serializer import deserialize, serialize_compressed
+
+
+logger = logging.getLogger(__name__)
+
+
+def write_date_blocks(sqlite_path, months_per_block):
+    if not os.path.exists(sqlite_path):
+        raise RuntimeError("No SQLite file at: {}".format(sqlite_path))
+    connection = sqlite3.connect(sqlite_path)
+    # Disable the sqlite module's magical transaction handling features because
+    # we want to use our own transactions below
+    previous_isolation_level = connection.isolation_level
+    connection.isolation_level = None
+    write_date_blocks_for_db(connection, months_per_block)
+    connection.isolation_level = previous_isolation_level
+    connection.commit()
+    connection.close()
+
+
+def write_date_blocks_for_db(connection, months_per_block):
+    cursor = connection.cursor()
+    num_dates = next(cursor.execute("SELECT COUNT(*) FROM date"))[0]
+    blocks = [
+        (start, min(start + months_per_block, num_dates))
+        for start in range(0, num_dates, months_per_block)
+    ]
+    logger.info(
+        "Splitting prescribing into %s blocks of %s months",
+        len(blocks),
+        months_per_block,
+    )
+    cursor.execute("SAVEPOINT write_date_blocks")
+    cursor.execute("DELETE FROM date_block")
+    cursor.execute("DELETE FROM presentation_date_block")
+    cursor.executemany(
+        "INSERT INTO date_block (start_offset, end_offset) VALUES (?, ?)", blocks
+    )
+    results = connection.cursor().execute(
+        """
+        SELECT
+          bnf_code, items, quantity, actual_cost, net_cost
+        FROM
+          presentation
+        WHERE
+          items IS NOT NULL
+        """
+    )
+    count = 0
+    for bnf_code, *values in results:
+        matrices = list(map(deserialize, values))
+        for start, end in blocks:
+            cursor.execute(
+                """
+                INSERT INTO
+                  presentation_date_block
+                  (bnf_code, start_offset, items, quantity, actual_cost, net_cost)
+                VALUES
+                  (?, ?, ?, ?, ?, ?)
+                """,
+                [bnf_code, start]
+                + [
+                    prepare_block(get_submatrix(matrix, cols=slice(start, end)))
+                    for matrix in matrices
+                ],
+            )
+        count += 1
+    cursor.execute("RELEASE write_date_blocks")
+    logger.info("Wrote date blocks for %s presentations", count)
+
+
+def prepare_block(matrix):
+    # The full matrix may be stored as either sparse or dense but the best
+    # representation for each block may differ, so we make a fresh choice here
+    matrix = finalise_matrix(scipy.sparse.csc_matrix(matrix))
+    return serialize_compressed(matrix)
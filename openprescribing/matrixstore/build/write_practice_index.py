@@ -0,0 +1,156 @@
+"""
+Store a transposed copy of the prescribing in which, for each practice, there is
+a single row holding a (presentations x months) matrix per column. Reading all
+the prescribing for a handful of practices then means reading a handful of rows,
+rather than reading and decompressing the full (practices x months) matrix for
+every presentation just to pull out a few of its rows.
+
+Each practice's matrices contain rows for just the presentations which it
+prescribed, and these are identified by their offsets in the
+`practice_index_presentation` table. We assign offsets in BNF code order so that
+all the presentations matching a BNF code prefix have a contiguous range of
+offsets.
+
+Transposing the whole file in one go would need far more memory than we have so
+we work through the practices in batches, making a pass over all the
+presentations for each batch.
+"""
+import logging
+import os.path
+import sqlite3
+
+import numpy
+import scipy.sparse
+from matrixstore.matrix_ops import finalise_matrix, get_submatrix
+from matrixstore.serializer import deserialize, serialize_compressed
+
+
+logger = logging.getLogger(__name__)
+
+
+COLUMNS = ["items", "quantity", "actual_cost", "net_cost"]
+
+DEFAULT_PRACTICES_PER_PASS = 1000
+
+
+def write_practice_index(sqlite_path, practices_per_pass=DEFAULT_PRACTICES_PER_PASS):
+    if not os.path.exists(sqlite_path):
+        raise RuntimeError("No SQLite file at: {}".format(sqlite_path))
+    connection = sqlite3.connect(sqlite_path)
+    # Disable the sqlite module's magical transaction handling features because
+    # we want to use our own transactions below
+    previous_isolation_level = connection.isolation_level
+    connection.isolation_level = None
+    write_practice_index_for_db(connection, practices_per_pass)
+    connection.isolation_level = previous_isolation_level
+    connection.commit()
+    connection.close()
+
+
+def write_practice_index_for_db(
+    connection, practices_per_pass=DEFAULT_PRACTICES_PER_PASS
+):
+    cursor = connection.cursor()
+    num_practices = next(cursor.execute("SELECT COUNT(*) FROM practice"))[0]
+    num_dates = next(cursor.execute("SELECT COUNT(*) FROM date"))[0]
+    bnf_codes = [
+        bnf_code
+        for (bnf_code,) in cursor.execute(
+            "SELECT bnf_code FROM presentation WHERE items IS NOT NULL ORDER BY bnf_code"
+        )
+    ]
+    cursor.execute("SAVEPOINT write_practice_index")
+    cursor.execute("DELETE FROM practice_index_presentation")
+    cursor.execute("DELETE FROM practice_prescribing")
+    cursor.executemany(
+        "INSERT INTO practice_index_presentation (offset, bnf_code) VALUES (?, ?)",
+        enumerate(bnf_codes),
+    )
+    count = 0
+    for start in range(0, num_practices, practices_per_pass):
+        end = min(start + practices_per_pass, num_practices)
+        logger.info("Transposing prescribing for practices %s to %s", start, end)
+        transposed = get_transposed_matrices(
+            connection, slice(start, end), len(bnf_codes), num_dates
+        )
+        for practice_offset in range(start, end):
+            columns = slice(
+                (practice_offset - start) * num_dates,
+                (practice_offset - start + 1) * num_dates,
+            )
+            matrices = [get_submatrix(matrix, cols=columns) for matrix in transposed]
+            # The presentations for which any column has a non-zero value
+            presentation_offsets = numpy.unique(
+                numpy.concatenate([matrix.indices for matrix in matrices])
+            ).astype(numpy.int32)
+            if not len(presentation_offsets):
+                continue
+            cursor.execute(
+                """
+                INSERT INTO
+                  practice_prescribing
+                  (
+                    practice_offset,
+                    presentation_offsets,
+                    items,
+                    quantity,
+                    actual_cost,
+                    net_cost
+                  )
+                VALUES
+                  (?, ?, ?, ?, ?, ?)
+                """,
+                [practice_offset, serialize_compressed(presentation_offsets)]
+                + [
+                    serialize_compressed(finalise_matrix(matrix[presentation_offsets]))
+                    for matrix in matrices
+                ],
+            )
+            count += 1
+    cursor.execute("RELEASE write_practice_index")
+    logger.info("Wrote transposed prescribing for %s practices", count)
+
+
+def get_transposed_matrices(connection, practices, num_presentations, num_dates):
+    """
+    Return a sparse CSC matrix for each column in which each row corresponds to
+    a presentation and each block of `num_dates` columns corresponds to one of
+    the supplied `practices`
+    """
+    num_practices = practices.stop - practices.start
+    entries = [([], [], []) for _ in COLUMNS]
+    results = connection.cursor().execute(
+        """
+        SELECT
+          {}
+        FROM
+          presentation
+        WHERE
+          items IS NOT NULL
+        ORDER BY
+          bnf_code
+        """.format(
+            ", ".join(COLUMNS)
+        )
+    )
+    for presentation_offset, values in enumerate(results):
+        for (rows, cols, data), value in zip(entries, values):
+            matrix = scipy.sparse.coo_matrix(
+                get_submatrix(deserialize(value), rows=practices)
+            )
+            rows.append(numpy.full(matrix.nnz, presentation_offset, numpy.int32))
+            cols.append(matrix.row.astype(numpy.int64) * num_dates + matrix.col)
+            data.append(matrix.data)
+    shape = (num_presentations, num_practices * num_dates)
+    return [
+        scipy.sparse.csc_matrix(
+            (concatenate(data), (concatenate(rows), concatenate(cols))), shape=shape
+        )
+        for rows, cols, data in entries
+    ]
+
+
+def concatenate(arrays):
+    if not arrays:
+        return numpy.array([], dtype=numpy.int64)
+    return numpy.concatenate(arrays)
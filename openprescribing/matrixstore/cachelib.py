@@ -9,15 +9,47 @@ Provides a basic caching decorator with a few special features:
       should only be applied to functions whose output is purely determined by
       their arguments. If the logic of the function changes then the `version`
       argument can be incremented.
+
+    * Values are cached at two levels: a small in-memory LRU cache in each
+      process (sized by MEMOIZE_LOCAL_CACHE_ENTRIES) in front of the shared
+      Django cache. Values held in memory are shared between callers, so any
+      arrays they contain are made read-only.
+
+    * Where several processes (or threads) miss on the same key at once, only
+      one of them computes the value while the others wait for it to appear in
+      the shared cache. This uses an atomic `cache.add` as a lock so it works
+      across processes with DiskCache. As cached values never go stale there
+      is nothing older we could serve in the meantime.
 """
 
 import functools
+import threading
+import time
+from collections import Counter, OrderedDict
 
+from django.conf import settings
 from django.core.cache import cache as default_cache
 
+from .connection import make_read_only
+
 MISSING = object()
 BASIC_TYPES = (bool, int, float, str)
 
+# Locks expire after this many seconds so that a process which dies while
+# computing a value doesn't block everyone else forever. Processes waiting on a
+# lock give up and compute the value themselves after the same period.
+LOCK_TIMEOUT = 300
+
+# Processes waiting on a lock check for the value this often (in seconds),
+# backing off up to the maximum
+POLL_INTERVAL = 0.05
+MAX_POLL_INTERVAL = 1.0
+
+# Maps `cache_key_base` of each memoized function to a Counter of events (see
+# `get_stats`)
+_stats = {}
+_stats_lock = threading.Lock()
+
 
 def memoize(version=1, cache=default_cache):
     def decorator(func):
@@ -26,10 +58,20 @@ def memoize(version=1, cache=default_cache):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
             cache_key = _get_cache_key(cache_key_base, args, kwargs)
+            # The shared cache key contains lists so we need a hashable version
+            local_key = (cache_key_base, tuple(cache_key[1]), tuple(cache_key[2]))
+            result = _local_cache.get(local_key)
+            if result is not MISSING:
+                _increment(cache_key_base, "local_hits")
+                return result
             result = cache.get(cache_key, default=MISSING)
-            if result is MISSING:
-                result = func(*args, **kwargs)
-                cache.set(cache_key, result)
+            if result is not MISSING:
+                _increment(cache_key_base, "hits")
+            else:
+                result = _get_single_flight(
+                    cache, cache_key, cache_key_base, func, args, kwargs
+                )
+            _local_cache.set(local_key, result)
             return result
 
         return wrapper
@@ -37,6 +79,123 @@ def memoize(version=1, cache=default_cache):
     return decorator
 
 
+def _get_single_flight(cache, cache_key, cache_key_base, func, args, kwargs):
+    """
+    Compute the value for `cache_key` and store it in `cache`, unless another
+    process is already computing it in which case wait for it to do so
+    """
+    lock_key = ("lock", cache_key)
+    deadline = time.monotonic() + LOCK_TIMEOUT
+    poll_interval = POLL_INTERVAL
+    waited = False
+    while True:
+        if cache.add(lock_key, True, timeout=LOCK_TIMEOUT):
+            try:
+                # The value may have been stored between our last check and
+                # acquiring the lock
+                result = cache.get(cache_key, default=MISSING)
+                if result is MISSING:
+                    _increment(cache_key_base, "misses")
+                    result = func(*args, **kwargs)
+                    cache.set(cache_key, result)
+                return result
+            finally:
+                cache.delete(lock_key)
+        if not waited:
+            _increment(cache_key_base, "waits")
+            waited = True
+        time.sleep(poll_interval)
+        poll_interval = min(poll_interval * 2, MAX_POLL_INTERVAL)
+        # If the other process succeeds we use its value; if it fails (or
+        # can't write to the cache) then the lock is released and we try
+        # to acquire it ourselves next time round
+        result = cache.get(cache_key, default=MISSING)
+        if result is not MISSING:
+            return result
+        if time.monotonic() > deadline:
+            _increment(cache_key_base, "wait_timeouts")
+            _increment(cache_key_base, "misses")
+            return func(*args, **kwargs)
+
+
+class LocalCache(object):
+    """
+    Thread-safe in-memory LRU cache holding up to MEMOIZE_LOCAL_CACHE_ENTRIES
+    values (read at runtime so that it can be changed in tests)
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        if not settings.MEMOIZE_LOCAL_CACHE_ENTRIES:
+            return MISSING
+        with self._lock:
+            try:
+                self._entries.move_to_end(key)
+            except KeyError:
+                return MISSING
+            return self._entries[key]
+
+    def set(self, key, value):
+        max_entries = settings.MEMOIZE_LOCAL_CACHE_ENTRIES
+        if not max_entries:
+            return
+        _make_read_only(value)
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_local_cache = LocalCache()
+
+
+def _make_read_only(value):
+    if isinstance(value, (tuple, list)):
+        for item in value:
+            _make_read_only(item)
+    else:
+        make_read_only(value)
+
+
+def _increment(cache_key_base, name):
+    with _stats_lock:
+        _stats.setdefault(cache_key_base, Counter())[name] += 1
+
+
+def get_stats():
+    """
+    Return a dict giving, for each memoized function called in this process,
+    counts of:
+
+        local_hits: values found in the in-memory cache
+              hits: values found in the shared cache
+            misses: values we had to compute
+             waits: calls which waited for another process to compute the value
+     wait_timeouts: calls which gave up waiting and computed the value anyway
+    """
+    with _stats_lock:
+        return {
+            cache_key_base: dict(counter) for cache_key_base, counter in _stats.items()
+        }
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+def clear_local_cache():
+    _local_cache.clear()
+
+
 def _get_cache_key_base(func, version):
     return "{}.{}:{}".format(func.__module__, func.__qualname__, version)
 
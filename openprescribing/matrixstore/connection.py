@@ -1,14 +1,42 @@
+import bisect
+import os
 import os.path
+import queue
 import sqlite3
+import threading
 import urllib.parse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import groupby
 
+import numpy
+import scipy.sparse
+
+from .arena import Arena, get_arena_path
+from .matrix_ops import get_sparse_memory_usage, get_submatrix, hstack_matrices
 from .serializer import deserialize
-from .sql_functions import MatrixSum
+from .sql_functions import MatrixSum, fast_in_place_add
+
+# Lengths of the BNF code prefixes for which we store precalculated totals in
+# the `bnf_prefix` table: chapter, section, paragraph, subparagraph and
+# chemical
+BNF_PREFIX_LENGTHS = (2, 4, 6, 7, 9)
+
+# Default number of threads to use when summing matrices in parallel
+DEFAULT_SUM_WORKERS = os.cpu_count() or 1
 
 
 class MatrixStore(object):
-    def __init__(self, sqlite_connection, filename=":memory:"):
+    def __init__(
+        self, sqlite_connection, filename=":memory:", matrix_cache=None, arena=None
+    ):
         self.connection = sqlite_connection
+        # Optional `MatrixCache` instance used by `query_rows`
+        self.matrix_cache = matrix_cache
+        # `Arena` instance holding the file's matrices, for files built with
+        # one (see `matrixstore.arena`)
+        self.arena = arena
         # `cache_key` attributes are used to identify the state of an object for
         # caching purposes. Because we create MatrixStore files with unique
         # names, and because they are immutable once created, we can simply use
@@ -28,10 +56,28 @@ class MatrixStore(object):
         )
         self.dates = sorted_keys(self.date_offsets)
         self.practices = sorted_keys(self.practice_offsets)
-        self.connection.create_aggregate("MATRIX_SUM", 1, MatrixSum)
+        self.bnf_prefixes = self.get_bnf_prefixes()
+        # Maps org types to the practice-to-org mappings used to group the
+        # prescribing in the `presentation_by_org` table
+        self.org_mappings = self.get_org_mappings()
+        self.grouped_org_types = frozenset(self.org_mappings.keys())
+        # List of (start_offset, end_offset) pairs giving the ranges of dates
+        # for which we store blocks of prescribing in the
+        # `presentation_date_block` table
+        self.date_blocks = self.get_date_blocks()
+        # BNF codes of the presentations in the practice-major
+        # `practice_prescribing` table, where each code's position in the list
+        # is its offset within that table's matrices
+        self.practice_index_bnf_codes = self.get_practice_index_bnf_codes()
+        self.has_practice_index = bool(self.practice_index_bnf_codes)
+        self.check_arena()
+        self.deserialize = arena.deserialize if arena is not None else deserialize
+        self.connection.create_aggregate(
+            "MATRIX_SUM", 1, partial(MatrixSum, self.deserialize)
+        )
 
     @classmethod
-    def from_file(cls, path):
+    def from_file(cls, path, matrix_cache=None):
         if not os.path.exists(path):
             raise RuntimeError("No SQLite file at: " + path)
         encoded_path = urllib.parse.quote(os.path.abspath(path))
@@ -50,18 +96,711 @@ class MatrixStore(object):
         # Record the name of the current file, first resolving any symlinks.
         # These files are generated with unique names which we can use as part
         # of a cache key
-        filename = os.path.basename(os.path.realpath(path))
-        return cls(connection, filename=filename)
+        real_path = os.path.realpath(path)
+        filename = os.path.basename(real_path)
+        arena_path = get_arena_path(real_path)
+        arena = Arena(arena_path) if os.path.exists(arena_path) else None
+        return cls(
+            connection, filename=filename, matrix_cache=matrix_cache, arena=arena
+        )
 
     def query(self, sql, params=()):
+        """
+        Execute `sql` and yield each row of results, with any matrices
+        deserialized
+        """
         for row in self.connection.cursor().execute(sql, params):
-            yield convert_row_types(row)
+            yield convert_row_types(row, self.deserialize)
 
     def query_one(self, sql, params=()):
         return next(self.query(sql, params=params))
 
+    def query_presentations(
+        self, columns, where=None, params=(), org_type=None, order_by=None
+    ):
+        """
+        Yield rows of the supplied `presentation` columns, with any matrices
+        deserialized (see `get_presentations_query` for the arguments)
+        """
+        sql, params = self.get_presentations_query(
+            columns, where=where, params=params, org_type=org_type, order_by=order_by
+        )
+        return self.query(sql, params)
+
+    def get_presentations_query(
+        self, columns, where=None, params=(), org_type=None, order_by=None
+    ):
+        """
+        Return an (sql, params) pair which selects the supplied columns for all
+        presentations matching the `where` condition (or all presentations if
+        None)
+
+        If `org_type` is supplied then we select from the `presentation_by_org`
+        table, which holds prescribing already grouped by that org type, so the
+        matrices have one row per org (ordered by org ID) rather than one row
+        per practice.
+        """
+        conditions = []
+        params = list(params)
+        if org_type is None:
+            table = "presentation"
+        else:
+            if org_type not in self.grouped_org_types:
+                raise ValueError("No grouped prescribing for org_type: " + org_type)
+            table = "presentation_by_org"
+            conditions.append("org_type = ?")
+            params.insert(0, org_type)
+        if where is not None:
+            conditions.append("({})".format(where))
+        sql = "SELECT {} FROM {}".format(", ".join(columns), table)
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        if order_by is not None:
+            sql += " ORDER BY " + order_by
+        return sql, params
+
+    def query_rows(self, table, key_column, columns, keys=None):
+        """
+        Yield rows of the form `[key, value, ...]` giving the values of the
+        supplied columns for each row in `table` whose `key_column` matches
+        one of the supplied keys (or every row if `keys` is None)
+
+        If we have a `matrix_cache` then deserialized values are cached there
+        so that frequently read matrices don't have to be decompressed and
+        deserialized each time. Cached matrices are read-only.
+        """
+        if keys is None:
+            where, params = "1=1", []
+        else:
+            where = "{} IN ({})".format(key_column, ",".join(["?"] * len(keys)))
+            params = list(keys)
+        if self.matrix_cache is None:
+            yield from self.query(
+                "SELECT {}, {} FROM {} WHERE {}".format(
+                    key_column, ", ".join(columns), table, where
+                ),
+                params,
+            )
+            return
+        cache = self.matrix_cache
+        keys = [
+            key
+            for (key,) in self.connection.execute(
+                "SELECT {} FROM {} WHERE {}".format(key_column, table, where), params
+            )
+        ]
+        cache_keys = {
+            key: [(self.cache_key, table, key, column) for column in columns]
+            for key in keys
+        }
+        values = {
+            key: [cache.get(cache_key) for cache_key in cache_keys[key]] for key in keys
+        }
+        missing_keys = [
+            key
+            for key in keys
+            if any(value is MatrixCache.MISSING for value in values[key])
+        ]
+        if missing_keys:
+            results = self.query(
+                "SELECT {}, {} FROM {} WHERE {} IN ({})".format(
+                    key_column,
+                    ", ".join(columns),
+                    table,
+                    key_column,
+                    ",".join(["?"] * len(missing_keys)),
+                ),
+                missing_keys,
+            )
+            for key, *row_values in results:
+                for cache_key, value in zip(cache_keys[key], row_values):
+                    cache.set(cache_key, value)
+                values[key] = row_values
+        for key in keys:
+            yield [key] + values[key]
+
+    def query_date_range(self, columns, bnf_codes, start_date, end_date):
+        """
+        Yield rows of the form `[bnf_code, matrix, ...]` giving the values of
+        the supplied `presentation` columns for each of the supplied BNF codes,
+        restricted to the dates from `start_date` to `end_date` inclusive
+
+        Where the file contains prescribing split into blocks of dates we read
+        and decompress only the blocks which overlap the date range, rather
+        than the entire matrix.
+        """
+        start = self.date_offsets[start_date]
+        end = self.date_offsets[end_date] + 1
+        select = ", ".join(columns)
+        placeholders = ",".join(["?"] * len(bnf_codes))
+        blocks = [
+            (block_start, block_end)
+            for (block_start, block_end) in self.date_blocks
+            if block_start < end and block_end > start
+        ]
+        if not blocks:
+            results = self.query(
+                "SELECT bnf_code, {} FROM presentation WHERE bnf_code IN ({})".format(
+                    select, placeholders
+                ),
+                bnf_codes,
+            )
+            for bnf_code, *matrices in results:
+                yield [bnf_code] + [
+                    get_submatrix(matrix, cols=slice(start, end)) for matrix in matrices
+                ]
+            return
+        offset = blocks[0][0]
+        results = self.query(
+            """
+            SELECT
+              bnf_code, {}
+            FROM
+              presentation_date_block
+            WHERE
+              bnf_code IN ({}) AND start_offset >= ? AND start_offset < ?
+            ORDER BY
+              bnf_code, start_offset
+            """.format(
+                select, placeholders
+            ),
+            list(bnf_codes) + [offset, end],
+        )
+        for bnf_code, rows in groupby(results, key=lambda row: row[0]):
+            # Transpose so we have a list of blocks for each column
+            matrix_blocks = zip(*[row[1:] for row in rows])
+            yield [bnf_code] + [
+                get_submatrix(
+                    hstack_matrices(matrices),
+                    cols=slice(start - offset, end - offset),
+                )
+                for matrices in matrix_blocks
+            ]
+
+    def get_practice_prescribing(self, columns, practice_code):
+        """
+        Return a pair of: an array giving the offsets (see
+        `practice_index_bnf_codes`) of the presentations which the practice
+        prescribed; and a list of dense matrices, one for each of the supplied
+        columns, with a row for each of those presentations
+
+        This reads just a single row from the practice-major
+        `practice_prescribing` table.
+        """
+        results = self.query(
+            "SELECT presentation_offsets, {} FROM practice_prescribing "
+            "WHERE practice_offset = ?".format(", ".join(columns)),
+            [self.practice_offsets[practice_code]],
+        )
+        row = next(results, None)
+        if row is None:
+            return numpy.array([], dtype=numpy.int32), [None] * len(columns)
+        presentation_offsets, *matrices = row
+        return presentation_offsets, [
+            matrix.toarray() if scipy.sparse.issparse(matrix) else matrix
+            for matrix in matrices
+        ]
+
+    def query_practices(self, columns, bnf_codes, practice_codes):
+        """
+        Yield rows of the form `[bnf_code, matrix, ...]` giving the values of
+        the supplied `presentation` columns for each of the supplied BNF codes
+        (in BNF code order, and skipping any codes with no prescribing) with
+        each matrix restricted to just the rows for the supplied practices, in
+        the order supplied
+
+        This reads from the practice-major `practice_prescribing` table so it
+        is much faster than reading the full matrices when there are only a few
+        practices.
+        """
+        target_offsets = numpy.array(
+            sorted(
+                offset
+                for offset in map(self.get_practice_index_offset, set(bnf_codes))
+                if offset is not None
+            ),
+            dtype=numpy.int32,
+        )
+        practices = [
+            self.get_practice_prescribing(columns, practice_code)
+            for practice_code in practice_codes
+        ]
+        outputs = [
+            numpy.zeros(
+                (len(target_offsets), len(practice_codes), len(self.dates)),
+                dtype=get_accumulator_dtype(
+                    matrices[column] for _, matrices in practices
+                ),
+            )
+            for column in range(len(columns))
+        ]
+        for practice, (presentation_offsets, matrices) in enumerate(practices):
+            if not len(presentation_offsets):
+                continue
+            positions = numpy.searchsorted(presentation_offsets, target_offsets)
+            positions[positions == len(presentation_offsets)] = 0
+            found = presentation_offsets[positions] == target_offsets
+            for output, matrix in zip(outputs, matrices):
+                output[found, practice] = matrix[positions[found]]
+        for n, offset in enumerate(target_offsets):
+            yield [self.practice_index_bnf_codes[offset]] + [
+                output[n] for output in outputs
+            ]
+
+    def sum_practices_by_bnf_prefixes(self, columns, bnf_code_prefixes, practice_codes):
+        """
+        Return a list of matrices, one for each of the supplied `presentation`
+        columns, giving totals over all presentations which match any of the
+        supplied BNF code prefixes for just the supplied practices (with one
+        row per practice, in the order supplied) or None where there are no
+        such presentations
+
+        Like `query_practices` this reads from the practice-major
+        `practice_prescribing` table. Because offsets are assigned in BNF code
+        order each prefix corresponds to a contiguous range of offsets, so we
+        just need to sum a slice of each practice's matrices.
+        """
+        codes = self.practice_index_bnf_codes
+        offset_ranges = [
+            (
+                bisect.bisect_left(codes, prefix),
+                bisect.bisect_right(codes, prefix + "\U0010ffff"),
+            )
+            for prefix in remove_redundant_prefixes(bnf_code_prefixes)
+        ]
+        offset_ranges = [(start, end) for (start, end) in offset_ranges if start < end]
+        if not offset_ranges:
+            return [None] * len(columns)
+        practices = [
+            self.get_practice_prescribing(columns, practice_code)
+            for practice_code in practice_codes
+        ]
+        outputs = [
+            numpy.zeros(
+                (len(practice_codes), len(self.dates)),
+                dtype=get_accumulator_dtype(
+                    matrices[column] for _, matrices in practices
+                ),
+            )
+            for column in range(len(columns))
+        ]
+        for practice, (presentation_offsets, matrices) in enumerate(practices):
+            if not len(presentation_offsets):
+                continue
+            for start, end in offset_ranges:
+                start, end = numpy.searchsorted(presentation_offsets, [start, end])
+                for output, matrix in zip(outputs, matrices):
+                    output[practice] += matrix[start:end].sum(
+                        axis=0, dtype=output.dtype
+                    )
+        return outputs
+
+    def get_practice_index_offset(self, bnf_code):
+        """
+        Return the offset of the presentation with the supplied BNF code in the
+        `practice_prescribing` table's matrices (or None if it has none)
+        """
+        codes = self.practice_index_bnf_codes
+        offset = bisect.bisect_left(codes, bnf_code)
+        if offset < len(codes) and codes[offset] == bnf_code:
+            return offset
+        return None
+
+    def fetch_stack(self, column, bnf_codes, date_slice=None, practice_rows=None):
+        """
+        Return a pair of: a list of BNF codes; and a dense array of shape
+        (codes, practices, dates) giving the values of the supplied
+        `presentation` column for each of those codes
+
+        The list contains those of the supplied codes which have any
+        prescribing, in BNF code order, so that `stack[i]` is the matrix for
+        `bnf_codes[i]`. Where `date_slice` is supplied the array contains just
+        those dates (reading just the relevant date blocks, where the file has
+        them) and where `practice_rows` is supplied it contains just those
+        rows, in that order.
+
+        Rather than building a row of Python objects for each presentation, as
+        `query` does, we write each matrix directly into its slice of a single
+        preallocated array so that callers can work on all the presentations at
+        once with vectorised numpy operations.
+        """
+        start, end, _ = (date_slice or slice(None)).indices(len(self.dates))
+        placeholders = ",".join(["?"] * len(bnf_codes))
+        blocks = [
+            block_start
+            for (block_start, block_end) in self.date_blocks
+            if block_start < end and block_end > start
+        ]
+        if date_slice is not None and blocks:
+            sql = (
+                "SELECT bnf_code, start_offset, {} FROM presentation_date_block "
+                "WHERE bnf_code IN ({}) AND start_offset >= ? AND start_offset < ? "
+                "ORDER BY bnf_code, start_offset"
+            ).format(column, placeholders)
+            params = list(bnf_codes) + [blocks[0], end]
+        else:
+            sql = (
+                "SELECT bnf_code, 0, {} FROM presentation "
+                "WHERE bnf_code IN ({}) AND {} IS NOT NULL ORDER BY bnf_code"
+            ).format(column, placeholders, column)
+            params = list(bnf_codes)
+        rows = self.connection.execute(sql, params).fetchall()
+        matrices = [self.deserialize(value) for (_, _, value) in rows]
+        codes = sorted({bnf_code for (bnf_code, _, _) in rows})
+        code_offsets = {bnf_code: n for n, bnf_code in enumerate(codes)}
+        if practice_rows is None:
+            num_rows = len(self.practices)
+        else:
+            practice_rows = numpy.asarray(practice_rows)
+            num_rows = len(practice_rows)
+        # We allocate the array so that each (practices, dates) matrix within
+        # it is in Fortran order, which is what `fast_in_place_add` needs
+        stack = numpy.zeros(
+            (len(codes), end - start, num_rows),
+            dtype=get_accumulator_dtype(matrices),
+        ).transpose(0, 2, 1)
+        for (bnf_code, block_start, _), matrix in zip(rows, matrices):
+            overlap_start = max(start, block_start)
+            overlap_end = min(end, block_start + matrix.shape[1])
+            if overlap_start >= overlap_end:
+                continue
+            matrix = get_submatrix(
+                matrix,
+                cols=slice(overlap_start - block_start, overlap_end - block_start),
+            )
+            if practice_rows is not None:
+                matrix = matrix[practice_rows]
+            target = stack[
+                code_offsets[bnf_code], :, overlap_start - start : overlap_end - start
+            ]
+            if isinstance(matrix, scipy.sparse.csc_matrix):
+                fast_in_place_add(target, matrix)
+            elif scipy.sparse.issparse(matrix):
+                target[...] = matrix.toarray()
+            else:
+                target[...] = matrix
+        return codes, stack
+
+    def sum_matrices(self, sql, params=(), workers=None):
+        """
+        Return a list giving, for each column returned by `sql`, the sum of
+        the matrices in that column over all rows (or None where there are no
+        matrices to sum)
+
+        This gives the same result as wrapping each column in MATRIX_SUM, but
+        rather than decompressing, deserializing and adding each matrix in turn
+        inside SQLite's aggregate callback we stream the raw values from the
+        cursor to a pool of `workers` threads. Each thread sums into its own
+        accumulators, which we combine at the end. As decompression and most
+        of the numpy and scipy operations release the GIL this work can happen
+        in parallel.
+        """
+        if workers is None:
+            workers = DEFAULT_SUM_WORKERS
+        cursor = self.connection.cursor().execute(sql, params)
+        num_columns = len(cursor.description)
+        if workers <= 1:
+            return sum_rows(cursor, num_columns, self.deserialize)
+        rows = queue.SimpleQueue()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    sum_rows, iter(rows.get, None), num_columns, self.deserialize
+                )
+                for _ in range(workers)
+            ]
+            try:
+                for row in cursor:
+                    rows.put(row)
+            finally:
+                # Tell each worker that there are no more rows
+                for _ in range(workers):
+                    rows.put(None)
+            results = [future.result() for future in futures]
+        return [add_matrices(matrices) for matrices in zip(*results)]
+
+    def has_table(self, name):
+        return (
+            self.connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", [name]
+            ).fetchone()
+            is not None
+        )
+
+    def get_org_mappings(self):
+        """
+        Return a dict mapping each org type for which we have prescribing
+        grouped by org to a dict of practice codes to org IDs (which will be
+        empty for files built without grouping by org)
+        """
+        if not self.has_table("practice_org"):
+            return {}
+        org_mappings = {}
+        results = self.connection.execute(
+            "SELECT org_type, practice_code, org_id FROM practice_org"
+        )
+        for org_type, practice_code, org_id in results:
+            org_mappings.setdefault(org_type, {})[practice_code] = org_id
+        return org_mappings
+
+    def get_practice_to_org_map(self, org_type):
+        """
+        Return the mapping from practice codes to org IDs which was used to
+        group prescribing by `org_type` when this file was built
+        """
+        return self.org_mappings[org_type]
+
+    def get_date_blocks(self):
+        """
+        Return the list of date ranges for which we store blocks of prescribing
+        (which will be empty for files built without these)
+        """
+        if not self.has_table("date_block"):
+            return []
+        return list(
+            self.connection.execute(
+                "SELECT start_offset, end_offset FROM date_block ORDER BY start_offset"
+            )
+        )
+
+    def check_arena(self):
+        """
+        Check that we have the arena file which this file was built with, if
+        any
+        """
+        if not self.has_table("arena"):
+            return
+        row = self.connection.execute("SELECT size FROM arena").fetchone()
+        if row is None:
+            return
+        if self.arena is None:
+            raise RuntimeError("MatrixStore file requires an arena file")
+        if self.arena.size != row[0]:
+            raise RuntimeError(
+                "Arena file has size {} but expected {}".format(self.arena.size, row[0])
+            )
+
+    def get_practice_index_bnf_codes(self):
+        """
+        Return the list of BNF codes in the `practice_index_presentation` table
+        in offset order (which will be empty for files built without a practice
+        index)
+        """
+        if not self.has_table("practice_index_presentation"):
+            return []
+        return [
+            bnf_code
+            for (bnf_code,) in self.connection.execute(
+                "SELECT bnf_code FROM practice_index_presentation ORDER BY offset"
+            )
+        ]
+
+    def get_bnf_prefixes(self):
+        """
+        Return the set of BNF code prefixes for which we have precalculated
+        totals (which will be empty for files built before we added these)
+        """
+        if not self.has_table("bnf_prefix"):
+            return frozenset()
+        return frozenset(
+            prefix
+            for (prefix,) in self.connection.execute("SELECT prefix FROM bnf_prefix")
+        )
+
+    def sum_by_bnf_prefixes(self, columns, bnf_code_prefixes, workers=None):
+        """
+        Return a list of matrices, one for each of the supplied `presentation`
+        columns, giving totals over all presentations which match any of the
+        supplied BNF code prefixes (or None where there are no such
+        presentations)
+
+        Where possible we use precalculated totals from the `bnf_prefix` table
+        rather than summing over individual presentations. Any summing is done
+        in parallel (see `sum_matrices`).
+        """
+        precalculated, other_conditions = self.plan_bnf_prefix_sum(bnf_code_prefixes)
+        results = [
+            self.sum_bnf_prefix_totals(columns, precalculated, workers=workers),
+            self.sum_presentations(columns, other_conditions, workers=workers),
+        ]
+        return [add_matrices(values) for values in zip(*results)]
+
+    def sum_bnf_prefix_totals(self, columns, prefixes, workers=None):
+        """
+        Return a list of matrices, one for each of the supplied columns, giving
+        the sum of the precalculated totals for the supplied prefixes in the
+        `bnf_prefix` table (or None where there are no prefixes)
+        """
+        if not prefixes:
+            return [None] * len(columns)
+        sql = "SELECT {} FROM bnf_prefix WHERE prefix IN ({})".format(
+            ", ".join(columns), ", ".join(["?"] * len(prefixes))
+        )
+        return self.sum_matrices(sql, prefixes, workers=workers)
+
+    def sum_presentations(self, columns, conditions, org_type=None, workers=None):
+        """
+        Return a list of matrices, one for each of the supplied `presentation`
+        columns, giving totals over all presentations which match any of the
+        supplied (sql, params) conditions (or None where there are no such
+        presentations)
+
+        If `org_type` is supplied these are summed from the prescribing grouped
+        by that org type (see `get_presentations_query`).
+        """
+        if not conditions:
+            return [None] * len(columns)
+        sql, params = self.get_presentations_query(
+            columns,
+            where=" OR ".join(sql for sql, _ in conditions),
+            params=[param for _, params in conditions for param in params],
+            org_type=org_type,
+        )
+        return self.sum_matrices(sql, params, workers=workers)
+
+    def plan_bnf_prefix_sum(self, bnf_code_prefixes):
+        """
+        Work out how to sum over all presentations matching any of the supplied
+        BNF code prefixes
+
+        Returns a pair of: a list of precalculated prefixes to read from the
+        `bnf_prefix` table; and a list of (sql, params) conditions selecting
+        any other presentations from the `presentation` table. Together these
+        cover each matching presentation exactly once.
+        """
+        precalculated = []
+        other_conditions = []
+        for prefix in remove_redundant_prefixes(bnf_code_prefixes):
+            if prefix in self.bnf_prefixes:
+                precalculated.append(prefix)
+                continue
+            # The prefixes at the next precalculated level down, plus any
+            # presentations whose codes are too short to belong to one of these,
+            # exactly cover the presentations matching this prefix
+            next_length = next(
+                (length for length in BNF_PREFIX_LENGTHS if length > len(prefix)),
+                None,
+            )
+            if next_length is None or not self.bnf_prefixes:
+                other_conditions.append(("bnf_code LIKE ?", [prefix + "%"]))
+            elif len(prefix) not in BNF_PREFIX_LENGTHS:
+                precalculated.extend(
+                    sorted(
+                        other_prefix
+                        for other_prefix in self.bnf_prefixes
+                        if len(other_prefix) == next_length
+                        and other_prefix.startswith(prefix)
+                    )
+                )
+                other_conditions.append(
+                    (
+                        "(bnf_code LIKE ? AND length(bnf_code) < ?)",
+                        [prefix + "%", next_length],
+                    )
+                )
+            # Otherwise this is a prefix of a precalculated length with no
+            # prescribing, so there's nothing to sum
+        return precalculated, other_conditions
+
     def close(self):
         self.connection.close()
+        if self.arena is not None:
+            self.arena.close()
+
+
+class MatrixCache(object):
+    """
+    In-memory LRU cache of deserialized matrices with a total size limited to
+    `max_bytes`
+
+    As MatrixStore files are immutable we never need to invalidate entries:
+    keys include the file's `cache_key` so entries for old files just drop out
+    of the cache as they go unused.
+    """
+
+    # Returned by `get` for keys which aren't in the cache (we can't use None as
+    # we also cache NULL values)
+    MISSING = object()
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # Maps keys to (value, size) pairs in least to most recently used order
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, _ = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return self.MISSING
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        size = get_memory_usage(value)
+        # There's no point evicting everything else to store something which
+        # won't fit anyway
+        if size > self.max_bytes:
+            return
+        make_read_only(value)
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+def get_memory_usage(value):
+    """
+    Return the number of bytes used by a matrix (or zero for non-matrix values)
+    """
+    if scipy.sparse.issparse(value):
+        return get_sparse_memory_usage(value)
+    return getattr(value, "nbytes", 0)
+
+
+def make_read_only(value):
+    """
+    Make sure that cached matrices can't be modified in place by callers
+    """
+    if scipy.sparse.issparse(value):
+        arrays = [value.data, value.indices, value.indptr]
+    elif hasattr(value, "flags"):
+        arrays = [value]
+    else:
+        arrays = []
+    for array in arrays:
+        array.flags.writeable = False
+
+
+def get_accumulator_dtype(matrices):
+    """
+    Return a type wide enough to hold sums of the supplied matrices (ignoring
+    any Nones) in the same way as `zeros_like`
+    """
+    dtypes = [matrix.dtype for matrix in matrices if matrix is not None]
+    if any(not numpy.issubdtype(dtype, numpy.integer) for dtype in dtypes):
+        return numpy.float64
+    return numpy.int64
 
 
 def sorted_keys(dictionary):
@@ -69,12 +808,52 @@ def sorted_keys(dictionary):
     return [key for (key, value) in sorted_items]
 
 
-def convert_row_types(row):
-    return list(map(convert_value, row))
+def remove_redundant_prefixes(prefixes):
+    """
+    Return the supplied prefixes (sorted) with any prefixes which are covered by
+    other prefixes in the list removed
+    """
+    output = []
+    for prefix in sorted(set(prefixes)):
+        if not output or not prefix.startswith(output[-1]):
+            output.append(prefix)
+    return output
+
+
+def sum_rows(rows, num_columns, deserialize_func=deserialize):
+    """
+    Return a list giving the sum of each column of serialized matrices over all
+    the supplied rows (or None where there were no matrices to sum)
+    """
+    accumulators = [MatrixSum(deserialize_func) for _ in range(num_columns)]
+    for row in rows:
+        for accumulator, value in zip(accumulators, row):
+            accumulator.step(value)
+    return [accumulator.accumulator for accumulator in accumulators]
+
+
+def add_matrices(matrices):
+    """
+    Return the sum of the supplied matrices, ignoring any Nones, or None if there
+    aren't any matrices to sum
+    """
+    matrices = [matrix for matrix in matrices if matrix is not None]
+    if len(matrices) == 0:
+        return None
+    if len(matrices) == 1:
+        return matrices[0]
+    matrix_sum = MatrixSum()
+    for matrix in matrices:
+        matrix_sum.add(matrix)
+    return matrix_sum.value()
+
+
+def convert_row_types(row, deserialize_func=deserialize):
+    return [convert_value(value, deserialize_func) for value in row]
 
 
-def convert_value(value):
+def convert_value(value, deserialize_func=deserialize):
     if isinstance(value, (bytes, memoryview)):
-        return deserialize(value)
+        return deserialize_func(value)
     else:
         return value
@@ -2,36 +2,195 @@
 This module provides the primary interface between the MatrixStore and the rest
 of the application.
 
-It makes use of the assumption that data is static throughout the runtime of
-the application and therefore any data imports or updates will require an
-application restart before they take effect.
+MatrixStore files are immutable once built, so the only way data changes is by
+updating the MATRIXSTORE_LIVE_FILE symlink to point to a new file. We check
+for this periodically (see `check_for_new_live_file`) and switch over to the
+new file without needing an application restart. Anything derived from the
+contents of the live file should be memoized using `memoize_per_db` so that it
+gets discarded along with the old file.
+
+Org relationships are read from Postgres and memoized alongside the file, so
+changes to these will be picked up the next time the live file changes (or on
+restart). The exception is where the file contains prescribing already grouped
+by org (see `matrixstore.build.group_by_org`), in which case we use the org
+relationships which were snapshotted into the file when it was built.
 """
 
-from functools import lru_cache
+import functools
+import os.path
+import threading
+import time
+import weakref
+from contextlib import contextmanager
 
+import numpy
+import scipy.sparse
 from django.conf import settings
 from frontend.models import Practice
 
-from .connection import MatrixStore
+from .connection import MatrixCache, MatrixStore, add_matrices
 
-# We don't raise this directly here but consumers of the module should be able
-# to catch this exception without having to import from `row_grouper` directly,
-# which violates the abstraction
+# Consumers of the module should be able to catch this exception without
+# having to import from `row_grouper` directly, which violates the abstraction
 from .row_grouper import RowGrouper
-from .row_grouper import UnknownGroupError as UnknownOrgIDError  # noqa
+from .row_grouper import UnknownGroupError as UnknownOrgIDError
+
+# Queries for up to this many practices read from the practice-major index
+# (where the file has one) rather than from the full matrices
+MAX_PRACTICES_FOR_PRACTICE_INDEX = 50
 
-# Create a memoize decorator (i.e. a decorator which caches the return value
-# for a given set of arguments). Here `maxsize=None` means "don't apply any
-# cache eviction, just keep values for ever"
-memoize = lru_cache(maxsize=None)
+# Pair of (resolved path, MatrixStore instance) for the current live file. We
+# always replace this as a whole so that readers never see a mismatched pair.
+_live = None
+_live_lock = threading.Lock()
+_last_checked = 0.0
+# Holds the MatrixStore instance pinned for the duration of the current request
+_pinned = threading.local()
+# In-memory cache of deserialized matrices, shared by all MatrixStore instances
+# in this process (see `get_matrix_cache`)
+_matrix_cache = None
+_matrix_cache_lock = threading.Lock()
+# Maps MatrixStore instances to dicts of values memoized against them. Using
+# weak references means these get garbage collected along with the instance
+# once nothing refers to it.
+_per_db_caches = weakref.WeakKeyDictionary()
 
 
-@memoize
 def get_db():
     """
-    Return a singleton instance of the current live version of the MatrixStore
+    Return the current live version of the MatrixStore
+
+    Inside a request wrapped by `pinned_db` this always returns the instance
+    which was live when the request started, even if the live file has changed
+    in the meantime, so that in-flight requests see consistent data.
+    """
+    db = getattr(_pinned, "db", None)
+    if db is None:
+        db = _get_live()[1]
+    return db
+
+
+def _get_live():
+    global _live
+    live = _live
+    if live is None:
+        with _live_lock:
+            if _live is None:
+                path = os.path.realpath(settings.MATRIXSTORE_LIVE_FILE)
+                _live = (path, _open_file(path))
+            live = _live
+    return live
+
+
+def check_for_new_live_file():
+    """
+    Switch to a new MatrixStore instance if the MATRIXSTORE_LIVE_FILE symlink
+    now points to a different file from the one we have open
+
+    Checks happen at most once every MATRIXSTORE_LIVE_FILE_CHECK_INTERVAL
+    seconds so this is cheap enough to call on every request. Returns True if
+    we switched files.
     """
-    return MatrixStore.from_file(settings.MATRIXSTORE_LIVE_FILE)
+    global _live, _last_checked
+    interval = settings.MATRIXSTORE_LIVE_FILE_CHECK_INTERVAL
+    if interval is None or _live is None:
+        return False
+    now = time.monotonic()
+    if now - _last_checked < interval:
+        return False
+    _last_checked = now
+    path = os.path.realpath(settings.MATRIXSTORE_LIVE_FILE)
+    if path == _live[0]:
+        return False
+    with _live_lock:
+        if path == _live[0]:
+            return False
+        # We open the new file before swapping so that if it's broken we carry
+        # on serving from the old one. The old instance isn't closed explicitly:
+        # any requests still using it hold references to it and its connection
+        # is closed when it gets garbage collected.
+        _live = (path, _open_file(path))
+    return True
+
+
+def _open_file(path):
+    return MatrixStore.from_file(path, matrix_cache=get_matrix_cache())
+
+
+def get_matrix_cache():
+    """
+    Return the process-wide cache of deserialized matrices, or None if this is
+    disabled (i.e. MATRIXSTORE_MATRIX_CACHE_BYTES is zero)
+
+    The cache's `stats()` method reports its hit and miss counts.
+    """
+    global _matrix_cache
+    max_bytes = settings.MATRIXSTORE_MATRIX_CACHE_BYTES
+    if not max_bytes:
+        return None
+    with _matrix_cache_lock:
+        if _matrix_cache is None or _matrix_cache.max_bytes != max_bytes:
+            _matrix_cache = MatrixCache(max_bytes)
+        return _matrix_cache
+
+
+@contextmanager
+def pinned_db(db=None):
+    """
+    Pin the supplied MatrixStore instance (or the current live instance if
+    none is supplied) so that `get_db` returns it for the duration of the block
+    """
+    previous = getattr(_pinned, "db", None)
+    _pinned.db = db if db is not None else get_db()
+    try:
+        yield
+    finally:
+        _pinned.db = previous
+
+
+def reset_live_db():
+    """
+    Forget the current live MatrixStore instance so that the next call to
+    `get_db` opens the live file afresh
+    """
+    global _live
+    with _live_lock:
+        _live = None
+
+
+def memoize_per_db(func):
+    """
+    Create a memoized version of `func` (i.e. one which caches the return
+    value for a given set of arguments) where values are stored against the
+    current MatrixStore instance, so they get rebuilt whenever the live file
+    changes
+
+    Supports `cache_clear()` in the same way as `functools.lru_cache`.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args):
+        db = get_db()
+        cache = _per_db_caches.setdefault(db, {})
+        key = (wrapper, args)
+        try:
+            return cache[key]
+        except KeyError:
+            pass
+        # Make sure that everything `func` reads comes from the same instance
+        # we're storing the value against
+        with pinned_db(db):
+            value = func(*args)
+        cache[key] = value
+        return value
+
+    def cache_clear():
+        for cache in list(_per_db_caches.values()):
+            for key in [key for key in cache if key[0] is wrapper]:
+                del cache[key]
+
+    wrapper.cache_clear = cache_clear
+    return wrapper
 
 
 def org_has_prescribing(org_type, org_id):
@@ -49,17 +208,37 @@ def latest_prescribing_date():
     return get_db().dates[-1]
 
 
-@memoize
+@memoize_per_db
 def get_row_grouper(org_type):
     """
     Return a "row grouper" function which will group the rows of a practice
     level matrix by the supplied `org_type`
 
     Note that the function is memoized so that if org relationships are changed
-    in the database then the application will need to be restarted to see the
-    changes.
+    in the database then these won't be seen until the live file changes or
+    the application is restarted.
+    """
+    db = get_db()
+    # Where the file contains prescribing already grouped by this org type we
+    # have to group everything else using the same org relationships, so that
+    # the rows of all the grouped matrices line up
+    if org_type in db.grouped_org_types:
+        mapping = db.get_practice_to_org_map(org_type)
+    else:
+        mapping = get_practice_to_org_map(org_type)
+    return RowGrouper(
+        (offset, mapping[practice_code])
+        for practice_code, offset in db.practice_offsets.items()
+        if practice_code in mapping
+    )
+
+
+def get_practice_to_org_map(org_type):
+    """
+    Return a dict mapping practice codes to the IDs of the orgs of the
+    supplied `org_type` to which they belong, as currently recorded in the
+    database
     """
-    # Get the mapping from practice codes to IDs of groups
     if org_type == "practice":
         mapping = _practice_to_practice_map()
     elif org_type == "standard_practice":
@@ -80,13 +259,127 @@ def get_row_grouper(org_type):
         mapping = _group_all(_practice_to_standard_practice_map())
     else:
         raise ValueError("Unhandled org_type: " + org_type)
-    return RowGrouper(
-        (offset, mapping[practice_code])
-        for practice_code, offset in get_db().practice_offsets.items()
-        if practice_code in mapping
+    return mapping
+
+
+def query_by_org(columns, org_type, where=None, params=(), order_by=None, org_ids=None):
+    """
+    Yield rows of the supplied `presentation` columns (for the presentations
+    matching `where`, as in `MatrixStore.get_presentations_query`) in which
+    each matrix has been summed by `org_type` exactly as if by:
+
+        get_row_grouper(org_type).sum(matrix, org_ids)
+
+    Where the file contains prescribing already grouped by this org type we
+    read the (much smaller) grouped matrices directly rather than grouping
+    practice level data here.
+    """
+    db = get_db()
+    group_by_org = get_row_grouper(org_type)
+    if org_type in db.grouped_org_types:
+        results = db.query_presentations(
+            columns, where=where, params=params, org_type=org_type, order_by=order_by
+        )
+        if org_ids is None:
+            yield from results
+            return
+        for row in results:
+            yield [
+                (
+                    group_by_org.select_groups(value, org_ids)
+                    if _is_matrix(value)
+                    else value
+                )
+                for value in row
+            ]
+    else:
+        results = db.query_presentations(
+            columns, where=where, params=params, order_by=order_by
+        )
+        for row in results:
+            yield [
+                group_by_org.sum(value, org_ids) if _is_matrix(value) else value
+                for value in row
+            ]
+
+
+def query_presentations_by_org(columns, bnf_codes, org_type, org_ids=None):
+    """
+    Yield rows of the form `[bnf_code, matrix, ...]` giving the values of the
+    supplied `presentation` columns for each of the supplied BNF codes (in BNF
+    code order) with each matrix summed by `org_type` as in `query_by_org`
+
+    For a few practices we read from the practice-major index (see
+    `matrixstore.build.write_practice_index`) which means reading one row per
+    practice rather than one full matrix per presentation.
+    """
+    if use_practice_index(org_type, org_ids):
+        yield from get_db().query_practices(columns, bnf_codes, org_ids)
+        return
+    yield from query_by_org(
+        ["bnf_code"] + list(columns),
+        org_type,
+        where="bnf_code IN ({})".format(",".join(["?"] * len(bnf_codes))),
+        params=bnf_codes,
+        order_by="bnf_code",
+        org_ids=org_ids,
     )
 
 
+def sum_by_org_and_bnf_prefixes(columns, bnf_code_prefixes, org_type):
+    """
+    Return a list of matrices, one for each of the supplied `presentation`
+    columns, giving totals by `org_type` over all presentations which match any
+    of the supplied BNF code prefixes exactly as if by grouping the results of
+    `MatrixStore.sum_by_bnf_prefixes` (or None where there are no such
+    presentations)
+
+    The precalculated totals in the `bnf_prefix` table are held at practice
+    level so we group those here, but where the file contains prescribing
+    already grouped by this org type we sum any other presentations from the
+    grouped matrices.
+    """
+    db = get_db()
+    group_by_org = get_row_grouper(org_type)
+    if org_type not in db.grouped_org_types:
+        matrices = db.sum_by_bnf_prefixes(columns, bnf_code_prefixes)
+        return [_group_matrix(group_by_org, matrix) for matrix in matrices]
+    precalculated, other_conditions = db.plan_bnf_prefix_sum(bnf_code_prefixes)
+    results = [
+        db.sum_presentations(columns, other_conditions, org_type=org_type),
+        [
+            _group_matrix(group_by_org, matrix)
+            for matrix in db.sum_bnf_prefix_totals(columns, precalculated)
+        ],
+    ]
+    return [add_matrices(values) for values in zip(*results)]
+
+
+def _group_matrix(group_by_org, matrix):
+    return group_by_org.sum(matrix) if matrix is not None else None
+
+
+def use_practice_index(org_type, org_ids):
+    """
+    Return whether queries for the supplied orgs should read from the
+    practice-major index
+
+    Raises UnknownOrgIDError for any unknown practices, just as grouping the
+    full matrices would.
+    """
+    if org_type != "practice" or org_ids is None:
+        return False
+    if len(org_ids) > MAX_PRACTICES_FOR_PRACTICE_INDEX:
+        return False
+    if not get_db().has_practice_index:
+        return False
+    offsets = get_row_grouper(org_type).offsets
+    for org_id in org_ids:
+        if org_id not in offsets:
+            raise UnknownOrgIDError(org_id)
+    return True
+
+
 def _practice_to_practice_map():
     # For practice level data we just map each practice code to itself. This
     # means that we're not really doing any "grouping" in a meaningful sense,
@@ -147,6 +440,10 @@ def _practice_to_regional_team_map():
     )
 
 
+def _is_matrix(value):
+    return isinstance(value, numpy.ndarray) or scipy.sparse.issparse(value)
+
+
 def _group_all(mapping):
     """
     Maps every practice contained in the supplied mapping to a single entity,
@@ -0,0 +1,114 @@
+"""
+Times the queries which account for most of the MatrixStore's workload and
+writes the results as JSON (see `matrixstore.benchmark`)
+
+By default this generates a synthetic MatrixStore file to run against (see
+`matrixstore.synthetic`) so that results from different commits can be
+compared. Pass `--compare-with` a previous set of results to see the change in
+each benchmark.
+"""
+
+import json
+import os
+import tempfile
+import time
+
+from django.core.management import BaseCommand
+from matrixstore.benchmark import compare_results, run_benchmarks
+from matrixstore.connection import MatrixStore
+from matrixstore.synthetic import generate_synthetic_matrixstore
+
+
+class Command(BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--matrixstore",
+            help="Run against this existing file instead of a synthetic one",
+        )
+        parser.add_argument(
+            "--synthetic-file",
+            help=(
+                "Write the synthetic file here (or reuse it, if it already "
+                "exists) rather than to a temporary directory"
+            ),
+        )
+        parser.add_argument("--practices", type=int, default=800)
+        parser.add_argument("--presentations", type=int, default=2000)
+        parser.add_argument("--months", type=int, default=24)
+        parser.add_argument(
+            "--density",
+            type=float,
+            default=0.05,
+            help="Average proportion of practice-months with prescribing",
+        )
+        parser.add_argument("--seed", type=int, default=507)
+        parser.add_argument(
+            "--arena",
+            help="Build the synthetic file with an arena",
+            action="store_true",
+        )
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument(
+            "--only",
+            nargs="+",
+            help="Run only benchmarks whose names start with these strings",
+        )
+        parser.add_argument("--output", help="Write JSON results to this file")
+        parser.add_argument(
+            "--compare-with", help="Compare results with those in this JSON file"
+        )
+
+    def handle(self, **options):
+        if options["matrixstore"]:
+            results = self.run(options["matrixstore"], options)
+        elif options["synthetic_file"]:
+            path = options["synthetic_file"]
+            synthetic = self.get_synthetic_parameters(options)
+            if not os.path.exists(path):
+                self.generate(path, synthetic)
+            results = self.run(path, options)
+            results["synthetic"] = synthetic
+        else:
+            synthetic = self.get_synthetic_parameters(options)
+            with tempfile.TemporaryDirectory() as tmpdir:
+                path = os.path.join(tmpdir, "synthetic.sqlite")
+                build_time = self.generate(path, synthetic)
+                results = self.run(path, options)
+            results["synthetic"] = synthetic
+            results["synthetic"]["build_time"] = build_time
+        output = json.dumps(results, indent=2, sort_keys=True)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(output + "\n")
+        else:
+            self.stdout.write(output)
+        if options["compare_with"]:
+            with open(options["compare_with"]) as f:
+                previous = json.load(f)
+            for line in compare_results(previous, results):
+                self.stdout.write(line)
+
+    def get_synthetic_parameters(self, options):
+        return {
+            "num_practices": options["practices"],
+            "num_presentations": options["presentations"],
+            "num_months": options["months"],
+            "density": options["density"],
+            "seed": options["seed"],
+            "arena": options["arena"],
+        }
+
+    def generate(self, path, synthetic):
+        self.stderr.write("Generating synthetic MatrixStore file at {}".format(path))
+        start = time.perf_counter()
+        generate_synthetic_matrixstore(path, **synthetic)
+        return time.perf_counter() - start
+
+    def run(self, path, options):
+        db = MatrixStore.from_file(path)
+        try:
+            return run_benchmarks(db, repeat=options["repeat"], only=options["only"])
+        finally:
+            db.close()
@@ -1,6 +1,11 @@
 """
 Runs the complete process to build a SQLite file with prescribing data in
 MatrixStore format and writes that file into `MATRIXSTORE_BUILD_DIR`
+
+Each stage of the build records a checkpoint in the working file, so if a
+build fails then running the same command again resumes from the stage which
+failed (see `matrixstore.build.checkpoints`). A report of the time taken by
+each stage is written alongside the finished file.
 """
 
 import logging
@@ -9,20 +14,52 @@ import sqlite3
 
 from django.conf import settings
 from django.core.management import BaseCommand
-from matrixstore.build.common import get_temp_filename
+from matrixstore.arena import get_arena_path
+from matrixstore.build.append_months import (
+    append_months,
+    get_dates_to_append,
+    verify_appended_months,
+)
+from matrixstore.build.checkpoints import (
+    Stage,
+    StageRunner,
+    get_report_path,
+    lock_working_file,
+)
 from matrixstore.build.dates import DEFAULT_NUM_MONTHS
 from matrixstore.build.download_practice_stats import download_practice_stats
 from matrixstore.build.download_prescribing import download_prescribing
 from matrixstore.build.generate_filename import generate_filename
+from matrixstore.build.group_by_org import group_by_org as group_prescribing_by_org
 from matrixstore.build.import_practice_stats import import_practice_stats
 from matrixstore.build.import_prescribing import import_prescribing
 from matrixstore.build.init_db import init_db
 from matrixstore.build.precalculate_totals import precalculate_totals
 from matrixstore.build.update_bnf_map import update_bnf_map
+from matrixstore.build.write_arena import write_arena
+from matrixstore.build.write_date_blocks import write_date_blocks
+from matrixstore.build.write_practice_index import write_practice_index
 
 logger = logging.getLogger(__name__)
 
 
+STAGE_NAMES = [
+    "init_db",
+    "download_practice_stats",
+    "import_practice_stats",
+    "download_prescribing",
+    "import_prescribing",
+    "append_months",
+    "update_bnf_map",
+    "write_date_blocks",
+    "precalculate_totals",
+    "group_by_org",
+    "write_practice_index",
+    "write_arena",
+    "verify_appended_months",
+]
+
+
 class Command(BaseCommand):
     help = __doc__
 
@@ -35,14 +72,86 @@ class Command(BaseCommand):
             ),
             default=DEFAULT_NUM_MONTHS,
         )
+        parser.add_argument(
+            "--group-by-org",
+            help="Also store prescribing grouped by CCG, STP, PCN and regional team",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--months-per-date-block",
+            help=(
+                "Also store prescribing split into separately compressed blocks "
+                "of this many months"
+            ),
+            type=int,
+        )
+        parser.add_argument(
+            "--practice-index",
+            help="Also store prescribing transposed by practice",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--arena",
+            help=(
+                "Store matrices uncompressed in a separate file which can be "
+                "memory-mapped by the application"
+            ),
+            action="store_true",
+        )
+        parser.add_argument(
+            "--previous",
+            help=(
+                "Build by taking the data from this existing file and appending "
+                "just the months it doesn't include, rather than from scratch"
+            ),
+        )
+        parser.add_argument(
+            "--verify-totals",
+            help=(
+                "Check the totals over all presentations calculated on import "
+                "against a full pass over the presentations"
+            ),
+            action="store_true",
+        )
+        parser.add_argument(
+            "--from-stage",
+            help=(
+                "Run the build from this stage onwards, even if an earlier "
+                "attempt completed it"
+            ),
+            choices=STAGE_NAMES,
+        )
         parser.add_argument(
             "--quiet", help="Don't emit logging output", action="store_true"
         )
 
-    def handle(self, end_date, months=None, quiet=False, **kwargs):
+    def handle(
+        self,
+        end_date,
+        months=None,
+        group_by_org=False,
+        months_per_date_block=None,
+        practice_index=False,
+        arena=False,
+        previous=None,
+        verify_totals=False,
+        from_stage=None,
+        quiet=False,
+        **kwargs
+    ):
         log_level = "INFO" if not quiet else "ERROR"
         with LogToStream("matrixstore", self.stdout, log_level):
-            return build(end_date, months=months)
+            return build(
+                end_date,
+                months=months,
+                group_by_org=group_by_org,
+                months_per_date_block=months_per_date_block,
+                practice_index=practice_index,
+                arena=arena,
+                previous=previous,
+                verify_totals=verify_totals,
+                from_stage=from_stage,
+            )
 
 
 class LogToStream(object):
@@ -72,24 +181,155 @@ class LogToStream(object):
         self.logger.removeHandler(self.handler)
 
 
-def build(end_date, months=None):
+def build(
+    end_date,
+    months=None,
+    group_by_org=False,
+    months_per_date_block=None,
+    practice_index=False,
+    arena=False,
+    previous=None,
+    verify_totals=False,
+    from_stage=None,
+):
     directory = settings.MATRIXSTORE_BUILD_DIR
-    sqlite_temp = get_temp_filename(os.path.join(directory, "matrixstore.sqlite"))
-    init_db(end_date, sqlite_temp, months=months)
-    download_practice_stats(end_date, months=months)
-    import_practice_stats(sqlite_temp)
-    download_prescribing(end_date, months=months)
-    import_prescribing(sqlite_temp)
-    update_bnf_map(sqlite_temp)
-    precalculate_totals(sqlite_temp)
-    vacuum_database(sqlite_temp)
-    basename = generate_filename(sqlite_temp)
-    filename = os.path.join(directory, basename)
-    logger.info("Moving file to final location: %s", filename)
-    os.rename(sqlite_temp, filename)
+    os.makedirs(directory, exist_ok=True)
+    # The working file has a predictable name so that we can find it again to
+    # resume a failed build, so we lock it for as long as we're using it
+    sqlite_temp = os.path.join(
+        directory, ".tmp.matrixstore_build_{}.sqlite".format(end_date)
+    )
+    stages = get_stages(
+        sqlite_temp,
+        end_date,
+        months=months,
+        group_by_org=group_by_org,
+        months_per_date_block=months_per_date_block,
+        practice_index=practice_index,
+        arena=arena,
+        previous=previous,
+        verify_totals=verify_totals,
+    )
+    runner = StageRunner(sqlite_temp, stages, from_stage=from_stage)
+    with lock_working_file(sqlite_temp):
+        runner.run()
+        runner.remove_checkpoints()
+        vacuum_database(sqlite_temp)
+        basename = generate_filename(sqlite_temp)
+        filename = os.path.join(directory, basename)
+        if arena:
+            # The arena must be in place before the SQLite file which refers to
+            # it
+            os.rename(get_arena_path(sqlite_temp), get_arena_path(filename))
+        logger.info("Moving file to final location: %s", filename)
+        os.rename(sqlite_temp, filename)
+    runner.write_report(get_report_path(filename))
     return filename
 
 
+def get_stages(
+    sqlite_path,
+    end_date,
+    months=None,
+    group_by_org=False,
+    months_per_date_block=None,
+    practice_index=False,
+    arena=False,
+    previous=None,
+    verify_totals=False,
+):
+    """
+    Return the list of Stages which make up the build
+    """
+    if previous:
+        # We only need to download the months which aren't already in the
+        # previous file
+        new_months = len(get_dates_to_append(previous, end_date, months=months))
+        stages = [
+            Stage(
+                "download_practice_stats",
+                download_practice_stats,
+                end_date,
+                months=new_months,
+            ),
+            Stage(
+                "download_prescribing",
+                download_prescribing,
+                end_date,
+                months=new_months,
+            ),
+            Stage(
+                "append_months",
+                append_months,
+                previous,
+                end_date,
+                sqlite_path,
+                months=months,
+                creates_file=True,
+            ),
+        ]
+    else:
+        stages = [
+            Stage(
+                "init_db",
+                init_db,
+                end_date,
+                sqlite_path,
+                months=months,
+                creates_file=True,
+            ),
+            Stage(
+                "download_practice_stats",
+                download_practice_stats,
+                end_date,
+                months=months,
+            ),
+            Stage("import_practice_stats", import_practice_stats, sqlite_path),
+            Stage(
+                "download_prescribing", download_prescribing, end_date, months=months
+            ),
+            Stage("import_prescribing", import_prescribing, sqlite_path),
+        ]
+    stages.append(Stage("update_bnf_map", update_bnf_map, sqlite_path))
+    if months_per_date_block:
+        stages.append(
+            Stage(
+                "write_date_blocks",
+                write_date_blocks,
+                sqlite_path,
+                months_per_date_block,
+            )
+        )
+    # When building from scratch the totals over all presentations are
+    # calculated on import, but appended files need them calculating afresh
+    stages.append(
+        Stage(
+            "precalculate_totals",
+            precalculate_totals,
+            sqlite_path,
+            all_presentations=bool(previous),
+            verify=verify_totals,
+        )
+    )
+    if group_by_org:
+        stages.append(Stage("group_by_org", group_prescribing_by_org, sqlite_path))
+    if practice_index:
+        stages.append(Stage("write_practice_index", write_practice_index, sqlite_path))
+    if arena:
+        stages.append(Stage("write_arena", write_arena, sqlite_path))
+    if previous:
+        # The previous file remains the one we use until this check passes
+        stages.append(
+            Stage(
+                "verify_appended_months",
+                verify_appended_months,
+                previous,
+                sqlite_path,
+            )
+        )
+    return stages
+
+
 def vacuum_database(sqlite_path):
     """
     Rebuild the database file, repacking it into the minimal amount of space
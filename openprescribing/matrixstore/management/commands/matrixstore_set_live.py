@@ -44,10 +44,17 @@ class Command(BaseCommand):
         temp_file = get_temp_filename(symlink)
         os.symlink(target_file, temp_file)
         os.rename(temp_file, symlink)
-        self.stdout.write(
-            "NOTE: You will need to restart the application in order for this "
-            "change to take effect"
-        )
+        check_interval = settings.MATRIXSTORE_LIVE_FILE_CHECK_INTERVAL
+        if check_interval is None:
+            self.stdout.write(
+                "NOTE: You will need to restart the application in order for this "
+                "change to take effect"
+            )
+        else:
+            self.stdout.write(
+                "NOTE: Running application processes will switch to this file "
+                "within {} seconds".format(check_interval)
+            )
 
 
 def get_target_file(filename):
@@ -13,6 +13,32 @@ def sparse_matrix(shape, integer=False):
     return scipy.sparse.lil_matrix(shape, dtype=dtype)
 
 
+def sparse_matrix_from_entries(shape, rows, cols, values):
+    """
+    Create a new Compressed Sparse Column matrix holding the supplied values at
+    the corresponding row and column offsets (all given as numpy arrays)
+
+    This gives exactly the same result as creating a `sparse_matrix` and
+    assigning each value to it in turn: where an offset appears more than once
+    the last value wins, and zeros aren't stored. We also construct the matrix
+    in the same way as `lil_matrix.tocsc()` does, so that the output of
+    `finalise_matrix` serializes to precisely the same bytes.
+    """
+    rows = numpy.asarray(rows, dtype=numpy.int64)
+    cols = numpy.asarray(cols, dtype=numpy.int64)
+    # `lexsort` is stable so repeated offsets keep their original order, and we
+    # keep just the last of each
+    order = numpy.lexsort((rows, cols))
+    rows, cols, values = rows[order], cols[order], values[order]
+    keep = numpy.ones(len(rows), dtype=bool)
+    keep[:-1] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+    keep &= values != 0
+    rows, cols, values = rows[keep], cols[keep], values[keep]
+    indptr = numpy.zeros(shape[1] + 1, dtype=numpy.int32)
+    numpy.cumsum(numpy.bincount(cols, minlength=shape[1]), out=indptr[1:])
+    return csc_matrix((values, rows.astype(numpy.int32), indptr), shape=shape)
+
+
 def finalise_matrix(matrix):
     """
     Return a copy of a sparse matrix in a form suitable for storage
@@ -148,3 +174,22 @@ def get_submatrix(matrix, rows=slice(None, None), cols=slice(None, None)):
     new_matrix.indptr = indptr
     new_matrix._shape = shape
     return new_matrix
+
+
+def hstack_matrices(matrices):
+    """
+    Stack the supplied matrices horizontally (i.e. join their columns)
+
+    The result is a Compressed Sparse Column matrix if all the supplied
+    matrices are sparse, and an ndarray otherwise.
+    """
+    if len(matrices) == 1:
+        return matrices[0]
+    if all(isinstance(matrix, csc_matrix) for matrix in matrices):
+        return scipy.sparse.hstack(matrices, format="csc")
+    return numpy.hstack(
+        [
+            matrix.toarray() if scipy.sparse.issparse(matrix) else matrix
+            for matrix in matrices
+        ]
+    )
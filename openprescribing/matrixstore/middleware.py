@@ -0,0 +1,16 @@
+from .db import check_for_new_live_file, pinned_db
+
+
+def live_matrixstore_middleware(get_response):
+    """
+    Picks up any change to the live MatrixStore file between requests, and pins
+    the current file for the duration of each request so that in-flight
+    requests finish using the file they started with
+    """
+
+    def middleware(request):
+        check_for_new_live_file()
+        with pinned_db():
+            return get_response(request)
+
+    return middleware
@@ -63,10 +63,25 @@ class RowGrouper(object):
         self.offsets = {
             group_id: group_offset for (group_offset, group_id) in enumerate(self.ids)
         }
+        # Same as above but raises UnknownGroupError for unknown group IDs
+        self._group_offsets = GroupsDict(self.offsets)
         # Maps group ID to the numpy object which selects the rows of that group
         self._group_selectors = GroupsDict(
             [(group_id, numpy.array(groups[group_id])) for group_id in self.ids]
         )
+        # Where groups contain multiple rows we sum them by multiplying by a
+        # sparse "aggregation matrix" of shape (groups X rows) which has a 1
+        # wherever a row belongs to a group. We store the components of this
+        # matrix in CSR form here and build the actual matrices (whose shape
+        # and type depend on the matrix being summed) as needed.
+        self._aggregation_indices = numpy.array(
+            [row for group_id in self.ids for row in groups[group_id]],
+            dtype=numpy.int64,
+        )
+        self._aggregation_indptr = numpy.cumsum(
+            [0] + [len(groups[group_id]) for group_id in self.ids], dtype=numpy.int64
+        )
+        self._aggregation_matrices = {}
         # Where each group contains only one row (which is the case whenever
         # we're working with practice level data) there's a much faster path we
         # can take where we just pull out the relevant rows using a single
@@ -109,35 +124,53 @@ class RowGrouper(object):
                 )
                 return matrix[row_selector]
 
-        # If we can't take the fast path then build a list of row selectors for
-        # each group we want
+        # Otherwise we sum all the groups in a single sparse matrix product
+        aggregation_matrix = self._get_aggregation_matrix(matrix)
         if group_ids is not None:
-            row_selectors = [self._group_selectors[group_id] for group_id in group_ids]
-        else:
-            row_selectors = self._group_selectors.values()
-
-        # Initialise an array to contain the output
-        rows = len(row_selectors)
-        columns = matrix.shape[1]
-        grouped_output = numpy.empty((rows, columns), dtype=matrix.dtype)
-
-        # This is awkward. We always want to return an `ndarray` even if the
-        # input type is `matrix`. But where the input is a `matrix` the `out`
-        # argument to `numpy.sum` below must be a `matrix` also. So we need a
-        # view on our output array which matches the type of the input array,
-        # while leaving the actual `grouped_output` return value always of type
-        # `ndarray`.  See the `is_matrix` docstring for more detail.
-        if is_matrix(matrix):
-            output_view = numpy.asmatrix(grouped_output)
-        else:
-            output_view = grouped_output
+            group_offsets = [self._group_offsets[group_id] for group_id in group_ids]
+            aggregation_matrix = aggregation_matrix[group_offsets]
+        grouped_output = aggregation_matrix @ matrix
+        # We always want to return an `ndarray` even if the input type is
+        # `matrix` or sparse. See the `is_matrix` docstring for more detail.
+        if scipy.sparse.issparse(grouped_output):
+            grouped_output = grouped_output.toarray()
+        return numpy.asarray(grouped_output)
+
+    def _get_aggregation_matrix(self, matrix):
+        """
+        Return a sparse matrix which, when multiplied by `matrix`, sums its
+        rows by group
+
+        The type of the aggregation matrix determines the type of the output.
+        We store integer matrices using the smallest type which can hold their
+        values, so we need to use a wider type here to avoid overflow when
+        summing them.
+        """
+        dtype = numpy.promote_types(matrix.dtype, numpy.int64)
+        key = (matrix.shape[0], dtype)
+        try:
+            return self._aggregation_matrices[key]
+        except KeyError:
+            pass
+        data = numpy.ones(len(self._aggregation_indices), dtype=dtype)
+        aggregation_matrix = scipy.sparse.csr_matrix(
+            (data, self._aggregation_indices, self._aggregation_indptr),
+            shape=(len(self.ids), matrix.shape[0]),
+        )
+        self._aggregation_matrices[key] = aggregation_matrix
+        return aggregation_matrix
+
+    def select_groups(self, grouped_matrix, group_ids):
+        """
+        Given a matrix which has already been grouped (i.e. one whose rows
+        correspond to `ids`) return just the rows for the specified groups, in
+        the specified order
 
-        for row_offset, row_selector in enumerate(row_selectors):
-            # Get the rows to be summed
-            row_group = matrix[row_selector]
-            # Sum them and write the result into the output array
-            numpy.sum(row_group, axis=0, out=output_view[row_offset])
-        return grouped_output
+        This gives the same result as calling `sum(matrix, group_ids)` on the
+        original ungrouped matrix.
+        """
+        group_offsets = [self._group_offsets[group_id] for group_id in group_ids]
+        return grouped_matrix[group_offsets]
 
     def sum_one_group(self, matrix, group_id):
         """
@@ -155,6 +188,13 @@ class RowGrouper(object):
         else:
             return group_sum
 
+    def get_row_offsets(self, group_id):
+        """
+        Return an array giving the offsets of the rows which belong to a
+        particular group
+        """
+        return self._group_selectors[group_id]
+
     def get_group(self, matrix, group_id):
         """
         Get the individual rows belonging to a particular group without summing
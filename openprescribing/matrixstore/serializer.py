@@ -28,14 +28,7 @@ def serialize(obj):
                  pyarrow  58           8063
             naive pickle  807          4217
     """
-    buffers = []
-    pickled = pickle.dumps(
-        obj,
-        protocol=5,
-        buffer_callback=lambda buffer: buffers.append(buffer.raw()),
-    )
-    buffers.append(pickled)
-    return serialize_buffers(buffers)
+    return serialize_buffers(pickle_to_buffers(obj))
 
 
 def deserialize_uncompressed(data):
@@ -48,6 +41,44 @@ def deserialize_uncompressed(data):
     return pickle.loads(buffers[-1], buffers=buffers)
 
 
+def serialize_aligned(obj, alignment):
+    """
+    Serialize an object without compression, such that each of its buffers starts
+    at a multiple of `alignment` bytes from the start of the output
+
+    Provided the output is itself stored at a suitably aligned location (e.g. in a
+    memory-mapped file) this means the arrays which `deserialize_aligned` returns are
+    properly aligned views on to that memory.
+    """
+    buffers = pickle_to_buffers(obj)
+    output = bytearray(
+        serialize_ints([alignment, *[len(buffer) for buffer in buffers]])
+    )
+    for buffer in buffers:
+        output += bytes(get_padding(len(output), alignment))
+        output += buffer
+    return output
+
+
+def deserialize_aligned(data):
+    """
+    Inverse of `serialize_aligned`
+
+    As with `deserialize_uncompressed`, the resulting object may contain zero-copy
+    views on to the original data.
+    """
+    data = memoryview(data)
+    ints, offset = deserialize_ints(data)
+    alignment, sizes = ints[0], ints[1:]
+    buffers = []
+    for size in sizes:
+        offset += get_padding(offset, alignment)
+        next_offset = offset + size
+        buffers.append(data[offset:next_offset])
+        offset = next_offset
+    return pickle.loads(buffers[-1], buffers=buffers)
+
+
 def serialize_compressed(obj):
     """
     Serialize an arbitrary Python object and compress the result using LZ4
@@ -66,6 +97,28 @@ def deserialize(data):
     return deserialize_uncompressed(data)
 
 
+def pickle_to_buffers(obj):
+    """
+    Pickle an object using Protocol 5, returning a list of its out-of-band buffers
+    followed by the pickled data itself
+    """
+    buffers = []
+    pickled = pickle.dumps(
+        obj,
+        protocol=5,
+        buffer_callback=lambda buffer: buffers.append(buffer.raw()),
+    )
+    buffers.append(pickled)
+    return buffers
+
+
+def get_padding(offset, alignment):
+    """
+    Return the number of bytes needed to pad `offset` to a multiple of `alignment`
+    """
+    return -offset % alignment
+
+
 def serialize_buffers(buffers):
     """
     Serialize a list of binary data objects to bytes
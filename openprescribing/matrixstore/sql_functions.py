@@ -14,9 +14,14 @@ class MatrixSum(object):
 
     accumulator = None
 
+    def __init__(self, deserialize_func=deserialize):
+        # MatrixStore files with an arena need their own deserialization
+        # function (see `matrixstore.arena`)
+        self.deserialize = deserialize_func
+
     def step(self, value):
         if value is not None:
-            self.add(deserialize(value))
+            self.add(self.deserialize(value))
 
     def add(self, matrix):
         if self.accumulator is None:
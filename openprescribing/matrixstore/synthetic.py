@@ -0,0 +1,319 @@
+"""
+Generates synthetic MatrixStore files of any size so that we can measure
+performance (see `matrixstore.benchmark`) without needing a copy of the
+production file
+
+The prescribing is random but has roughly the shape of the real data:
+presentations are spread across BNF chapters in realistic proportions, each
+chemical has a generic presentation for each of its strengths plus some number
+of branded equivalents, a few presentations are prescribed almost everywhere
+while most are prescribed by only a small minority of practices, and a few
+practices pay well over the odds for some presentations (so there are price-per-
+unit savings and ghost-branded generics to find).
+
+We write the data using the same code as the real build (see
+`matrixstore.build`), with only the BigQuery and CSV inputs replaced by
+generated rows, and apply the same optional build steps as the production build
+so that the file has the same structure as the one we actually serve.
+
+Invoke with:
+./manage.py shell -c 'from matrixstore.synthetic import generate_synthetic_matrixstore; generate_synthetic_matrixstore("synthetic.sqlite")'
+"""
+
+import logging
+import os.path
+import sqlite3
+import string
+
+import numpy
+from matrixstore.arena import get_arena_path
+from matrixstore.build.dates import generate_dates
+from matrixstore.build.group_by_org import group_by_org_for_db
+from matrixstore.build.import_practice_stats import write_practice_stats
+from matrixstore.build.import_prescribing import write_prescribing
+from matrixstore.build.init_db import SCHEMA_SQL, import_dates
+from matrixstore.build.precalculate_totals import precalculate_totals_for_db
+from matrixstore.build.write_arena import write_arena_for_db
+from matrixstore.build.write_date_blocks import write_date_blocks_for_db
+from matrixstore.build.write_practice_index import write_practice_index_for_db
+
+logger = logging.getLogger(__name__)
+
+# Approximate share of presentations in each BNF chapter. Chapters 20-23 are
+# dressings and appliances.
+CHAPTER_WEIGHTS = {
+    "01": 6,
+    "02": 10,
+    "03": 5,
+    "04": 12,
+    "05": 4,
+    "06": 8,
+    "07": 4,
+    "08": 3,
+    "09": 6,
+    "10": 3,
+    "11": 3,
+    "12": 3,
+    "13": 6,
+    "14": 1,
+    "15": 1,
+    "19": 2,
+    "20": 5,
+    "21": 12,
+    "22": 2,
+    "23": 4,
+}
+
+# Proportion of the months in which a practice prescribes a presentation at all
+# that it prescribes it in any given month
+MONTH_PROBABILITY = 0.8
+
+# Proportion of practices which pay well over the typical price for each
+# presentation
+OVERPAYING_PRACTICE_PROBABILITY = 0.02
+
+PACK_SIZES = [1, 7, 14, 28, 30, 56, 60, 84, 100, 500]
+
+PRACTICE_STATISTICS = [
+    "total_list_size",
+    "astro_pu_cost",
+    "astro_pu_items",
+    "star_pu.oral_antibacterials_item",
+]
+
+
+def generate_synthetic_matrixstore(
+    sqlite_path,
+    num_practices=800,
+    num_presentations=2000,
+    num_months=24,
+    density=0.05,
+    chapter_weights=None,
+    end_date="2020-12",
+    seed=507,
+    group_by_org=True,
+    months_per_date_block=1,
+    practice_index=True,
+    arena=False,
+):
+    """
+    Write a synthetic MatrixStore file to `sqlite_path`
+
+    `density` gives the average proportion of (practice, month) pairs for
+    which each presentation has prescribing, and `chapter_weights` the relative
+    number of presentations in each BNF chapter (defaulting to
+    `CHAPTER_WEIGHTS`). The remaining options correspond to the optional
+    build steps of the `matrixstore_build` command and default to the settings
+    we use in production.
+
+    The same arguments always produce the same file.
+    """
+    if os.path.exists(sqlite_path):
+        raise RuntimeError("File already exists at: " + sqlite_path)
+    rng = numpy.random.default_rng(seed)
+    dates = generate_dates(end_date, months=num_months)
+    practice_codes = generate_practice_codes(rng, num_practices)
+    bnf_codes = generate_bnf_codes(
+        rng, num_presentations, chapter_weights or CHAPTER_WEIGHTS
+    )
+    list_sizes = rng.lognormal(mean=8.8, sigma=0.5, size=num_practices)
+    logger.info(
+        "Generating %s practices, %s presentations and %s months",
+        num_practices,
+        num_presentations,
+        num_months,
+    )
+    connection = sqlite3.connect(sqlite_path)
+    connection.executescript(SCHEMA_SQL)
+    import_dates(connection, dates)
+    connection.executemany(
+        "INSERT INTO practice (offset, code) VALUES (?, ?)",
+        enumerate(practice_codes),
+    )
+    write_practice_stats(
+        connection, generate_practice_statistics(practice_codes, dates, list_sizes)
+    )
+    write_prescribing(
+        connection,
+        generate_prescribing(
+            rng, bnf_codes, practice_codes, dates, list_sizes, density
+        ),
+    )
+    connection.commit()
+    # Disable the sqlite module's magical transaction handling features
+    # because the build steps below use their own transactions
+    connection.isolation_level = None
+    # Totals over all presentations were calculated by `write_prescribing`
+    precalculate_totals_for_db(connection, all_presentations=False)
+    if group_by_org:
+        group_by_org_for_db(connection, generate_org_mappings(rng, practice_codes))
+    if months_per_date_block:
+        write_date_blocks_for_db(connection, months_per_date_block)
+    if practice_index:
+        write_practice_index_for_db(connection)
+    if arena:
+        write_arena_for_db(connection, get_arena_path(sqlite_path))
+    connection.execute("VACUUM")
+    connection.close()
+    logger.info("Wrote synthetic MatrixStore file to %s", sqlite_path)
+
+
+def generate_practice_codes(rng, num_practices):
+    """
+    Return a sorted list of unique practice codes of the form A12345
+    """
+    codes = set()
+    while len(codes) < num_practices:
+        codes.add(
+            "{}{:05d}".format(
+                rng.choice(list(string.ascii_uppercase)), rng.integers(100000)
+            )
+        )
+    return sorted(codes)
+
+
+def generate_bnf_codes(rng, num_presentations, chapter_weights):
+    """
+    Return a sorted list of unique 15 character BNF codes, distributed across
+    chapters according to `chapter_weights`
+
+    For each chemical we generate a generic presentation for each strength
+    (e.g. 0212000AAAAAAAA) and, for some of these, one or more branded
+    equivalents (e.g. 0212000AABBABAA) which share the generic's final two
+    characters, just as real brands do.
+    """
+    chapters = sorted(chapter_weights)
+    weights = numpy.array([chapter_weights[chapter] for chapter in chapters])
+    weights = weights / weights.sum()
+    letters = string.ascii_uppercase
+    codes = set()
+    while len(codes) < num_presentations:
+        chemical = "{}{:02d}{:02d}0{}{}".format(
+            rng.choice(chapters, p=weights),
+            rng.integers(1, 10),
+            rng.integers(1, 6),
+            rng.choice(list(letters)),
+            rng.choice(list(letters)),
+        )
+        for strength in letters[: rng.integers(1, 4)]:
+            strength = "A" + strength
+            codes.add(chemical + "AA" + strength + strength)
+            for brand in range(rng.poisson(1.0)):
+                codes.add(
+                    "{}B{}A{}{}".format(
+                        chemical, letters[brand], rng.choice(list(letters)), strength
+                    )
+                )
+    # Which codes we drop here is arbitrary, but as `codes` is a set we need to
+    # sort it first to keep things deterministic
+    codes = sorted(codes)
+    keep = rng.choice(len(codes), size=num_presentations, replace=False)
+    return sorted(codes[i] for i in keep)
+
+
+def generate_prescribing(rng, bnf_codes, practice_codes, dates, list_sizes, density):
+    """
+    Yield prescribing as tuples of the form:
+
+        bnf_code, practice_code, date, items, quantity, actual_cost, net_cost
+
+    sorted by BNF code, practice and date, which is what `write_prescribing`
+    expects
+    """
+    num_practices = len(practice_codes)
+    num_dates = len(dates)
+    # Popularity is very unevenly distributed between presentations, but we
+    # scale it so that the overall density is roughly as requested
+    popularity = rng.pareto(1.5, size=len(bnf_codes)) + 0.1
+    popularity *= density / MONTH_PROBABILITY / popularity.mean()
+    # Items per month per thousand patients
+    practice_scale = list_sizes / 1000
+    for bnf_code, practice_probability in zip(bnf_codes, popularity):
+        prescribers = numpy.flatnonzero(
+            rng.random(num_practices) < min(practice_probability, 1.0)
+        )
+        # Make sure every presentation has at least some prescribing
+        if not len(prescribers):
+            prescribers = rng.integers(num_practices, size=1)
+        pack_size = rng.choice(PACK_SIZES)
+        # Price per unit in pence, with occasional practices paying much more
+        ppu = rng.lognormal(mean=1.5, sigma=1.5)
+        practice_ppus = numpy.full(len(prescribers), ppu)
+        overpaying = rng.random(len(prescribers)) < OVERPAYING_PRACTICE_PROBABILITY
+        practice_ppus[overpaying] *= rng.uniform(1.5, 4.0, size=overpaying.sum())
+        mean_items = practice_scale[prescribers] * rng.lognormal(0, 1)
+        prescribed = rng.random((len(prescribers), num_dates)) < MONTH_PROBABILITY
+        # Each prescribing practice prescribes in at least one month
+        unprescribed = numpy.flatnonzero(~prescribed.any(axis=1))
+        prescribed[unprescribed, rng.integers(num_dates, size=len(unprescribed))] = True
+        items = 1 + rng.poisson(mean_items[:, numpy.newaxis], size=prescribed.shape)
+        for row, practice in enumerate(prescribers):
+            practice_code = practice_codes[practice]
+            for col in numpy.flatnonzero(prescribed[row]):
+                quantity = int(items[row, col]) * pack_size
+                net_cost = int(round(quantity * practice_ppus[row]))
+                actual_cost = int(round(net_cost * 0.93))
+                yield (
+                    bnf_code,
+                    practice_code,
+                    dates[col],
+                    int(items[row, col]),
+                    float(quantity),
+                    actual_cost,
+                    net_cost,
+                )
+
+
+def generate_practice_statistics(practice_codes, dates, list_sizes):
+    """
+    Yield practice statistics as tuples of the form:
+
+        statistic_name, practice_code, date, statistic_value
+    """
+    for practice_code, list_size in zip(practice_codes, list_sizes):
+        values = [
+            int(list_size),
+            list_size * 1.3,
+            list_size * 0.9,
+            list_size * 0.3,
+        ]
+        for date in dates:
+            for name, value in zip(PRACTICE_STATISTICS, values):
+                yield name, practice_code, date, value
+
+
+def generate_org_mappings(rng, practice_codes):
+    """
+    Return a dict mapping each of the org types in
+    `matrixstore.build.group_by_org.ORG_TYPES` to a dict of practice codes to
+    org IDs, with orgs forming a hierarchy of roughly realistic sizes
+    """
+    num_ccgs = max(1, len(practice_codes) // 60)
+    num_stps = max(1, num_ccgs // 4)
+    num_regional_teams = max(1, num_stps // 6)
+    ccg_ids = [
+        "{:02d}{}".format(n % 100, "CDEFGHJKLMNPQRTVWXY"[n // 100])
+        for n in range(num_ccgs)
+    ]
+    stp_ids = ["E54{:06d}".format(n) for n in range(num_stps)]
+    regional_team_ids = ["Y{:02d}".format(n) for n in range(num_regional_teams)]
+    ccg_to_stp = {ccg_id: stp_ids[n % num_stps] for n, ccg_id in enumerate(ccg_ids)}
+    stp_to_regional_team = {
+        stp_id: regional_team_ids[n % num_regional_teams]
+        for n, stp_id in enumerate(stp_ids)
+    }
+    mappings = {"ccg": {}, "stp": {}, "pcn": {}, "regional_team": {}}
+    practice_ccgs = rng.integers(num_ccgs, size=len(practice_codes))
+    for n, practice_code in enumerate(practice_codes):
+        ccg_id = ccg_ids[practice_ccgs[n]]
+        stp_id = ccg_to_stp[ccg_id]
+        mappings["ccg"][practice_code] = ccg_id
+        mappings["stp"][practice_code] = stp_id
+        mappings["regional_team"][practice_code] = stp_to_regional_team[stp_id]
+        # Practices form PCNs of around 7 within each CCG (and, as in the
+        # real data, a few don't belong to any PCN)
+        if rng.random() > 0.02:
+            mappings["pcn"][practice_code] = "U{}{:03d}".format(
+                ccg_id, rng.integers(max(1, len(practice_codes) // num_ccgs // 7))
+            )
+    return mappings
@@ -0,0 +1,162 @@
+import sqlite3
+
+import numpy
+import scipy.sparse
+from django.test import SimpleTestCase
+from matrixstore.build.append_months import (
+    append_months_for_db,
+    get_new_dates,
+    verify_appended_months_for_db,
+)
+from matrixstore.build.import_practice_stats import parse_practice_statistics_csv
+from matrixstore.build.import_prescribing import parse_prescribing_csv
+from matrixstore.build.init_db import generate_dates
+from matrixstore.build.precalculate_totals import precalculate_totals_for_db
+from matrixstore.connection import MatrixStore
+from matrixstore.csv_utils import dicts_to_csv
+from matrixstore.serializer import serialize_compressed
+from matrixstore.tests.data_factory import DataFactory
+from matrixstore.tests.import_test_data_fast import (
+    import_test_data_fast,
+    update_bnf_map,
+)
+
+
+class TestAppendMonths(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        factory = DataFactory()
+        months = factory.create_months("2018-06-01", 7)
+        practices = factory.create_practices(4)
+        presentations = factory.create_presentations(4)
+        factory.create_prescribing(presentations, practices, months)
+        factory.create_practice_statistics(practices, months)
+        # This practice and presentation only have data for the month which gets
+        # dropped
+        closed_practice = factory.create_practice()
+        old_presentation = factory.create_presentation()
+        factory.create_prescription(old_presentation, closed_practice, months[0])
+        factory.create_statistics_for_one_practice_and_month(closed_practice, months[0])
+        # And these only have data for the month which gets appended
+        new_practice = factory.create_practice()
+        new_presentation = factory.create_presentation()
+        factory.create_prescription(new_presentation, new_practice, months[-1])
+        factory.create_statistics_for_one_practice_and_month(new_practice, months[-1])
+        # This presentation's prescribing in the new month is under its old BNF
+        # code, which needs mapping on to the code used in the previous file
+        presentation_to_update = factory.create_presentation()
+        factory.create_prescribing([presentation_to_update], practices, months[:-1])
+        updated_presentation = factory.update_bnf_code(presentation_to_update)
+        factory.create_prescribing([updated_presentation], practices, months[:-1])
+        factory.create_prescribing([presentation_to_update], practices, months[-1:])
+        cls.factory = factory
+        cls.previous = build_matrixstore(factory, "2018-11", months=6)
+        cls.expected = build_matrixstore(factory, "2018-12", months=6)
+        cls.matrixstore = append_to_matrixstore(
+            cls.previous, factory, "2018-12", months=6
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.previous.close()
+        cls.expected.close()
+        cls.matrixstore.close()
+
+    def test_dates_and_practices_match_full_build(self):
+        self.assertEqual(self.matrixstore.dates, self.expected.dates)
+        self.assertEqual(self.matrixstore.practices, self.expected.practices)
+        self.assertNotEqual(self.matrixstore.practices, self.previous.practices)
+
+    def test_data_matches_full_build(self):
+        queries = [
+            "SELECT bnf_code, items, quantity, actual_cost, net_cost FROM presentation",
+            "SELECT name, value FROM practice_statistic",
+            "SELECT prefix, items, quantity, actual_cost, net_cost FROM bnf_prefix",
+            "SELECT 1, items, quantity, actual_cost, net_cost FROM all_presentations",
+        ]
+        for sql in queries:
+            with self.subTest(sql=sql):
+                expected = get_rows_by_key(self.expected, sql)
+                results = get_rows_by_key(self.matrixstore, sql)
+                self.assertEqual(sorted(results.keys()), sorted(expected.keys()))
+                for key, row in results.items():
+                    for matrix, expected_matrix in zip(row, expected[key]):
+                        numpy.testing.assert_array_almost_equal(
+                            to_dense(matrix), to_dense(expected_matrix)
+                        )
+
+    def test_verify_passes(self):
+        verify_appended_months_for_db(self.previous, self.matrixstore)
+
+    def test_verify_detects_mismatch(self):
+        matrixstore = append_to_matrixstore(
+            self.previous, self.factory, "2018-12", months=6
+        )
+        bnf_code, items = next(
+            matrixstore.query("SELECT bnf_code, items FROM presentation")
+        )
+        matrixstore.connection.execute(
+            "UPDATE presentation SET items = ? WHERE bnf_code = ?",
+            [serialize_compressed(to_dense(items) + 1), bnf_code],
+        )
+        precalculate_totals_for_db(matrixstore.connection)
+        with self.assertRaisesRegex(RuntimeError, "all_presentations.items"):
+            verify_appended_months_for_db(self.previous, matrixstore)
+        matrixstore.close()
+
+    def test_get_new_dates(self):
+        previous_dates = generate_dates("2018-11", months=6)
+        self.assertEqual(
+            get_new_dates(previous_dates, generate_dates("2019-01", months=6)),
+            ["2018-12-01", "2019-01-01"],
+        )
+        with self.assertRaisesRegex(RuntimeError, "already contains"):
+            get_new_dates(previous_dates, generate_dates("2018-11", months=3))
+        with self.assertRaisesRegex(RuntimeError, "follow on"):
+            get_new_dates(previous_dates, generate_dates("2019-06", months=6))
+
+
+def build_matrixstore(factory, end_date, months):
+    connection = sqlite3.connect(":memory:", check_same_thread=False)
+    import_test_data_fast(connection, factory, end_date, months=months)
+    return MatrixStore(connection)
+
+
+def append_to_matrixstore(previous, factory, end_date, months):
+    """
+    Build a MatrixStore by appending the data in `factory` for the dates which
+    aren't in `previous`, following the same steps as `import_test_data_fast`
+    """
+    dates = generate_dates(end_date, months=months)
+    new_dates = get_new_dates(previous.dates, dates)
+    prescribing = sorted(
+        filter_by_date(factory.prescribing, new_dates),
+        key=lambda p: (p["bnf_code"], p["practice"], p["month"]),
+    )
+    practice_statistics = list(filter_by_date(factory.practice_statistics, new_dates))
+    practice_codes = {p["practice"] for p in prescribing + practice_statistics}
+    connection = sqlite3.connect(":memory:", check_same_thread=False)
+    connection.isolation_level = None
+    append_months_for_db(
+        previous,
+        connection,
+        dates,
+        practice_codes,
+        parse_prescribing_csv(dicts_to_csv(prescribing)),
+        parse_practice_statistics_csv(dicts_to_csv(practice_statistics)),
+    )
+    update_bnf_map(connection, factory)
+    precalculate_totals_for_db(connection)
+    return MatrixStore(connection)
+
+
+def filter_by_date(items, dates):
+    return [item for item in items if item["month"][:10] in dates]
+
+
+def get_rows_by_key(matrixstore, sql):
+    return {row[0]: row[1:] for row in matrixstore.query(sql)}
+
+
+def to_dense(matrix):
+    return matrix.toarray() if scipy.sparse.issparse(matrix) else matrix
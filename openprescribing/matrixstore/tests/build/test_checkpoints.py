@@ -0,0 +1,138 @@
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+
+from django.test import SimpleTestCase
+from matrixstore.build.checkpoints import (
+    Stage,
+    StageRunner,
+    WorkingFileLocked,
+    lock_working_file,
+)
+
+
+class StageFailed(Exception):
+    pass
+
+
+class TestStageRunner(SimpleTestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.sqlite_path = os.path.join(self.tempdir, "working.sqlite")
+        self.calls = []
+        self.fail_at = None
+
+    def create_file(self, sqlite_path):
+        self.record_call("create_file")
+        connection = sqlite3.connect(sqlite_path)
+        connection.execute("CREATE TABLE data (stage TEXT)")
+        connection.commit()
+        connection.close()
+
+    def add_data(self, name, sqlite_path, value=None):
+        self.record_call(name)
+        connection = sqlite3.connect(sqlite_path)
+        connection.execute("INSERT INTO data VALUES (?)", [name])
+        connection.commit()
+        connection.close()
+
+    def record_call(self, name):
+        if name == self.fail_at:
+            raise StageFailed(name)
+        self.calls.append(name)
+
+    def get_stages(self, value="a"):
+        return [
+            Stage("download", self.record_call, "download"),
+            Stage("create", self.create_file, self.sqlite_path, creates_file=True),
+            Stage("first", self.add_data, "first", self.sqlite_path),
+            Stage("second", self.add_data, "second", self.sqlite_path, value=value),
+            Stage("third", self.add_data, "third", self.sqlite_path),
+        ]
+
+    def run_stages(self, from_stage=None, **kwargs):
+        self.calls = []
+        self.runner = StageRunner(
+            self.sqlite_path, self.get_stages(**kwargs), from_stage=from_stage
+        )
+        self.runner.run()
+        return self.calls
+
+    def get_data(self):
+        connection = sqlite3.connect(self.sqlite_path)
+        data = [stage for (stage,) in connection.execute("SELECT stage FROM data")]
+        connection.close()
+        return data
+
+    def test_completed_stages_are_skipped(self):
+        all_stages = ["download", "create_file", "first", "second", "third"]
+        self.assertEqual(self.run_stages(), all_stages)
+        self.assertEqual(self.run_stages(), [])
+        self.assertEqual(
+            [status for _, status, _ in self.runner.timings], ["skipped"] * 5
+        )
+
+    def test_resumes_from_failed_stage(self):
+        self.fail_at = "second"
+        with self.assertRaises(StageFailed):
+            self.run_stages()
+        self.fail_at = None
+        self.assertEqual(self.run_stages(), ["second", "third"])
+        self.assertEqual(self.get_data(), ["first", "second", "third"])
+
+    def test_changed_inputs_invalidate_following_stages(self):
+        self.run_stages()
+        self.assertEqual(self.run_stages(value="b"), ["second", "third"])
+
+    def test_from_stage(self):
+        self.run_stages()
+        self.assertEqual(self.run_stages(from_stage="third"), ["third"])
+        # Running an earlier stage means the later ones need to run again
+        self.fail_at = "third"
+        with self.assertRaises(StageFailed):
+            self.run_stages(from_stage="first")
+        self.fail_at = None
+        self.assertEqual(self.run_stages(), ["third"])
+
+    def test_from_stage_which_creates_file_starts_afresh(self):
+        self.run_stages()
+        self.assertEqual(
+            self.run_stages(from_stage="create"),
+            ["create_file", "first", "second", "third"],
+        )
+        self.assertEqual(self.get_data(), ["first", "second", "third"])
+
+    def test_unknown_from_stage_raises_error(self):
+        with self.assertRaisesRegex(ValueError, "Unknown stage 'fourth'"):
+            self.run_stages(from_stage="fourth")
+
+    def test_remove_checkpoints_and_write_report(self):
+        self.run_stages()
+        self.runner.remove_checkpoints()
+        self.assertEqual(self.runner.read_checkpoints(), {})
+        report_path = os.path.join(self.tempdir, "report.json")
+        self.runner.write_report(report_path)
+        with open(report_path) as f:
+            report = json.load(f)
+        self.assertEqual(
+            [(stage["stage"], stage["status"]) for stage in report],
+            [
+                ("download", "completed"),
+                ("create", "completed"),
+                ("first", "completed"),
+                ("second", "completed"),
+                ("third", "completed"),
+            ],
+        )
+
+    def test_lock_working_file(self):
+        with lock_working_file(self.sqlite_path):
+            with self.assertRaises(WorkingFileLocked):
+                with lock_working_file(self.sqlite_path):
+                    pass
+        # Once released the lock can be taken again
+        with lock_working_file(self.sqlite_path):
+            self.assertEqual(self.run_stages()[:2], ["download", "create_file"])
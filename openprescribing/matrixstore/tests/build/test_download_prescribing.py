@@ -0,0 +1,113 @@
+import csv
+import gzip
+import os
+import shutil
+import tempfile
+
+from django.test import SimpleTestCase, override_settings
+from gcutils.storage import LocalBucket
+from matrixstore.build.common import get_filename_for_download, get_prescribing_filename
+from matrixstore.build.download_prescribing import (
+    SENTINEL_SUFFIX,
+    download_prescribing,
+    remote_storage_prefix_for_date,
+)
+
+HEADERS = [
+    "bnf_code",
+    "practice",
+    "month",
+    "items",
+    "quantity",
+    "net_cost",
+    "actual_cost",
+]
+
+
+class CountingBucket(LocalBucket):
+    """
+    Records the names of the blobs which get downloaded
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.downloaded = []
+
+    def blob(self, name):
+        blob = super().blob(name)
+        download_to_filename = blob.download_to_filename
+
+        def counting_download_to_filename(filename):
+            self.downloaded.append(name)
+            download_to_filename(filename)
+
+        blob.download_to_filename = counting_download_to_filename
+        return blob
+
+
+class TestDownloadPrescribing(SimpleTestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        import_dir = os.path.join(self.tempdir, "import")
+        os.makedirs(os.path.join(import_dir, "temporary_downloads"))
+        settings_override = override_settings(MATRIXSTORE_IMPORT_DIR=import_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.bucket = CountingBucket(os.path.join(self.tempdir, "bucket"))
+        # Export some prescribing, unsorted and split over several shards, as
+        # BigQuery would
+        self.date = "2019-01-01"
+        self.rows = [
+            [bnf_code, practice, "2019-01-01 00:00:00 UTC", "1", "2.0", "3.5", "3.4"]
+            for bnf_code in ["0703021Q0AAAAAA", "0101010G0AAABAB", "2301000A0AAAAAA"]
+            for practice in ["Y00002", "A81001", "N84014"]
+        ]
+        self.prefix = remote_storage_prefix_for_date(self.date)
+        self.shards = []
+        for n in range(3):
+            name = "{}{:012d}.csv.gz".format(self.prefix, n)
+            self.write_shard(name, self.rows[n::3])
+            self.shards.append(name)
+        self.bucket.blob(self.prefix + SENTINEL_SUFFIX).upload_from_string("done")
+
+    def write_shard(self, name, rows):
+        filename = os.path.join(self.tempdir, "shard.csv.gz")
+        with gzip.open(filename, "wt", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(HEADERS)
+            writer.writerows(rows)
+        self.bucket.blob(name).upload_from_filename(filename)
+
+    def read_prescribing(self):
+        with gzip.open(get_prescribing_filename(self.date), "rt", newline="") as f:
+            return list(csv.reader(f))
+
+    def test_downloads_and_sorts_prescribing(self):
+        download_prescribing("2019-01", months=1, bucket=self.bucket)
+        expected = [HEADERS] + sorted(self.rows)
+        self.assertEqual(self.read_prescribing(), expected)
+        self.assertEqual(
+            sorted(self.bucket.downloaded),
+            self.shards + [self.prefix + SENTINEL_SUFFIX],
+        )
+        # The shards get cleaned up once they've been consolidated
+        self.assertEqual(
+            os.listdir(os.path.dirname(get_filename_for_download("x"))), []
+        )
+
+    def test_resumes_interrupted_download(self):
+        # Pretend that the first shard was downloaded before we were interrupted
+        shutil.copyfile(
+            self.bucket.blob(self.shards[0]).path,
+            get_filename_for_download(self.shards[0]),
+        )
+        download_prescribing("2019-01", months=1, bucket=self.bucket)
+        self.assertNotIn(self.shards[0], self.bucket.downloaded)
+        self.assertEqual(self.read_prescribing(), [HEADERS] + sorted(self.rows))
+
+    def test_already_consolidated_data_not_downloaded(self):
+        download_prescribing("2019-01", months=1, bucket=self.bucket)
+        self.bucket.downloaded = []
+        download_prescribing("2019-01", months=1, bucket=self.bucket)
+        self.assertEqual(self.bucket.downloaded, [])
@@ -0,0 +1,131 @@
+import sqlite3
+
+import numpy
+from django.test import SimpleTestCase
+
+from matrixstore import db
+from matrixstore.build.group_by_org import group_by_org_for_db
+from matrixstore.build.precalculate_totals import precalculate_totals_for_db
+from matrixstore.connection import MatrixStore
+from matrixstore.row_grouper import RowGrouper
+from matrixstore.tests.data_factory import DataFactory
+from matrixstore.tests.import_test_data_fast import import_test_data_fast
+
+
+class TestGroupByOrg(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        factory = DataFactory()
+        factory.create_all(
+            start_date="2018-06-01", num_months=6, num_practices=8, num_presentations=6
+        )
+        practice_codes = sorted(p["code"] for p in factory.practices)
+        cls.org_mappings = {
+            "ccg": {
+                code: "CCG{}".format(i % 3) for i, code in enumerate(practice_codes)
+            },
+            # Not every practice belongs to a PCN
+            "pcn": {
+                code: "PCN{}".format(i % 2) for i, code in enumerate(practice_codes[1:])
+            },
+        }
+        connection = sqlite3.connect(":memory:", check_same_thread=False)
+        import_test_data_fast(connection, factory, "2018-11", months=6)
+        group_by_org_for_db(connection, cls.org_mappings)
+        precalculate_totals_for_db(connection)
+        cls.bnf_codes = sorted(p["bnf_code"] for p in factory.presentations)
+        cls.matrixstore = MatrixStore(connection)
+        cls.columns = ["bnf_code", "items", "actual_cost"]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.matrixstore.close()
+
+    def test_grouped_org_types(self):
+        self.assertEqual(self.matrixstore.grouped_org_types, {"ccg", "pcn"})
+        self.assertEqual(
+            self.matrixstore.get_practice_to_org_map("pcn"), self.org_mappings["pcn"]
+        )
+
+    def test_query_reads_grouped_prescribing(self):
+        practice_offsets = self.matrixstore.practice_offsets
+        for org_type, mapping in self.org_mappings.items():
+            with self.subTest(org_type=org_type):
+                row_grouper = RowGrouper(
+                    (practice_offsets[code], org_id) for code, org_id in mapping.items()
+                )
+                results = list(
+                    self.matrixstore.query_presentations(
+                        self.columns, order_by="bnf_code"
+                    )
+                )
+                grouped_results = list(
+                    self.matrixstore.query_presentations(
+                        self.columns, org_type=org_type, order_by="bnf_code"
+                    )
+                )
+                self.assertEqual(len(grouped_results), len(results))
+                for row, grouped_row in zip(results, grouped_results):
+                    self.assertEqual(grouped_row[0], row[0])
+                    for matrix, grouped_matrix in zip(row[1:], grouped_row[1:]):
+                        self.assertEqual(
+                            grouped_matrix.shape, (len(row_grouper.ids), 6)
+                        )
+                        numpy.testing.assert_array_almost_equal(
+                            grouped_matrix, row_grouper.sum(matrix)
+                        )
+
+    def test_query_with_ungrouped_org_type_raises_error(self):
+        with self.assertRaises(ValueError):
+            self.matrixstore.get_presentations_query(self.columns, org_type="stp")
+
+    def test_query_by_org_matches_row_grouper(self):
+        for org_ids in [None, ["CCG2", "CCG0"]]:
+            with self.subTest(org_ids=org_ids), db.pinned_db(self.matrixstore):
+                row_grouper = db.get_row_grouper("ccg")
+                self.assertEqual(row_grouper.ids, ["CCG0", "CCG1", "CCG2"])
+                expected = [
+                    [row[0]] + [row_grouper.sum(matrix, org_ids) for matrix in row[1:]]
+                    for row in self.matrixstore.query_presentations(
+                        self.columns, order_by="bnf_code"
+                    )
+                ]
+                results = list(
+                    db.query_by_org(
+                        self.columns, "ccg", order_by="bnf_code", org_ids=org_ids
+                    )
+                )
+                self.assertEqual(len(results), len(expected))
+                for row, expected_row in zip(results, expected):
+                    self.assertEqual(row[0], expected_row[0])
+                    for matrix, expected_matrix in zip(row[1:], expected_row[1:]):
+                        numpy.testing.assert_array_almost_equal(matrix, expected_matrix)
+
+    def test_sum_by_org_and_bnf_prefixes_matches_row_grouper(self):
+        columns = ["items", "quantity", "actual_cost"]
+        bnf_code = self.bnf_codes[0]
+        test_cases = [
+            [bnf_code[:2]],
+            [bnf_code[:3]],
+            [bnf_code[:4], bnf_code],
+            [bnf_code[:8]],
+            ["99"],
+        ]
+        with db.pinned_db(self.matrixstore):
+            for org_type in ["ccg", "pcn", "practice"]:
+                row_grouper = db.get_row_grouper(org_type)
+                for prefixes in test_cases:
+                    with self.subTest(org_type=org_type, prefixes=prefixes):
+                        values = db.sum_by_org_and_bnf_prefixes(
+                            columns, prefixes, org_type
+                        )
+                        expected_values = self.matrixstore.sum_by_bnf_prefixes(
+                            columns, prefixes
+                        )
+                        for value, expected_value in zip(values, expected_values):
+                            if expected_value is None:
+                                self.assertIsNone(value)
+                            else:
+                                numpy.testing.assert_array_almost_equal(
+                                    value, row_grouper.sum(expected_value)
+                                )
@@ -0,0 +1,88 @@
+import sqlite3
+
+import numpy
+from django.test import SimpleTestCase
+from matrixstore.build.import_prescribing import (
+    parse_prescribing_csv,
+    write_prescribing,
+)
+from matrixstore.build.init_db import SCHEMA_SQL, generate_dates, import_dates
+from matrixstore.build.precalculate_totals import (
+    precalculate_all_presentations_totals,
+    verify_all_presentations_totals,
+)
+from matrixstore.connection import MatrixStore
+from matrixstore.csv_utils import dicts_to_csv
+from matrixstore.tests.data_factory import DataFactory
+
+
+class TestWritePrescribing(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.factory = DataFactory()
+        months = cls.factory.create_months("2018-06-01", 6)
+        practices = cls.factory.create_practices(8)
+        presentations = cls.factory.create_presentations(12)
+        cls.factory.create_prescribing(presentations, practices, months)
+
+    def write_prescribing(self, workers):
+        connection = self.create_db(workers)
+        rows = list(connection.execute("SELECT * FROM presentation ORDER BY rowid"))
+        connection.close()
+        return rows
+
+    def create_db(self, workers=1):
+        connection = sqlite3.connect(":memory:")
+        connection.isolation_level = None
+        connection.executescript(SCHEMA_SQL)
+        dates = generate_dates("2018-11", months=6)
+        import_dates(connection, dates)
+        prescribing = sorted(
+            self.factory.prescribing,
+            key=lambda p: (p["bnf_code"], p["practice"], p["month"]),
+        )
+        connection.executemany(
+            "INSERT INTO practice (offset, code) VALUES (?, ?)",
+            enumerate(sorted({p["practice"] for p in prescribing})),
+        )
+        write_prescribing(
+            connection,
+            parse_prescribing_csv(dicts_to_csv(prescribing)),
+            workers=workers,
+        )
+        return connection
+
+    def test_worker_processes_produce_identical_output(self):
+        rows = self.write_prescribing(workers=1)
+        self.assertEqual(len(rows), 12)
+        self.assertEqual(self.write_prescribing(workers=3), rows)
+
+    def test_all_presentations_totals_match_full_pass(self):
+        connection = self.create_db()
+        verify_all_presentations_totals(connection)
+        totals = get_all_presentations_totals(connection)
+        precalculate_all_presentations_totals(connection)
+        expected = get_all_presentations_totals(connection)
+        for matrix, expected_matrix in zip(totals, expected):
+            self.assertEqual(matrix.dtype, expected_matrix.dtype)
+            numpy.testing.assert_array_equal(matrix, expected_matrix)
+        connection.close()
+
+    def test_verify_detects_mismatched_totals(self):
+        connection = self.create_db()
+        connection.execute(
+            """
+            UPDATE presentation SET items=(
+              SELECT items FROM presentation ORDER BY bnf_code LIMIT 1
+            )
+            """
+        )
+        with self.assertRaisesRegex(RuntimeError, "all_presentations.items"):
+            verify_all_presentations_totals(connection)
+        connection.close()
+
+
+def get_all_presentations_totals(connection):
+    rows = list(MatrixStore(connection).query("SELECT * FROM all_presentations"))
+    assert len(rows) == 1
+    return rows[0]
@@ -0,0 +1,88 @@
+import csv
+import gzip
+import os
+import random
+import shutil
+import tempfile
+
+from django.test import SimpleTestCase
+from matrixstore.build.sort_and_merge_gzipped_csv_files import (
+    InvalidHeaderError,
+    sort_and_merge_gzipped_csv_files,
+)
+
+
+class TestSortAndMergeGzippedCSVFiles(SimpleTestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        rng = random.Random(42)
+        self.headers = ["bnf_code", "practice", "month", "items"]
+        self.rows = [
+            [
+                "{:02d}{}".format(rng.randint(1, 23), rng.choice("ABC")),
+                "P{}".format(rng.randint(1, 20)),
+                "2019-0{}-01".format(rng.randint(1, 3)),
+                str(rng.randint(1, 100)),
+            ]
+            for _ in range(500)
+        ]
+        # Make sure there are some rows which differ only in their unsorted
+        # columns, and some values which need quoting
+        self.rows.extend(
+            [["01A", "P1", "2019-01-01", "2"], ["01A", "P1", "2019-01-01", "1"]]
+        )
+        self.rows.append(["01A", "P1, P2", "2019-01-01", "3"])
+        rng.shuffle(self.rows)
+
+    def write_input(self, name, rows, headers=None, gzipped=True):
+        filename = os.path.join(self.tempdir, name)
+        open_file = gzip.open if gzipped else open
+        with open_file(filename, "wt", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(headers or self.headers)
+            writer.writerows(rows)
+        return filename
+
+    def sort(self, input_filenames, **kwargs):
+        output_filename = os.path.join(self.tempdir, "output.csv.gz")
+        sort_and_merge_gzipped_csv_files(
+            input_filenames,
+            output_filename,
+            ["bnf_code", "practice", "month"],
+            **kwargs
+        )
+        with gzip.open(output_filename, "rt", newline="") as f:
+            return list(csv.reader(f))
+
+    def test_sorts_and_merges_files(self):
+        input_filenames = [
+            self.write_input("a.csv.gz", self.rows[:200]),
+            self.write_input("b.csv", self.rows[200:250], gzipped=False),
+            self.write_input("c.csv.gz", self.rows[250:]),
+        ]
+        expected = [self.headers] + sorted(self.rows, key=lambda row: (row[:3], row))
+        for workers in [1, 2]:
+            with self.subTest(workers=workers):
+                results = self.sort(
+                    input_filenames, workers=workers, max_rows_in_memory=128
+                )
+                self.assertEqual(results, expected)
+                # Check that all temporary files are cleaned up
+                self.assertEqual(
+                    sorted(os.listdir(self.tempdir)),
+                    ["a.csv.gz", "b.csv", "c.csv.gz", "output.csv.gz"],
+                )
+
+    def test_mismatched_headers_raise_error(self):
+        input_filenames = [
+            self.write_input("a.csv.gz", self.rows[:10]),
+            self.write_input("b.csv.gz", self.rows[10:], headers=self.headers[::-1]),
+        ]
+        with self.assertRaises(InvalidHeaderError):
+            self.sort(input_filenames)
+
+    def test_missing_sort_column_raises_error(self):
+        input_filenames = [self.write_input("a.csv.gz", [], headers=["bnf_code"])]
+        with self.assertRaises(InvalidHeaderError):
+            self.sort(input_filenames)
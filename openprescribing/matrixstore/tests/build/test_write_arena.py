@@ -0,0 +1,97 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+
+import numpy
+from django.test import SimpleTestCase
+from matrixstore.arena import Arena, get_arena_path
+from matrixstore.build.write_arena import write_arena_for_db
+from matrixstore.connection import MatrixStore
+from matrixstore.tests.data_factory import DataFactory
+from matrixstore.tests.import_test_data_fast import import_test_data_fast
+
+
+class TestWriteArena(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        factory = DataFactory()
+        factory.create_all(
+            start_date="2018-06-01", num_months=6, num_practices=6, num_presentations=6
+        )
+        cls.tempdir = tempfile.mkdtemp()
+        cls.sqlite_path = os.path.join(cls.tempdir, "matrixstore.sqlite")
+        connection = sqlite3.connect(cls.sqlite_path)
+        import_test_data_fast(connection, factory, "2018-11", months=6)
+        connection.commit()
+        cls.expected = {
+            sql: list(MatrixStore(connection).query(sql)) for sql in cls.queries()
+        }
+        write_arena_for_db(connection, get_arena_path(cls.sqlite_path))
+        connection.commit()
+        connection.close()
+        cls.matrixstore = MatrixStore.from_file(cls.sqlite_path)
+
+    @classmethod
+    def queries(cls):
+        return [
+            "SELECT bnf_code, items, actual_cost FROM presentation ORDER BY bnf_code",
+            "SELECT name, value FROM practice_statistic ORDER BY name",
+            "SELECT items, net_cost FROM all_presentations",
+            "SELECT MATRIX_SUM(items), MATRIX_SUM(net_cost) FROM presentation",
+        ]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.matrixstore.close()
+        shutil.rmtree(cls.tempdir)
+
+    def test_sqlite_file_contains_only_references(self):
+        sizes = self.matrixstore.connection.execute(
+            "SELECT MAX(length(items)), MAX(length(net_cost)) FROM presentation"
+        ).fetchone()
+        self.assertEqual(sizes, (20, 20))
+
+    def test_query_results_are_unchanged(self):
+        self.assertIsInstance(self.matrixstore.arena, Arena)
+        for sql, expected in self.expected.items():
+            with self.subTest(sql=sql):
+                results = list(self.matrixstore.query(sql))
+                self.assertEqual(len(results), len(expected))
+                for row, expected_row in zip(results, expected):
+                    for value, expected_value in zip(row, expected_row):
+                        assert_values_equal(value, expected_value)
+
+    def test_sum_matrices(self):
+        sql = "SELECT items, net_cost FROM presentation"
+        expected = self.expected[
+            "SELECT MATRIX_SUM(items), MATRIX_SUM(net_cost) FROM presentation"
+        ][0]
+        for workers in [1, 2]:
+            with self.subTest(workers=workers):
+                values = self.matrixstore.sum_matrices(sql, workers=workers)
+                for value, expected_value in zip(values, expected):
+                    assert_values_equal(value, expected_value)
+
+    def test_matrices_are_views_on_arena(self):
+        _, value = self.matrixstore.query_one(
+            "SELECT name, value FROM practice_statistic ORDER BY name"
+        )
+        self.assertFalse(value.flags.owndata)
+        self.assertEqual(value.ctypes.data % 64, 0)
+        with self.assertRaises(ValueError):
+            value[0, 0] = 1
+
+    def test_missing_arena_raises_error(self):
+        connection = sqlite3.connect(self.sqlite_path)
+        with self.assertRaises(RuntimeError):
+            MatrixStore(connection)
+        connection.close()
+
+
+def assert_values_equal(value, expected_value):
+    if hasattr(value, "toarray"):
+        value = value.toarray()
+    if hasattr(expected_value, "toarray"):
+        expected_value = expected_value.toarray()
+    numpy.testing.assert_array_equal(value, expected_value)
@@ -0,0 +1,132 @@
+import sqlite3
+
+import numpy
+from django.test import SimpleTestCase
+from matrixstore import db
+from matrixstore.build.write_practice_index import write_practice_index_for_db
+from matrixstore.connection import MatrixStore
+from matrixstore.tests.data_factory import DataFactory
+from matrixstore.tests.import_test_data_fast import import_test_data_fast
+
+
+class TestWritePracticeIndex(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        factory = DataFactory()
+        factory.create_all(
+            start_date="2018-06-01", num_months=6, num_practices=7, num_presentations=8
+        )
+        connection = sqlite3.connect(":memory:", check_same_thread=False)
+        import_test_data_fast(connection, factory, "2018-11", months=6)
+        # Use a small batch size so that we test batching
+        write_practice_index_for_db(connection, practices_per_pass=3)
+        cls.matrixstore = MatrixStore(connection)
+        cls.columns = ["items", "quantity", "actual_cost", "net_cost"]
+        cls.full_matrices = {
+            row[0]: row[1:]
+            for row in cls.matrixstore.query(
+                "SELECT bnf_code, {} FROM presentation".format(", ".join(cls.columns))
+            )
+        }
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.matrixstore.close()
+
+    def test_has_practice_index(self):
+        self.assertTrue(self.matrixstore.has_practice_index)
+        self.assertEqual(
+            self.matrixstore.practice_index_bnf_codes, sorted(self.full_matrices)
+        )
+
+    def test_query_practices(self):
+        practices = self.matrixstore.practices
+        bnf_codes = list(self.full_matrices)
+        test_cases = [
+            (bnf_codes, practices),
+            (bnf_codes[2:5], practices[-1:]),
+            (bnf_codes[:3] + ["9999"], practices[:1] + practices[4:6]),
+            ([], practices),
+        ]
+        for bnf_codes, practice_codes in test_cases:
+            with self.subTest(bnf_codes=bnf_codes, practice_codes=practice_codes):
+                rows = [self.matrixstore.practice_offsets[p] for p in practice_codes]
+                results = list(
+                    self.matrixstore.query_practices(
+                        self.columns, bnf_codes, practice_codes
+                    )
+                )
+                self.assertEqual(
+                    [row[0] for row in results],
+                    sorted(set(bnf_codes) & set(self.full_matrices)),
+                )
+                for bnf_code, *matrices in results:
+                    for matrix, full_matrix in zip(
+                        matrices, self.full_matrices[bnf_code]
+                    ):
+                        numpy.testing.assert_array_almost_equal(
+                            matrix, to_array(full_matrix)[rows]
+                        )
+
+    def test_sum_practices_by_bnf_prefixes(self):
+        practice_codes = self.matrixstore.practices[1:4]
+        rows = [self.matrixstore.practice_offsets[p] for p in practice_codes]
+        prefixes = {bnf_code[:4] for bnf_code in self.full_matrices}
+        test_cases = [[""], sorted(prefixes)[:1], sorted(prefixes), ["99"]]
+        for bnf_code_prefixes in test_cases:
+            with self.subTest(bnf_code_prefixes=bnf_code_prefixes):
+                values = self.matrixstore.sum_practices_by_bnf_prefixes(
+                    self.columns, bnf_code_prefixes, practice_codes
+                )
+                expected_values = self.matrixstore.query_one(
+                    "SELECT {} FROM presentation WHERE {}".format(
+                        ", ".join(f"MATRIX_SUM({column})" for column in self.columns),
+                        " OR ".join(["bnf_code LIKE ?"] * len(bnf_code_prefixes)),
+                    ),
+                    [prefix + "%" for prefix in bnf_code_prefixes],
+                )
+                for value, expected_value in zip(values, expected_values):
+                    if expected_value is None:
+                        self.assertIsNone(value)
+                    else:
+                        numpy.testing.assert_array_almost_equal(
+                            value, expected_value[rows]
+                        )
+
+    def test_query_presentations_by_org_uses_practice_index(self):
+        bnf_codes = list(self.full_matrices)[:4]
+        practice_codes = self.matrixstore.practices[:2]
+        with db.pinned_db(self.matrixstore):
+            db.get_row_grouper.cache_clear()
+            self.addCleanup(db.get_row_grouper.cache_clear)
+            self.assertTrue(db.use_practice_index("practice", practice_codes))
+            with self.assertRaises(db.UnknownOrgIDError):
+                db.use_practice_index("practice", ["X99999"])
+            results = list(
+                db.query_presentations_by_org(
+                    self.columns, bnf_codes, "practice", org_ids=practice_codes
+                )
+            )
+            expected = list(
+                db.query_by_org(
+                    ["bnf_code"] + self.columns,
+                    "practice",
+                    where="bnf_code IN ({})".format(",".join(["?"] * len(bnf_codes))),
+                    params=bnf_codes,
+                    order_by="bnf_code",
+                    org_ids=practice_codes,
+                )
+            )
+        self.assertEqual(len(results), len(expected))
+        for row, expected_row in zip(results, expected):
+            self.assertEqual(row[0], expected_row[0])
+            for matrix, expected_matrix in zip(row[1:], expected_row[1:]):
+                numpy.testing.assert_array_almost_equal(
+                    matrix, to_array(expected_matrix)
+                )
+
+
+def to_array(matrix):
+    if hasattr(matrix, "toarray"):
+        matrix = matrix.toarray()
+    return matrix
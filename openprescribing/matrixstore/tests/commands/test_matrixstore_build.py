@@ -229,7 +229,12 @@ class TestMatrixStoreBuild(SimpleTestCase):
             # Check they match the stored values
             for (practice, month), expected_value in totals.items():
                 value = get_value(1, practice, month)
-                self.assertEqual(value, expected_value)
+                # Totals are summed on import, in a different order from the
+                # above, so floating point values may differ very slightly
+                if field == "quantity":
+                    self.assertAlmostEqual(value, expected_value)
+                else:
+                    self.assertEqual(value, expected_value)
             # Check there are no additional values that we weren't expecting
             self.assertEqual(get_value.nonzero_values, len(totals))
 
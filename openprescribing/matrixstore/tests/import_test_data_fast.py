@@ -33,7 +33,7 @@ def import_test_data_fast(sqlite_conn, data_factory, end_date, months=None):
     import_practice_stats(sqlite_conn, data_factory, dates)
     import_prescribing(sqlite_conn, data_factory, dates)
     update_bnf_map(sqlite_conn, data_factory)
-    precalculate_totals_for_db(sqlite_conn)
+    precalculate_totals_for_db(sqlite_conn, all_presentations=False, verify=True)
 
     sqlite_conn.isolation_level = previous_isolation_level
     sqlite_conn.commit()
@@ -0,0 +1,52 @@
+import json
+import os.path
+import tempfile
+
+from django.test import SimpleTestCase
+from matrixstore.benchmark import compare_results, run_benchmarks
+from matrixstore.connection import MatrixStore
+from matrixstore.synthetic import generate_synthetic_matrixstore
+
+
+class TestRunBenchmarks(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        path = os.path.join(cls.tmpdir.name, "synthetic.sqlite")
+        generate_synthetic_matrixstore(
+            path, num_practices=30, num_presentations=40, num_months=3
+        )
+        cls.matrixstore = MatrixStore.from_file(path)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.matrixstore.close()
+        cls.tmpdir.cleanup()
+
+    def test_runs_all_benchmarks(self):
+        results = run_benchmarks(self.matrixstore, repeat=1)
+        # Results must survive a round trip through JSON
+        results = json.loads(json.dumps(results))
+        names = results["benchmarks"].keys()
+        for prefix in [
+            "matrix_sum.",
+            "sum_by_bnf_prefixes.",
+            "row_grouper.",
+            "row_grouper_dense.",
+            "query_by_org.",
+            "ppu_savings.",
+            "ghost_generics.",
+            "measure_numerators.",
+        ]:
+            self.assertTrue(any(name.startswith(prefix) for name in names), prefix)
+        self.assertEqual(results["matrixstore"]["presentations"], 40)
+        self.assertEqual(
+            len(compare_results(results, results)), len(results["benchmarks"])
+        )
+
+    def test_only_runs_selected_benchmarks(self):
+        results = run_benchmarks(self.matrixstore, repeat=1, only=["matrix_sum."])
+        self.assertEqual(
+            sorted(results["benchmarks"].keys()),
+            ["matrix_sum.chapter", "matrix_sum.chemical", "matrix_sum.section"],
+        )
@@ -1,9 +1,13 @@
+import threading
+import time
 import warnings
 
-from django.core.cache import CacheKeyWarning
+import numpy
+from django.core.cache import CacheKeyWarning, cache
 from django.test import SimpleTestCase, override_settings
+from matrixstore import cachelib
 from matrixstore.cachelib import memoize
-from mock import Mock
+from mock import Mock, patch
 
 # The local memory cache backend we use in testing warns that our binary cache
 # keys won't be compatible with memcached, but we really don't care
@@ -63,3 +67,98 @@ class MemoizeDecoratorTest(SimpleTestCase):
         test_arg = MyTestObject()
         with self.assertRaises(ValueError):
             cached_func(test_arg)
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    MEMOIZE_LOCAL_CACHE_ENTRIES=2,
+)
+class MemoizeLocalCacheTest(SimpleTestCase):
+    def setUp(self):
+        cachelib.clear_local_cache()
+        cachelib.reset_stats()
+        self.addCleanup(cachelib.clear_local_cache)
+
+    def test_repeat_calls_are_served_from_local_cache(self):
+        test_func = Mock(
+            side_effect=lambda n: numpy.arange(n), __qualname__="local_test_func"
+        )
+        cached_func = memoize()(test_func)
+        result = cached_func(3)
+        cache.clear()
+        result2 = cached_func(3)
+        self.assertIs(result2, result)
+        test_func.assert_called_once_with(3)
+        # Values are shared between callers so mustn't be modifiable
+        with self.assertRaises(ValueError):
+            result[0] = 1
+        self.assertEqual(
+            cachelib.get_stats()[cachelib._get_cache_key_base(test_func, 1)],
+            {"misses": 1, "local_hits": 1},
+        )
+
+    def test_least_recently_used_values_are_evicted(self):
+        test_func = Mock(side_effect=lambda n: n, __qualname__="local_test_func2")
+        cached_func = memoize()(test_func)
+        for n in [1, 2, 1, 3]:
+            cached_func(n)
+        # The value for 2 was evicted from the local cache, but is still in the
+        # shared cache
+        cached_func(2)
+        self.assertEqual(test_func.call_count, 3)
+        self.assertEqual(
+            cachelib.get_stats()[cachelib._get_cache_key_base(test_func, 1)],
+            {"misses": 3, "local_hits": 1, "hits": 1},
+        )
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+@patch.object(cachelib, "POLL_INTERVAL", 0.01)
+class MemoizeSingleFlightTest(SimpleTestCase):
+    def setUp(self):
+        cachelib.reset_stats()
+
+    def test_concurrent_misses_compute_value_once(self):
+        started = threading.Event()
+
+        def slow_func(n):
+            started.set()
+            time.sleep(0.2)
+            return n * 2
+
+        test_func = Mock(side_effect=slow_func, __qualname__="single_flight_func")
+        cached_func = memoize()(test_func)
+        results = []
+
+        def call():
+            results.append(cached_func(21))
+
+        first = threading.Thread(target=call)
+        first.start()
+        started.wait()
+        others = [threading.Thread(target=call) for _ in range(3)]
+        for thread in others:
+            thread.start()
+        for thread in [first] + others:
+            thread.join()
+        self.assertEqual(results, [42, 42, 42, 42])
+        test_func.assert_called_once_with(21)
+        stats = cachelib.get_stats()[cachelib._get_cache_key_base(test_func, 1)]
+        self.assertEqual(stats, {"misses": 1, "waits": 3})
+
+    def test_waiting_caller_computes_value_if_lock_is_released_without_one(self):
+        test_func = Mock(return_value="foo", __qualname__="single_flight_func2")
+        cached_func = memoize()(test_func)
+        cache_key = cachelib._get_cache_key(
+            cachelib._get_cache_key_base(test_func, 1), ["bar"], {}
+        )
+        # Simulate another process which holds the lock but then fails
+        lock_key = ("lock", cache_key)
+        cache.add(lock_key, True)
+        threading.Timer(0.05, cache.delete, [lock_key]).start()
+        self.assertEqual(cached_func("bar"), "foo")
+        test_func.assert_called_once_with("bar")
+        stats = cachelib.get_stats()[cachelib._get_cache_key_base(test_func, 1)]
+        self.assertEqual(stats, {"misses": 1, "waits": 1})
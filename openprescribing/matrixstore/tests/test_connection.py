@@ -1,7 +1,11 @@
 import numbers
 from collections import defaultdict
 
+import numpy
+import scipy.sparse
 from django.test import SimpleTestCase
+from matrixstore.build.write_date_blocks import write_date_blocks_for_db
+from matrixstore.connection import MatrixCache, MatrixStore
 from matrixstore.tests.data_factory import DataFactory
 from matrixstore.tests.matrixstore_factory import matrixstore_from_data_factory
 
@@ -69,6 +73,301 @@ class TestMatrixStoreConnection(SimpleTestCase):
                 expected_value = items_dict[practice, date]
                 self.assertEqual(value, expected_value)
 
+    def test_sum_matrices(self):
+        expected_values = self.matrixstore.query_one(
+            "SELECT MATRIX_SUM(items), MATRIX_SUM(actual_cost) FROM presentation"
+        )
+        for workers in [1, 4]:
+            with self.subTest(workers=workers):
+                values = self.matrixstore.sum_matrices(
+                    "SELECT items, actual_cost FROM presentation", workers=workers
+                )
+                for value, expected_value in zip(values, expected_values):
+                    self.assertTrue(numpy.allclose(value, expected_value))
+
+    def test_sum_matrices_with_no_rows(self):
+        for workers in [1, 4]:
+            with self.subTest(workers=workers):
+                values = self.matrixstore.sum_matrices(
+                    "SELECT items, actual_cost FROM presentation WHERE 0",
+                    workers=workers,
+                )
+                self.assertEqual(values, [None, None])
+
     @classmethod
     def tearDownClass(cls):
         cls.matrixstore.close()
+
+
+class TestSumByBNFPrefixes(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        factory = DataFactory()
+        months = factory.create_months("2018-06-01", 3)
+        practices = factory.create_practices(4)
+        presentations = [
+            factory.create_presentation(bnf_code)
+            for bnf_code in [
+                "0101010A0AAAAAA",
+                "0101010A0AAABAB",
+                "0101010B0AAAAAA",
+                "0101020A0AAAAAA",
+                "0102000A0AAAAAA",
+                "0212000A0AAAAAA",
+                # Unusually short code
+                "1001",
+            ]
+        ]
+        factory.create_practice_statistics(practices, months)
+        factory.create_prescribing(presentations, practices, months)
+        cls.matrixstore = matrixstore_from_data_factory(factory)
+
+    def test_precalculated_prefixes(self):
+        self.assertEqual(
+            sorted(p for p in self.matrixstore.bnf_prefixes if p.startswith("0101")),
+            ["0101", "010101", "0101010", "0101010A0", "0101010B0", "010102"]
+            + ["0101020", "0101020A0"],
+        )
+
+    def test_uses_precalculated_totals(self):
+        precalculated, other_conditions = self.matrixstore.plan_bnf_prefix_sum(
+            ["0101", "0212"]
+        )
+        self.assertEqual(precalculated, ["0101", "0212"])
+        self.assertEqual(other_conditions, [])
+
+    def test_sum_matches_sum_over_presentations(self):
+        columns = ["items", "quantity", "actual_cost", "net_cost"]
+        test_cases = [
+            ["01"],
+            ["0101"],
+            ["010"],
+            ["0101010A0AAAB"],
+            ["01", "0101010"],
+            ["0", "1"],
+            ["10"],
+            ["100"],
+            ["99"],
+        ]
+        for prefixes in test_cases:
+            with self.subTest(prefixes=prefixes):
+                values = self.matrixstore.sum_by_bnf_prefixes(columns, prefixes)
+                expected_values = self.matrixstore.query_one(
+                    "SELECT {} FROM presentation WHERE {}".format(
+                        ", ".join(f"MATRIX_SUM({column})" for column in columns),
+                        " OR ".join(["bnf_code LIKE ?"] * len(prefixes)),
+                    ),
+                    [prefix + "%" for prefix in prefixes],
+                )
+                for value, expected_value in zip(values, expected_values):
+                    if expected_value is None:
+                        self.assertIsNone(value)
+                    else:
+                        self.assertTrue(numpy.allclose(value, expected_value))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.matrixstore.close()
+
+
+class TestQueryDateRange(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        factory = DataFactory()
+        factory.create_all(
+            start_date="2018-06-01", num_months=6, num_practices=6, num_presentations=6
+        )
+        cls.bnf_codes = [p["bnf_code"] for p in factory.presentations][:4]
+        cls.matrixstore = matrixstore_from_data_factory(factory)
+        cls.matrixstore_with_blocks = matrixstore_from_data_factory(factory)
+        write_date_blocks_for_db(cls.matrixstore_with_blocks.connection, 4)
+        # Reconnect so we pick up the date blocks
+        cls.matrixstore_with_blocks = MatrixStore(
+            cls.matrixstore_with_blocks.connection
+        )
+
+    def test_date_blocks(self):
+        self.assertEqual(self.matrixstore.date_blocks, [])
+        self.assertEqual(self.matrixstore_with_blocks.date_blocks, [(0, 4), (4, 6)])
+
+    def test_query_date_range(self):
+        columns = ["items", "quantity", "net_cost"]
+        dates = self.matrixstore.dates
+        full_matrices = {
+            row[0]: row[1:]
+            for row in self.matrixstore.query(
+                "SELECT bnf_code, {} FROM presentation".format(", ".join(columns))
+            )
+        }
+        date_ranges = [(0, 0), (3, 3), (4, 4), (2, 5), (0, 5), (5, 5)]
+        for matrixstore in [self.matrixstore, self.matrixstore_with_blocks]:
+            for start, end in date_ranges:
+                with self.subTest(blocks=matrixstore.date_blocks, dates=(start, end)):
+                    results = list(
+                        matrixstore.query_date_range(
+                            columns, self.bnf_codes, dates[start], dates[end]
+                        )
+                    )
+                    self.assertEqual(
+                        [row[0] for row in results], sorted(self.bnf_codes)
+                    )
+                    for bnf_code, *matrices in results:
+                        expected_matrices = full_matrices[bnf_code]
+                        for matrix, expected_matrix in zip(matrices, expected_matrices):
+                            self.assertEqual(matrix.shape, (6, end - start + 1))
+                            self.assertEqual(
+                                to_list_of_lists(matrix),
+                                to_list_of_lists(expected_matrix[:, start : end + 1]),
+                            )
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.matrixstore.close()
+        cls.matrixstore_with_blocks.close()
+
+
+class TestFetchStack(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        factory = DataFactory()
+        factory.create_all(
+            start_date="2018-06-01", num_months=6, num_practices=6, num_presentations=6
+        )
+        cls.bnf_codes = [p["bnf_code"] for p in factory.presentations][:4]
+        cls.matrixstore = matrixstore_from_data_factory(factory)
+        cls.matrixstore_with_blocks = matrixstore_from_data_factory(factory)
+        write_date_blocks_for_db(cls.matrixstore_with_blocks.connection, 4)
+        # Reconnect so we pick up the date blocks
+        cls.matrixstore_with_blocks = MatrixStore(
+            cls.matrixstore_with_blocks.connection
+        )
+        cls.full_matrices = {
+            bnf_code: to_list_of_lists(matrix)
+            for bnf_code, matrix in cls.matrixstore.query(
+                "SELECT bnf_code, quantity FROM presentation"
+            )
+        }
+
+    def test_fetch_stack_matches_query(self):
+        # Include a code which doesn't exist and one which is repeated
+        bnf_codes = ["9999999999"] + self.bnf_codes + self.bnf_codes[:1]
+        date_slices = [None, slice(0, 1), slice(3, 4), slice(4, 5), slice(2, 6)]
+        practice_rows_options = [None, [4, 1, 2]]
+        for matrixstore in [self.matrixstore, self.matrixstore_with_blocks]:
+            for date_slice in date_slices:
+                for practice_rows in practice_rows_options:
+                    with self.subTest(
+                        blocks=matrixstore.date_blocks,
+                        date_slice=date_slice,
+                        practice_rows=practice_rows,
+                    ):
+                        codes, stack = matrixstore.fetch_stack(
+                            "quantity",
+                            bnf_codes,
+                            date_slice=date_slice,
+                            practice_rows=practice_rows,
+                        )
+                        self.assertEqual(codes, sorted(self.bnf_codes))
+                        rows = practice_rows or slice(None)
+                        cols = date_slice or slice(None)
+                        for bnf_code, matrix in zip(codes, stack):
+                            expected = numpy.array(self.full_matrices[bnf_code])
+                            self.assertEqual(
+                                matrix.tolist(), expected[rows, cols].tolist()
+                            )
+
+    def test_fetch_stack_with_no_codes(self):
+        codes, stack = self.matrixstore.fetch_stack("quantity", [])
+        self.assertEqual(codes, [])
+        self.assertEqual(stack.shape, (0, 6, 6))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.matrixstore.close()
+        cls.matrixstore_with_blocks.close()
+
+
+def to_list_of_lists(matrix):
+    if hasattr(matrix, "toarray"):
+        matrix = matrix.toarray()
+    return matrix.tolist()
+
+
+class TestQueryRows(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        factory = DataFactory()
+        factory.create_all(
+            start_date="2018-06-01", num_months=6, num_practices=6, num_presentations=6
+        )
+        cls.matrixstore = matrixstore_from_data_factory(factory)
+        cls.names = ["total_list_size", "astro_pu_cost"]
+
+    def query_rows(self, matrixstore, keys):
+        return list(
+            matrixstore.query_rows("practice_statistic", "name", ["value"], keys)
+        )
+
+    def test_query_rows_matches_query(self):
+        expected = list(
+            self.matrixstore.query(
+                "SELECT name, value FROM practice_statistic WHERE name IN (?, ?)",
+                self.names,
+            )
+        )
+        cached_matrixstore = MatrixStore(
+            self.matrixstore.connection, matrix_cache=MatrixCache(10 * 1024**2)
+        )
+        for matrixstore in [self.matrixstore, cached_matrixstore, cached_matrixstore]:
+            with self.subTest(matrix_cache=matrixstore.matrix_cache):
+                results = self.query_rows(matrixstore, self.names)
+                self.assertEqual(
+                    [row[0] for row in results], [row[0] for row in expected]
+                )
+                for (_, value), (_, expected_value) in zip(results, expected):
+                    self.assertTrue(numpy.array_equal(value, expected_value))
+        # The second query should have been served entirely from the cache
+        stats = cached_matrixstore.matrix_cache.stats()
+        self.assertEqual(stats["misses"], 2)
+        self.assertEqual(stats["hits"], 2)
+        self.assertEqual(stats["entries"], 2)
+
+    def test_query_rows_with_no_keys(self):
+        all_names = [row[0] for row in self.query_rows(self.matrixstore, None)]
+        self.assertIn("total_list_size", all_names)
+        self.assertEqual(self.query_rows(self.matrixstore, []), [])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.matrixstore.close()
+
+
+class TestMatrixCache(SimpleTestCase):
+    def test_evicts_least_recently_used_entries(self):
+        cache = MatrixCache(max_bytes=250)
+        # Each of these is 80 bytes
+        for key in ["a", "b", "c"]:
+            cache.set(key, numpy.zeros(10))
+        self.assertIsNot(cache.get("a"), MatrixCache.MISSING)
+        cache.set("d", numpy.zeros(10))
+        self.assertIs(cache.get("b"), MatrixCache.MISSING)
+        for key in ["a", "c", "d"]:
+            self.assertIsNot(cache.get(key), MatrixCache.MISSING)
+        self.assertEqual(
+            cache.stats(),
+            {"hits": 4, "misses": 1, "entries": 3, "bytes": 240, "max_bytes": 250},
+        )
+
+    def test_does_not_store_values_larger_than_budget(self):
+        cache = MatrixCache(max_bytes=50)
+        cache.set("a", numpy.zeros(10))
+        self.assertIs(cache.get("a"), MatrixCache.MISSING)
+
+    def test_cached_values_are_read_only(self):
+        cache = MatrixCache(max_bytes=1000)
+        cache.set("a", numpy.zeros(10))
+        cache.set("b", scipy.sparse.csc_matrix(numpy.ones((2, 2))))
+        with self.assertRaises(ValueError):
+            cache.get("a")[0] = 1
+        with self.assertRaises(ValueError):
+            cache.get("b").data[0] = 2
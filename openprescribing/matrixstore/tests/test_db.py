@@ -0,0 +1,96 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+
+from django.test import SimpleTestCase, override_settings
+from matrixstore import db
+from matrixstore.tests.data_factory import DataFactory
+from matrixstore.tests.import_test_data_fast import import_test_data_fast
+
+
+@db.memoize_per_db
+def get_practice_count():
+    return len(db.get_db().practices)
+
+
+class TestLiveFileSwitching(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.tempdir = tempfile.mkdtemp()
+        cls.old_file = cls.build_file("matrixstore_old.sqlite", num_practices=3)
+        cls.new_file = cls.build_file("matrixstore_new.sqlite", num_practices=5)
+        cls.live_file = os.path.join(cls.tempdir, "matrixstore_live.sqlite")
+
+    @classmethod
+    def build_file(cls, name, num_practices):
+        factory = DataFactory()
+        factory.create_all(
+            start_date="2019-01-01",
+            num_months=2,
+            num_practices=num_practices,
+            num_presentations=2,
+        )
+        path = os.path.join(cls.tempdir, name)
+        connection = sqlite3.connect(path)
+        import_test_data_fast(connection, factory, "2019-02", months=2)
+        connection.close()
+        return path
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tempdir)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.set_live(self.old_file)
+        settings_override = override_settings(
+            MATRIXSTORE_LIVE_FILE=self.live_file,
+            MATRIXSTORE_LIVE_FILE_CHECK_INTERVAL=0,
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        db.reset_live_db()
+        self.addCleanup(db.reset_live_db)
+
+    def set_live(self, target):
+        temp_link = self.live_file + ".tmp"
+        os.symlink(target, temp_link)
+        os.rename(temp_link, self.live_file)
+
+    def test_no_switch_when_file_unchanged(self):
+        old_db = db.get_db()
+        self.assertFalse(db.check_for_new_live_file())
+        self.assertIs(db.get_db(), old_db)
+
+    def test_switches_to_new_file(self):
+        old_db = db.get_db()
+        self.assertEqual(get_practice_count(), 3)
+        self.set_live(self.new_file)
+        self.assertTrue(db.check_for_new_live_file())
+        self.assertIsNot(db.get_db(), old_db)
+        self.assertEqual(db.get_db().cache_key, b"matrixstore_new.sqlite")
+        self.assertEqual(get_practice_count(), 5)
+
+    def test_pinned_db_is_unaffected_by_switch(self):
+        with db.pinned_db():
+            old_db = db.get_db()
+            self.set_live(self.new_file)
+            self.assertTrue(db.check_for_new_live_file())
+            self.assertIs(db.get_db(), old_db)
+            self.assertEqual(get_practice_count(), 3)
+        self.assertIsNot(db.get_db(), old_db)
+        self.assertEqual(get_practice_count(), 5)
+
+    def test_respects_check_interval(self):
+        db.get_db()
+        self.set_live(self.new_file)
+        with override_settings(MATRIXSTORE_LIVE_FILE_CHECK_INTERVAL=None):
+            self.assertFalse(db.check_for_new_live_file())
+        self.assertEqual(db.get_db().cache_key, b"matrixstore_old.sqlite")
+
+    def test_cache_clear(self):
+        self.assertEqual(get_practice_count(), 3)
+        get_practice_count.cache_clear()
+        self.assertEqual(get_practice_count(), 3)
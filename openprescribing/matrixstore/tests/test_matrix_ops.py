@@ -6,7 +6,9 @@ from matrixstore.matrix_ops import (
     convert_to_smallest_int_type,
     finalise_matrix,
     sparse_matrix,
+    sparse_matrix_from_entries,
 )
+from matrixstore.serializer import serialize
 from scipy.sparse import spmatrix as SparseMatrixBase
 
 
@@ -93,3 +95,47 @@ class TestFinaliseMatrix(SimpleTestCase):
             i = int(n / cols)
             j = n % cols
             yield i, j
+
+
+class TestSparseMatrixFromEntries(SimpleTestCase):
+    def setUp(self):
+        self.random = random.Random()
+        self.random.seed(27)
+
+    def test_matches_assigning_values_one_at_a_time(self):
+        for integer in [True, False]:
+            for sample_density in [0.1, 0.5, 1.5]:
+                with self.subTest(integer=integer, sample_density=sample_density):
+                    shape = (30, 6)
+                    entries = self._random_entries(shape, sample_density, integer)
+                    matrix = sparse_matrix(shape, integer=integer)
+                    for i, j, value in entries:
+                        matrix[i, j] = value
+                    rows, cols, values = zip(*entries)
+                    dtype = numpy.int64 if integer else numpy.float64
+                    built = sparse_matrix_from_entries(
+                        shape, rows, cols, numpy.array(values, dtype=dtype)
+                    )
+                    # The finalised matrices should be indistinguishable, right
+                    # down to their serialized bytes
+                    self.assertEqual(
+                        serialize(finalise_matrix(built)),
+                        serialize(finalise_matrix(matrix)),
+                    )
+
+    def _random_entries(self, shape, sample_density, integer):
+        """
+        Return a list of (row, column, value) entries, including some zeros and
+        (for densities above 1) some repeated offsets
+        """
+        entries = []
+        for _ in range(int(shape[0] * shape[1] * sample_density)):
+            value = self.random.randint(0, 300) if integer else self.random.random()
+            entries.append(
+                (
+                    self.random.randrange(shape[0]),
+                    self.random.randrange(shape[1]),
+                    value if self.random.random() > 0.1 else 0,
+                )
+            )
+        return entries
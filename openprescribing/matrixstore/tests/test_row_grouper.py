@@ -4,7 +4,7 @@ from itertools import product
 import numpy
 from django.test import SimpleTestCase
 from matrixstore.matrix_ops import finalise_matrix, sparse_matrix
-from matrixstore.row_grouper import RowGrouper
+from matrixstore.row_grouper import RowGrouper, UnknownGroupError
 
 
 class TestGrouper(SimpleTestCase):
@@ -100,6 +100,32 @@ class TestGrouper(SimpleTestCase):
         value = to_list_of_lists(grouped_matrix)
         self.assertEqual(value, [])
 
+    def test_sum_with_unknown_group_raises_error(self):
+        group_definition = [(0, "even"), (1, "odd"), (2, "even"), (3, "odd")]
+        matrix = numpy.ones((4, 4))
+        row_grouper = RowGrouper(group_definition)
+        with self.assertRaises(UnknownGroupError):
+            row_grouper.sum(matrix, ["even", "no_such_group"])
+
+    def test_sum_returns_ndarray_of_wide_type(self):
+        group_definition = [(0, "even"), (1, "odd"), (2, "even"), (3, "odd")]
+        row_grouper = RowGrouper(group_definition)
+        test_cases = [
+            (numpy.uint8, numpy.int64),
+            (numpy.int64, numpy.int64),
+            (numpy.float64, numpy.float64),
+        ]
+        for dtype, expected_dtype in test_cases:
+            with self.subTest(dtype=dtype):
+                matrix = numpy.full((4, 4), 200, dtype=dtype)
+                for input_matrix in [matrix, finalise_matrix(sparse_matrix((4, 4)))]:
+                    grouped_matrix = row_grouper.sum(input_matrix.astype(dtype))
+                    self.assertIsInstance(grouped_matrix, numpy.ndarray)
+                    self.assertNotIsInstance(grouped_matrix, numpy.matrix)
+                    self.assertEqual(grouped_matrix.dtype, expected_dtype)
+                # Summing small integer types shouldn't overflow
+                self.assertEqual(row_grouper.sum(matrix)[0, 0], 400)
+
     def test_sum_with_all_group_and_matrix_type_combinations(self):
         """
         Tests the `sum` method with every combination of group type and matrix
@@ -3,7 +3,13 @@ import sqlite3
 import numpy
 import scipy.sparse
 from django.test import SimpleTestCase
-from matrixstore.serializer import deserialize, serialize, serialize_compressed
+from matrixstore.serializer import (
+    deserialize,
+    deserialize_aligned,
+    serialize,
+    serialize_aligned,
+    serialize_compressed,
+)
 
 
 class TestSerializer(SimpleTestCase):
@@ -42,6 +48,22 @@ class TestSerializer(SimpleTestCase):
         new_obj = deserialize(new_data)
         self.assertEqual(new_obj, obj)
 
+    def test_aligned_serialisation(self):
+        obj = scipy.sparse.csc_matrix(
+            numpy.arange(35, dtype=numpy.float64).reshape(5, 7)
+        )
+        data = serialize_aligned(obj, 64)
+        # Copy the data to a suitably aligned location in a larger buffer
+        buffer = numpy.zeros(len(data) + 64, dtype=numpy.uint8)
+        start = -buffer.ctypes.data % 64
+        aligned_data = buffer[start : start + len(data)]
+        aligned_data[:] = numpy.frombuffer(data, dtype=numpy.uint8)
+        new_obj = deserialize_aligned(aligned_data)
+        self.assertTrue(numpy.array_equal(obj.todense(), new_obj.todense()))
+        for array in [new_obj.data, new_obj.indices, new_obj.indptr]:
+            self.assertEqual(array.ctypes.data % 64, 0)
+            self.assertTrue(numpy.shares_memory(array, buffer))
+
 
 def roundtrip_through_sqlite(value):
     db = sqlite3.connect(":memory:")
@@ -0,0 +1,57 @@
+import hashlib
+import os.path
+import tempfile
+
+from django.test import SimpleTestCase
+from matrixstore.connection import MatrixStore
+from matrixstore.synthetic import generate_synthetic_matrixstore
+
+
+class TestGenerateSyntheticMatrixStore(SimpleTestCase):
+    def generate(self, directory, filename, **kwargs):
+        path = os.path.join(directory, filename)
+        generate_synthetic_matrixstore(
+            path, num_practices=20, num_presentations=30, num_months=3, **kwargs
+        )
+        return path
+
+    def test_generates_file_of_requested_size(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db = MatrixStore.from_file(self.generate(tmpdir, "test.sqlite"))
+            try:
+                self.assertEqual(len(db.practices), 20)
+                self.assertEqual(len(db.dates), 3)
+                bnf_codes = [
+                    bnf_code
+                    for (bnf_code, items) in db.query(
+                        "SELECT bnf_code, items FROM presentation"
+                    )
+                    if items.sum() > 0
+                ]
+                self.assertEqual(len(bnf_codes), 30)
+                self.assertTrue(all(len(code) == 15 for code in bnf_codes))
+                self.assertEqual(
+                    db.grouped_org_types, {"ccg", "stp", "pcn", "regional_team"}
+                )
+                self.assertEqual(len(db.date_blocks), 3)
+                self.assertTrue(db.has_practice_index)
+            finally:
+                db.close()
+
+    def test_same_arguments_produce_same_file(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            hashes = [
+                hash_file(self.generate(tmpdir, filename, seed=seed))
+                for filename, seed in [
+                    ("a.sqlite", 1),
+                    ("b.sqlite", 1),
+                    ("c.sqlite", 2),
+                ]
+            ]
+        self.assertEqual(hashes[0], hashes[1])
+        self.assertNotEqual(hashes[0], hashes[2])
+
+
+def hash_file(path):
+    with open(path, "rb") as f:
+        return hashlib.md5(f.read()).hexdigest()
@@ -3,6 +3,7 @@
 import sys
 from os.path import abspath, basename, dirname, join, normpath
 from sys import path
+from tempfile import gettempdir
 
 from common import utils
 from django.core.exceptions import ImproperlyConfigured
@@ -180,6 +181,7 @@ MIDDLEWARE = (
     "django.contrib.messages.middleware.MessageMiddleware",
     # 'django.middleware.clickjacking.XFrameOptionsMiddleware',
     "frontend.middleware.stp_redirect_middleware",
+    "matrixstore.middleware.live_matrixstore_middleware",
 )
 # END MIDDLEWARE CONFIGURATION
 
@@ -319,6 +321,12 @@ BQ_SCMD_DATASET = "scmd"
 BQ_DEFAULT_TABLE_EXPIRATION_MS = None
 BQ_LOCATION = "EU"
 
+# Maximum number of pipeline tasks which `pipeline.runner.run_all` runs at once.
+# This defaults to running tasks one at a time because tasks.json doesn't yet
+# declare all the ordering dependencies between tasks which write to the same
+# tables.
+PIPELINE_MAX_WORKERS = int(utils.get_env_setting("PIPELINE_MAX_WORKERS", default="1"))
+
 # Use django-anymail through mailgun for sending emails
 EMAIL_BACKEND = "anymail.backends.mailgun.EmailBackend"
 ANYMAIL = {
@@ -340,6 +348,18 @@ CRISPY_TEMPLATE_PACK = "bootstrap3"
 # For grabbing images that we insert into alert emails
 GRAB_HOST = "https://openprescribing.net"
 
+# The maximum number of PhantomJS processes which render images for alert
+# emails at once, and where we keep the images (see `frontend.chart_images`).
+# Images are only reused until the data changes, so a temporary directory is
+# fine.
+CHART_RENDERER_PROCESSES = int(
+    utils.get_env_setting("CHART_RENDERER_PROCESSES", default="4")
+)
+CHART_IMAGE_CACHE_DIR = utils.get_env_setting(
+    "CHART_IMAGE_CACHE_DIR",
+    default=join(gettempdir(), "openprescribing-chart-images"),
+)
+
 # For sending messages to Slack
 # Webhook URLs for posting to different channels can be configured at
 # https://api.slack.com/apps/A03UM1N45JN/incoming-webhooks
@@ -352,6 +372,25 @@ SLACK_SENDING_ACTIVE = True
 ENABLE_CACHING = utils.get_env_setting_bool("ENABLE_CACHING", default=False)
 
 
+# How often (in seconds) each app process checks whether MATRIXSTORE_LIVE_FILE
+# has been updated to point to a new file. Checking just involves resolving
+# the symlink so this can be fairly frequent. Set to None to disable checking,
+# in which case a restart is needed to pick up a new file.
+MATRIXSTORE_LIVE_FILE_CHECK_INTERVAL = 60
+
+# Memory budget (in bytes) for each app process's in-memory cache of frequently
+# read MatrixStore matrices, such as practice statistics. Zero disables it.
+MATRIXSTORE_MATRIX_CACHE_BYTES = int(
+    utils.get_env_setting("MATRIXSTORE_MATRIX_CACHE_BYTES", default="0")
+)
+
+
+# Number of values memoized by `matrixstore.cachelib.memoize` which each app
+# process keeps in memory, in front of the shared cache below. Zero disables it.
+MEMOIZE_LOCAL_CACHE_ENTRIES = int(
+    utils.get_env_setting("MEMOIZE_LOCAL_CACHE_ENTRIES", default="0")
+)
+
 # Total on-disk size of the cache. We want _some_ limit here so it doesn't grow
 # without bound, but I don't think we need to be too fussy about exactly what
 # it is as we're not short on disk space.  For reference, a month's worth of
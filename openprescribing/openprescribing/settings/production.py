@@ -127,5 +127,11 @@ MATRIXSTORE_BUILD_DIR = "/mnt/database/matrixstore"
 # This is expected to be a symlink to a file in MATRIXSTORE_BUILD_DIR
 MATRIXSTORE_LIVE_FILE = os.path.join(MATRIXSTORE_BUILD_DIR, "matrixstore_live.sqlite")
 
+# Keep the most recently memoized values in each app process as well as in the
+# shared cache
+MEMOIZE_LOCAL_CACHE_ENTRIES = int(
+    utils.get_env_setting("MEMOIZE_LOCAL_CACHE_ENTRIES", default="128")
+)
+
 # This is where we put outliers data
 OUTLIERS_DATA_DIR = Path(os.path.join(PIPELINE_DATA_BASEDIR, "outliers"))
@@ -108,3 +108,9 @@ MATRIXSTORE_IMPORT_DIR = os.path.join(PIPELINE_DATA_BASEDIR, "matrixstore_import
 MATRIXSTORE_BUILD_DIR = os.path.join(PIPELINE_DATA_BASEDIR, "matrixstore_build")
 # This is expected to be a symlink to a file in MATRIXSTORE_BUILD_DIR
 MATRIXSTORE_LIVE_FILE = os.path.join(MATRIXSTORE_BUILD_DIR, "matrixstore_live.sqlite")
+
+# Keep the most recently memoized values in each app process as well as in the
+# shared cache
+MEMOIZE_LOCAL_CACHE_ENTRIES = int(
+    utils.get_env_setting("MEMOIZE_LOCAL_CACHE_ENTRIES", default="128")
+)
@@ -1,5 +1,6 @@
 import os
 import random
+import tempfile
 
 from .base import *
 
@@ -69,6 +70,9 @@ BQ_DEFAULT_TABLE_EXPIRATION_MS = 3 * 60 * 60 * 1000  # 3 hours
 
 # For grabbing images that we insert into alert emails
 GRAB_HOST = "http://localhost"
+CHART_IMAGE_CACHE_DIR = os.path.join(
+    tempfile.gettempdir(), "openprescribing-test-chart-images"
+)
 
 # This is the same as the dev/local one
 GOOGLE_TRACKING_ID = "UA-62480003-2"
@@ -91,6 +95,10 @@ MATRIXSTORE_BUILD_DIR = os.path.join(PIPELINE_DATA_BASEDIR, "matrixstore_build")
 # This is expected to be a symlink to a file in MATRIXSTORE_BUILD_DIR
 MATRIXSTORE_LIVE_FILE = os.path.join(MATRIXSTORE_BUILD_DIR, "matrixstore_live.sqlite")
 
+# Tests disable memoization by overriding CACHES, which wouldn't affect the
+# in-process cache, so we disable it here and enable it only where needed
+MEMOIZE_LOCAL_CACHE_ENTRIES = 0
+
 SLACK_SENDING_ACTIVE = False
 
 # Running with a different storage backend in test is not ideal but it's what
@@ -1,10 +1,23 @@
 import shutil
+from collections import namedtuple
 
+import numpy
 import pandas as pd
 from django.conf import settings
 from matrixstore.build.dates import generate_dates
 from matrixstore.db import get_db, get_row_grouper
 
+ORG_TYPES = ["practice", "ccg", "pcn", "stp", "regional_team"]
+
+# Maximum number of values we fetch from the MatrixStore in a single stack (see
+# `prescribing_by_practice`), which bounds the memory used to around 128MB
+MAX_STACK_SIZE = 2**24
+
+PracticeTotals = namedtuple(
+    "PracticeTotals",
+    "chemicals chemical_items subparagraph_items subparagraph_offsets",
+)
+
 
 def build(end_date, months):
     """
@@ -36,15 +49,10 @@ def build(end_date, months):
     """
 
     start_date, *_, end_date = generate_dates(end_date, months)
+    totals = prescribing_by_practice(start_date, end_date)
 
-    for org_type in [
-        "practice",
-        "ccg",
-        "pcn",
-        "stp",
-        "regional_team",
-    ]:
-        df = prescribing_for_orgs(start_date, end_date, org_type)
+    for org_type in ORG_TYPES:
+        df = prescribing_for_orgs(start_date, end_date, org_type, totals)
         dir_path = settings.OUTLIERS_DATA_DIR / org_type
         try:
             # This means that outliers data will be unavailable for a few minutes during
@@ -59,61 +67,101 @@ def build(end_date, months):
             ).to_feather(dir_path / f"{org_code}.feather")
 
 
-def prescribing_for_orgs(start_date, end_date, org_type):
+def prescribing_for_orgs(start_date, end_date, org_type, totals=None):
     """
     Returns a large pd.DataFrame, indexed by organisation and BNF chemical, with columns
-    as described in prescribing_by_chemical.
-    """
-    chemicals = all_chemicals()
-    df = pd.concat(
-        (
-            prescribing_by_chemical(start_date, end_date, org_type, chemical)
-            for chemical in chemicals
-        ),
-        keys=chemicals,
-    )
-    return df.swaplevel().sort_index()
+    for the number of items prescribed in given time period for both the BNF chemical
+    and its BNF subparagraph, as well as the ratio between the two, the mean and
+    standard deviation of the ratio for each chemical, and the z-score for each
+    organisation.
 
-
-def prescribing_by_chemical(start_date, end_date, org_type, chemical):
-    """
-    Returns a pd.DataFrame, indexed by organisation, with colunms for the number of
-    items prescribed in given time period for both the given BNF chemical and its BNF
-    subparagraph, as well as the ratio between the two, the mean and standard deviation
-    of the ratio, and the z-score for each organisation.
+    `totals` is the result of prescribing_by_practice, which can be shared between
+    calls for different organisation types.
     """
-    subparagraph = chemical[:-2]
-    df = pd.DataFrame()
-    df["chemical_items"] = prescribing_by_org(start_date, end_date, org_type, chemical)
-    df["subparagraph_items"] = prescribing_by_org(
-        start_date, end_date, org_type, subparagraph
+    if totals is None:
+        totals = prescribing_by_practice(start_date, end_date)
+    grouper_org_type = {
+        "practice": "standard_practice",
+        "ccg": "standard_ccg",
+    }.get(org_type, org_type)
+    grouper = get_row_grouper(grouper_org_type)
+    # Each of these has one row per organisation and one column per chemical
+    chemical_items = grouper.sum(totals.chemical_items)
+    subparagraph_items = grouper.sum(totals.subparagraph_items)[
+        :, totals.subparagraph_offsets
+    ]
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        ratio = chemical_items / subparagraph_items
+    ratios = pd.DataFrame(ratio)
+    mean = ratios.mean().to_numpy()
+    std = ratios.std().to_numpy()
+    num_orgs = len(grouper.ids)
+    return pd.DataFrame(
+        {
+            "chemical_items": chemical_items.ravel(),
+            "subparagraph_items": subparagraph_items.ravel(),
+            "ratio": ratio.ravel(),
+            "mean": numpy.tile(mean, num_orgs),
+            "std": numpy.tile(std, num_orgs),
+            "zscore": ((ratio - mean) / std).ravel(),
+        },
+        index=pd.MultiIndex.from_product([grouper.ids, totals.chemicals]),
     )
-    df["ratio"] = df["chemical_items"] / df["subparagraph_items"]
-    df["mean"] = df["ratio"].mean()
-    df["std"] = df["ratio"].std()
-    df["zscore"] = (df["ratio"] - df["mean"]) / df["std"]
-    return df
 
 
-def prescribing_by_org(start_date, end_date, org_type, bnf_prefix):
+def prescribing_by_practice(start_date, end_date):
     """
-    Returns a pd.Series, indexed by organisation, containing the total number of items
-    with given BNF prefix, prescribed in given time period.
+    Returns a PracticeTotals containing the list of all BNF chemicals up to and
+    including chapter 17, and matrices, with one row per practice, containing the
+    total number of items prescribed in given time period for each chemical and for
+    each subparagraph, along with the offset of each chemical's subparagraph.
+
+    We read each presentation just once, adding its items to the totals for both its
+    chemical and its subparagraph, rather than summing over the whole file for every
+    chemical and every subparagraph.
     """
     db = get_db()
-    sql = f"select matrix_sum(items) from presentation where bnf_code like '{bnf_prefix}%'"
-    results = list(db.query_one(sql))[0]
-    from_offset = db.date_offsets[start_date]
-    to_offset = db.date_offsets[end_date] + 1
-    filtered_results = results[:, from_offset:to_offset]
-    grouper_org_type = {
-        "practice": "standard_practice",
-        "ccg": "standard_ccg",
-    }.get(org_type, org_type)
-    grouper = get_row_grouper(grouper_org_type)
-    return pd.Series(
-        grouper.sum(filtered_results).sum(axis=1),
-        index=grouper.offsets.keys(),
+    chemicals = all_chemicals()
+    subparagraphs = sorted({chemical[:-2] for chemical in chemicals})
+    chemical_offsets = {chemical: i for i, chemical in enumerate(chemicals)}
+    subparagraph_offsets = {
+        subparagraph: i for i, subparagraph in enumerate(subparagraphs)
+    }
+    bnf_codes = [
+        r[0]
+        for r in db.query(
+            "select bnf_code from presentation where bnf_code < '18' order by bnf_code"
+        )
+    ]
+    date_slice = slice(db.date_offsets[start_date], db.date_offsets[end_date] + 1)
+    num_practices = len(db.practices)
+    chemical_items = numpy.zeros((len(chemicals), num_practices), dtype=numpy.int64)
+    subparagraph_items = numpy.zeros(
+        (len(subparagraphs), num_practices), dtype=numpy.int64
+    )
+    stack_size = num_practices * (date_slice.stop - date_slice.start)
+    batch_size = max(1, MAX_STACK_SIZE // max(1, stack_size))
+    for start in range(0, len(bnf_codes), batch_size):
+        codes, stack = db.fetch_stack(
+            "items", bnf_codes[start : start + batch_size], date_slice
+        )
+        # Total items for each presentation and practice over the whole period
+        items = stack.sum(axis=2)
+        numpy.add.at(
+            chemical_items, [chemical_offsets[code[:9]] for code in codes], items
+        )
+        numpy.add.at(
+            subparagraph_items,
+            [subparagraph_offsets[code[:7]] for code in codes],
+            items,
+        )
+    return PracticeTotals(
+        chemicals=chemicals,
+        chemical_items=chemical_items.T,
+        subparagraph_items=subparagraph_items.T,
+        subparagraph_offsets=[
+            subparagraph_offsets[chemical[:-2]] for chemical in chemicals
+        ],
     )
 
 
@@ -1,11 +1,13 @@
+import numpy
 from django.test import TestCase
 from frontend.models import PCT
+from matrixstore.db import get_db
 from matrixstore.tests.data_factory import DataFactory
 from matrixstore.tests.matrixstore_factory import (
     matrixstore_from_data_factory,
     patch_global_matrixstore,
 )
-from outliers.build import prescribing_for_orgs
+from outliers.build import prescribing_by_practice, prescribing_for_orgs
 
 
 class BuildTest(TestCase):
@@ -29,6 +31,24 @@ class BuildTest(TestCase):
         df = prescribing_for_orgs("2018-06-01", "2018-09-01", "practice")
         assert len(df) == 6
 
+    def test_prescribing_by_practice(self):
+        # Totals accumulated in a single pass should match summing over each prefix
+        db = get_db()
+        totals = prescribing_by_practice("2018-06-01", "2018-09-01")
+        dates = slice(db.date_offsets["2018-06-01"], db.date_offsets["2018-09-01"] + 1)
+        for offset, chemical in enumerate(totals.chemicals):
+            for prefix, items in [
+                (chemical, totals.chemical_items[:, offset]),
+                (
+                    chemical[:-2],
+                    totals.subparagraph_items[:, totals.subparagraph_offsets[offset]],
+                ),
+            ]:
+                sql = "select matrix_sum(items) from presentation where bnf_code like ?"
+                matrix = db.query_one(sql, [prefix + "%"])[0]
+                expected = numpy.asarray(matrix[:, dates].sum(axis=1)).ravel()
+                numpy.testing.assert_array_equal(items, expected)
+
     @classmethod
     def tearDownClass(cls):
         cls._remove_patch()
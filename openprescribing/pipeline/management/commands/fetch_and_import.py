@@ -7,6 +7,11 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument("year", type=int)
         parser.add_argument("month", type=int)
+        parser.add_argument(
+            "--max-workers",
+            type=int,
+            help="Number of tasks to run at once (default: PIPELINE_MAX_WORKERS)",
+        )
 
     def handle(self, *args, **kwargs):
-        run_all(kwargs["year"], kwargs["month"])
+        run_all(kwargs["year"], kwargs["month"], max_workers=kwargs["max_workers"])
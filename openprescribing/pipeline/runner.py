@@ -6,11 +6,15 @@ import os
 import re
 import shlex
 import textwrap
+import threading
+import time
 from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 
 import networkx as nx
 from django.conf import settings
 from django.core.management import call_command as django_call_command
+from django.db import connections
 from gcutils.storage import Client as StorageClient
 
 from openprescribing.slack import notify_slack
@@ -18,6 +22,10 @@ from openprescribing.utils import find_files
 
 from .models import TaskLog
 
+# Tasks running in parallel all record the files they've imported in the same
+# import log, so updates to it need to be serialised
+import_records_lock = threading.Lock()
+
 
 class Source(object):
     def __init__(self, name, attrs):
@@ -132,9 +140,12 @@ class Task(object):
     def set_last_imported_path(self, path):
         """Set the path of the most recently imported data for this source."""
         now = datetime.datetime.now().replace(microsecond=0).isoformat()
-        records = load_import_records()
-        records[self.source.name].append({"imported_file": path, "imported_at": now})
-        dump_import_records(records)
+        with import_records_lock:
+            records = load_import_records()
+            records[self.source.name].append(
+                {"imported_file": path, "imported_at": now}
+            )
+            dump_import_records(records)
 
     def unimported_paths(self):
         """Return list of of paths to input files for task that have not been
@@ -375,17 +386,22 @@ def call_command(*args):
 
 
 def run_task(task, year, month, **kwargs):
+    """
+    Run the task, unless it has already been run successfully for this month,
+    and return whether it was run
+    """
     if TaskLog.objects.filter(
         year=year, month=month, task_name=task.name, status=TaskLog.SUCCESSFUL
     ).exists():
         # This task has already been run successfully
-        return
+        return False
 
     task_log = TaskLog.objects.create(year=year, month=month, task_name=task.name)
 
     try:
         task.run(year, month, **kwargs)
         task_log.mark_succeeded()
+        return True
     except BaseException:
         # We want to catch absolutely every error here, including things that
         # wouldn't be caught by `except Exception` (like `KeyboardInterrupt`),
@@ -400,29 +416,237 @@ def run_task(task, year, month, **kwargs):
         raise
 
 
-def run_all(year, month, under_test=False):
+class TaskRun(object):
+    """
+    Records what happened when running a collection of tasks with `run_tasks`
+    """
+
+    def __init__(self, tasks):
+        self.tasks = list(tasks)
+        # Maps task name to the time (in seconds) spent running it
+        self.durations = {}
+        # Names of tasks which didn't need running as they had already
+        # succeeded (see `run_task`)
+        self.already_run = []
+        # Maps task name to the exception raised by any task which failed
+        self.failures = {}
+        # Names of tasks which weren't run because a task they depend on failed
+        self.not_run = []
+        self.wall_time = 0.0
+
+    def critical_path(self):
+        """
+        Return the chain of tasks, each depending on the one before, which took
+        longest to run in total, along with its total duration
+
+        However many tasks we run at once we can't finish any sooner than this.
+        """
+        names = {task.name for task in self.tasks}
+        finish_times = {}
+        previous = {}
+        for task in TaskCollection(self.tasks, ordered=True):
+            if task.name not in names:
+                continue
+            dependencies = [
+                dependency.name
+                for dependency in task.dependencies
+                if dependency.name in finish_times
+            ]
+            previous[task.name] = max(
+                dependencies, key=finish_times.__getitem__, default=None
+            )
+            start = finish_times[previous[task.name]] if previous[task.name] else 0
+            finish_times[task.name] = start + self.durations.get(task.name, 0)
+        if not finish_times:
+            return [], 0
+        name = max(finish_times, key=finish_times.__getitem__)
+        total = finish_times[name]
+        path = []
+        while name is not None:
+            path.append(name)
+            name = previous[name]
+        return path[::-1], total
+
+    def report(self):
+        """
+        Return a list of lines describing how long each task took and the
+        critical path through them
+        """
+        lines = ["Ran {} tasks in {:.1f}s".format(len(self.durations), self.wall_time)]
+        for name, duration in sorted(
+            self.durations.items(), key=lambda item: item[1], reverse=True
+        ):
+            status = "failed" if name in self.failures else ""
+            lines.append(
+                "  {:<45} {:>9.1f}s {}".format(name, duration, status).rstrip()
+            )
+        if self.already_run:
+            lines.append("Already run: {}".format(", ".join(self.already_run)))
+        if self.not_run:
+            lines.append("Not run: {}".format(", ".join(self.not_run)))
+        path, total = self.critical_path()
+        if path:
+            lines.append("Critical path ({:.1f}s): {}".format(total, " -> ".join(path)))
+        return lines
+
+    def raise_first_failure(self):
+        for exception in self.failures.values():
+            raise exception
+
+
+class InlineExecutor(object):
+    """
+    Stands in for a `ThreadPoolExecutor` but runs each function in the calling
+    thread as soon as it is submitted
+    """
+
+    def submit(self, fn, *args):
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+def run_tasks(tasks, run, max_workers=1):
+    """
+    Call `run(task)` for each of the supplied tasks, running up to
+    `max_workers` of them at once and starting each one as soon as all of its
+    dependencies have succeeded, and return a `TaskRun`
+
+    Any dependencies which aren't amongst the supplied tasks are assumed to
+    have been run already. `run` should return False if it didn't need to run
+    the task (as `run_task` does).
+
+    If a task fails we don't start any of the tasks which depend on it (directly
+    or indirectly) but we do carry on with all the others, so that as much as
+    possible has been done when we come to resume. A KeyboardInterrupt (or
+    similar) stops us starting any more tasks at all. It's the caller's job to
+    decide what to do about failures (see `TaskRun.raise_first_failure`).
+
+    With `max_workers=1` we run each task in the calling thread, in the order
+    given by `TaskCollection.ordered`, so the behaviour is exactly as if we'd
+    just run each task in turn.
+    """
+    tasks = list(tasks)
+    names = {task.name for task in tasks}
+    # Ordering the tasks also yields any dependencies outside the collection
+    tasks = [task for task in TaskCollection(tasks, ordered=True) if task.name in names]
+    waiting_for = {
+        task.name: {
+            dependency.name
+            for dependency in task.dependencies
+            if dependency.name in names
+        }
+        for task in tasks
+    }
+    dependents = defaultdict(list)
+    for task in tasks:
+        for name in waiting_for[task.name]:
+            dependents[name].append(task)
+    task_run = TaskRun(tasks)
+    position = {task.name: n for n, task in enumerate(tasks)}
+    ready = [task for task in tasks if not waiting_for[task.name]]
+    running = {}
+    finished = set()
+    stopped = False
+    start = time.monotonic()
+
+    def run_and_time(task):
+        task_start = time.monotonic()
+        try:
+            return run(task)
+        finally:
+            task_run.durations[task.name] = time.monotonic() - task_start
+            # Each thread gets its own database connections, which we need to
+            # close ourselves
+            if threading.current_thread() is not threading.main_thread():
+                connections.close_all()
+
+    if max_workers > 1:
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+    else:
+        executor = InlineExecutor()
+    with executor:
+        while running or (ready and not stopped):
+            while ready and not stopped and len(running) < max_workers:
+                # Start the earliest ready task in dependency order, which
+                # means that with one worker we run tasks in exactly that order
+                task = min(ready, key=lambda task: position[task.name])
+                ready.remove(task)
+                running[executor.submit(run_and_time, task)] = task
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in sorted(done, key=lambda future: running[future].name):
+                task = running.pop(future)
+                finished.add(task.name)
+                exception = future.exception()
+                if exception is not None:
+                    task_run.failures[task.name] = exception
+                    if not isinstance(exception, Exception):
+                        stopped = True
+                    continue
+                if future.result() is False:
+                    task_run.already_run.append(task.name)
+                    del task_run.durations[task.name]
+                for dependent in dependents[task.name]:
+                    waiting_for[dependent.name].discard(task.name)
+                    if not waiting_for[dependent.name]:
+                        ready.append(dependent)
+    task_run.not_run = [task.name for task in tasks if task.name not in finished]
+    task_run.wall_time = time.monotonic() - start
+    return task_run
+
+
+def run_all(year, month, under_test=False, max_workers=None):
+    """
+    Run all the tasks needed to import the data for the given month
+
+    Within each stage of the import (fetching, converting, importing and
+    post-processing) tasks run in parallel, up to `max_workers` at once
+    (defaulting to `settings.PIPELINE_MAX_WORKERS`), as their dependencies
+    allow. Tasks which have already succeeded for this month are skipped, so
+    running this again after a failure resumes where we left off.
+
+    Not all the dependencies between tasks which write to the same tables are
+    declared in tasks.json, so running more than one task at once is only safe
+    for stages whose dependencies have been checked.
+    """
+    if max_workers is None:
+        max_workers = settings.PIPELINE_MAX_WORKERS
     tasks = load_tasks()
 
+    def run_stage(stage_tasks, **kwargs):
+        task_run = run_tasks(
+            stage_tasks,
+            lambda task: run_task(task, year, month, **kwargs),
+            max_workers=max_workers,
+        )
+        print("\n".join(task_run.report()))
+        task_run.raise_first_failure()
+
     if not under_test:
         for task in tasks.by_type("manual_fetch"):
             run_task(task, year, month)
 
-        for task in tasks.by_type("auto_fetch"):
-            run_task(task, year, month)
+        run_stage(tasks.by_type("auto_fetch"))
 
     upload_all_to_storage(tasks)
 
-    for task in tasks.by_type("convert").ordered():
-        run_task(task, year, month)
+    run_stage(tasks.by_type("convert"))
 
-    for task in tasks.by_type("import").ordered():
-        run_task(task, year, month)
+    run_stage(tasks.by_type("import"))
 
     prescribing_path = tasks["convert_hscic_prescribing"].imported_paths()[-1]
     last_imported = re.findall(r"/(\d{4}_\d{2})/", prescribing_path)[0]
 
-    for task in tasks.by_type("post_process").ordered():
-        run_task(task, year, month, last_imported=last_imported)
+    run_stage(tasks.by_type("post_process"), last_imported=last_imported)
 
     if not under_test:
         # Remove numbers.json files.  These are created by check_numbers, and we want to
@@ -1,11 +1,19 @@
 import json
 import os
+import threading
 
 import mock
 from django.conf import settings
-from django.test import TestCase, override_settings
+from django.test import SimpleTestCase, TestCase, override_settings
 from pipeline.models import TaskLog
-from pipeline.runner import in_progress, load_tasks, run_task
+from pipeline.runner import (
+    TaskCollection,
+    TaskRun,
+    in_progress,
+    load_tasks,
+    run_task,
+    run_tasks,
+)
 
 
 class PipelineTests(TestCase):
@@ -385,6 +393,98 @@ The last imported data can be found at:
         self.assertTrue(in_progress())
 
 
+class FakeTask(object):
+    def __init__(self, name, dependencies=()):
+        self.name = name
+        self.dependencies = list(dependencies)
+
+
+class RunTasksTests(SimpleTestCase):
+    def setUp(self):
+        # a -> b -> d, with c independent and e depending on both b and c
+        self.a = FakeTask("a")
+        self.b = FakeTask("b", [self.a])
+        self.c = FakeTask("c")
+        self.d = FakeTask("d", [self.b])
+        self.e = FakeTask("e", [self.b, self.c])
+        self.tasks = [self.e, self.d, self.c, self.b, self.a]
+
+    def test_runs_tasks_after_their_dependencies(self):
+        events = []
+        lock = threading.Lock()
+
+        def run(task):
+            with lock:
+                events.append(("start", task.name))
+            with lock:
+                events.append(("end", task.name))
+
+        task_run = run_tasks(self.tasks, run, max_workers=3)
+        self.assertEqual(len(events), 10)
+        for task in self.tasks:
+            started = events.index(("start", task.name))
+            for dependency in task.dependencies:
+                self.assertLess(events.index(("end", dependency.name)), started)
+        self.assertEqual(set(task_run.durations), {"a", "b", "c", "d", "e"})
+        self.assertEqual(task_run.failures, {})
+
+    def test_runs_independent_tasks_at_once(self):
+        # Each of these tasks waits for the other to start, so they can only
+        # succeed if they run concurrently
+        barrier = threading.Barrier(2, timeout=10)
+        task_run = run_tasks(
+            [self.a, self.c], lambda task: barrier.wait(), max_workers=2
+        )
+        self.assertEqual(task_run.failures, {})
+
+    def test_runs_tasks_in_order_in_this_thread_with_one_worker(self):
+        calls = []
+
+        def run(task):
+            calls.append((task.name, threading.current_thread()))
+
+        run_tasks(self.tasks, run, max_workers=1)
+        names = [name for name, _ in calls]
+        expected = [task.name for task in TaskCollection(self.tasks, ordered=True)]
+        self.assertEqual(names, expected)
+        for _, thread in calls:
+            self.assertIs(thread, threading.current_thread())
+
+    def test_does_not_run_dependents_of_failed_tasks(self):
+        ran = []
+        error = ValueError("boom")
+
+        def run(task):
+            if task.name == "b":
+                raise error
+            ran.append(task.name)
+
+        task_run = run_tasks(self.tasks, run, max_workers=2)
+        self.assertEqual(sorted(ran), ["a", "c"])
+        self.assertEqual(task_run.failures, {"b": error})
+        self.assertEqual(sorted(task_run.not_run), ["d", "e"])
+        with self.assertRaises(ValueError):
+            task_run.raise_first_failure()
+
+    def test_records_tasks_already_run(self):
+        task_run = run_tasks(self.tasks, lambda task: task.name != "a", max_workers=2)
+        self.assertEqual(task_run.already_run, ["a"])
+        self.assertEqual(set(task_run.durations), {"b", "c", "d", "e"})
+
+    def test_ignores_dependencies_outside_tasks(self):
+        ran = []
+        run_tasks([self.b, self.d], lambda task: ran.append(task.name))
+        self.assertEqual(ran, ["b", "d"])
+
+    def test_critical_path(self):
+        task_run = TaskRun(self.tasks)
+        task_run.durations = {"a": 1.0, "b": 2.0, "c": 4.0, "d": 1.0, "e": 0.5}
+        self.assertEqual(task_run.critical_path(), (["c", "e"], 4.5))
+        task_run.durations["a"] = 3.0
+        self.assertEqual(task_run.critical_path(), (["a", "b", "d"], 6.0))
+        self.assertIn("Critical path (6.0s): a -> b -> d", task_run.report())
+
+
 def build_path(source_id, year_and_month, filename):
     return os.path.join(
         settings.PIPELINE_DATA_BASEDIR, source_id, year_and_month, filename